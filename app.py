@@ -1,24 +1,37 @@
 import os
 import sys
 import argparse
+import atexit
+import functools
 import logging
-import pkg_resources
+import signal
+import threading
+import time
 
-from error import EmeraldEmailRouterDatabaseInitializationError
+from error import EmeraldEmailRouterDatabaseInitializationError, EmeraldEmailRouterSpoolError, \
+    EmeraldEmailRouterDeadLetterError, EmeraldEmailRouterMatchNotFoundError, EmeraldEmailRouterInputDataError, \
+    EmeraldEmailRouterRecipientNotAllowedError
 from exitcode import ExitCode
 from version import __version__
 
-from emerald_message.logging.logger import EmeraldLogger
-from emerald_message.error import EmeraldEmailParsingError
-from emerald_message.parsers.email.sendgrid_email_parser import ParsedEmail
-
+# only what argument parsing needs is imported here - --help and --version must not pay for Flask, the
+#  parsers or the router (netaddr, dateutil, ...).  The rest is imported on the paths that use it
 from email_router.email_router_config_source import \
     EmailRouterDatastoreSourceType, EmailRouterSourceConfig
-from email_router.email_router_datastore import EmailRouter
 from email_router.router_instance_type import RouterInstanceType
-from email_router.email_router_datastore import EmailRouterMatchResultCollection
+from email_router.email_router_routing_policy import EmailRouterRoutingPolicy
+from email_router.email_router_match_engine import EmailRouterMatchEngine
+
+from typing import Callable, List, Optional, TYPE_CHECKING
 
-from flask import Flask, request, render_template
+if TYPE_CHECKING:
+    from emerald_message.logging.logger import EmeraldLogger
+    from email_router.email_router_datastore import EmailRouter
+    from email_router.email_router_inbound_processor import EmailRouterInboundProcessor
+    from email_router.email_router_spool import EmailRouterSpool, EmailRouterSpoolRecord
+    from email_router.email_router_inbound_envelope import EmailRouterInboundFormat
+    from email_router.email_router_dead_letter import EmailRouterDeadLetterStore, EmailRouterDeadLetterReason
+    from email_router.email_router_dispatcher import EmailRouterDispatcher
 
 APP_NAME = 'EMERALD INBOUND EMAIL READER ROUTER'
 MIN_PYTHON_VER_MAJOR = 3
@@ -26,9 +39,12 @@ MIN_PYTHON_VER_MINOR = 6
 
 
 def get_command_info_as_string() -> str:
-    the_package = __name__
-    the_path = '/'.join(('reference', 'command_notes.txt'))
-    the_reference_info = pkg_resources.resource_string(the_package, the_path).decode('utf-8')
+    # importlib.resources (or its backport before 3.9) is much lighter to import than pkg_resources
+    try:
+        from importlib.resources import files
+    except ImportError:
+        from importlib_resources import files
+    the_reference_info = files('reference').joinpath('command_notes.txt').read_text(encoding='utf-8')
 
     return the_reference_info
 
@@ -62,11 +78,224 @@ def emerald_inbound_email_readerrouter_launcher(argv):
                         type=str,
                         help='Specify instance type (defines location, data class, etc. - see devops docs)' +
                              os.linesep + 'Must be one of following: ' + ','.join(
-                            [x.name for x in RouterInstanceType])),
+                            [x.name for x in RouterInstanceType]) +
+                             os.linesep + 'Give a comma separated list to serve several instance types from one ' +
+                             'process' + os.linesep + '(then give the router db source once per instance type, ' +
+                             'in the same order)'),
     parser.add_argument('--router_db_source_file',
                         type=str,
+                        action='append',
                         help='Specify to include a JSON file that contains the email router database' +
                              os.linesep + 'Other methods may be supported')
+    parser.add_argument('--router_db_source_sqlite',
+                        type=str,
+                        action='append',
+                        help='Specify to use a SQLite file that contains the email router database' +
+                             os.linesep + 'Rules are looked up per email instead of being loaded into memory')
+    parser.add_argument('--router_db_source_shared_memory',
+                        type=str,
+                        action='append',
+                        help='Specify the name of a shared memory segment holding the email router database' +
+                             os.linesep + '(written by a separate process started with --publish_shared_rules)')
+    parser.add_argument('--shadow_router_db_source_file',
+                        type=str,
+                        action='append',
+                        help='Specify a candidate JSON router database to evaluate in the background against a' +
+                             os.linesep + 'sample of live traffic (once per instance type, in the same order) - ' +
+                             'divergences' + os.linesep + 'from the live rules are reported under /metrics/')
+    parser.add_argument('--shadow_sample_rate',
+                        type=float,
+                        default=0.01,
+                        help='Specify the fraction of inbound emails evaluated against the candidate router database')
+    parser.add_argument('--shadow_max_evaluations_per_second',
+                        type=float,
+                        default=100.0,
+                        help='Specify the most candidate evaluations per second per instance type (samples beyond ' +
+                             'that are dropped)')
+    parser.add_argument('--flight_recorder_size',
+                        type=int,
+                        default=0,
+                        help='Specify how many recent routing decisions to keep per instance type for ' +
+                             '/debug/routing/' + os.linesep + '(0 to keep none)')
+    parser.add_argument('--debug_routing_endpoint',
+                        action='store_true',
+                        default=False,
+                        help='Specify to serve the flight recorder at /debug/routing/ (always served with --debug)' +
+                             os.linesep + '(decisions include sender addresses and ips - do not expose publicly)')
+    parser.add_argument('--match_cache_size',
+                        type=int,
+                        default=0,
+                        help='Specify how many recently routed envelopes to cache the matched targets of per ' +
+                             'instance type' + os.linesep + '(router databases read from files only - 0 to ' +
+                             'cache none)')
+    parser.add_argument('--match_cache_snapshot_file',
+                        type=str,
+                        help='Specify a file to save the most used routing cache entries to at shutdown - at ' +
+                             'startup they' + os.linesep + 'are matched against the rules then loaded to warm ' +
+                             'the cache (/ready/ answers 503 until done)')
+    parser.add_argument('--match_cache_snapshot_size',
+                        type=int,
+                        default=1000,
+                        help='Specify how many routing cache entries per instance type to save with ' +
+                             '--match_cache_snapshot_file')
+    parser.add_argument('--publish_shared_rules',
+                        type=str,
+                        help='Specify a shared memory segment name to publish the router database into for ' +
+                             'worker processes' + os.linesep + 'Runs as the loader only (no web server) - ' +
+                             'send SIGHUP to reload and republish')
+    parser.add_argument('--export_router_db_sqlite',
+                        type=str,
+                        help='Specify to write the database read with --router_db_source_file to a new SQLite ' +
+                             'file and exit' + os.linesep + '(for use with --router_db_source_sqlite)')
+    parser.add_argument('--routing_policy',
+                        type=str,
+                        default=EmailRouterRoutingPolicy.ALL_MATCHES.name,
+                        help='Specify FIRST_MATCH to route each email to the highest priority matching target only' +
+                             os.linesep + 'or ALL_MATCHES (default) to route to every matching target')
+    parser.add_argument('--match_engine',
+                        type=str,
+                        default=EmailRouterMatchEngine.WALK.name,
+                        help='Specify BITSET to evaluate each kind of rule check once per email over all rules ' +
+                             '(router databases read from files only)' + os.linesep +
+                             'or WALK (default) to try targets and rules in priority order')
+    parser.add_argument('--analyze_rules',
+                        action='store_true',
+                        default=False,
+                        help='Specify to log rules that can never change a routing result (identical, subsumed or ' +
+                             'shadowed)' + os.linesep + 'and whitelist entries covered by other entries')
+    parser.add_argument('--prune_dead_rules',
+                        action='store_true',
+                        default=False,
+                        help='Specify to analyze the rules as with --analyze_rules and drop dead rules from ' +
+                             'evaluation' + os.linesep + '(JSON file source only)')
+    parser.add_argument('--structured_logging',
+                        action='store_true',
+                        default=False,
+                        help='Specify to log JSON records through a queue written by a background thread' +
+                             os.linesep + '(debug records are sampled and, if the queue fills, records dropped ' +
+                             'rather than blocking requests)')
+    parser.add_argument('--dedupe_ttl_seconds',
+                        type=float,
+                        default=3600.0,
+                        help='Specify how long to remember accepted emails (by Message-ID) so webhook retries are ' +
+                             'acknowledged' + os.linesep + 'without routing them again - 0 turns deduplication off')
+    parser.add_argument('--dedupe_capacity',
+                        type=int,
+                        default=100000,
+                        help='Specify the most emails remembered per instance type for deduplication')
+    parser.add_argument('--admission_sender_domain_rate',
+                        type=float,
+                        default=0.0,
+                        help='Specify the most inbound emails per second accepted from one sender domain' +
+                             os.linesep + '(answered with 429 above that) - 0 turns the limit off')
+    parser.add_argument('--admission_sender_ip_rate',
+                        type=float,
+                        default=0.0,
+                        help='Specify the most inbound emails per second accepted from one sender IP - 0 turns ' +
+                             'the limit off')
+    parser.add_argument('--admission_target_rate',
+                        type=float,
+                        default=0.0,
+                        help='Specify the most inbound emails per second routed to one target - 0 turns the ' +
+                             'limit off')
+    parser.add_argument('--admission_burst_seconds',
+                        type=float,
+                        default=10.0,
+                        help='Specify how many seconds of the admission rate a sender or target may use at once')
+    parser.add_argument('--admission_tracked_keys',
+                        type=int,
+                        default=10000,
+                        help='Specify the most senders or targets per limit given a token bucket of their own' +
+                             os.linesep + '(the rest are counted approximately in fixed memory)')
+    parser.add_argument('--spool_directory',
+                        type=str,
+                        help='Specify a directory to spool accepted requests to before routing them' +
+                             os.linesep + 'Requests left unfinished by a crash are routed again at startup')
+    parser.add_argument('--spool_group_commit_ms',
+                        type=float,
+                        default=5.0,
+                        help='Specify how long spool writes wait to share one fsync with concurrent requests')
+    parser.add_argument('--spool_segment_mb',
+                        type=int,
+                        default=64,
+                        help='Specify the spool segment file size in MB')
+    parser.add_argument('--dead_letter_directory',
+                        type=str,
+                        help='Specify a directory to keep inbound emails that cannot be routed (no matching rule, ' +
+                             'unreadable request)' + os.linesep + 'in - they are then acknowledged instead of ' +
+                             'failed, so the sender does not retry them')
+    parser.add_argument('--dead_letter_group_commit_ms',
+                        type=float,
+                        default=20.0,
+                        help='Specify how long dead letter writes wait to share one compressed block and fsync ' +
+                             'with concurrent requests')
+    parser.add_argument('--dead_letter_segment_mb',
+                        type=int,
+                        default=64,
+                        help='Specify the dead letter segment file size in MB')
+    parser.add_argument('--redrive_dead_letters',
+                        action='store_true',
+                        default=False,
+                        help='Specify to route the emails in --dead_letter_directory again (e.g. after the rules ' +
+                             'changed), deliver' + os.linesep + 'those that now match and exit - emails still ' +
+                             'unroutable stay dead lettered')
+    parser.add_argument('--redrive_drain_seconds',
+                        type=float,
+                        default=600.0,
+                        help='Specify how long --redrive_dead_letters waits for the re-routed emails of a dead ' +
+                             'letter segment' + os.linesep + 'to be delivered before giving up (the segment is ' +
+                             'then kept)')
+    parser.add_argument('--cluster_nodes',
+                        type=str,
+                        help='Specify a comma separated list of the base URLs of all router nodes (including this ' +
+                             'one)' + os.linesep + 'to run in cluster mode - each inbound email is handled by the ' +
+                             'node owning its' + os.linesep + 'sender domain on a consistent hash ring')
+    parser.add_argument('--cluster_self',
+                        type=str,
+                        help='Specify the base URL of this node as given in --cluster_nodes')
+    parser.add_argument('--cluster_forward_timeout_seconds',
+                        type=float,
+                        default=5.0,
+                        help='Specify how long to wait for the owning node before handling a request locally')
+    parser.add_argument('--dispatch_workers',
+                        type=int,
+                        default=16,
+                        help='Specify how many threads deliver routed emails to HTTP_POST destinations' +
+                             os.linesep + '(0 to not deliver)')
+    parser.add_argument('--dispatch_timeout_seconds',
+                        type=float,
+                        default=30.0,
+                        help='Specify how long to wait for an HTTP_POST destination to accept an email')
+    parser.add_argument('--dispatch_max_attempts',
+                        type=int,
+                        default=5,
+                        help='Specify how many times delivery of an email to an HTTP_POST destination is tried')
+    parser.add_argument('--dispatch_retry_queue_size',
+                        type=int,
+                        default=10000,
+                        help='Specify how many failed deliveries may wait for a retry (more are dropped)')
+    parser.add_argument('--dispatch_breaker_failures',
+                        type=int,
+                        default=5,
+                        help='Specify after how many consecutive failures delivery to a destination is paused')
+    parser.add_argument('--dispatch_breaker_open_seconds',
+                        type=float,
+                        default=30.0,
+                        help='Specify how long delivery to a failing destination is paused before a trial delivery')
+    parser.add_argument('--dispatch_batch_max_count',
+                        type=int,
+                        default=100,
+                        help='Specify how many emails at most are sent together to an HTTP_POST_BATCH destination')
+    parser.add_argument('--dispatch_batch_max_bytes',
+                        type=int,
+                        default=4 * 1024 * 1024,
+                        help='Specify how many bytes of email at most are sent together to an HTTP_POST_BATCH ' +
+                             'destination')
+    parser.add_argument('--dispatch_batch_linger_ms',
+                        type=float,
+                        default=50.0,
+                        help='Specify how long an email may wait for others to fill a batch to an HTTP_POST_BATCH ' +
+                             'destination')
     parser.add_argument('--host',
                         type=str,
                         action='store',
@@ -89,45 +318,145 @@ def emerald_inbound_email_readerrouter_launcher(argv):
 
     args = parser.parse_args(argv[1:])
 
+    from emerald_message.logging.logger import EmeraldLogger
+    from email_router.email_router_datastore import EmailRouter
+    from email_router.email_router_inbound_processor import EmailRouterInboundProcessor
+    from email_router.email_router_admission import EmailRouterAdmissionDimension
+
     logger = EmeraldLogger(logging_module_name='main',
                            console_logging_level=logging.DEBUG if args.debug else logging.INFO)
 
+    queue_logging = None
+    if args.structured_logging:
+        from email_router.email_router_logging import EmailRouterQueueLogging
+        queue_logging = EmailRouterQueueLogging()
+        queue_logging.start()
+        queue_logging.attach(logger.logger)
+        # the listener thread is a daemon - write out what is queued on the way out
+        atexit.register(queue_logging.stop)
+
     logger.logger.info('Starting ' + APP_NAME + ' Version ' + __version__)
 
     # initialize the router source type since there is no standard way to do this in argparse
     #  You can do it by setting the type, but the Namespace doesn't handle accessing the values
     # properly so it is better to make a string and then initialize complex type here
     try:
-        router_instance_type = RouterInstanceType.from_string(type_name=args.router_instance_type)
+        router_instance_types = [RouterInstanceType.from_string(type_name=x.strip())
+                                 for x in args.router_instance_type.split(',')]
     except ValueError:
         logger.logger.critical('User specified invalid or unsupported router instance type with --router_instance_type' +
                         os.linesep + '\tMust be one of: ' + ','.join([x.name for x in RouterInstanceType]))
         return ExitCode.ARGUMENT_ERROR
+    if len(set(router_instance_types)) != len(router_instance_types):
+        logger.logger.critical('Each instance type may be given only once with --router_instance_type')
+        return ExitCode.ARGUMENT_ERROR
 
-    router_source_identifier = None
-    if args.router_db_source_file is not None and len(args.router_db_source_file) > 0:
-        # this means we assume our initialization will come from JSON file first
-        logger.logger.info('Add read of JSON file here')
+    try:
+        routing_policy = EmailRouterRoutingPolicy.from_string(policy_name=args.routing_policy)
+    except ValueError:
+        logger.logger.critical('User specified invalid routing policy with --routing_policy' +
+                               os.linesep + '\tMust be one of: ' + ','.join([x.name for x in EmailRouterRoutingPolicy]))
+        return ExitCode.ARGUMENT_ERROR
+
+    try:
+        match_engine = EmailRouterMatchEngine.from_string(engine_name=args.match_engine)
+    except ValueError:
+        logger.logger.critical('User specified invalid match engine with --match_engine' +
+                               os.linesep + '\tMust be one of: ' + ','.join([x.name for x in EmailRouterMatchEngine]))
+        return ExitCode.ARGUMENT_ERROR
+
+    # one source per instance type, all of the same kind
+    router_source_identifiers = None
+    for source_type, source_uris in [
+        (EmailRouterDatastoreSourceType.JSONFILE, args.router_db_source_file),
+        (EmailRouterDatastoreSourceType.SQLITE, args.router_db_source_sqlite),
+        (EmailRouterDatastoreSourceType.SHARED_MEMORY, args.router_db_source_shared_memory)
+    ]:
+        if source_uris is None or len([x for x in source_uris if len(x) > 0]) == 0:
+            continue
+        if router_source_identifiers is not None:
+            logger.logger.critical('Specify only one of --router_db_source_file, --router_db_source_sqlite and ' +
+                                   '--router_db_source_shared_memory')
+            return ExitCode.ARGUMENT_ERROR
 
-        router_source_identifier = EmailRouterSourceConfig(
-            source_type=EmailRouterDatastoreSourceType.JSONFILE,
-            source_uri=args.router_db_source_file
-        )
+        router_source_identifiers = [
+            EmailRouterSourceConfig(source_type=source_type, source_uri=x) for x in source_uris if len(x) > 0
+        ]
 
     # at this point fail if no source provided
-    if router_source_identifier is None:
+    if router_source_identifiers is None:
         logger.logger.critical('Initialization error: no valid router initialization source provided' +
-                        os.linesep + 'Specify with file using --router_db_source_file')
+                        os.linesep + 'Specify with file using --router_db_source_file or --router_db_source_sqlite' +
+                        os.linesep + 'or with a shared memory segment using --router_db_source_shared_memory')
+        return ExitCode.ARGUMENT_ERROR
+
+    if len(router_source_identifiers) != len(router_instance_types):
+        logger.logger.critical('Give one router db source per instance type - ' +
+                               str(len(router_instance_types)) + ' instance type(s) and ' +
+                               str(len(router_source_identifiers)) + ' source(s) provided')
         return ExitCode.ARGUMENT_ERROR
 
+    if (args.publish_shared_rules is not None or args.export_router_db_sqlite is not None) and \
+            len(router_instance_types) > 1:
+        logger.logger.critical('--publish_shared_rules and --export_router_db_sqlite take a single instance type')
+        return ExitCode.ARGUMENT_ERROR
+
+    if args.publish_shared_rules is not None and \
+            router_source_identifiers[0].source_type == EmailRouterDatastoreSourceType.SHARED_MEMORY:
+        logger.logger.critical('--publish_shared_rules needs a file source, not --router_db_source_shared_memory')
+        return ExitCode.ARGUMENT_ERROR
+
+    if args.export_router_db_sqlite is not None and \
+            router_source_identifiers[0].source_type != EmailRouterDatastoreSourceType.JSONFILE:
+        logger.logger.critical('--export_router_db_sqlite requires --router_db_source_file')
+        return ExitCode.ARGUMENT_ERROR
+
+    if args.redrive_dead_letters and args.dead_letter_directory is None:
+        logger.logger.critical('--redrive_dead_letters requires --dead_letter_directory')
+        return ExitCode.ARGUMENT_ERROR
+
+    shadow_source_identifiers = [None] * len(router_instance_types)
+    if args.shadow_router_db_source_file is not None:
+        if len(args.shadow_router_db_source_file) != len(router_instance_types):
+            logger.logger.critical('Give one --shadow_router_db_source_file per instance type - ' +
+                                   str(len(router_instance_types)) + ' instance type(s) and ' +
+                                   str(len(args.shadow_router_db_source_file)) + ' candidate(s) provided')
+            return ExitCode.ARGUMENT_ERROR
+        shadow_source_identifiers = [
+            EmailRouterSourceConfig(source_type=EmailRouterDatastoreSourceType.JSONFILE, source_uri=x)
+            for x in args.shadow_router_db_source_file
+        ]
+
     # log key provided arguments
     logger.logger.info('Command line arguments: ' + os.linesep + '\t' +
                 (os.linesep + '\t').join([k + ': ' + str(v) for k, v in sorted(vars(args).items())]))
 
     try:
-        email_router = EmailRouter(router_db_source_identifier=router_source_identifier,
-                                   router_instance_type=router_instance_type,
-                                   debug=args.debug)
+        inbound_processor = EmailRouterInboundProcessor(email_routers=[
+            EmailRouter(router_db_source_identifier=this_source_identifier,
+                        router_instance_type=this_instance_type,
+                        debug=args.debug,
+                        routing_policy=routing_policy,
+                        match_engine=match_engine,
+                        analyze_rules=args.analyze_rules,
+                        prune_dead_rules=args.prune_dead_rules,
+                        log_handler=queue_logging.queue_handler if queue_logging is not None else None,
+                        shadow_source_identifier=this_shadow_source_identifier,
+                        shadow_sample_rate=args.shadow_sample_rate,
+                        shadow_max_evaluations_per_second=args.shadow_max_evaluations_per_second,
+                        flight_recorder_capacity=max(args.flight_recorder_size, 0),
+                        match_cache_capacity=max(args.match_cache_size, 0))
+            for this_instance_type, this_source_identifier, this_shadow_source_identifier in
+            zip(router_instance_types, router_source_identifiers, shadow_source_identifiers)
+        ], dedupe_ttl_seconds=args.dedupe_ttl_seconds if args.dedupe_ttl_seconds > 0 else None,
+            dedupe_capacity=args.dedupe_capacity,
+            admission_rates_per_second={
+                EmailRouterAdmissionDimension.SENDER_DOMAIN: args.admission_sender_domain_rate,
+                EmailRouterAdmissionDimension.SENDER_IP: args.admission_sender_ip_rate,
+                EmailRouterAdmissionDimension.TARGET: args.admission_target_rate
+            },
+            admission_burst_seconds=args.admission_burst_seconds,
+            admission_tracked_key_capacity=args.admission_tracked_keys)
     except EmeraldEmailRouterDatabaseInitializationError as eex:
         logger.logger.critical('Unable to initialize ' + appname + ': email router initialization error' +
                         os.linesep + 'Router database initialization error: ' + eex.message)
@@ -137,39 +466,438 @@ def emerald_inbound_email_readerrouter_launcher(argv):
                         os.linesep + 'Exception: ' + str(vex.args[0]))
         return ExitCode.ARGUMENT_ERROR
 
+    if args.export_router_db_sqlite is not None:
+        from email_router.email_router_sqlite_datastore import create_sqlite_database
+        email_router = inbound_processor.get_email_router(router_instance_types[0])
+        try:
+            create_sqlite_database(rules_datastore=email_router.router_rules_datastore,
+                                   sqlite_path=args.export_router_db_sqlite)
+        except EmeraldEmailRouterDatabaseInitializationError as eex:
+            logger.logger.critical('Unable to export router database: ' + eex.message)
+            return ExitCode.INITIALIZATION_ERROR
+        logger.logger.warning('Exported router database to SQLite file ' + args.export_router_db_sqlite)
+        return ExitCode.SUCCESS
+
+    if args.publish_shared_rules is not None:
+        return run_shared_rules_publisher(email_router=inbound_processor.get_email_router(router_instance_types[0]),
+                                          segment_name=args.publish_shared_rules,
+                                          logger=logger)
+
     # now start the app
     logger.logger.warning('Initializing ' + APP_NAME + ' Version ' + __version__)
 
+    cluster = None
+    if args.cluster_nodes is not None:
+        from email_router.email_router_cluster import EmailRouterCluster
+        try:
+            cluster = EmailRouterCluster(
+                self_node_url=args.cluster_self if args.cluster_self is not None else
+                'http://' + args.host + ':' + str(args.port),
+                node_urls=args.cluster_nodes.split(','),
+                forward_timeout_seconds=args.cluster_forward_timeout_seconds)
+        except ValueError as vex:
+            logger.logger.critical('Unable to initialize ' + appname + ': cluster configuration error' +
+                                   os.linesep + 'Exception: ' + str(vex.args[0]))
+            return ExitCode.ARGUMENT_ERROR
+        logger.logger.warning('Cluster mode: node ' + cluster.self_node_id + ' of ' + ','.join(cluster.node_ids))
+
+    spool = None
+    spooled_records = list()
+    # a redrive takes no requests - the spool is left to the server
+    if args.spool_directory is not None and not args.redrive_dead_letters:
+        from email_router.email_router_spool import EmailRouterSpool
+        try:
+            spool = EmailRouterSpool(spool_directory=args.spool_directory,
+                                     segment_max_bytes=args.spool_segment_mb * 1024 * 1024,
+                                     group_commit_window_seconds=args.spool_group_commit_ms / 1000.0)
+            spooled_records = spool.open()
+        except EmeraldEmailRouterSpoolError as sex:
+            logger.logger.critical('Unable to initialize ' + appname + ': ' + sex.message)
+            return ExitCode.INITIALIZATION_ERROR
+        except ValueError as vex:
+            logger.logger.critical('Unable to initialize ' + appname + ': spool error' +
+                                   os.linesep + 'Exception: ' + str(vex.args[0]))
+            return ExitCode.ARGUMENT_ERROR
+
+    dead_letter_store = None
+    if args.dead_letter_directory is not None:
+        from email_router.email_router_dead_letter import EmailRouterDeadLetterStore
+        try:
+            dead_letter_store = EmailRouterDeadLetterStore(
+                dead_letter_directory=args.dead_letter_directory,
+                segment_max_bytes=args.dead_letter_segment_mb * 1024 * 1024,
+                group_commit_window_seconds=args.dead_letter_group_commit_ms / 1000.0)
+            dead_letter_store.open()
+        except EmeraldEmailRouterDeadLetterError as dlex:
+            logger.logger.critical('Unable to initialize ' + appname + ': ' + dlex.message)
+            return ExitCode.INITIALIZATION_ERROR
+        except ValueError as vex:
+            logger.logger.critical('Unable to initialize ' + appname + ': dead letter error' +
+                                   os.linesep + 'Exception: ' + str(vex.args[0]))
+            return ExitCode.ARGUMENT_ERROR
+
+    dispatcher = None
+    if args.dispatch_workers > 0:
+        from email_router.email_router_dispatcher import EmailRouterDispatcher
+        try:
+            dispatcher = EmailRouterDispatcher(worker_count=args.dispatch_workers,
+                                               delivery_timeout_seconds=args.dispatch_timeout_seconds,
+                                               retry_queue_capacity=args.dispatch_retry_queue_size,
+                                               max_attempts=args.dispatch_max_attempts,
+                                               failure_threshold=args.dispatch_breaker_failures,
+                                               open_seconds=args.dispatch_breaker_open_seconds,
+                                               batch_max_count=args.dispatch_batch_max_count,
+                                               batch_max_bytes=args.dispatch_batch_max_bytes,
+                                               batch_linger_seconds=args.dispatch_batch_linger_ms / 1000.0,
+                                               logger=logger.logger)
+        except ValueError as vex:
+            logger.logger.critical('Unable to initialize ' + appname + ': dispatch configuration error' +
+                                   os.linesep + 'Exception: ' + str(vex.args[0]))
+            return ExitCode.ARGUMENT_ERROR
+        dispatcher.start()
+
+    from flask import Flask, request, render_template, jsonify
+    from email_router.email_router_inbound_envelope import EmailRouterInboundEnvelope, EmailRouterInboundFormat, \
+        get_inbound_envelope
+    from email_router.email_router_postmark_payload import get_postmark_inbound_message
+    from email_router.email_router_destination import EmailRouterDestinationType
+    from email_router.email_router_inbound_payload import get_inbound_payload_info, get_inbound_dedupe_key, \
+        get_inbound_sender_info
+    from email_router.email_router_dead_letter import EmailRouterDeadLetterReason
+    from email_router.email_router_dedupe import EmailRouterDedupeStatus, DEDUPE_IN_FLIGHT_RETRY_AFTER_SECONDS
+
     app = Flask(__name__)
+    # set once startup work (warming the routing cache) is done - requests are served before, just not as fast
+    routing_ready = threading.Event()
 
     @app.route('/', methods=['GET'])
     def index():
         """Show index page to confirm that server is running."""
         return render_template('index.html')
 
-    @app.route('/inbound/' + router_instance_type.name.lower() + '/', methods=['POST'])
-    def inbound_parse():
-        """Process POST from Inbound Parse and print received data."""
-        print('Type of request = ' + type(request).__name__)
+    @app.route('/ready/', methods=['GET'])
+    def ready():
+        """503 until the routing cache is warm, for load balancers to hold traffic back until then"""
+        if not routing_ready.is_set():
+            return 'Service Unavailable', 503
+        return "OK"
+
+    @app.route('/metrics/', methods=['GET'])
+    def metrics():
+        """Match statistics for each instance type served"""
+        metrics_info = inbound_processor.get_metrics_as_dict()
+        if queue_logging is not None:
+            metrics_info['logging'] = queue_logging.get_statistics_as_dict()
+        if cluster is not None:
+            metrics_info['cluster'] = cluster.get_statistics_as_dict()
+        if dispatcher is not None:
+            metrics_info['dispatch'] = dispatcher.get_statistics_as_dict()
+        if dead_letter_store is not None:
+            metrics_info['dead_letter'] = dead_letter_store.get_statistics_as_dict()
+        return jsonify(metrics_info)
 
+    def debug_routing():
+        """
+        Recent routing decisions, newest first - filter with ?instance_type=, ?sender= (address, domain or ip),
+        ?target=, ?envelope_digest= and ?limit=
+        """
         try:
-            parsed_email = ParsedEmail(inbound_request=request)
-        except EmeraldEmailParsingError as epex:
-            logger.error('Error parsing email received for instance type ' + router_instance_type.name.lower() +
-                         os.linesep + 'Exception: ' + os.linesep + epex.args[0]
-                         )
-            # DET FIXME - add logging here
+            router_instance_types = [RouterInstanceType[request.args['instance_type'].upper()]] \
+                if 'instance_type' in request.args else inbound_processor.router_instance_types
+            email_routers = [inbound_processor.get_email_router(x) for x in router_instance_types]
+            limit = int(request.args.get('limit', 100))
+        except (KeyError, ValueError):
+            return 'Bad Request', 400
+
+        decisions = dict()
+        for this_email_router in email_routers:
+            if this_email_router.flight_recorder is None:
+                continue
+            decisions[this_email_router.router_instance_type.name.lower()] = [
+                x.get_as_dict() for x in this_email_router.flight_recorder.get_records(
+                    sender=request.args.get('sender'),
+                    target_name=request.args.get('target'),
+                    envelope_digest=request.args.get('envelope_digest'),
+                    limit=limit)
+            ]
+        return jsonify(decisions)
+
+    # the decisions name senders and targets, so they are only served when asked for
+    if args.debug or args.debug_routing_endpoint:
+        if args.flight_recorder_size <= 0:
+            logger.logger.warning('/debug/routing/ is served but --flight_recorder_size is 0 - no decisions ' +
+                                  'will be recorded')
+        app.add_url_rule('/debug/routing/', view_func=debug_routing, methods=['GET'])
+
+    def get_request_envelope(inbound_request, inbound_format: EmailRouterInboundFormat) -> EmailRouterInboundEnvelope:
+        if inbound_format == EmailRouterInboundFormat.POSTMARK:
+            return get_postmark_inbound_message(inbound_request=inbound_request).inbound_envelope
+        return get_inbound_envelope(inbound_request=inbound_request)
+
+    def route_inbound_request(router_instance_type: RouterInstanceType,
+                              inbound_request,
+                              inbound_format: EmailRouterInboundFormat = EmailRouterInboundFormat.SENDGRID,
+                              inbound_envelope: Optional[EmailRouterInboundEnvelope] = None):
+        """Route one inbound POST (live, or replayed from the spool) and return the match result"""
+        # routing needs only the envelope fields - the email itself is parsed once a target has matched
+        if inbound_envelope is None:
+            inbound_envelope = get_request_envelope(inbound_request=inbound_request, inbound_format=inbound_format)
+
+        # body size and attachment presence come from the request and part headers, not the parsed content
+        inbound_payload_info = get_inbound_payload_info(inbound_envelope=inbound_envelope)
 
         # now get a router destination for this
         match_result_set = \
-            email_router.match_inbound_email(
-                address_to_collection=parsed_email.email_container.email_envelope.address_to_collection,
-                address_from=parsed_email.email_container.email_envelope.address_from,
-                sender_ip=parsed_email.email_container.email_container_metadata.email_sender_ip)
-        for result_count, this_result in enumerate(match_result_set.matched_target_results, start=1):
-            print('Result #' + str(result_count) + ': ' + 'Target ' + str(this_result.matched_target_name) +
-                  os.linesep + 'Destinations: ' + os.linesep + '\t' +
-                  (os.linesep + '\t').join([str(x) for x in this_result.destinations]))
+            inbound_processor.match_inbound_email(
+                router_instance_type=router_instance_type,
+                address_to_collection=inbound_envelope.address_to_collection,
+                address_from=inbound_envelope.address_from,
+                sender_ip=inbound_envelope.sender_ip,
+                attachment_included=inbound_payload_info.attachment_included,
+                body_size=inbound_payload_info.body_size)
+
+        matched_target_names = [x.matched_target_name for x in match_result_set.matched_target_results]
+        logger.logger.info('Routed inbound email for instance type ' + router_instance_type.name.lower() +
+                           ' to target(s) ' + ','.join(matched_target_names),
+                           extra={'instance_type': router_instance_type.name.lower(),
+                                  'matched_targets': matched_target_names})
+        if logger.logger.isEnabledFor(logging.DEBUG):
+            for result_count, this_result in enumerate(match_result_set.matched_target_results, start=1):
+                logger.logger.debug('Result #' + str(result_count) + ': ' + 'Target ' +
+                                    str(this_result.matched_target_name) +
+                                    os.linesep + 'Destinations: ' + os.linesep + '\t' +
+                                    (os.linesep + '\t').join([str(x) for x in this_result.destinations]))
+        return match_result_set
+
+    def dispatch_routed_email(router_instance_type: RouterInstanceType,
+                              inbound_request,
+                              match_result_set,
+                              on_complete: Optional[Callable[[], None]] = None):
+        """
+        Queue the inbound POST for every HTTP_POST(_BATCH) destination of the matched targets.  on_complete, if
+        given, is called once every delivery is made, or once the email is dead lettered after a failed one (right
+        away if there is nothing to deliver) - never if a failed email cannot be dead lettered
+        """
+        # read now - the deliveries finish after the request is gone
+        content_type = inbound_request.content_type
+        body = inbound_request.get_data(cache=True)
+
+        deliveries = list()
+        for this_result in match_result_set.matched_target_results:
+            for this_destination in sorted(this_result.destinations):
+                if this_destination.destination_type not in (EmailRouterDestinationType.HTTP_POST,
+                                                             EmailRouterDestinationType.HTTP_POST_BATCH):
+                    continue
+                if dispatcher is None:
+                    logger.logger.warning('Not delivering email for target ' + this_result.matched_target_name +
+                                          ' to ' + this_destination.destination_uri + ' (--dispatch_workers is 0)')
+                    continue
+                deliveries.append((this_result.matched_target_name, this_destination))
+
+        if on_complete is not None and len(deliveries) == 0:
+            on_complete()
+            return
+
+        pending_delivery_count = [len(deliveries)]
+        undelivered_target_names = list()
+        completion_lock = threading.Lock()
+
+        def on_delivery_complete(target_name: str, delivered: bool):
+            with completion_lock:
+                pending_delivery_count[0] -= 1
+                if not delivered:
+                    undelivered_target_names.append(target_name)
+                if pending_delivery_count[0] > 0:
+                    return
+            if len(undelivered_target_names) > 0:
+                if dead_letter_store is None:
+                    logger.logger.error('Email for instance type ' + router_instance_type.name.lower() +
+                                        ' not delivered for target(s) ' + ','.join(undelivered_target_names) +
+                                        ' and not dead lettered (no --dead_letter_directory)')
+                    return
+                try:
+                    dead_letter_email(router_instance_type=router_instance_type,
+                                      content_type=content_type,
+                                      body=body,
+                                      reason=EmailRouterDeadLetterReason.UNDELIVERABLE,
+                                      detail='Not delivered for target(s) ' + ','.join(undelivered_target_names))
+                except EmeraldEmailRouterDeadLetterError as dlex:
+                    logger.logger.error('Unable to dead letter undelivered email for instance type ' +
+                                        router_instance_type.name.lower() + os.linesep + 'Exception: ' +
+                                        dlex.message)
+                    return
+            on_complete()
+
+        for (target_name, this_destination) in deliveries:
+            dispatcher.submit(destination_uri=this_destination.destination_uri,
+                              router_instance_type_name=router_instance_type.name,
+                              target_name=target_name,
+                              content_type=content_type,
+                              body=body,
+                              batched=this_destination.destination_type == EmailRouterDestinationType.HTTP_POST_BATCH,
+                              on_complete=functools.partial(on_delivery_complete, target_name)
+                              if on_complete is not None else None)
+
+    def route_and_dispatch_inbound_request(router_instance_type: RouterInstanceType,
+                                           inbound_request,
+                                           inbound_format: EmailRouterInboundFormat,
+                                           on_complete: Optional[Callable[[], None]] = None):
+        match_result_set = route_inbound_request(router_instance_type=router_instance_type,
+                                                 inbound_request=inbound_request,
+                                                 inbound_format=inbound_format)
+        dispatch_routed_email(router_instance_type=router_instance_type,
+                              inbound_request=inbound_request,
+                              match_result_set=match_result_set,
+                              on_complete=on_complete)
+        return match_result_set
+
+    def too_many_requests(router_instance_type: RouterInstanceType, dimension: EmailRouterAdmissionDimension):
+        logger.logger.info('Inbound email for instance type ' + router_instance_type.name.lower() +
+                           ' over its ' + dimension.name.lower() + ' admission limit - answered with 429',
+                           extra={'instance_type': router_instance_type.name.lower(),
+                                  'admission_dimension': dimension.name.lower()})
+        return 'Too Many Requests', 429, {
+            'Retry-After': str(inbound_processor.get_retry_after_seconds(router_instance_type=router_instance_type,
+                                                                         dimension=dimension))
+        }
+
+    def dead_letter_inbound_request(router_instance_type: RouterInstanceType,
+                                    inbound_request,
+                                    reason: EmailRouterDeadLetterReason,
+                                    ex: Exception):
+        """Keep an inbound POST that cannot be routed, to be acknowledged instead of retried by the sender"""
+        dead_letter_email(router_instance_type=router_instance_type,
+                          content_type=inbound_request.content_type,
+                          body=inbound_request.get_data(cache=True),
+                          reason=reason,
+                          detail=get_error_detail(ex))
+
+    def dead_letter_email(router_instance_type: RouterInstanceType,
+                          content_type: Optional[str],
+                          body: bytes,
+                          reason: EmailRouterDeadLetterReason,
+                          detail: str):
+        dead_letter_store.append(router_instance_type_name=router_instance_type.name,
+                                 reason=reason,
+                                 detail=detail,
+                                 content_type=content_type,
+                                 body=body)
+        logger.logger.info('Dead lettered inbound email for instance type ' + router_instance_type.name.lower() +
+                           ' (' + reason.name + ')',
+                           extra={'instance_type': router_instance_type.name.lower(),
+                                  'dead_letter_reason': reason.name})
+
+    def inbound_parse(instance_type_name: str, inbound_format_name: str):
+        """Process POST from Inbound Parse (or a Postmark inbound webhook) and log the routing result."""
+        router_instance_type = RouterInstanceType[instance_type_name]
+        inbound_format = EmailRouterInboundFormat[inbound_format_name]
+        logger.logger.debug('Type of request = ' + type(request).__name__)
+        if EmailRouterInboundFormat.from_mimetype(request.mimetype) != inbound_format:
+            return 'Unsupported Media Type', 415
+
+        # the routing fields only - the raw body stays cached on the request for the spool, a forward or
+        #  the full parse once a target has matched
+        try:
+            inbound_envelope = get_request_envelope(inbound_request=request, inbound_format=inbound_format)
+        except EmeraldEmailRouterInputDataError as idex:
+            if dead_letter_store is None:
+                raise
+            # nothing to forward, limit or dedupe on without an envelope
+            dead_letter_inbound_request(router_instance_type=router_instance_type,
+                                        inbound_request=request,
+                                        reason=EmailRouterDeadLetterReason.UNPARSEABLE,
+                                        ex=idex)
+            return "OK"
+        sender_info = get_inbound_sender_info(inbound_envelope=inbound_envelope)
+
+        # in cluster mode the node owning the sender domain handles the email, so its per-sender state is warm
+        if cluster is not None:
+            forwarded = cluster.is_forwarded(request.headers)
+            owner_node_id = cluster.get_owner_node_id(sender_info.sender_domain)
+            if not forwarded and owner_node_id != cluster.self_node_id:
+                forward_result = cluster.forward(node_id=owner_node_id,
+                                                 path=request.path,
+                                                 content_type=request.content_type,
+                                                 body=request.get_data(cache=True))
+                if forward_result is not None:
+                    return forward_result.body, forward_result.status_code, forward_result.headers
+                logger.logger.warning('Cluster node ' + owner_node_id + ' unreachable - handling inbound email ' +
+                                      'for sender domain ' + str(sender_info.sender_domain) + ' locally')
+            cluster.record_local(forwarded=forwarded)
+
+        # a flooding sender is turned away before anything is parsed, matched or remembered for dedupe
+        rejected_dimension = inbound_processor.check_sender_admission(
+            router_instance_type=router_instance_type,
+            sender_info=sender_info)
+        if rejected_dimension is not None:
+            return too_many_requests(router_instance_type=router_instance_type, dimension=rejected_dimension)
+
+        # webhook retries of an email already accepted are acknowledged without parsing or routing it again.
+        #  A retry arriving while the first copy is still processed waits - that one may yet fail
+        dedupe_key = get_inbound_dedupe_key(inbound_envelope=inbound_envelope)
+        dedupe_status = inbound_processor.check_duplicate(router_instance_type=router_instance_type,
+                                                          dedupe_key=dedupe_key)
+        if dedupe_status == EmailRouterDedupeStatus.DUPLICATE:
+            logger.logger.info('Duplicate inbound email for instance type ' + router_instance_type.name.lower() +
+                               ' acknowledged without routing (key ' + dedupe_key + ')')
+            return "OK"
+        if dedupe_status == EmailRouterDedupeStatus.IN_FLIGHT:
+            logger.logger.info('Retry of inbound email for instance type ' + router_instance_type.name.lower() +
+                               ' still being processed answered with 503 (key ' + dedupe_key + ')')
+            return 'Service Unavailable', 503, {'Retry-After': str(DEDUPE_IN_FLIGHT_RETRY_AFTER_SECONDS)}
+
+        spool_record_id = None
+        try:
+            # durable before we do anything else - if we die from here on the request is replayed at startup
+            if spool is not None:
+                spool_record_id = spool.append_accepted(router_instance_type_name=router_instance_type.name,
+                                                        content_type=request.content_type,
+                                                        body=request.get_data(cache=True))
+
+            match_result_set = route_inbound_request(router_instance_type=router_instance_type,
+                                                     inbound_request=request,
+                                                     inbound_format=inbound_format,
+                                                     inbound_envelope=inbound_envelope)
+            rejected_dimension = inbound_processor.check_target_admission(
+                router_instance_type=router_instance_type,
+                match_result_collection=match_result_set)
+            if rejected_dimension is not None:
+                # the sender retries this one later, so it must not be dropped as a duplicate then
+                inbound_processor.forget_dedupe_key(router_instance_type=router_instance_type,
+                                                    dedupe_key=dedupe_key)
+                return too_many_requests(router_instance_type=router_instance_type, dimension=rejected_dimension)
+
+            # the spooled copy is kept until the deliveries are made (or the email is dead lettered) - a restart
+            #  before then replays it
+            on_dispatched = functools.partial(spool.mark_completed, spool_record_id) \
+                if spool_record_id is not None else None
+            spool_record_id = None
+            dispatch_routed_email(router_instance_type=router_instance_type,
+                                  inbound_request=request,
+                                  match_result_set=match_result_set,
+                                  on_complete=on_dispatched)
+        except Exception as ex:
+            dead_letter_reason = get_dead_letter_reason(ex) if dead_letter_store is not None else None
+            if dead_letter_reason is None:
+                # not processed, so a retry of this email must not be dropped as a duplicate
+                inbound_processor.forget_dedupe_key(router_instance_type=router_instance_type, dedupe_key=dedupe_key)
+                raise
+            # a retry would fail the same way - keep it and acknowledge it
+            try:
+                dead_letter_inbound_request(router_instance_type=router_instance_type,
+                                            inbound_request=request,
+                                            reason=dead_letter_reason,
+                                            ex=ex)
+            except EmeraldEmailRouterDeadLetterError:
+                inbound_processor.forget_dedupe_key(router_instance_type=router_instance_type, dedupe_key=dedupe_key)
+                raise
+        finally:
+            # the sender retries anything we fail, so the spooled copy of an email not dispatched is done with
+            if spool_record_id is not None:
+                spool.mark_completed(spool_record_id)
+
+        # routed or dead lettered - either way retries of it are duplicates now
+        inbound_processor.complete_dedupe_key(router_instance_type=router_instance_type, dedupe_key=dedupe_key)
 
         # we expect to see these fields in the immutable dict:
         #
@@ -178,15 +906,383 @@ def emerald_inbound_email_readerrouter_launcher(argv):
         # Everything is 200 OK :)
         return "OK"
 
+    # one inbound route per instance type and inbound format served, all handled by the same view
+    for this_instance_type in inbound_processor.router_instance_types:
+        for this_inbound_format in EmailRouterInboundFormat:
+            app.add_url_rule(get_inbound_path(router_instance_type=this_instance_type,
+                                              inbound_format=this_inbound_format),
+                             endpoint='inbound_parse_' + this_instance_type.name.lower() +
+                                      '_' + this_inbound_format.name.lower(),
+                             view_func=inbound_parse,
+                             methods=['POST'],
+                             defaults={'instance_type_name': this_instance_type.name,
+                                       'inbound_format_name': this_inbound_format.name})
+
+    if args.redrive_dead_letters:
+        try:
+            return redrive_dead_letters(dead_letter_store=dead_letter_store,
+                                        inbound_processor=inbound_processor,
+                                        get_request_envelope=get_request_envelope,
+                                        dispatch_routed_email=dispatch_routed_email,
+                                        dispatcher=dispatcher,
+                                        drain_seconds=args.redrive_drain_seconds,
+                                        logger=logger)
+        finally:
+            dead_letter_store.close()
+            if dispatcher is not None:
+                dispatcher.stop()
+
+    match_cache_snapshot_enabled = args.match_cache_snapshot_file is not None and args.match_cache_size > 0
+    if match_cache_snapshot_enabled:
+        threading.Thread(target=warm_match_caches,
+                         kwargs={
+                             'inbound_processor': inbound_processor,
+                             'snapshot_path': args.match_cache_snapshot_file,
+                             'routing_ready': routing_ready,
+                             'logger': logger
+                         },
+                         name='match-cache-warmer',
+                         daemon=True).start()
+    else:
+        routing_ready.set()
+
+    if spool is not None:
+        replay_spooled_requests(spool=spool,
+                                spooled_records=spooled_records,
+                                inbound_processor=inbound_processor,
+                                route_inbound_request=route_and_dispatch_inbound_request,
+                                logger=logger,
+                                dead_letter_inbound_request=dead_letter_inbound_request
+                                if dead_letter_store is not None else None)
+
+    # process managers stop us with SIGTERM - unwind the way Ctrl-C does, so the shutdown below (routing cache
+    #  snapshot, spool, dead letters, dispatcher) runs too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(ExitCode.SUCCESS))
+
     logger.logger.warning('Starting app using host=' + args.host + ' and port=' + str(args.port))
-    app.run(debug=args.debug,
-            host=args.host,
-            port=args.port)
+    try:
+        app.run(debug=args.debug,
+                host=args.host,
+                port=args.port)
+    finally:
+        # a second SIGTERM must not cut the shutdown short (the snapshot is written to a temporary file and
+        #  renamed into place, so an interrupted save would at least keep the previous one)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        if match_cache_snapshot_enabled:
+            save_match_caches(inbound_processor=inbound_processor,
+                              snapshot_path=args.match_cache_snapshot_file,
+                              entry_count=args.match_cache_snapshot_size,
+                              logger=logger)
+        if spool is not None:
+            spool.close()
+        if dead_letter_store is not None:
+            dead_letter_store.close()
+        if dispatcher is not None:
+            dispatcher.stop()
+
+    return ExitCode.SUCCESS
+
+
+def get_inbound_path(router_instance_type: RouterInstanceType,
+                     inbound_format: 'EmailRouterInboundFormat') -> str:
+    """
+    /inbound/<url_prefix>/ for SendGrid inbound parse, /inbound/<url_prefix>/postmark/ for Postmark
+    """
+    from email_router.email_router_inbound_envelope import EmailRouterInboundFormat
+
+    inbound_path = '/inbound/' + router_instance_type.value.url_prefix + '/'
+    if inbound_format != EmailRouterInboundFormat.SENDGRID:
+        inbound_path += inbound_format.name.lower() + '/'
+    return inbound_path
+
+
+def get_stored_request(router_instance_type: RouterInstanceType,
+                       content_type: Optional[str],
+                       body: bytes):
+    """
+    Rebuild an inbound POST kept by the spool or the dead letter store - returns the request and its inbound format
+    """
+    from werkzeug.test import EnvironBuilder
+    from werkzeug.wrappers import Request
+    from email_router.email_router_inbound_envelope import EmailRouterInboundFormat
+
+    inbound_format = EmailRouterInboundFormat.from_mimetype((content_type or '').split(';')[0].strip().lower())
+    stored_environ = EnvironBuilder(path=get_inbound_path(router_instance_type=router_instance_type,
+                                                          inbound_format=inbound_format),
+                                    method='POST',
+                                    data=body,
+                                    content_type=content_type).get_environ()
+    return Request(stored_environ), inbound_format
+
+
+def get_dead_letter_reason(ex: Exception) -> Optional['EmailRouterDeadLetterReason']:
+    """
+    Why an inbound request cannot be routed - None if the failure is not the request's (a retry may succeed)
+    """
+    from emerald_message.error import EmeraldEmailParsingError
+    from email_router.email_router_dead_letter import EmailRouterDeadLetterReason
+
+    if isinstance(ex, EmeraldEmailRouterRecipientNotAllowedError):
+        return EmailRouterDeadLetterReason.RECIPIENT_NOT_ALLOWED
+    if isinstance(ex, EmeraldEmailRouterMatchNotFoundError):
+        return EmailRouterDeadLetterReason.NO_MATCH
+    if isinstance(ex, EmeraldEmailRouterInputDataError):
+        return EmailRouterDeadLetterReason.INPUT_ERROR
+    if isinstance(ex, EmeraldEmailParsingError):
+        return EmailRouterDeadLetterReason.UNPARSEABLE
+    return None
+
+
+def get_error_detail(ex: Exception) -> str:
+    return str(ex.args[0]) if len(ex.args) > 0 else type(ex).__name__
+
+
+def replay_spooled_requests(spool: 'EmailRouterSpool',
+                            spooled_records: List['EmailRouterSpoolRecord'],
+                            inbound_processor: 'EmailRouterInboundProcessor',
+                            route_inbound_request,
+                            logger: 'EmeraldLogger',
+                            dead_letter_inbound_request: Optional[Callable] = None):
+    """
+    Route the requests a previous run accepted but did not finish.  They are marked completed once delivered
+    (route_inbound_request calls on_complete then).  Requests that cannot be routed are dropped, or given to
+    dead_letter_inbound_request if provided
+    """
+    if len(spooled_records) == 0:
+        return
+
+    logger.logger.warning('Replaying ' + str(len(spooled_records)) + ' spooled inbound request(s)')
+    for this_record in spooled_records:
+        try:
+            router_instance_type = RouterInstanceType[this_record.router_instance_type_name]
+            inbound_processor.get_email_router(router_instance_type)
+        except (KeyError, ValueError):
+            logger.logger.error('Spooled request #' + str(this_record.record_id) + ' is for instance type ' +
+                                this_record.router_instance_type_name + ' which is not served - leaving it spooled')
+            continue
+
+        (replay_request, inbound_format) = get_stored_request(router_instance_type=router_instance_type,
+                                                             content_type=this_record.content_type,
+                                                             body=this_record.body)
+        try:
+            route_inbound_request(router_instance_type=router_instance_type,
+                                  inbound_request=replay_request,
+                                  inbound_format=inbound_format,
+                                  on_complete=functools.partial(spool.mark_completed, this_record.record_id))
+            continue
+        except Exception as ex:
+            dead_letter_reason = get_dead_letter_reason(ex) if dead_letter_inbound_request is not None else None
+            if dead_letter_reason is None:
+                logger.logger.error('Unable to route spooled request #' + str(this_record.record_id) +
+                                    ' (accepted ' + this_record.accepted_datetime.isoformat() + ') - dropping it' +
+                                    os.linesep + 'Exception: ' + str(ex))
+            else:
+                try:
+                    dead_letter_inbound_request(router_instance_type=router_instance_type,
+                                                inbound_request=replay_request,
+                                                reason=dead_letter_reason,
+                                                ex=ex)
+                except EmeraldEmailRouterDeadLetterError as dlex:
+                    logger.logger.error('Unable to dead letter spooled request #' + str(this_record.record_id) +
+                                        ' - leaving it spooled' + os.linesep + 'Exception: ' + dlex.message)
+                    continue
+        spool.mark_completed(this_record.record_id)
+
+    spool.compact()
+
+
+def redrive_dead_letters(dead_letter_store: 'EmailRouterDeadLetterStore',
+                         inbound_processor: 'EmailRouterInboundProcessor',
+                         get_request_envelope: Callable,
+                         dispatch_routed_email: Callable,
+                         dispatcher: Optional['EmailRouterDispatcher'],
+                         drain_seconds: float,
+                         logger: 'EmeraldLogger') -> ExitCode:
+    """
+    Route the dead letters again with the current rules and deliver those that match - a segment is deleted
+    once its re-routed emails are delivered, the rest are dead lettered again
+    """
+    from email_router.email_router_datastore import EmailRouterBatchEmail
+    from email_router.email_router_dead_letter import DEAD_LETTER_DETAIL_MAX_LENGTH
+    from email_router.email_router_inbound_payload import get_inbound_payload_info
+
+    def redrive_segment_dead_letters(dead_letters):
+        still_dead_letters = list()
+
+        def keep_dead_letter(dead_letter, ex: Exception):
+            still_dead_letters.append(dead_letter._replace(
+                reason=get_dead_letter_reason(ex) or dead_letter.reason,
+                detail=get_error_detail(ex)[:DEAD_LETTER_DETAIL_MAX_LENGTH]))
+
+        # one batch match per instance type
+        for router_instance_type_name in sorted(set(x.router_instance_type_name for x in dead_letters)):
+            instance_type_dead_letters = [x for x in dead_letters
+                                          if x.router_instance_type_name == router_instance_type_name]
+            try:
+                router_instance_type = RouterInstanceType[router_instance_type_name]
+                email_router = inbound_processor.get_email_router(router_instance_type)
+            except (KeyError, ValueError):
+                logger.logger.error(str(len(instance_type_dead_letters)) + ' dead letter(s) are for instance type ' +
+                                    router_instance_type_name + ' which is not served - leaving them dead lettered')
+                still_dead_letters.extend(instance_type_dead_letters)
+                continue
+
+            readable_dead_letters = list()
+            for this_dead_letter in instance_type_dead_letters:
+                (inbound_request, inbound_format) = get_stored_request(router_instance_type=router_instance_type,
+                                                                       content_type=this_dead_letter.content_type,
+                                                                       body=this_dead_letter.body)
+                try:
+                    inbound_envelope = get_request_envelope(inbound_request=inbound_request,
+                                                            inbound_format=inbound_format)
+                    inbound_payload_info = get_inbound_payload_info(inbound_envelope=inbound_envelope)
+                    batch_email = EmailRouterBatchEmail(address_to_collection=inbound_envelope.address_to_collection,
+                                                        address_from=inbound_envelope.address_from,
+                                                        sender_ip=inbound_envelope.sender_ip,
+                                                        attachment_included=inbound_payload_info.attachment_included,
+                                                        body_size=inbound_payload_info.body_size)
+                except EmeraldEmailRouterInputDataError as idex:
+                    keep_dead_letter(this_dead_letter, idex)
+                    continue
+                readable_dead_letters.append((this_dead_letter, inbound_request, batch_email))
+
+            batch_match_results = email_router.match_inbound_email_batch([x[2] for x in readable_dead_letters])
+            for (this_dead_letter, inbound_request, _), this_batch_match_result in \
+                    zip(readable_dead_letters, batch_match_results):
+                if this_batch_match_result.error is not None:
+                    keep_dead_letter(this_dead_letter, this_batch_match_result.error)
+                    continue
+                dispatch_routed_email(router_instance_type=router_instance_type,
+                                      inbound_request=inbound_request,
+                                      match_result_set=this_batch_match_result.match_result_collection)
+
+        # the segment is deleted once this returns - the emails routed from it must be delivered by then
+        if dispatcher is not None and not dispatcher.drain(timeout_seconds=drain_seconds):
+            raise EmeraldEmailRouterDeadLetterError('Re-routed dead letters not delivered within ' +
+                                                    str(drain_seconds) + ' seconds')
+        return still_dead_letters
+
+    try:
+        (redriven_count, still_dead_count) = dead_letter_store.redrive(redrive_segment_dead_letters)
+    except EmeraldEmailRouterDeadLetterError as dlex:
+        logger.logger.critical('Unable to redrive dead letters: ' + dlex.message)
+        return ExitCode.INITIALIZATION_ERROR
+
+    logger.logger.warning('Re-drove ' + str(redriven_count) + ' dead letter(s) - ' +
+                          str(redriven_count - still_dead_count) + ' routed, ' + str(still_dead_count) +
+                          ' still dead lettered')
+    return ExitCode.SUCCESS
+
+
+def warm_match_caches(inbound_processor: 'EmailRouterInboundProcessor',
+                      snapshot_path: str,
+                      routing_ready: threading.Event,
+                      logger: 'EmeraldLogger'):
+    """
+    Warm the routing cache of every instance type served from the snapshot a previous run saved, then set
+    routing_ready
+    """
+    from email_router.email_router_match_cache import load_match_cache_snapshots
+
+    try:
+        snapshots_by_instance_type_name = load_match_cache_snapshots(snapshot_path)
+    except FileNotFoundError:
+        logger.logger.info('No routing cache snapshot ' + snapshot_path + ' - starting with a cold routing cache')
+        routing_ready.set()
+        return
+    except (OSError, ValueError) as ex:
+        logger.logger.warning('Unable to read routing cache snapshot ' + snapshot_path + ' - starting with a cold ' +
+                              'routing cache' + os.linesep + 'Exception: ' + str(ex))
+        routing_ready.set()
+        return
+
+    try:
+        for this_instance_type in inbound_processor.router_instance_types:
+            this_snapshot = snapshots_by_instance_type_name.get(this_instance_type.name)
+            if this_snapshot is None:
+                continue
+            start_time = time.perf_counter()
+            (cached_count, changed_count) = \
+                inbound_processor.get_email_router(this_instance_type).warm_match_cache(this_snapshot)
+            logger.logger.warning('Warmed routing cache for instance type ' + this_instance_type.name.lower() +
+                                  ' with ' + str(cached_count) + ' of ' + str(len(this_snapshot.entries)) +
+                                  ' saved entries in ' + str(round(time.perf_counter() - start_time, 3)) + 's (' +
+                                  str(changed_count) + ' now routed differently)')
+    except Exception as ex:
+        # a cold cache is slower, not wrong
+        logger.logger.error('Unable to warm routing cache' + os.linesep + 'Exception: ' + str(ex))
+    finally:
+        routing_ready.set()
+
+
+def save_match_caches(inbound_processor: 'EmailRouterInboundProcessor',
+                      snapshot_path: str,
+                      entry_count: int,
+                      logger: 'EmeraldLogger'):
+    from email_router.email_router_match_cache import save_match_cache_snapshots
+
+    snapshots_by_instance_type_name = dict()
+    for this_instance_type in inbound_processor.router_instance_types:
+        this_snapshot = inbound_processor.get_email_router(this_instance_type).get_match_cache_snapshot(
+            entry_count=entry_count)
+        if this_snapshot is not None:
+            snapshots_by_instance_type_name[this_instance_type.name] = this_snapshot
+    try:
+        save_match_cache_snapshots(snapshot_path=snapshot_path,
+                                   snapshots_by_instance_type_name=snapshots_by_instance_type_name)
+    except OSError as oex:
+        logger.logger.error('Unable to save routing cache snapshot ' + snapshot_path +
+                            os.linesep + 'Exception: ' + str(oex))
+        return
+    logger.logger.warning('Saved routing cache snapshot ' + snapshot_path + ' with ' +
+                          str(sum(len(x.entries) for x in snapshots_by_instance_type_name.values())) + ' entries')
+
+
+def run_shared_rules_publisher(email_router: 'EmailRouter',
+                               segment_name: str,
+                               logger: 'EmeraldLogger') -> ExitCode:
+    from email_router.email_router_shared_datastore import EmailRouterSharedRulesPublisher
+
+    try:
+        publisher = EmailRouterSharedRulesPublisher(segment_name=segment_name)
+    except EmeraldEmailRouterDatabaseInitializationError as eex:
+        logger.logger.critical('Unable to publish shared rules: ' + eex.message)
+        return ExitCode.INITIALIZATION_ERROR
+
+    reload_requested = threading.Event()
+    stop_requested = threading.Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+
+    try:
+        generation = publisher.publish(email_router.router_rules_datastore)
+        logger.logger.warning('Published router rules revision ' +
+                              str(email_router.router_rules_datastore.revision_number) +
+                              ' to shared memory segment "' + segment_name + '" (generation ' + str(generation) + ')')
+
+        while not stop_requested.is_set():
+            if not reload_requested.wait(timeout=1.0):
+                continue
+            reload_requested.clear()
+            try:
+                email_router.reload()
+            except (EmeraldEmailRouterDatabaseInitializationError, ValueError) as ex:
+                logger.logger.error('Reload failed - workers keep generation ' + str(publisher.generation) +
+                                    os.linesep + 'Exception: ' + str(ex))
+                continue
+            generation = publisher.publish(email_router.router_rules_datastore)
+            logger.logger.warning('Published router rules revision ' +
+                                  str(email_router.router_rules_datastore.revision_number) +
+                                  ' (generation ' + str(generation) + ')')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.close()
 
     return ExitCode.SUCCESS
 
 
-def make_test_entry(email_router: EmailRouter):
+def make_test_entry(email_router: 'EmailRouter'):
     # now make a test entry
     match_result_set = \
         email_router.match_inbound_email(address_to_collection=['hello@my.com', 'bse@blue.ingestion.'],
@@ -0,0 +1,164 @@
+import math
+import threading
+import time
+
+from collections import OrderedDict
+from enum import unique, Enum, auto
+from typing import Dict, List, Optional
+
+from email_router.email_router_count_min_sketch import EmailRouterCountMinSketch
+
+
+@unique
+class EmailRouterAdmissionDimension(Enum):
+    SENDER_DOMAIN = auto()
+    SENDER_IP = auto()
+    TARGET = auto()
+
+
+class EmailRouterTokenBucketLimiter:
+    """
+    Token bucket per key: rate_per_second tokens are added up to burst, and a request takes one.
+
+    Only keys that have sent more than burst requests recently get a bucket of their own.  Every other key is
+    counted in a count-min sketch covering the last one to two refill periods (burst / rate seconds) - such a
+    key cannot have used up a full bucket, so it is admitted without one.  At most tracked_key_capacity buckets
+    are kept (least recently used dropped first); a dropped key that keeps sending is promoted again with the
+    tokens it has left in the current period, as counted by the sketch.
+    """
+
+    @property
+    def rate_per_second(self) -> float:
+        return self._rate_per_second
+
+    @property
+    def burst(self) -> float:
+        return self._burst
+
+    @property
+    def retry_after_seconds(self) -> int:
+        return max(1, int(math.ceil(1.0 / self._rate_per_second)))
+
+    def __init__(self,
+                 rate_per_second: float,
+                 burst: float,
+                 tracked_key_capacity: int = 10000,
+                 sketch_depth: int = 4):
+        if rate_per_second <= 0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': rate_per_second must be positive ' +
+                             '(value = ' + str(rate_per_second) + ')')
+        if burst < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': burst must be at least 1 ' +
+                             '(value = ' + str(burst) + ')')
+        if tracked_key_capacity < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': tracked_key_capacity must be at ' +
+                             'least 1 (value = ' + str(tracked_key_capacity) + ')')
+
+        self._rate_per_second = rate_per_second
+        self._burst = burst
+        self._tracked_key_capacity = tracked_key_capacity
+        self._lock = threading.Lock()
+
+        # key -> [tokens, last refill time], least recently used first
+        self._buckets: Dict[str, List[float]] = OrderedDict()
+
+        # two sketches rotated every refill period, like the Bloom filters of EmailRouterDedupeCache
+        self._sketch_period_seconds = burst / rate_per_second
+        self._current_sketch = EmailRouterCountMinSketch(width=max(64, 2 * tracked_key_capacity), depth=sketch_depth)
+        self._previous_sketch = EmailRouterCountMinSketch(width=max(64, 2 * tracked_key_capacity), depth=sketch_depth)
+        self._sketch_rotation_time = time.monotonic() + self._sketch_period_seconds
+
+        self._admitted_count = 0
+        self._rejected_count = 0
+        self._evicted_count = 0
+
+    def try_acquire(self, key: str) -> bool:
+        """
+        Take a token for key - False if it has none left
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._sketch_rotation_time:
+                self._previous_sketch, self._current_sketch = self._current_sketch, self._previous_sketch
+                self._current_sketch.clear()
+                self._sketch_rotation_time = now + self._sketch_period_seconds
+
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                current_count = self._current_sketch.add(key)
+                if current_count + self._previous_sketch.estimate(key) <= self._burst:
+                    self._admitted_count += 1
+                    return True
+
+                # a heavy key - track it exactly from now on, starting with what is left of this period's burst
+                bucket = [max(0.0, self._burst - (current_count - 1)), now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self._tracked_key_capacity:
+                    self._buckets.popitem(last=False)
+                    self._evicted_count += 1
+            else:
+                self._buckets.move_to_end(key)
+
+            tokens = min(self._burst, bucket[0] + (now - bucket[1]) * self._rate_per_second)
+            bucket[1] = now
+            if tokens >= 1.0:
+                bucket[0] = tokens - 1.0
+                self._admitted_count += 1
+                return True
+
+            bucket[0] = tokens
+            self._rejected_count += 1
+            return False
+
+    def get_statistics_as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'rate_per_second': self._rate_per_second,
+                'burst': self._burst,
+                'admitted_count': self._admitted_count,
+                'rejected_count': self._rejected_count,
+                'tracked_key_count': len(self._buckets),
+                'evicted_count': self._evicted_count
+            }
+
+
+class EmailRouterAdmissionController:
+    """
+    Token bucket limits on inbound emails by sender domain, sender IP and matched target.  A dimension without
+    a rate is not limited.  Keys are compared case-insensitively.
+    """
+
+    @property
+    def limited_dimensions(self) -> List[EmailRouterAdmissionDimension]:
+        return [x for x in EmailRouterAdmissionDimension if x in self._limiters]
+
+    def __init__(self,
+                 rates_per_second: Dict[EmailRouterAdmissionDimension, Optional[float]],
+                 burst_seconds: float = 10.0,
+                 tracked_key_capacity: int = 10000):
+        if burst_seconds <= 0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': burst_seconds must be positive ' +
+                             '(value = ' + str(burst_seconds) + ')')
+
+        self._limiters: Dict[EmailRouterAdmissionDimension, EmailRouterTokenBucketLimiter] = dict()
+        for this_dimension, this_rate in rates_per_second.items():
+            if this_rate is None or this_rate <= 0:
+                continue
+            self._limiters[this_dimension] = \
+                EmailRouterTokenBucketLimiter(rate_per_second=this_rate,
+                                              burst=max(1.0, this_rate * burst_seconds),
+                                              tracked_key_capacity=tracked_key_capacity)
+
+    def admit(self,
+              dimension: EmailRouterAdmissionDimension,
+              key: Optional[str]) -> bool:
+        limiter = self._limiters.get(dimension)
+        if limiter is None or key is None or len(key) == 0:
+            return True
+        return limiter.try_acquire(key.lower())
+
+    def get_retry_after_seconds(self, dimension: EmailRouterAdmissionDimension) -> int:
+        return self._limiters[dimension].retry_after_seconds if dimension in self._limiters else 1
+
+    def get_statistics_as_dict(self) -> dict:
+        return {x.name.lower(): self._limiters[x].get_statistics_as_dict() for x in self.limited_dimensions}
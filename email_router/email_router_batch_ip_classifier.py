@@ -0,0 +1,168 @@
+import numpy
+
+from netaddr import IPAddress
+from netaddr.core import AddrFormatError
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from email_router.email_router_compiled_rules import CompiledIpWhitelist
+
+#
+# Classifies a whole batch of sender ips against the ip whitelists of every rule at once.
+#
+# The whitelist ranges of all rules are cut into non-overlapping segments (as in email_router_bitset_index), each
+#  with the mask of the rules whose whitelists cover it.  The segment starts are kept as a sorted array per ip
+#  version - integers for IPv4, 16 byte big endian values for IPv6 (numpy has no 128 bit integers, and a bytes
+#  compare of those is a numeric compare) - so one searchsorted call finds the segment of every sender ip.
+#
+# Rule masks use the rule numbering of the caller: bit n (and row n of the match matrix) is rule n.  Rules
+#  without a whitelist pass every valid sender ip.
+#
+
+_IP_VERSION_BITS = {4: 32, 6: 128}
+
+
+def _get_ip_keys(ip_values: Sequence[int], ip_version: int) -> numpy.ndarray:
+    if ip_version == 4:
+        return numpy.array(ip_values, dtype=numpy.uint64)
+    return numpy.array([x.to_bytes(16, 'big') for x in ip_values], dtype='S16')
+
+
+class EmailRouterBatchIpClassification:
+    """
+    The rules passing the sender ip check, for each sender ip of a batch
+    """
+
+    @property
+    def email_count(self) -> int:
+        return len(self._segment_indexes)
+
+    @property
+    def valid_mask(self) -> numpy.ndarray:
+        """
+        Per email: False if the sender ip could not be read (those emails pass no rule)
+        """
+        return self._ip_versions != 0
+
+    @property
+    def match_matrix(self) -> numpy.ndarray:
+        """
+        rules x emails: True where the rule passes the email's sender ip
+        """
+        packed_masks = self._classifier.packed_segment_masks[self._segment_indexes]
+        packed_masks[self._ip_versions == 0] = 0
+        return numpy.unpackbits(packed_masks, axis=1, count=self._classifier.rule_count,
+                                bitorder='little').T.astype(bool)
+
+    def __init__(self,
+                 classifier: 'EmailRouterBatchIpClassifier',
+                 ip_versions: numpy.ndarray,
+                 segment_indexes: numpy.ndarray):
+        self._classifier = classifier
+        self._ip_versions = ip_versions
+        self._segment_indexes = segment_indexes
+
+    def get_rule_mask(self, email_index: int) -> Optional[int]:
+        """
+        The rules passing the sender ip of one email as a bit mask - None if the sender ip could not be read
+        """
+        if self._ip_versions[email_index] == 0:
+            return None
+        return self._classifier.segment_masks[self._segment_indexes[email_index]]
+
+
+class EmailRouterBatchIpClassifier:
+    """
+    Sender ip whitelists of every rule of a rule base (see the notes at the top of this module)
+    """
+
+    @property
+    def rule_count(self) -> int:
+        return self._rule_count
+
+    @property
+    def segment_masks(self) -> List[int]:
+        return self._segment_masks
+
+    @property
+    def packed_segment_masks(self) -> numpy.ndarray:
+        return self._packed_segment_masks
+
+    def __init__(self, sender_ip_whitelists: Sequence[Optional[CompiledIpWhitelist]]):
+        """
+        sender_ip_whitelists has one entry per rule, None for rules without a whitelist
+        """
+        self._rule_count = len(sender_ip_whitelists)
+        unconstrained_mask = 0
+        for rule_index, this_whitelist in enumerate(sender_ip_whitelists):
+            if this_whitelist is None:
+                unconstrained_mask |= 1 << rule_index
+
+        # segment masks of both versions in one list - row 0 is for ips outside every whitelist range, then each
+        #  version's segments, found at segment_offset + the searchsorted position
+        self._segment_masks: List[int] = [unconstrained_mask]
+        self._segment_starts: Dict[int, numpy.ndarray] = dict()
+        self._segment_offsets: Dict[int, int] = dict()
+        for ip_version, ip_ranges_attribute in ((4, 'ipv4_ranges'), (6, 'ipv6_ranges')):
+            ranges_with_rule_indexes = [(range_start, range_end, rule_index)
+                                        for rule_index, this_whitelist in enumerate(sender_ip_whitelists)
+                                        if this_whitelist is not None
+                                        for range_start, range_end in getattr(this_whitelist, ip_ranges_attribute)]
+            segment_starts, segment_masks = type(self)._get_segments(ranges_with_rule_indexes,
+                                                                     ip_value_limit=1 << _IP_VERSION_BITS[ip_version])
+            self._segment_starts[ip_version] = _get_ip_keys(segment_starts, ip_version)
+            self._segment_offsets[ip_version] = len(self._segment_masks) - 1
+            self._segment_masks.extend(x | unconstrained_mask for x in segment_masks)
+
+        mask_byte_count = max(1, (self._rule_count + 7) // 8)
+        self._packed_segment_masks = numpy.frombuffer(
+            b''.join(x.to_bytes(mask_byte_count, 'little') for x in self._segment_masks),
+            dtype=numpy.uint8).reshape(len(self._segment_masks), mask_byte_count)
+
+    @staticmethod
+    def _get_segments(ranges_with_rule_indexes: Sequence[Tuple[int, int, int]],
+                      ip_value_limit: int) -> Tuple[List[int], List[int]]:
+        added_masks: Dict[int, int] = dict()
+        removed_masks: Dict[int, int] = dict()
+        for range_start, range_end, rule_index in ranges_with_rule_indexes:
+            added_masks[range_start] = added_masks.get(range_start, 0) | 1 << rule_index
+            # a range up to the last address never ends
+            if range_end + 1 < ip_value_limit:
+                removed_masks[range_end + 1] = removed_masks.get(range_end + 1, 0) | 1 << rule_index
+
+        # the ranges of one rule are merged, so a rule never ends and starts again at the same point
+        segment_starts = sorted(set(added_masks.keys()) | set(removed_masks.keys()))
+        segment_masks = list()
+        active_mask = 0
+        for this_point in segment_starts:
+            active_mask = (active_mask & ~removed_masks.get(this_point, 0)) | added_masks.get(this_point, 0)
+            segment_masks.append(active_mask)
+        return segment_starts, segment_masks
+
+    def classify(self, sender_ips: Sequence[str]) -> EmailRouterBatchIpClassification:
+        # batches repeat senders - each distinct sender ip is read once, as the sender ip check reads it
+        ip_versions_and_values_by_sender_ip: Dict[str, Tuple[int, int]] = dict()
+        for this_sender_ip in sender_ips:
+            if this_sender_ip in ip_versions_and_values_by_sender_ip:
+                continue
+            try:
+                sender_ip_as_address = IPAddress(this_sender_ip)
+                ip_versions_and_values_by_sender_ip[this_sender_ip] = \
+                    (sender_ip_as_address.version, int(sender_ip_as_address))
+            except (AddrFormatError, TypeError, ValueError):
+                ip_versions_and_values_by_sender_ip[this_sender_ip] = (0, 0)
+
+        ip_versions_and_values = [ip_versions_and_values_by_sender_ip[x] for x in sender_ips]
+        ip_versions = numpy.array([x[0] for x in ip_versions_and_values], dtype=numpy.int8)
+        segment_indexes = numpy.zeros(len(sender_ips), dtype=numpy.int64)
+        for ip_version, this_segment_starts in self._segment_starts.items():
+            version_email_indexes = numpy.flatnonzero(ip_versions == ip_version)
+            if len(version_email_indexes) == 0 or len(this_segment_starts) == 0:
+                continue
+            ip_keys = _get_ip_keys([ip_versions_and_values[x][1] for x in version_email_indexes], ip_version)
+            segment_positions = numpy.searchsorted(this_segment_starts, ip_keys, side='right')
+            # position 0 is in front of the first segment - outside every range
+            segment_indexes[version_email_indexes] = numpy.where(
+                segment_positions > 0, segment_positions + self._segment_offsets[ip_version], 0)
+        return EmailRouterBatchIpClassification(classifier=self,
+                                                ip_versions=ip_versions,
+                                                segment_indexes=segment_indexes)
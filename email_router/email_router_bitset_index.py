@@ -0,0 +1,309 @@
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from email_router.email_router_compiled_rules import CompiledRouterRule, CompiledRouterTarget
+from email_router.email_router_flight_recorder import EmailRouterTargetRejection
+from email_router.email_router_rule_predicates import EmailRouterMatchInput, EmailRouterPredicateType, \
+    EmailRouterRulePredicate
+
+#
+# Every rule gets one bit, numbered in evaluation order (targets by target priority, then rules by match
+#  priority), so a target owns a contiguous run of bits and the lowest set bit is the highest priority rule.
+#
+# For each kind of check there is an index that, for one email, returns the mask of rules that pass it - rules
+#  without that check always pass.  A rule matches when its bit survives the AND of all those masks, so the
+#  work per email depends on the number of indexes (and distinct patterns), not on the number of rules:
+#
+#  - attachment included: two masks
+#  - body size minimum / maximum: masks accumulated over the sorted limits, found by binary search
+#  - sender ip: the whitelist ranges of all rules cut into non-overlapping segments, each with the mask of the
+#    rules covering it, found by binary search
+#  - sender domain / sender name / recipient name: exact literal patterns (e.g. ^orders$) in a dict, every
+#    other distinct pattern evaluated once
+#
+# Checks are evaluated with the predicates the walking matcher uses, so both engines agree on every result.
+#
+
+
+class _PatternIndex:
+    """
+    Distinct patterns of one kind of pattern check, each with the mask of rules using it
+    """
+    __slots__ = ('_exact_masks_by_literal', '_exact_predicates', '_other_predicates')
+
+    def __init__(self, predicates_with_masks: Sequence[Tuple[EmailRouterRulePredicate, int]]):
+        masks_by_pattern: Dict[str, int] = dict()
+        predicate_by_pattern: Dict[str, EmailRouterRulePredicate] = dict()
+        for this_predicate, this_mask in predicates_with_masks:
+            masks_by_pattern[this_predicate.pattern] = masks_by_pattern.get(this_predicate.pattern, 0) | this_mask
+            predicate_by_pattern.setdefault(this_predicate.pattern, this_predicate)
+
+        self._exact_masks_by_literal: Dict[str, int] = dict()
+        self._exact_predicates: List[Tuple[EmailRouterRulePredicate, int]] = list()
+        self._other_predicates: List[Tuple[EmailRouterRulePredicate, int]] = list()
+        for this_pattern, this_predicate in predicate_by_pattern.items():
+            literal_pattern = this_predicate.literal_pattern
+            if literal_pattern is not None and literal_pattern.exact_match:
+                self._exact_masks_by_literal[literal_pattern.literal] = \
+                    self._exact_masks_by_literal.get(literal_pattern.literal, 0) | masks_by_pattern[this_pattern]
+                self._exact_predicates.append((this_predicate, masks_by_pattern[this_pattern]))
+            else:
+                self._other_predicates.append((this_predicate, masks_by_pattern[this_pattern]))
+
+    def get_pass_mask(self,
+                      match_input: EmailRouterMatchInput,
+                      values_lower: Sequence[Optional[str]]) -> int:
+        pass_mask = 0
+        if any(x is None for x in values_lower):
+            # non ascii values are left to the regexes, as the predicates do
+            for this_predicate, this_mask in self._exact_predicates:
+                if this_predicate.evaluate(match_input):
+                    pass_mask |= this_mask
+        else:
+            for this_value_lower in values_lower:
+                pass_mask |= self._exact_masks_by_literal.get(this_value_lower, 0)
+                # "$" also matches in front of a trailing newline
+                if this_value_lower.endswith('\n'):
+                    pass_mask |= self._exact_masks_by_literal.get(this_value_lower[:-1], 0)
+
+        for this_predicate, this_mask in self._other_predicates:
+            if this_predicate.evaluate(match_input):
+                pass_mask |= this_mask
+        return pass_mask
+
+
+class _RangeIndex:
+    """
+    Integer ranges of many rules cut into segments, each with the mask of the rules whose ranges cover it
+    """
+    __slots__ = ('_segment_starts', '_segment_masks')
+
+    def __init__(self, ranges_with_masks: Sequence[Tuple[int, int, int]]):
+        added_masks: Dict[int, int] = dict()
+        removed_masks: Dict[int, int] = dict()
+        for range_start, range_end, this_mask in ranges_with_masks:
+            added_masks[range_start] = added_masks.get(range_start, 0) | this_mask
+            removed_masks[range_end + 1] = removed_masks.get(range_end + 1, 0) | this_mask
+
+        # the ranges of one rule are merged, so a rule never ends and starts again at the same point
+        self._segment_starts: List[int] = list()
+        self._segment_masks: List[int] = list()
+        active_mask = 0
+        for this_point in sorted(set(added_masks.keys()) | set(removed_masks.keys())):
+            active_mask = (active_mask & ~removed_masks.get(this_point, 0)) | added_masks.get(this_point, 0)
+            self._segment_starts.append(this_point)
+            self._segment_masks.append(active_mask)
+
+    def get_mask(self, value: int) -> int:
+        segment_index = bisect_right(self._segment_starts, value) - 1
+        return self._segment_masks[segment_index] if segment_index >= 0 else 0
+
+
+class EmailRouterBitsetMatch(NamedTuple):
+    # (target, the highest priority rule that matched it) in target priority order
+    matched_rules: List[Tuple[CompiledRouterTarget, CompiledRouterRule]]
+    # for every target tried that did not match: its first rule and the check that rejected it
+    target_rejections: List[EmailRouterTargetRejection]
+
+
+class EmailRouterBitsetIndex:
+    """
+    Bitmask indexes over every rule of a rule base held in memory (see the notes at the top of this module)
+    """
+
+    @property
+    def rule_count(self) -> int:
+        return len(self._rules)
+
+    @property
+    def rules(self) -> List[CompiledRouterRule]:
+        """
+        Every rule, by bit
+        """
+        return list(self._rules)
+
+    def __init__(self, compiled_targets: Sequence[CompiledRouterTarget]):
+        """
+        compiled_targets must be sorted by target priority, each with its rules sorted by match priority
+        """
+        self._compiled_targets = list(compiled_targets)
+        self._rules: List[CompiledRouterRule] = list()
+        # index of the target owning each rule bit, and the first bit past each target's rules
+        self._target_index_by_bit: List[int] = list()
+        self._target_end_bits: List[int] = list()
+        for target_index, this_target in enumerate(self._compiled_targets):
+            for this_rule in this_target.router_rules:
+                self._rules.append(this_rule)
+                self._target_index_by_bit.append(target_index)
+            self._target_end_bits.append(len(self._rules))
+
+        all_rules_mask = (1 << len(self._rules)) - 1
+        predicates_by_type: Dict[EmailRouterPredicateType, List[Tuple[EmailRouterRulePredicate, int]]] = dict()
+        for rule_bit, this_rule in enumerate(self._rules):
+            for this_predicate in this_rule.predicates:
+                predicates_by_type.setdefault(this_predicate.predicate_type, list()).append(
+                    (this_predicate, 1 << rule_bit))
+
+        # rules without a check of a given type always pass it
+        self._unconstrained_masks: Dict[EmailRouterPredicateType, int] = {
+            this_type: all_rules_mask & ~self._get_combined_mask(this_predicates_with_masks)
+            for this_type, this_predicates_with_masks in predicates_by_type.items()
+        }
+
+        attachment_predicates = predicates_by_type.get(EmailRouterPredicateType.ATTACHMENT_INCLUDED, list())
+        self._attachment_masks = {
+            True: self._get_combined_mask([x for x in attachment_predicates if x[0].attachment_included]),
+            False: self._get_combined_mask([x for x in attachment_predicates if not x[0].attachment_included])
+        }
+
+        # rules passing a minimum of at most the body size: prefix masks over the ascending minimums
+        body_size_minimums = sorted(
+            [(x[0].body_size_minimum, x[1])
+             for x in predicates_by_type.get(EmailRouterPredicateType.BODY_SIZE_MINIMUM, list())],
+            key=lambda x: x[0])
+        self._body_size_minimums = [x[0] for x in body_size_minimums]
+        self._body_size_minimum_masks = type(self)._get_accumulated_masks([x[1] for x in body_size_minimums])
+
+        # rules passing a maximum of at least the body size: prefix masks over the descending maximums
+        body_size_maximums = sorted(
+            [(x[0].body_size_maximum, x[1])
+             for x in predicates_by_type.get(EmailRouterPredicateType.BODY_SIZE_MAXIMUM, list())],
+            key=lambda x: x[0])
+        self._body_size_maximums = [x[0] for x in body_size_maximums]
+        self._body_size_maximum_masks = list(reversed(type(self)._get_accumulated_masks(
+            [x[1] for x in reversed(body_size_maximums)])))
+
+        ip_predicates = predicates_by_type.get(EmailRouterPredicateType.SENDER_IP_WHITELIST, list())
+        self._ip_range_indexes = {
+            4: _RangeIndex([(x[0], x[1], this_mask) for this_predicate, this_mask in ip_predicates
+                            for x in this_predicate.sender_ip_whitelist.ipv4_ranges]),
+            6: _RangeIndex([(x[0], x[1], this_mask) for this_predicate, this_mask in ip_predicates
+                            for x in this_predicate.sender_ip_whitelist.ipv6_ranges])
+        }
+
+        self._pattern_indexes = {
+            this_type: _PatternIndex(predicates_by_type[this_type])
+            for this_type in (EmailRouterPredicateType.SENDER_DOMAIN,
+                              EmailRouterPredicateType.SENDER_NAME,
+                              EmailRouterPredicateType.RECIPIENT_NAME)
+            if this_type in predicates_by_type
+        }
+
+    @staticmethod
+    def _get_combined_mask(predicates_with_masks: Sequence[Tuple[EmailRouterRulePredicate, int]]) -> int:
+        combined_mask = 0
+        for _, this_mask in predicates_with_masks:
+            combined_mask |= this_mask
+        return combined_mask
+
+    @staticmethod
+    def _get_accumulated_masks(masks: Sequence[int]) -> List[int]:
+        accumulated_masks = list()
+        accumulated_mask = 0
+        for this_mask in masks:
+            accumulated_mask |= this_mask
+            accumulated_masks.append(accumulated_mask)
+        return accumulated_masks
+
+    def _get_constrained_pass_mask(self,
+                                   predicate_type: EmailRouterPredicateType,
+                                   match_input: EmailRouterMatchInput) -> int:
+        """
+        Mask of the rules with a check of this type that pass it
+        """
+        if predicate_type == EmailRouterPredicateType.ATTACHMENT_INCLUDED:
+            return self._attachment_masks.get(match_input.attachment_included, 0)
+        if predicate_type == EmailRouterPredicateType.BODY_SIZE_MINIMUM:
+            if match_input.body_size is None:
+                return 0
+            limit_count = bisect_right(self._body_size_minimums, match_input.body_size)
+            return self._body_size_minimum_masks[limit_count - 1] if limit_count > 0 else 0
+        if predicate_type == EmailRouterPredicateType.BODY_SIZE_MAXIMUM:
+            if match_input.body_size is None:
+                return 0
+            limit_index = bisect_left(self._body_size_maximums, match_input.body_size)
+            return self._body_size_maximum_masks[limit_index] if limit_index < len(self._body_size_maximums) else 0
+        if predicate_type == EmailRouterPredicateType.SENDER_IP_WHITELIST:
+            sender_ip_version_and_value = match_input.sender_ip_version_and_value
+            # a malformed sender ip is in no whitelist
+            if sender_ip_version_and_value is None:
+                return 0
+            return self._ip_range_indexes[sender_ip_version_and_value[0]].get_mask(sender_ip_version_and_value[1])
+        if predicate_type == EmailRouterPredicateType.SENDER_DOMAIN:
+            return self._pattern_indexes[predicate_type].get_pass_mask(match_input, [match_input.sender_domain_lower])
+        if predicate_type == EmailRouterPredicateType.SENDER_NAME:
+            return self._pattern_indexes[predicate_type].get_pass_mask(match_input, [match_input.sender_name_lower])
+        return self._pattern_indexes[predicate_type].get_pass_mask(match_input, match_input.recipient_names_lower)
+
+    def match(self,
+              match_input: EmailRouterMatchInput,
+              first_match_only: bool,
+              max_target_rejections: int = 0,
+              max_no_match_target_rejections: int = 0,
+              sender_ip_pass_mask: Optional[int] = None) -> EmailRouterBitsetMatch:
+        """
+        Same targets, in the same order, as walking the rules with FIRST_MATCH (first_match_only) or
+        ALL_MATCHES, and the rejections of up to max_target_rejections targets, highest priority first.
+        If no rule matches, up to max_no_match_target_rejections rejections are reported instead when that
+        is more - the no match error can then be built without matching again.
+
+        sender_ip_pass_mask, if given, is the mask of the rules passing the sender ip check (rules without one
+        included) worked out beforehand - e.g. for a whole batch by email_router_batch_ip_classifier
+        """
+        pass_masks: Dict[EmailRouterPredicateType, int] = dict()
+        matched_mask = (1 << len(self._rules)) - 1
+        for this_type, this_unconstrained_mask in self._unconstrained_masks.items():
+            if this_type == EmailRouterPredicateType.SENDER_IP_WHITELIST and sender_ip_pass_mask is not None:
+                pass_masks[this_type] = sender_ip_pass_mask
+            else:
+                pass_masks[this_type] = this_unconstrained_mask | \
+                    self._get_constrained_pass_mask(this_type, match_input)
+            matched_mask &= pass_masks[this_type]
+        if matched_mask == 0:
+            max_target_rejections = max(max_target_rejections, max_no_match_target_rejections)
+
+        matched_rules = list()
+        target_rejections = list()
+        next_target_index = 0
+        while matched_mask != 0 or (len(target_rejections) < max_target_rejections and
+                                    next_target_index < len(self._compiled_targets)):
+            if matched_mask != 0:
+                # the lowest set bit is the highest priority matching rule
+                rule_bit = (matched_mask & -matched_mask).bit_length() - 1
+                matched_target_index = self._target_index_by_bit[rule_bit]
+            else:
+                rule_bit = None
+                matched_target_index = len(self._compiled_targets)
+
+            for this_target_index in range(next_target_index, matched_target_index):
+                if len(target_rejections) >= max_target_rejections:
+                    break
+                target_rejection = self._get_target_rejection(this_target_index, pass_masks)
+                if target_rejection is not None:
+                    target_rejections.append(target_rejection)
+            if rule_bit is None:
+                break
+
+            matched_rules.append((self._compiled_targets[matched_target_index], self._rules[rule_bit]))
+            if first_match_only:
+                break
+            # one matching rule is enough for a target - skip the rest of its rules
+            next_target_index = matched_target_index + 1
+            matched_mask &= ~((1 << self._target_end_bits[matched_target_index]) - 1)
+
+        return EmailRouterBitsetMatch(matched_rules=matched_rules, target_rejections=target_rejections)
+
+    def _get_target_rejection(self,
+                              target_index: int,
+                              pass_masks: Dict[EmailRouterPredicateType, int]) -> Optional[EmailRouterTargetRejection]:
+        # the walk reports the first check (in the rule's current order) to fail on the target's first rule
+        first_rule_bit = self._target_end_bits[target_index - 1] if target_index > 0 else 0
+        if first_rule_bit >= self._target_end_bits[target_index]:
+            return None
+        first_rule = self._rules[first_rule_bit]
+        for this_predicate in first_rule.predicates:
+            if not pass_masks[this_predicate.predicate_type] >> first_rule_bit & 1:
+                return EmailRouterTargetRejection(target_name=self._compiled_targets[target_index].target_name,
+                                                  match_priority=first_rule.match_priority,
+                                                  check_name=this_predicate.check_name)
+        return None
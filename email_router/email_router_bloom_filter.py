@@ -0,0 +1,77 @@
+import hashlib
+import math
+
+from typing import Union
+
+
+class EmailRouterBloomFilter:
+    """
+    Fixed size Bloom filter.  "not in" is always right; "in" is wrong with probability close to
+    false_positive_rate while no more than capacity keys have been added.  Keys cannot be removed.
+    """
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def bit_count(self) -> int:
+        return self._bit_count
+
+    @property
+    def hash_count(self) -> int:
+        return self._hash_count
+
+    @property
+    def key_count(self) -> int:
+        return self._key_count
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self._bits)
+
+    def __init__(self,
+                 capacity: int,
+                 false_positive_rate: float = 0.01):
+        if capacity < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': capacity must be at least 1 (value = ' +
+                             str(capacity) + ')')
+        if not 0.0 < false_positive_rate < 1.0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': false_positive_rate must be between ' +
+                             '0 and 1 (value = ' + str(false_positive_rate) + ')')
+
+        self._capacity = capacity
+        # standard sizing: m = -n ln(p) / ln(2)^2 bits and k = m/n ln(2) hashes
+        self._bit_count = max(8, int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))))
+        self._hash_count = max(1, int(round(self._bit_count / capacity * math.log(2))))
+        self._bits = bytearray((self._bit_count + 7) // 8)
+        self._key_count = 0
+
+    def _get_bit_positions(self, key: Union[str, bytes]):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        # two 64 bit hashes combined as h1 + i * h2 (Kirsch-Mitzenmacher) stand in for k independent hashes
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        hash_1 = int.from_bytes(digest[:8], byteorder='little')
+        hash_2 = int.from_bytes(digest[8:], byteorder='little') | 1
+        return [(hash_1 + i * hash_2) % self._bit_count for i in range(self._hash_count)]
+
+    def add(self, key: Union[str, bytes]):
+        for this_position in self._get_bit_positions(key):
+            self._bits[this_position >> 3] |= 1 << (this_position & 7)
+        self._key_count += 1
+
+    def __contains__(self, key: Union[str, bytes]) -> bool:
+        for this_position in self._get_bit_positions(key):
+            if not self._bits[this_position >> 3] & (1 << (this_position & 7)):
+                return False
+        return True
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+        self._key_count = 0
+
+    # expected false positive rate for the keys added so far: (1 - e^(-kn/m))^k
+    @property
+    def estimated_false_positive_rate(self) -> float:
+        return (1.0 - math.exp(-self._hash_count * self._key_count / self._bit_count)) ** self._hash_count
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from bisect import bisect_right
+from typing import Collection, Dict, List, NamedTuple, Optional
+
+#
+# Cluster mode: every node is given the same static list of nodes (base URLs) and builds the same consistent hash
+#  ring from it, so all nodes agree which one owns a sender domain.  A request that arrives at another node is
+#  forwarded - same path, same body - to the owner, which then holds all per-sender state (dedupe, admission
+#  buckets, caches) for that domain.  The forwarded request carries the X-Emerald-Forwarded header naming the
+#  forwarding node and is always handled where it lands, so a request is forwarded at most once.
+#
+
+
+class EmailRouterHashRing:
+    """
+    Consistent hash ring with virtual_node_count points per node - adding or removing a node only moves the keys
+    next to its points
+    """
+
+    @property
+    def node_ids(self) -> List[str]:
+        return list(self._node_ids)
+
+    def __init__(self,
+                 node_ids: Collection[str],
+                 virtual_node_count: int = 100):
+        if len(node_ids) == 0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': at least one node is required')
+        if virtual_node_count < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': virtual_node_count must be at ' +
+                             'least 1 (value = ' + str(virtual_node_count) + ')')
+
+        self._node_ids = sorted(set(node_ids))
+        ring_points = sorted((type(self)._get_hash(this_node_id + '#' + str(i)), this_node_id)
+                             for this_node_id in self._node_ids for i in range(virtual_node_count))
+        self._ring_hashes = [x[0] for x in ring_points]
+        self._ring_node_ids = [x[1] for x in ring_points]
+
+    @staticmethod
+    def _get_hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), byteorder='little')
+
+    def get_node_id(self, key: str) -> str:
+        # first ring point at or after the key hash, wrapping round at the end
+        ring_index = bisect_right(self._ring_hashes, type(self)._get_hash(key))
+        return self._ring_node_ids[ring_index % len(self._ring_node_ids)]
+
+
+class EmailRouterClusterForwardResult(NamedTuple):
+    status_code: int
+    body: bytes
+    # the owner's Content-Type and Retry-After headers, to be passed back to the sender
+    headers: Dict[str, str]
+
+
+_PASSED_BACK_HEADERS = ('Content-Type', 'Retry-After')
+
+
+class EmailRouterCluster:
+    """
+    Static cluster of router nodes identified by their base URLs (e.g. http://10.0.0.5:8080).  A peer that cannot
+    be reached is skipped for unreachable_retry_seconds - requests it owns are then handled locally
+    """
+
+    FORWARDED_HEADER = 'X-Emerald-Forwarded'
+
+    @property
+    def self_node_id(self) -> str:
+        return self._self_node_id
+
+    @property
+    def node_ids(self) -> List[str]:
+        return self._hash_ring.node_ids
+
+    def __init__(self,
+                 self_node_url: str,
+                 node_urls: Collection[str],
+                 virtual_node_count: int = 100,
+                 forward_timeout_seconds: float = 5.0,
+                 unreachable_retry_seconds: float = 10.0):
+        node_ids = [x.strip().rstrip('/') for x in node_urls if len(x.strip()) > 0]
+        self._self_node_id = self_node_url.strip().rstrip('/')
+        if self._self_node_id not in node_ids:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': this node "' + self._self_node_id +
+                             '" is not in the cluster node list' + os.linesep + 'Node(s): ' + ','.join(node_ids))
+        if forward_timeout_seconds <= 0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': forward_timeout_seconds must be ' +
+                             'positive (value = ' + str(forward_timeout_seconds) + ')')
+
+        self._hash_ring = EmailRouterHashRing(node_ids=node_ids, virtual_node_count=virtual_node_count)
+        self._forward_timeout_seconds = forward_timeout_seconds
+        self._unreachable_retry_seconds = unreachable_retry_seconds
+
+        self._lock = threading.Lock()
+        self._unreachable_until: Dict[str, float] = dict()
+        self._local_count = 0
+        self._forwarded_count = 0
+        self._received_forwarded_count = 0
+        self._forward_failed_count = 0
+
+    def get_owner_node_id(self, sender_domain: Optional[str]) -> str:
+        if sender_domain is None or len(sender_domain) == 0:
+            return self._self_node_id
+        return self._hash_ring.get_node_id(sender_domain.lower())
+
+    def is_forwarded(self, request_headers) -> bool:
+        return request_headers.get(type(self).FORWARDED_HEADER) is not None
+
+    def record_local(self, forwarded: bool):
+        with self._lock:
+            if forwarded:
+                self._received_forwarded_count += 1
+            else:
+                self._local_count += 1
+
+    def forward(self,
+                node_id: str,
+                path: str,
+                content_type: Optional[str],
+                body: bytes) -> Optional[EmailRouterClusterForwardResult]:
+        """
+        POST the request to its owner and return the owner's response - None if the owner cannot be reached
+        (the caller should then handle the request itself)
+        """
+        with self._lock:
+            if self._unreachable_until.get(node_id, 0.0) > time.monotonic():
+                self._forward_failed_count += 1
+                return None
+
+        forward_request = urllib.request.Request(url=node_id + path,
+                                                 data=body,
+                                                 method='POST',
+                                                 headers={type(self).FORWARDED_HEADER: self._self_node_id})
+        if content_type is not None:
+            forward_request.add_header('Content-Type', content_type)
+
+        try:
+            with urllib.request.urlopen(forward_request, timeout=self._forward_timeout_seconds) as response:
+                forward_result = EmailRouterClusterForwardResult(
+                    status_code=response.status,
+                    body=response.read(),
+                    headers={x: response.headers[x] for x in _PASSED_BACK_HEADERS if x in response.headers})
+        except urllib.error.HTTPError as htex:
+            # the owner answered - pass its answer (e.g. 429) on
+            forward_result = EmailRouterClusterForwardResult(
+                status_code=htex.code,
+                body=htex.read(),
+                headers={x: htex.headers[x] for x in _PASSED_BACK_HEADERS if x in htex.headers})
+        except (urllib.error.URLError, OSError):
+            with self._lock:
+                self._unreachable_until[node_id] = time.monotonic() + self._unreachable_retry_seconds
+                self._forward_failed_count += 1
+            return None
+
+        with self._lock:
+            self._unreachable_until.pop(node_id, None)
+            self._forwarded_count += 1
+        return forward_result
+
+    def get_statistics_as_dict(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'self_node_id': self._self_node_id,
+                'node_ids': self.node_ids,
+                'unreachable_node_ids': sorted(k for k, v in self._unreachable_until.items() if v > now),
+                'local_count': self._local_count,
+                'forwarded_count': self._forwarded_count,
+                'received_forwarded_count': self._received_forwarded_count,
+                'forward_failed_count': self._forward_failed_count
+            }
@@ -0,0 +1,262 @@
+import re
+import sys
+
+from array import array
+from bisect import bisect_right
+from netaddr import IPNetwork
+from typing import Collection, Dict, FrozenSet, Iterable, List, Optional, Pattern, Tuple
+
+from email_router.email_router_pattern import get_literal_from_pattern
+from email_router.email_router_rule_predicates import EmailRouterRulePredicate, EmailRouterPredicateStatistics, \
+    AttachmentIncludedPredicate, BodySizeMinimumPredicate, BodySizeMaximumPredicate, SenderIpWhitelistPredicate, \
+    SenderDomainPredicate, SenderNamePredicate, RecipientNamePredicate, order_predicates
+
+#
+# Compact representation of the loaded rules used by the matcher.  The public NamedTuples in
+#  email_router_datastore (EmailRouterTargetConfig and friends) are rebuilt from these on demand for introspection.
+#
+#  - classes use __slots__ (no per instance __dict__)
+#  - pattern strings and names are interned, and each distinct regex is compiled once per compiler
+#  - ip whitelists are merged into sorted, non-overlapping integer ranges held in arrays instead of
+#    a set of netaddr IPNetwork objects; lookup is a binary search
+#  - each rule also carries its checks as a tuple of predicates ordered cheapest first (see
+#    email_router_rule_predicates) - this is what the matcher evaluates
+#
+
+
+class _Ipv6RangeArray:
+    """
+    Sequence of 128 bit integers packed as 16 byte big endian values (array has no 128 bit type)
+    """
+    __slots__ = ('_packed_values',)
+
+    def __init__(self, values: Iterable[int]):
+        self._packed_values = b''.join([x.to_bytes(16, byteorder='big') for x in values])
+
+    def __len__(self):
+        return len(self._packed_values) // 16
+
+    def __getitem__(self, index: int) -> int:
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('Index out of range for ' + type(self).__name__)
+        return int.from_bytes(self._packed_values[index * 16:(index + 1) * 16], byteorder='big')
+
+
+def _merge_ranges(ranges: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    merged_ranges: List[Tuple[int, int]] = list()
+    for range_start, range_end in sorted(ranges):
+        if len(merged_ranges) > 0 and range_start <= merged_ranges[-1][1] + 1:
+            if range_end > merged_ranges[-1][1]:
+                merged_ranges[-1] = (merged_ranges[-1][0], range_end)
+            continue
+        merged_ranges.append((range_start, range_end))
+    return merged_ranges
+
+
+class CompiledIpWhitelist:
+    __slots__ = ('cidrs', '_ipv4_starts', '_ipv4_ends', '_ipv6_starts', '_ipv6_ends')
+
+    def __init__(self,
+                 cidrs: Tuple[str, ...],
+                 ipv4_ranges: Iterable[Tuple[int, int]],
+                 ipv6_ranges: Iterable[Tuple[int, int]]):
+        self.cidrs = cidrs
+
+        merged_ipv4_ranges = _merge_ranges(ipv4_ranges)
+        self._ipv4_starts = array('L', [x[0] for x in merged_ipv4_ranges])
+        self._ipv4_ends = array('L', [x[1] for x in merged_ipv4_ranges])
+
+        merged_ipv6_ranges = _merge_ranges(ipv6_ranges)
+        self._ipv6_starts = _Ipv6RangeArray([x[0] for x in merged_ipv6_ranges])
+        self._ipv6_ends = _Ipv6RangeArray([x[1] for x in merged_ipv6_ranges])
+
+    def __len__(self):
+        return len(self.cidrs)
+
+    @property
+    def ipv4_ranges(self) -> List[Tuple[int, int]]:
+        return list(zip(self._ipv4_starts, self._ipv4_ends))
+
+    @property
+    def ipv6_ranges(self) -> List[Tuple[int, int]]:
+        return [(self._ipv6_starts[x], self._ipv6_ends[x]) for x in range(len(self._ipv6_starts))]
+
+    def contains(self,
+                 ip_version: int,
+                 ip_value: int) -> bool:
+        if ip_version == 4:
+            starts, ends = self._ipv4_starts, self._ipv4_ends
+        else:
+            starts, ends = self._ipv6_starts, self._ipv6_ends
+
+        range_index = bisect_right(starts, ip_value) - 1
+        return range_index >= 0 and ip_value <= ends[range_index]
+
+
+class CompiledRouterRule:
+    __slots__ = ('match_priority',
+                 'sender_domain',
+                 'sender_domain_regex',
+                 'sender_name',
+                 'sender_name_regex',
+                 'recipient_name',
+                 'recipient_name_regex',
+                 'attachment_included',
+                 'body_size_minimum',
+                 'body_size_maximum',
+                 'sender_ip_whitelist',
+                 'predicates')
+
+    def __init__(self,
+                 match_priority: float,
+                 sender_domain: Optional[str],
+                 sender_domain_regex: Optional[Pattern],
+                 sender_name: Optional[str],
+                 sender_name_regex: Optional[Pattern],
+                 recipient_name: Optional[str],
+                 recipient_name_regex: Optional[Pattern],
+                 attachment_included: Optional[bool],
+                 body_size_minimum: Optional[int],
+                 body_size_maximum: Optional[int],
+                 sender_ip_whitelist: Optional[CompiledIpWhitelist],
+                 predicates: Tuple[EmailRouterRulePredicate, ...] = ()):
+        self.match_priority = match_priority
+        self.sender_domain = sender_domain
+        self.sender_domain_regex = sender_domain_regex
+        self.sender_name = sender_name
+        self.sender_name_regex = sender_name_regex
+        self.recipient_name = recipient_name
+        self.recipient_name_regex = recipient_name_regex
+        self.attachment_included = attachment_included
+        self.body_size_minimum = body_size_minimum
+        self.body_size_maximum = body_size_maximum
+        self.sender_ip_whitelist = sender_ip_whitelist
+        # all must pass for the rule to match; may be reordered while routing, never changes the result
+        self.predicates = predicates
+
+
+class CompiledRouterTarget:
+    __slots__ = ('target_name',
+                 'target_priority',
+                 'router_rules',
+                 'destinations')
+
+    def __init__(self,
+                 target_name: str,
+                 target_priority: float,
+                 router_rules: Tuple[CompiledRouterRule, ...],
+                 destinations: FrozenSet):
+        self.target_name = target_name
+        self.target_priority = target_priority
+        # kept sorted by match priority so the matcher never sorts
+        self.router_rules = router_rules
+        self.destinations = destinations
+
+
+class EmailRouterRuleCompiler:
+    """
+    Builds compiled rules and targets.  Keep one compiler per datastore so every rule sharing a pattern
+    shares one compiled regex.
+    """
+
+    @property
+    def predicate_statistics(self) -> Optional[EmailRouterPredicateStatistics]:
+        return self._predicate_statistics
+
+    # rules compiled after this is set order their predicates using the observed reject rates
+    @predicate_statistics.setter
+    def predicate_statistics(self, value: Optional[EmailRouterPredicateStatistics]):
+        self._predicate_statistics = value
+
+    def __init__(self):
+        self._compiled_regex_by_pattern: Dict[str, Pattern] = dict()
+        self._predicate_statistics: Optional[EmailRouterPredicateStatistics] = None
+
+    def _intern(self, value: Optional[str]) -> Optional[str]:
+        return None if value is None else sys.intern(value)
+
+    def _compile_regex(self, pattern: Optional[str]) -> Optional[Pattern]:
+        if pattern is None:
+            return None
+        if pattern not in self._compiled_regex_by_pattern:
+            self._compiled_regex_by_pattern[self._intern(pattern)] = re.compile(pattern, re.IGNORECASE)
+        return self._compiled_regex_by_pattern[pattern]
+
+    def compile_ip_whitelist(self,
+                             sender_ip_whitelist_cidrs: Optional[Collection[str]]) -> Optional[CompiledIpWhitelist]:
+        if sender_ip_whitelist_cidrs is None:
+            return None
+
+        ipv4_ranges = list()
+        ipv6_ranges = list()
+        for this_cidr in sender_ip_whitelist_cidrs:
+            this_ip_network = IPNetwork(this_cidr)
+            (ipv4_ranges if this_ip_network.version == 4 else ipv6_ranges).append(
+                (this_ip_network.first, this_ip_network.last))
+
+        return CompiledIpWhitelist(cidrs=tuple(sorted([self._intern(str(x)) for x in sender_ip_whitelist_cidrs])),
+                                   ipv4_ranges=ipv4_ranges,
+                                   ipv6_ranges=ipv6_ranges)
+
+    def compile_rule(self,
+                     match_priority: float,
+                     sender_domain: Optional[str] = None,
+                     sender_name: Optional[str] = None,
+                     recipient_name: Optional[str] = None,
+                     attachment_included: Optional[bool] = None,
+                     body_size_minimum: Optional[int] = None,
+                     body_size_maximum: Optional[int] = None,
+                     sender_ip_whitelist_cidrs: Optional[Collection[str]] = None) -> CompiledRouterRule:
+        compiled_rule = CompiledRouterRule(match_priority=match_priority,
+                                           sender_domain=self._intern(sender_domain),
+                                           sender_domain_regex=self._compile_regex(sender_domain),
+                                           sender_name=self._intern(sender_name),
+                                           sender_name_regex=self._compile_regex(sender_name),
+                                           recipient_name=self._intern(recipient_name),
+                                           recipient_name_regex=self._compile_regex(recipient_name),
+                                           attachment_included=attachment_included,
+                                           body_size_minimum=body_size_minimum,
+                                           body_size_maximum=body_size_maximum,
+                                           sender_ip_whitelist=self.compile_ip_whitelist(sender_ip_whitelist_cidrs))
+        compiled_rule.predicates = order_predicates(self._build_predicates(compiled_rule),
+                                                    predicate_statistics=self.predicate_statistics)
+        return compiled_rule
+
+    def _build_predicates(self, compiled_rule: CompiledRouterRule) -> List[EmailRouterRulePredicate]:
+        predicates: List[EmailRouterRulePredicate] = list()
+        if compiled_rule.attachment_included is not None:
+            predicates.append(AttachmentIncludedPredicate(compiled_rule.attachment_included))
+        if compiled_rule.body_size_minimum is not None:
+            predicates.append(BodySizeMinimumPredicate(compiled_rule.body_size_minimum))
+        if compiled_rule.body_size_maximum is not None:
+            predicates.append(BodySizeMaximumPredicate(compiled_rule.body_size_maximum))
+        if compiled_rule.recipient_name is not None:
+            predicates.append(RecipientNamePredicate(pattern=compiled_rule.recipient_name,
+                                                     regex=compiled_rule.recipient_name_regex,
+                                                     literal_pattern=get_literal_from_pattern(
+                                                         compiled_rule.recipient_name)))
+        if compiled_rule.sender_domain is not None:
+            predicates.append(SenderDomainPredicate(pattern=compiled_rule.sender_domain,
+                                                    regex=compiled_rule.sender_domain_regex,
+                                                    literal_pattern=get_literal_from_pattern(
+                                                        compiled_rule.sender_domain)))
+        if compiled_rule.sender_name is not None:
+            predicates.append(SenderNamePredicate(pattern=compiled_rule.sender_name,
+                                                  regex=compiled_rule.sender_name_regex,
+                                                  literal_pattern=get_literal_from_pattern(
+                                                      compiled_rule.sender_name)))
+        if compiled_rule.sender_ip_whitelist is not None:
+            predicates.append(SenderIpWhitelistPredicate(compiled_rule.sender_ip_whitelist))
+        return predicates
+
+    def compile_target(self,
+                       target_name: str,
+                       target_priority: float,
+                       router_rules: Iterable[CompiledRouterRule],
+                       destinations: FrozenSet) -> CompiledRouterTarget:
+        return CompiledRouterTarget(target_name=self._intern(target_name),
+                                    target_priority=target_priority,
+                                    router_rules=tuple(sorted(router_rules, key=lambda x: x.match_priority)),
+                                    destinations=destinations)
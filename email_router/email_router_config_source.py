@@ -5,6 +5,8 @@ from typing import NamedTuple, Optional
 @unique
 class EmailRouterDatastoreSourceType(Enum):
     JSONFILE = auto()
+    SQLITE = auto()
+    SHARED_MEMORY = auto()
     UNSUPPORTED = auto()
 
 
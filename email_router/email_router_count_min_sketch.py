@@ -0,0 +1,70 @@
+import hashlib
+
+from array import array
+from typing import List, Union
+
+
+class EmailRouterCountMinSketch:
+    """
+    Approximate counts for an unbounded set of keys in fixed memory (width x depth counters).  An estimate is
+    never below the true count; it exceeds it by more than total / width * e with probability about e^-depth.
+    """
+
+    @property
+    def width(self) -> int:
+        return self._width
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    @property
+    def total_count(self) -> int:
+        return self._total_count
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(len(x) * x.itemsize for x in self._rows)
+
+    def __init__(self,
+                 width: int,
+                 depth: int = 4):
+        if width < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': width must be at least 1 (value = ' +
+                             str(width) + ')')
+        if depth < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': depth must be at least 1 (value = ' +
+                             str(depth) + ')')
+
+        self._width = width
+        self._depth = depth
+        self._rows: List[array] = list()
+        self.clear()
+
+    def _get_columns(self, key: Union[str, bytes]) -> List[int]:
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        # same double hashing as EmailRouterBloomFilter - one column per row from two 64 bit hashes
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        hash_1 = int.from_bytes(digest[:8], byteorder='little')
+        hash_2 = int.from_bytes(digest[8:], byteorder='little') | 1
+        return [(hash_1 + i * hash_2) % self._width for i in range(self._depth)]
+
+    def add(self, key: Union[str, bytes], count: int = 1) -> int:
+        """
+        Count key and return its new estimate
+        """
+        estimate = None
+        for this_row, this_column in zip(self._rows, self._get_columns(key)):
+            this_row[this_column] += count
+            if estimate is None or this_row[this_column] < estimate:
+                estimate = this_row[this_column]
+        self._total_count += count
+        return estimate
+
+    def estimate(self, key: Union[str, bytes]) -> int:
+        return min(this_row[this_column] for this_row, this_column in zip(self._rows, self._get_columns(key)))
+
+    def clear(self):
+        self._rows = [array('L', bytes(self._width * array('L').itemsize)) for _ in range(self._depth)]
+        self._total_count = 0
@@ -3,27 +3,39 @@ import datetime
 import logging
 import json
 import re
+import threading
+import time
 
-from netaddr import IPNetwork, IPAddress
+from bisect import bisect_right
+from netaddr import IPNetwork
 from netaddr.core import AddrConversionError, AddrFormatError
 
 from dateutil.parser import parse
 from pytz import timezone
-from typing import NamedTuple, Optional, Collection, FrozenSet, List, Set
+from typing import NamedTuple, Optional, Collection, FrozenSet, List, Sequence, Set, Tuple
 from tzlocal import get_localzone
 
-from emerald_message.containers.email.email_container import EmailContainer
-from emerald_message.containers.email.email_envelope import EmailEnvelope
-from emerald_message.containers.email.email_message_metadata import EmailMessageMetadata
-
+from email_router.email_router_bitset_index import EmailRouterBitsetIndex, EmailRouterBitsetMatch
+from email_router.email_router_compiled_rules import EmailRouterRuleCompiler, CompiledRouterTarget
 from email_router.email_router_config_source import EmailRouterDatastoreSourceType, EmailRouterSourceConfig
 from email_router.email_router_destination import EmailRouterDestinationType, EmailRouterDestinationConfig
+from email_router.email_router_flight_recorder import EmailRouterFlightRecorder, EmailRouterMatchTrace, \
+    EmailRouterRoutingOutcome, EmailRouterTargetRejection
+from email_router.email_router_match_cache import EmailRouterMatchCache, EmailRouterMatchCacheEntry, \
+    EmailRouterMatchCacheKey, EmailRouterMatchCacheSnapshot
+from email_router.email_router_match_engine import EmailRouterMatchEngine
+from email_router.email_router_recipient_allowlist import EmailRouterRecipientAllowlist
+from email_router.email_router_routing_policy import EmailRouterRoutingPolicy
+from email_router.email_router_rule_predicates import EmailRouterMatchInput, EmailRouterPredicateStatistics, \
+    EmailRouterPredicateType, order_predicates
 from email_router.router_instance_type import RouterInstanceType
 from error import EmeraldEmailRouterDatabaseInitializationError, \
     EmeraldEmailRouterDuplicateTargetError, \
     EmeraldEmailRouterMatchNotFoundError, \
+    EmeraldEmailRouterRecipientNotAllowedError, \
     EmeraldEmailRouterConfigNotActiveError, \
-    EmeraldEmailRouterInputDataError
+    EmeraldEmailRouterInputDataError, \
+    EmeraldError
 
 
 class EmailRouterRuleMatchPattern(NamedTuple):
@@ -46,7 +58,8 @@ class EmailRouterRuleMatchPattern(NamedTuple):
                    'body_size_minimum=' + str(self.body_size_minimum),
                    'body_size_maximum=' + str(self.body_size_maximum),
                    'sender_ip_set=' +
-                   ','.join([str(x) for x in self.sender_ip_whitelist] if self.sender_ip_whitelist is not None else '')
+                   ','.join(sorted([str(x) for x in self.sender_ip_whitelist])
+                            if self.sender_ip_whitelist is not None else '')
                ])
 
     def __hash__(self):
@@ -67,7 +80,7 @@ class EmailRouterRuleMatchPattern(NamedTuple):
         )
 
     def __ne__(self, other):
-        return not (__eq__(self, other))
+        return not self.__eq__(other)
 
 
 # router rules are sorted only by sequence - rules with identical sequence have indeterminate sort order
@@ -98,7 +111,7 @@ class EmailRouterRule(NamedTuple):
         return True
 
     def __ne__(self, other):
-        return not (__eq__(self, other))
+        return not self.__eq__(other)
 
     def __lt__(self, other):
         if not isinstance(other, EmailRouterRule):
@@ -163,6 +176,65 @@ class EmailRouterMatchResultCollection(NamedTuple):
     matched_target_results: List[EmailRouterMatchResult]
 
 
+# one email of a batch (see EmailRouter.match_inbound_email_batch)
+class EmailRouterBatchEmail(NamedTuple):
+    address_to_collection: Collection[str]
+    address_from: str
+    sender_ip: str
+    attachment_included: Optional[bool] = None
+    body_size: Optional[int] = None
+
+
+class EmailRouterBatchMatchResult(NamedTuple):
+    # the match, or why there is none (match not found or input error)
+    match_result_collection: Optional[EmailRouterMatchResultCollection]
+    error: Optional[EmeraldError]
+
+
+def compile_target_config(target_config: EmailRouterTargetConfig,
+                          rule_compiler: EmailRouterRuleCompiler) -> CompiledRouterTarget:
+    return rule_compiler.compile_target(
+        target_name=target_config.target_name,
+        target_priority=target_config.target_priority,
+        router_rules=[
+            rule_compiler.compile_rule(
+                match_priority=this_rule.match_priority,
+                sender_domain=this_rule.match_pattern.sender_domain,
+                sender_name=this_rule.match_pattern.sender_name,
+                recipient_name=this_rule.match_pattern.recipient_name,
+                attachment_included=this_rule.match_pattern.attachment_included,
+                body_size_minimum=this_rule.match_pattern.body_size_minimum,
+                body_size_maximum=this_rule.match_pattern.body_size_maximum,
+                sender_ip_whitelist_cidrs=None if this_rule.match_pattern.sender_ip_whitelist is None else
+                [str(x) for x in this_rule.match_pattern.sender_ip_whitelist])
+            for this_rule in target_config.router_rules
+        ],
+        destinations=target_config.destinations)
+
+
+# the compiled form is what we route with - this rebuilds the public NamedTuple for introspection
+def get_target_config_from_compiled(compiled_target: CompiledRouterTarget) -> EmailRouterTargetConfig:
+    return EmailRouterTargetConfig(
+        target_name=compiled_target.target_name,
+        target_priority=compiled_target.target_priority,
+        router_rules=frozenset([
+            EmailRouterRule(
+                match_priority=this_rule.match_priority,
+                match_pattern=EmailRouterRuleMatchPattern(
+                    sender_domain=this_rule.sender_domain,
+                    sender_name=this_rule.sender_name,
+                    recipient_name=this_rule.recipient_name,
+                    attachment_included=this_rule.attachment_included,
+                    body_size_minimum=this_rule.body_size_minimum,
+                    body_size_maximum=this_rule.body_size_maximum,
+                    sender_ip_whitelist=None if this_rule.sender_ip_whitelist is None else
+                    frozenset([IPNetwork(x) for x in this_rule.sender_ip_whitelist.cidrs]))
+            )
+            for this_rule in compiled_target.router_rules
+        ]),
+        destinations=compiled_target.destinations)
+
+
 class EmailRouterRulesDatastore:
     @property
     def datastore_name(self) -> str:
@@ -186,14 +258,14 @@ class EmailRouterRulesDatastore:
 
     @property
     def target_count(self) -> int:
-        return len(self._router_config_by_target)
+        return len(self._compiled_targets)
 
     # TODO: just use csv toolkit and return as csv with column headers
     @property
     def targets_info_as_list_with_header(self) -> List[List[str]]:
         return_data: List[List[str]] = list()
         return_data.append(['Priority', 'Target Name'])
-        for this_target in sorted(self._router_config_by_target):
+        for this_target in self._compiled_targets:
             return_data.append([str(this_target.target_priority), this_target.target_name])
         return return_data
 
@@ -201,7 +273,7 @@ class EmailRouterRulesDatastore:
     def targets_info_as_table(self) -> List[str]:
         return_data: List[str] = list()
         return_data.append('Priority' + '  ' + 'Target Name')
-        for this_target in sorted(self._router_config_by_target):
+        for this_target in self._compiled_targets:
             return_data.append('{:05.3f}'.format(this_target.target_priority) + '{:5s}'.format('') +
                                '{:20s}'.format(this_target.target_name))
         return return_data
@@ -213,9 +285,49 @@ class EmailRouterRulesDatastore:
                             type(value).__name__ + '" - this is a boolean')
         self._router_rules_datastore_initialized = value
 
+    # built on request from the compiled rules - use for introspection, not on the routing path
     @property
     def router_config_by_target(self) -> Set[EmailRouterTargetConfig]:
-        return self._router_config_by_target
+        return set([get_target_config_from_compiled(x) for x in self._compiled_targets])
+
+    # the whole evaluation plan, sorted by target priority - only datastores holding every rule in memory have it
+    @property
+    def compiled_targets(self) -> List[CompiledRouterTarget]:
+        return list(self._compiled_targets)
+
+    # the distinct recipient_name values of the rules (None for rules without one), for the recipient allowlist
+    def get_recipient_patterns(self) -> List[Optional[str]]:
+        return list(set(this_rule.recipient_name
+                        for this_target in self._compiled_targets
+                        for this_rule in this_target.router_rules))
+
+    # everything is in memory so every target is a candidate - other datastores may narrow this down
+    def get_candidate_compiled_targets(self,
+                                       sender_domain: str,
+                                       sender_ip: str) -> List[CompiledRouterTarget]:
+        return self._compiled_targets
+
+    def prune_rules(self, rules_to_prune: Collection[Tuple[str, float]]):
+        """
+        Drop rules, given as (target name, match priority), from the evaluation plan.  router_config_by_target
+        no longer lists them either
+        """
+        rules_to_prune = frozenset(rules_to_prune)
+        self._compiled_targets = [
+            self._rule_compiler.compile_target(
+                target_name=this_target.target_name,
+                target_priority=this_target.target_priority,
+                router_rules=[x for x in this_target.router_rules
+                              if (this_target.target_name, x.match_priority) not in rules_to_prune],
+                destinations=this_target.destinations)
+            for this_target in self._compiled_targets
+        ]
+
+    def reorder_predicates(self, predicate_statistics: EmailRouterPredicateStatistics):
+        for this_target in self._compiled_targets:
+            for this_rule in this_target.router_rules:
+                this_rule.predicates = order_predicates(this_rule.predicates,
+                                                        predicate_statistics=predicate_statistics)
 
     def __init__(self,
                  name: str,
@@ -229,9 +341,9 @@ class EmailRouterRulesDatastore:
 
         self._router_rules_datastore_initialized = False
 
-        # create the dictionary that will store rules by target name
-        #  its members will have collections of sortable (prioritized) router rules and destinations
-        self._router_config_by_target: Set[EmailRouterTargetConfig] = set()
+        # compiled targets kept sorted by target priority, each with its rules sorted by match priority
+        self._rule_compiler = EmailRouterRuleCompiler()
+        self._compiled_targets: List[CompiledRouterTarget] = list()
 
     def add_target_routing_config(self,
                                   target_config: EmailRouterTargetConfig):
@@ -242,15 +354,17 @@ class EmailRouterRulesDatastore:
 
         # parse step 2 - do not allow multiple target configs that are identical or have identical
         #  target name
-        if target_config in self._router_config_by_target:
-            # callers will have option of ignoring or letting this halt operation
-            raise EmeraldEmailRouterDuplicateTargetError(
-                'Duplicate target config entry (' + target_config.target_name +
-                ') found in source data - skipping this entry'
-            )
+        for this_target in self._compiled_targets:
+            if target_config.target_name == this_target.target_name and \
+                    target_config == get_target_config_from_compiled(this_target):
+                # callers will have option of ignoring or letting this halt operation
+                raise EmeraldEmailRouterDuplicateTargetError(
+                    'Duplicate target config entry (' + target_config.target_name +
+                    ') found in source data - skipping this entry'
+                )
 
         # parse step 3 - look for conflicting names (i.e. same name, different data) OR equal target priority
-        for this_target in self._router_config_by_target:
+        for this_target in self._compiled_targets:
             if target_config.target_name == this_target.target_name:
                 raise EmeraldEmailRouterDatabaseInitializationError(
                     'Conflicting entry found for target name "' + this_target.target_name + '" - aborting new add' +
@@ -262,8 +376,17 @@ class EmailRouterRulesDatastore:
                     os.linesep + 'Duplicate target priority - each must be unique for sorting'
                 )
 
-        # now add to the collection
-        self._router_config_by_target.add(target_config)
+        # now compile and add to the collection, keeping priority order
+        compiled_target = compile_target_config(target_config=target_config,
+                                                rule_compiler=self._rule_compiler)
+        insert_position = bisect_right([x.target_priority for x in self._compiled_targets],
+                                       compiled_target.target_priority)
+        self._compiled_targets.insert(insert_position, compiled_target)
+
+
+# lines of the activity log carried in a no match error - unroutable mail is common and the full log grows with
+#  the rule base (the bitset engine reports one line per rejected target)
+WALK_NO_MATCH_LOG_LINE_COUNT = 64
 
 
 class EmailRouter:
@@ -279,6 +402,7 @@ class EmailRouter:
     def router_db_initialized(self) -> bool:
         return self._router_db_initialized
 
+    # either an EmailRouterRulesDatastore or (for SQLITE sources) an EmailRouterSqliteRulesDatastore
     @property
     def router_rules_datastore(self) -> Optional[EmailRouterRulesDatastore]:
         return self._router_rules_datastore
@@ -291,16 +415,92 @@ class EmailRouter:
     def router_db_source_identifier(self) -> EmailRouterSourceConfig:
         return self._router_db_source_identifier
 
+    @property
+    def routing_policy(self) -> EmailRouterRoutingPolicy:
+        return self._routing_policy
+
+    # the engine actually in use - BITSET falls back to WALK for datastores that do not hold the rules in memory
+    @property
+    def match_engine(self) -> EmailRouterMatchEngine:
+        return EmailRouterMatchEngine.BITSET if self._bitset_index is not None else EmailRouterMatchEngine.WALK
+
+    # findings of the last rule analysis (empty unless created with analyze_rules or prune_dead_rules)
+    @property
+    def rule_findings(self) -> list:
+        return self._rule_findings
+
+    # None unless the router was created with adaptive_predicate_order
+    @property
+    def predicate_statistics(self) -> Optional[EmailRouterPredicateStatistics]:
+        return self._predicate_statistics
+
+    # rebuilt with every (re)load of the rules, and when a shared memory datastore moves to a new generation
+    @property
+    def recipient_allowlist(self) -> Optional[EmailRouterRecipientAllowlist]:
+        return self._recipient_allowlist
+
+    # None unless the router was created with a shadow_source_identifier
+    @property
+    def shadow_evaluator(self):
+        return self._shadow_evaluator
+
+    @property
+    def flight_recorder(self) -> Optional[EmailRouterFlightRecorder]:
+        return self._flight_recorder
+
+    # None unless the router was created with match_cache_capacity and the rules are held in memory
+    @property
+    def match_cache(self) -> Optional[EmailRouterMatchCache]:
+        return self._match_cache if self._match_cache_state is not None else None
+
     @classmethod
     def get_supported_router_db_source_types(cls):
         return frozenset([
-            EmailRouterDatastoreSourceType.JSONFILE
+            EmailRouterDatastoreSourceType.JSONFILE,
+            EmailRouterDatastoreSourceType.SQLITE,
+            EmailRouterDatastoreSourceType.SHARED_MEMORY
         ])
 
     def __init__(self,
                  router_db_source_identifier: EmailRouterSourceConfig,
                  router_instance_type: RouterInstanceType,
-                 debug: bool = False):
+                 debug: bool = False,
+                 routing_policy: EmailRouterRoutingPolicy = EmailRouterRoutingPolicy.ALL_MATCHES,
+                 match_engine: EmailRouterMatchEngine = EmailRouterMatchEngine.WALK,
+                 adaptive_predicate_order: bool = False,
+                 predicate_reorder_interval: int = 10000,
+                 analyze_rules: bool = False,
+                 prune_dead_rules: bool = False,
+                 log_handler: Optional[logging.Handler] = None,
+                 shadow_source_identifier: Optional[EmailRouterSourceConfig] = None,
+                 shadow_sample_rate: float = 0.01,
+                 shadow_max_evaluations_per_second: float = 100.0,
+                 flight_recorder_capacity: int = 0,
+                 match_cache_capacity: int = 0,
+                 logger_name: Optional[str] = None):
+        """
+        match_engine BITSET evaluates each kind of rule check once per email over all rules (see
+        email_router_bitset_index) instead of walking the rules - same results, for rule bases held in memory.
+
+        With adaptive_predicate_order the router counts how often each kind of rule check rejects an email and
+        every predicate_reorder_interval matches re-orders rule checks to reject as early as possible.
+
+        With analyze_rules the loaded rules are checked for rules that can never change a result (see
+        email_router_rule_analyzer) and findings are logged; prune_dead_rules also drops those rules from the
+        evaluation plan.
+
+        log_handler replaces the default console handler (e.g. with a queue handler so logging does not block)
+
+        With shadow_source_identifier a second (candidate) rule base is loaded and shadow_sample_rate of the
+        live matches are evaluated against it in the background (see email_router_shadow) to report where it
+        would route differently.  The live results never depend on the candidate.
+
+        With flight_recorder_capacity the last that many routing decisions are kept (see
+        email_router_flight_recorder) to answer "why did this email route (or not)?"
+
+        With match_cache_capacity the targets matched for that many recent envelopes are cached (see
+        email_router_match_cache) - for rule bases held in memory.  Cache hits record no target rejections.
+        """
 
         if not isinstance(router_db_source_identifier, EmailRouterSourceConfig):
             raise ValueError('Cannot initialize ' + type(self).__name__ + ': ' +
@@ -331,23 +531,95 @@ class EmailRouter:
 
         self._debug = debug
 
-        self._logger = logging.getLogger(type(self).__name__)
+        if not isinstance(routing_policy, EmailRouterRoutingPolicy):
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': ' +
+                             'routing_policy must be of type ' +
+                             EmailRouterRoutingPolicy.__name__ + os.linesep +
+                             'Value provided had type "' + str(type(routing_policy)))
+        self._routing_policy = routing_policy
+
+        if not isinstance(match_engine, EmailRouterMatchEngine):
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': ' +
+                             'match_engine must be of type ' +
+                             EmailRouterMatchEngine.__name__ + os.linesep +
+                             'Value provided had type "' + str(type(match_engine)))
+        self._requested_match_engine = match_engine
+        self._bitset_index: Optional[EmailRouterBitsetIndex] = None
+
+        if predicate_reorder_interval < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': ' +
+                             'predicate_reorder_interval must be at least 1 (value = ' +
+                             str(predicate_reorder_interval) + ')')
+        self._predicate_statistics = EmailRouterPredicateStatistics() if adaptive_predicate_order else None
+        self._predicate_reorder_interval = predicate_reorder_interval
+        self._matches_since_predicate_reorder = 0
+
+        self._analyze_rules = analyze_rules
+        self._prune_dead_rules = prune_dead_rules
+        self._rule_findings = list()
+
+        # one logger (and handler) per instance type so several routers can share a process
+        self._logger = logging.getLogger(logger_name if logger_name is not None else
+                                         type(self).__name__ + '.' + router_instance_type.name.lower())
         self.logger.setLevel(logging.DEBUG if self.debug else logging.INFO)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG if self.debug else logging.INFO)
+        if log_handler is not None:
+            if log_handler not in self.logger.handlers:
+                self.logger.addHandler(log_handler)
+            self.logger.propagate = False
+        else:
+            ch = logging.StreamHandler()
+            ch.setLevel(logging.DEBUG if self.debug else logging.INFO)
 
-        formatter = logging.Formatter('%(asctime)s|%(levelname)s|%(message)s',
-                                      datefmt='%Y-%d-%mT%H:%M:%S')
-        ch.setFormatter(formatter)
+            formatter = logging.Formatter('%(asctime)s|%(levelname)s|%(message)s',
+                                          datefmt='%Y-%d-%mT%H:%M:%S')
+            ch.setFormatter(formatter)
 
-        self.logger.addHandler(ch)
+            self.logger.addHandler(ch)
 
         # now match the source type and initialize as needed
         self._router_db_initialized = False
         self._router_rules_datastore = None
-
+        self._recipient_allowlist = None
+        # the datastore generation the allowlist was built from (None for datastores that do not change)
+        self._recipient_allowlist_generation = None
+        self._recipient_allowlist_lock = threading.Lock()
+        self._shadow_evaluator = None
+        self._flight_recorder = EmailRouterFlightRecorder(capacity=flight_recorder_capacity) \
+            if flight_recorder_capacity > 0 else None
+        # (rules datastore, bitset index, batch ip classifier) for match_inbound_email_batch, built on first use
+        self._batch_match_lock = threading.Lock()
+        self._batch_match_index = None
+        self._match_cache = EmailRouterMatchCache(capacity=match_cache_capacity) if match_cache_capacity > 0 else None
+        # (rules datastore, keyed on attachment, keyed on body size) - replaced as a whole, so a match never
+        #  builds its key for one rule base and caches the result for another
+        self._match_cache_state: Optional[Tuple[object, bool, bool]] = None
+
+        self._initialize_from_source()
+
+        if shadow_source_identifier is not None:
+            # imported here as the evaluator is only needed in shadow mode
+            from email_router.email_router_shadow import EmailRouterShadowEvaluator
+
+            candidate_router = EmailRouter(router_db_source_identifier=shadow_source_identifier,
+                                           router_instance_type=router_instance_type,
+                                           debug=debug,
+                                           routing_policy=routing_policy,
+                                           log_handler=log_handler,
+                                           logger_name=type(self).__name__ + 'Shadow.' +
+                                           router_instance_type.name.lower())
+            self._shadow_evaluator = EmailRouterShadowEvaluator(
+                candidate_router=candidate_router,
+                sample_rate=shadow_sample_rate,
+                max_evaluations_per_second=shadow_max_evaluations_per_second,
+                logger=self.logger)
+
+    def _initialize_from_source(self):
         if self.router_db_source_identifier.source_type == EmailRouterDatastoreSourceType.JSONFILE:
             self._initialize_from_jsonfile()
+        elif self.router_db_source_identifier.source_type == EmailRouterDatastoreSourceType.SQLITE:
+            self._initialize_from_sqlite()
+        elif self.router_db_source_identifier.source_type == EmailRouterDatastoreSourceType.SHARED_MEMORY:
+            self._initialize_from_shared_memory()
         else:
             raise \
                 EmeraldEmailRouterDatabaseInitializationError('Unsupported router database source type "' +
@@ -356,6 +628,206 @@ class EmailRouter:
                                                               ','.join([x.name for x in type(
                                                                   self).get_supported_router_db_source_types()]))
 
+        if self._analyze_rules or self._prune_dead_rules:
+            self._analyze_router_rules()
+
+        with self._recipient_allowlist_lock:
+            self._build_recipient_allowlist()
+
+        if self._requested_match_engine == EmailRouterMatchEngine.BITSET:
+            self._build_bitset_index()
+
+        # a reloaded rule base starts from what has been learned so far
+        if self._predicate_statistics is not None:
+            self._router_rules_datastore.reorder_predicates(self._predicate_statistics)
+
+        if self._match_cache is not None:
+            self._reset_match_cache()
+
+    def _reset_match_cache(self):
+        # a datastore that looks rules up per email may change under us (a new shared memory generation)
+        if not hasattr(self._router_rules_datastore, 'compiled_targets'):
+            self._match_cache_state = None
+            self._match_cache.reset(None)
+            self.logger.warning('Router database source type ' + self.router_db_source_identifier.source_type.name +
+                                ' does not hold the rules in memory - not caching routing results')
+            return
+
+        # the optional fields are only part of the key if some rule tests them
+        predicate_types = set(z.predicate_type
+                              for x in self._router_rules_datastore.compiled_targets
+                              for y in x.router_rules
+                              for z in y.predicates)
+        self._match_cache.reset(self._router_rules_datastore)
+        self._match_cache_state = (self._router_rules_datastore,
+                                   EmailRouterPredicateType.ATTACHMENT_INCLUDED in predicate_types,
+                                   EmailRouterPredicateType.BODY_SIZE_MINIMUM in predicate_types or
+                                   EmailRouterPredicateType.BODY_SIZE_MAXIMUM in predicate_types)
+
+    def get_match_cache_snapshot(self, entry_count: int) -> Optional[EmailRouterMatchCacheSnapshot]:
+        """
+        The entry_count most hit routing cache entries, to warm the cache of the next process - None if there is
+        no routing cache
+        """
+        match_cache_state = self._match_cache_state
+        if match_cache_state is None:
+            return None
+        (_, keyed_on_attachment, keyed_on_body_size) = match_cache_state
+        return EmailRouterMatchCacheSnapshot(
+            keyed_on_attachment=keyed_on_attachment,
+            keyed_on_body_size=keyed_on_body_size,
+            entries=[EmailRouterMatchCacheEntry(key=match_cache_key,
+                                                target_names=tuple(x.matched_target_name for x in target_results),
+                                                hit_count=hit_count)
+                     for match_cache_key, target_results, hit_count in self._match_cache.get_hottest(entry_count)])
+
+    def warm_match_cache(self, match_cache_snapshot: EmailRouterMatchCacheSnapshot) -> Tuple[int, int]:
+        """
+        Match the keys of a snapshot against the current rules (as a batch) and cache the results.  Returns how
+        many entries were cached and how many of those now match other targets than when the snapshot was taken -
+        keys that no longer match are left out
+        """
+        match_cache_state = self._match_cache_state
+        if match_cache_state is None:
+            return 0, 0
+        (rules_datastore, keyed_on_attachment, keyed_on_body_size) = match_cache_state
+        if match_cache_snapshot.keyed_on_attachment != keyed_on_attachment or \
+                match_cache_snapshot.keyed_on_body_size != keyed_on_body_size:
+            self.logger.warning('Routing cache snapshot is keyed on other fields than the current rules test - ' +
+                                'not warming the routing cache')
+            return 0, 0
+
+        # hottest last, so they are the last to be evicted
+        snapshot_entries = list(reversed(match_cache_snapshot.entries))
+        batch_match_results = self.match_inbound_email_batch([
+            EmailRouterBatchEmail(address_to_collection=list(x.key.address_to_collection),
+                                  address_from=x.key.address_from,
+                                  sender_ip=x.key.sender_ip,
+                                  attachment_included=x.key.attachment_included,
+                                  body_size=x.key.body_size) for x in snapshot_entries])
+
+        cached_count = 0
+        changed_count = 0
+        for this_entry, this_batch_match_result in zip(snapshot_entries, batch_match_results):
+            if this_batch_match_result.error is not None:
+                continue
+            matched_target_results = tuple(this_batch_match_result.match_result_collection.matched_target_results)
+            if tuple(x.matched_target_name for x in matched_target_results) != this_entry.target_names:
+                changed_count += 1
+            self._match_cache.put(this_entry.key, matched_target_results,
+                                  rules_datastore=rules_datastore,
+                                  hit_count=this_entry.hit_count)
+            cached_count += 1
+        return cached_count, changed_count
+
+    def _build_bitset_index(self):
+        if not hasattr(self._router_rules_datastore, 'compiled_targets'):
+            self._bitset_index = None
+            self.logger.warning('Router database source type ' + self.router_db_source_identifier.source_type.name +
+                                ' does not hold the rules in memory - matching with the ' +
+                                EmailRouterMatchEngine.WALK.name + ' engine')
+            return
+        self._bitset_index = EmailRouterBitsetIndex(compiled_targets=self._router_rules_datastore.compiled_targets)
+        self.logger.info('Bitset match index built over ' + str(self._bitset_index.rule_count) + ' rule(s)')
+
+    def _get_batch_match_index(self) -> Tuple[Optional[EmailRouterBitsetIndex], Optional[object]]:
+        """
+        The bitset index and batch ip classifier for the current rules - (None, None) if the rules are not held
+        in memory, no classifier if numpy is not installed
+        """
+        rules_datastore = self._router_rules_datastore
+        with self._batch_match_lock:
+            if self._batch_match_index is not None and self._batch_match_index[0] is rules_datastore:
+                return self._batch_match_index[1], self._batch_match_index[2]
+
+            bitset_index = self._bitset_index
+            if bitset_index is None and hasattr(rules_datastore, 'compiled_targets'):
+                bitset_index = EmailRouterBitsetIndex(compiled_targets=rules_datastore.compiled_targets)
+            if bitset_index is None:
+                self.logger.warning('Router database source type ' +
+                                    self.router_db_source_identifier.source_type.name +
+                                    ' does not hold the rules in memory - matching batches one email at a time')
+                batch_ip_classifier = None
+            else:
+                try:
+                    # imported here as numpy is only needed for batches
+                    from email_router.email_router_batch_ip_classifier import EmailRouterBatchIpClassifier
+                    batch_ip_classifier = EmailRouterBatchIpClassifier(
+                        sender_ip_whitelists=[x.sender_ip_whitelist for x in bitset_index.rules])
+                except ImportError as iex:
+                    self.logger.warning('Batch sender ip classification is not available (' + str(iex) + ') - ' +
+                                        'checking sender ips one email at a time')
+                    batch_ip_classifier = None
+            self._batch_match_index = (rules_datastore, bitset_index, batch_ip_classifier)
+            return bitset_index, batch_ip_classifier
+
+    # caller must hold the recipient allowlist lock
+    def _build_recipient_allowlist(self):
+        rules_datastore = self._router_rules_datastore
+        # read the generation first - if another is published meanwhile the allowlist is just built again
+        self._recipient_allowlist_generation = rules_datastore.refresh() if hasattr(rules_datastore, 'refresh') \
+            else None
+        self._recipient_allowlist = EmailRouterRecipientAllowlist(
+            recipient_patterns=rules_datastore.get_recipient_patterns())
+        self.logger.info('Recipient allowlist: ' + self._recipient_allowlist.mode.name + ' with ' +
+                         str(self._recipient_allowlist.literal_name_count) + ' literal name(s) and ' +
+                         str(self._recipient_allowlist.residual_pattern_count) + ' other pattern(s)')
+
+    def _get_recipient_allowlist(self) -> EmailRouterRecipientAllowlist:
+        # a shared memory datastore moves to a newly published generation by itself - the allowlist follows it
+        rules_datastore = self._router_rules_datastore
+        if hasattr(rules_datastore, 'refresh') and rules_datastore.refresh() != self._recipient_allowlist_generation:
+            with self._recipient_allowlist_lock:
+                if rules_datastore.generation != self._recipient_allowlist_generation:
+                    self._build_recipient_allowlist()
+        return self._recipient_allowlist
+
+    def _analyze_router_rules(self):
+        # the analysis works on the whole rule base, which only the in memory datastore holds
+        if not hasattr(self._router_rules_datastore, 'prune_rules'):
+            self.logger.warning('Rule analysis needs the rules in memory - router database source type ' +
+                                self.router_db_source_identifier.source_type.name + ' is not analyzed ' +
+                                '(analyze the JSON source it was built from instead)')
+            return
+
+        # imported here as the analyzer builds on this module
+        from email_router.email_router_rule_analyzer import analyze_target_configs
+
+        self._rule_findings = analyze_target_configs(
+            target_configs=self._router_rules_datastore.router_config_by_target,
+            routing_policy=self.routing_policy)
+        for this_finding in self._rule_findings:
+            self.logger.warning('Rule analysis: ' + str(this_finding))
+
+        prunable_rules = [(x.target_name, x.match_priority) for x in self._rule_findings if x.prunable]
+        if not self._prune_dead_rules or len(prunable_rules) == 0:
+            return
+        self._router_rules_datastore.prune_rules(prunable_rules)
+        self.logger.warning('Pruned ' + str(len(prunable_rules)) + ' dead rule(s) from the evaluation plan')
+
+    def reload(self):
+        """
+        Re-read the router database from its source.  The current rules stay active if the new ones fail to load
+        """
+        previous_rules_datastore = self._router_rules_datastore
+        try:
+            self._initialize_from_source()
+        except Exception:
+            self._router_rules_datastore = previous_rules_datastore
+            raise
+
+        if previous_rules_datastore is not None and previous_rules_datastore is not self._router_rules_datastore \
+                and hasattr(previous_rules_datastore, 'close'):
+            previous_rules_datastore.close()
+
+        # the candidate may have changed too - a candidate that fails to load must not fail the live reload
+        if self._shadow_evaluator is not None:
+            try:
+                self._shadow_evaluator.candidate_router.reload()
+            except Exception as ex:
+                self.logger.warning('Shadow candidate reload failed - keeping the current candidate rules' +
+                                    os.linesep + 'Exception: ' + str(ex))
+
     def _initialize_from_jsonfile(self):
         # read the json file from the source identifier
         if type(self.router_db_source_identifier.source_uri) is not str or \
@@ -368,7 +840,9 @@ class EmailRouter:
                       encoding='utf-8',
                       mode='r') as json_config_source:
                 json_data = json.load(json_config_source)
-                print('JSON = ' + str(json_data))
+            # the whole rule base - only worth building the string when debugging
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('JSON = ' + str(json_data))
         except json.JSONDecodeError as jdex:
             error_string = 'Source JSON file "' + \
                            str(self.router_db_source_identifier.source_uri) + '" cannot be decoded' + \
@@ -507,15 +981,18 @@ class EmailRouter:
         #
         target_or_client_keys_found = []
         for this_target_or_client in json_data['router_rules']:
-            self.logger.info('Reading data for target / client = ' + str(this_target_or_client))
+            # per target and per rule logging is debug only, and guarded so that no strings are built otherwise
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('Reading data for target / client = ' + str(this_target_or_client))
 
             for tc_name, tc_router_rules in this_target_or_client.items():
                 target_or_client_keys_found.append(tc_name)
 
                 # now we have a valid instance set - time to parse the rules
                 #  If we fail here we will abort initialization
-                self.logger.info('Parsing data for target / client "' + tc_name + '"')
-                self.logger.info('Rules = ' + str(tc_router_rules))
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('Parsing data for target / client "' + tc_name + '"')
+                    self.logger.debug('Rules = ' + str(tc_router_rules))
 
                 #  now make sure required elements for instance data are there
                 required_elements = [
@@ -534,7 +1011,7 @@ class EmailRouter:
                         '" did not contain required element(s): ' +
                         ','.join([x for x in required_but_not_found])
                     )
-                self.logger.info('Required elements found - parsing rules')
+                self.logger.debug('Required elements found - parsing rules')
 
                 # target priority specifies which target is examined and handled first, since one inbound email
                 #  may be handled to multiple targets.  The priority CANNOT BE THE SAME for multiple entries
@@ -567,7 +1044,8 @@ class EmailRouter:
                 rules_for_target: List[EmailRouterRule] = list()
 
                 for rule_count, this_rule in enumerate(tc_router_rules['match_rules'], start=1):
-                    self.logger.info('Checking rule "' + str(this_rule) + '"')
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug('Checking rule "' + str(this_rule) + '"')
 
                     try:
                         rule_match_priority = float(this_rule['match_priority'])
@@ -577,6 +1055,7 @@ class EmailRouter:
                             str(rule_count) + ' - aborting')
 
                     # initialize our text based fields, noting we treat empty strings as nulls
+                    #  (attachment_included is a JSON boolean and the body sizes JSON integers - checked below)
                     sender_domain = this_rule['sender_domain'] \
                         if ('sender_domain' in this_rule and len(this_rule['sender_domain']) > 0) \
                         else None
@@ -587,13 +1066,13 @@ class EmailRouter:
                         if ('recipient_name' in this_rule and len(this_rule['recipient_name'])) \
                         else None
                     attachment_included = this_rule['attachment_included'] \
-                        if 'attachment_included' in this_rule and len(this_rule['attachment_included']) > 0 \
+                        if 'attachment_included' in this_rule and this_rule['attachment_included'] != '' \
                         else None
                     body_size_minimum = this_rule['body_size_minimum'] \
-                        if 'body_size_minimum' in this_rule and len(this_rule['body_size_minimum']) > 0 \
+                        if 'body_size_minimum' in this_rule and this_rule['body_size_minimum'] != '' \
                         else None
                     body_size_maximum = this_rule['body_size_maximum'] \
-                        if 'body_size_maximum' in this_rule and len(this_rule['body_size_maximum']) > 0 \
+                        if 'body_size_maximum' in this_rule and this_rule['body_size_maximum'] != '' \
                         else None
 
                     # initialize the ip whitelisting which will arrive as an (optional) comma separated list of CIDRs
@@ -606,8 +1085,9 @@ class EmailRouter:
                     if sender_ip_whitelist_csv is not None:
                         sender_ip_whitelist_set = set()
                         for this_ip_count, this_ip_entry in enumerate(sender_ip_whitelist_csv.split(','), start=1):
-                            self.logger.debug('Testing entry #' + str(this_ip_count) + ' IP whitelist - value = ' +
-                                              str(this_ip_entry))
+                            if self.logger.isEnabledFor(logging.DEBUG):
+                                self.logger.debug('Testing entry #' + str(this_ip_count) +
+                                                  ' IP whitelist - value = ' + str(this_ip_entry))
                             # now attempt to convert this entry into an IP network (i.e. CIDR)
                             try:
                                 this_entry_as_ip_network = IPNetwork(this_ip_entry)
@@ -709,8 +1189,8 @@ class EmailRouter:
 
                 # at this point we can trust our rules_for_target collection and will shortly add to configuration
                 #  first we need to validate the destination
-                self.logger.info('Validated rules collection (count=' + str(len(rules_for_target)) +
-                                 ') for target ' + tc_name)
+                self.logger.debug('Validated rules collection (count=' + str(len(rules_for_target)) +
+                                  ') for target ' + tc_name)
 
                 #
                 #  Next make sure the destination works - we only support a limited number of options
@@ -733,8 +1213,17 @@ class EmailRouter:
                 destination_uri = tc_router_rules['destination_uri'] \
                     if 'destination_uri' in tc_router_rules and len(tc_router_rules['destination_uri']) > 0 \
                     else None
+                if destination in (EmailRouterDestinationType.HTTP_POST,
+                                   EmailRouterDestinationType.HTTP_POST_BATCH) and \
+                        (destination_uri is None or
+                         not destination_uri.lower().startswith(('http://', 'https://'))):
+                    raise EmeraldEmailRouterDatabaseInitializationError(
+                        'Unable to initialize - destination for target config "' + tc_name + '" is ' +
+                        destination.name + ' but destination_uri is not an http(s) URL' +
+                        os.linesep + 'Value provided = ' + str(destination_uri)
+                    )
 
-                self.logger.info('Validated destination for target config + ' + tc_name)
+                self.logger.debug('Validated destination for target config + ' + tc_name)
 
                 target_config = EmailRouterTargetConfig(
                     target_name=tc_name,
@@ -747,14 +1236,15 @@ class EmailRouter:
                     ])
                 )
 
-                self.logger.debug('The target config = ' + os.linesep + str(target_config))
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('The target config = ' + os.linesep + str(target_config))
 
                 # now make a rules entry for the specified tc_name (target)
                 #  FIXME - noting that JSON only supports one destination per target config right now, but
                 #  rules database will support multiple ones.  Hard-coding sequence now
                 self.router_rules_datastore.add_target_routing_config(target_config)
 
-                self.logger.info('Completed initialization of rules configuration for target config ' + tc_name)
+                self.logger.debug('Completed initialization of rules configuration for target config ' + tc_name)
 
         # getting here means success
         self.logger.warning('Activating router rules configuration with target count ' +
@@ -764,332 +1254,312 @@ class EmailRouter:
 
         self._router_rules_datastore.router_rules_datastore_initialized = True
 
-    def match_inbound_email(self,
-                            email_container: EmailContainer):
-        if not self._router_rules_datastore.router_rules_datastore_initialized:
-            raise EmeraldEmailRouterConfigNotActiveError('Router match table is not active - current configuration ' +
-                                                         'entry count: ' +
-                                                         str(self._router_rules_datastore.target_count))
-        matched_info_log: List[str] = list()
-        # now sort the router match table by target first (based on target priority) and then on rules
-        #  the first match "wins"
-        matched_targets = list()
-        for this_target in sorted(self._router_rules_datastore.router_config_by_target):
-            matched_info_log.append('Evaluating match for target "' + this_target.target_name + '" at priority ' +
-                                    str(this_target.target_priority) + os.linesep)
-
-            # now iterate through the match rules.  We will take the first one we get
-            for this_rule in sorted(this_target.router_rules):
-                matched_info_log.append('Checking rule at priority ' + str(this_rule.match_priority))
-
-                #
-                # matching proceeds where all included parameters within a rule must match (i.e. AND)
-                #  the outer iteration through rules by match priority provides the "OR" for more complex cases
-                #
+    def _initialize_from_sqlite(self):
+        # imported here as the sqlite datastore builds on the types in this module
+        from email_router.email_router_sqlite_datastore import EmailRouterSqliteRulesDatastore
 
-                # split the from address into domain and name
-                try:
-                    (left, right) = email_container.email_envelope.address_from.split('@')
-                    message_sender_name: str = left
-                    message_sender_domain: str = right
-                except ValueError:
-                    raise EmeraldEmailRouterInputDataError('Input from_address invalid - should be in form ' +
-                                                           'name@domain' + os.linesep +
-                                                           'Value = ' + address_from)
-
-                # match 1 - recipient name
-                # scan the to list and see
-                if this_rule.match_pattern.recipient_name is not None:
-                    # caller will pass a collection of recipients - iterate through each and find a match
-                    for to_address_count, this_to_address in enumerate(
-                            email_container.email_envelope.address_to_collection,
-                            start=1):
-                        matched_info_log.append('Checking recipient #' + str(to_address_count) + ' (value ' +
-                                                str(this_to_address) + ')')
-
-                        try:
-                            (left, right) = this_to_address.split('@')
-                            this_to_address_name: str = left
-                            this_to_address_domain: str = right
-                        except ValueError:
-                            raise EmeraldEmailRouterInputDataError('Input recipient #' + str(to_address_count) +
-                                                                   'is invalid - should be in form ' +
-                                                                   'name@domain' + os.linesep +
-                                                                   'Value = ' + str(this_to_address))
-
-                        try:
-                            match_set = re.search(this_rule.match_pattern.recipient_name,
-                                                  this_to_address_name, re.IGNORECASE).group()
-                        except AttributeError:
-                            # means we did not get a result
-                            matched_info_log.append('Target "' + this_target.target_name +
-                                                    '" match failed on recipient #' + str(to_address_count) +
-                                                    ' check' +
-                                                    os.linesep + 'Recipient name  was "' + this_to_address_name + '"' +
-                                                    os.linesep + 'Match pattern was "' +
-                                                    this_rule.match_pattern.recipient_name + '"')
-                        else:
-                            matched_info_log.append('Target "' + this_target.target_name +
-                                                    '" passed recipient name check' + os.linesep +
-                                                    'Matched ' + str(match_set))
-                            # no need to check others
-                            break
-
-                # match 2 - sender domain
-                # when we find a match set this
-                if this_rule.match_pattern.sender_domain is not None:
-                    try:
-                        match_set = re.search(this_rule.match_pattern.sender_domain,
-                                              message_sender_domain, re.IGNORECASE).group()
-                    except AttributeError:
-                        # means we did not get a result
-                        matched_info_log.append('Target "' + this_target.target_name +
-                                                '" match failed on sender domain check' +
-                                                os.linesep + 'Sender domain  was "' + message_sender_domain + '"' +
-                                                os.linesep + 'Match pattern was "' +
-                                                this_rule.match_pattern.sender_domain + '"')
-                        break
-                    else:
-                        matched_info_log.append('Target "' + this_target.target_name + '" passed sender domain check' +
-                                                os.linesep +
-                                                'Matched ' + str(match_set))
-
-                # match 3 - sender name
-                if this_rule.match_pattern.sender_name is not None:
-                    try:
-                        match_set = re.search(this_rule.match_pattern.sender_name,
-                                              message_sender_name, re.IGNORECASE).group()
-                    except AttributeError:
-                        # means we did not get a result
-                        matched_info_log.append(
-                            'Target "' + this_target.target_name + '" match failed on sender domain check' +
-                            os.linesep + 'Sender name was "' + message_sender_name + '"' +
-                            os.linesep + 'Match pattern was "' + this_rule.match_pattern.sender_name + '"')
-                        break
-                    else:
-                        matched_info_log.append('Target "' + this_target.target_name + '" passed sender name check' +
-                                                os.linesep +
-                                                'Matched ' + str(match_set))
-
-                # match 4 - ip address whitelisting
-                if this_rule.match_pattern.sender_ip_whitelist is not None:
-                    try:
-                        sender_ip_as_address = IPAddress(email_container.email_container_metadata.email_sender_ip)
-                    except AddrFormatError:
-                        raise EmeraldEmailRouterInputDataError(
-                            'Input sender_ip invalid - cannot be converted to IP addr ' +
-                            'Value = ' + str(email_container.email_container_metadata.email_sender_ip))
-
-                    ip_matched = False
-                    for this_ip_network_count, this_ip_network in enumerate(this_rule.match_pattern.sender_ip_whitelist,
-                                                                            start=1):
-                        if sender_ip_as_address in this_ip_network:
-                            matched_info_log.append('Target "' + this_target.target_name +
-                                                    '" passed sender ip check against whitelist')
-                            ip_matched = True
-                            break
-                    if not ip_matched:
-                        matched_info_log.append('Target "' + this_target.target_name +
-                                                '" match failed on sender ip check (whitelist entry count: ' +
-                                                str(len(this_rule.match_pattern.sender_ip_whitelist)) + ') ' +
-                                                os.linesep + 'Sender ip was "' +
-                                                email_container.email_container_metadata.email_sender_ip + '"' +
-                                                os.linesep + 'Whitelist pattern was "' +
-                                                ','.join([str(x) for x in
-                                                          this_rule.match_pattern.sender_ip_whitelist]) + '"')
-                        break
-
-                # match 5 - attachment included
-                if this_rule.match_pattern.attachment_included is not None:
-                    if this_rule.match_pattern.attachment_included is True:
-                        if email_container.email_container_metadata.attachment_count == 0:
-                            matched_info_log.append('Target "' + this_target.target_name +
-                                                    '" match failed on attachment included check: ' +
-                                                    str(this_rule.match_pattern.attachment_included) + ') ' +
-                                                    os.linesep + 'Attachment count was "' +
-                                                    str(email_container.email_container_metadata.attachment_count))
-                            break
+        sqlite_rules_datastore = EmailRouterSqliteRulesDatastore(sqlite_path=self.router_db_source_identifier.source_uri)
+        if sqlite_rules_datastore.instance_type != self.router_instance_type:
+            sqlite_rules_datastore.close()
+            raise EmeraldEmailRouterDatabaseInitializationError(
+                'Specified SQLite datastore is for a different router instance type "' +
+                sqlite_rules_datastore.instance_type.name.lower() + '"' + os.linesep +
+                'Program specified this instance to be ' + self.router_instance_type.name.lower()
+            )
 
+        self._router_rules_datastore = sqlite_rules_datastore
+        self.logger.warning('Activating SQLite router rules configuration "' + sqlite_rules_datastore.sqlite_path +
+                            '" with target count ' + str(self._router_rules_datastore.target_count) +
+                            os.linesep + 'Target(s): ' + os.linesep + '\t' +
+                            (os.linesep + '\t').join(self._router_rules_datastore.targets_info_as_table))
 
-                if this_rule.match_pattern.body_size_minimum is not None:
-                    raise NotImplementedError('Code does not yet support parsing of body_size_minimum')
+        self._router_rules_datastore.router_rules_datastore_initialized = True
 
-                if this_rule.match_pattern.body_size_maximum is not None:
-                    raise NotImplementedError('Code does not yet support parsing of body_size_maximum')
+    def _initialize_from_shared_memory(self):
+        # imported here as the shared memory datastore builds on the types in this module
+        from email_router.email_router_shared_datastore import EmailRouterSharedRulesDatastore
 
-                # keep track of which ones have matched in order - use a list
-                matched_targets.append(this_target)
-                # do not break out of loop - try to match another
-
-        if len(matched_targets) == 0:
-            raise EmeraldEmailRouterMatchNotFoundError('Unable to find match for target email request' +
-                                                       os.linesep + 'Activity log: ' +
-                                                       os.linesep + os.linesep.join(matched_info_log))
+        shared_rules_datastore = \
+            EmailRouterSharedRulesDatastore(segment_name=self.router_db_source_identifier.source_uri)
+        if shared_rules_datastore.instance_type != self.router_instance_type:
+            shared_rules_datastore.close()
+            raise EmeraldEmailRouterDatabaseInitializationError(
+                'Specified shared memory datastore is for a different router instance type "' +
+                shared_rules_datastore.instance_type.name.lower() + '"' + os.linesep +
+                'Program specified this instance to be ' + self.router_instance_type.name.lower()
+            )
 
-        match_result_targets = list()
-        for this_target in matched_targets:
-            match_result_targets.append(
-                EmailRouterMatchResult(matched_target_name=this_target.target_name,
-                                       destinations=this_target.destinations))
+        self._router_rules_datastore = shared_rules_datastore
+        self.logger.warning('Activating shared memory router rules configuration "' +
+                            shared_rules_datastore.segment_name + '" (generation ' +
+                            str(shared_rules_datastore.generation) + ') with target count ' +
+                            str(self._router_rules_datastore.target_count) +
+                            os.linesep + 'Target(s): ' + os.linesep + '\t' +
+                            (os.linesep + '\t').join(self._router_rules_datastore.targets_info_as_table))
 
-        return EmailRouterMatchResultCollection(
-            matched_info_log=matched_info_log,
-            matched_target_results=match_result_targets)
+        self._router_rules_datastore.router_rules_datastore_initialized = True
 
     def match_inbound_email(self,
                             address_to_collection: Collection[str],
                             address_from: str,
-                            sender_ip: str) -> EmailRouterMatchResultCollection:
-
+                            sender_ip: str,
+                            attachment_included: Optional[bool] = None,
+                            body_size: Optional[int] = None) -> EmailRouterMatchResultCollection:
+        """
+        Find the targets for an inbound email.  attachment_included and body_size come from the inbound payload
+        (see email_router_inbound_payload) - when not provided, rules that test them do not match.
+        """
+        shadow_evaluator = self._shadow_evaluator
+        flight_recorder = self._flight_recorder
+        shadow_sampled = shadow_evaluator is not None and shadow_evaluator.should_sample()
+        if flight_recorder is None and not shadow_sampled:
+            return self._match_inbound_email_cached(address_to_collection=address_to_collection,
+                                                    address_from=address_from,
+                                                    sender_ip=sender_ip,
+                                                    attachment_included=attachment_included,
+                                                    body_size=body_size)
+
+        # recorded or sampled for the candidate - time the live match so the two can be compared
+        match_trace = EmailRouterMatchTrace(max_target_rejections=flight_recorder.max_target_rejections) \
+            if flight_recorder is not None else None
+        live_target_names = list()
+        match_not_found_error = None
+        start_time = time.perf_counter()
+        try:
+            match_result_collection = self._match_inbound_email_cached(address_to_collection=address_to_collection,
+                                                                       address_from=address_from,
+                                                                       sender_ip=sender_ip,
+                                                                       attachment_included=attachment_included,
+                                                                       body_size=body_size,
+                                                                       match_trace=match_trace)
+            live_target_names = [x.matched_target_name for x in match_result_collection.matched_target_results]
+            outcome = EmailRouterRoutingOutcome.MATCHED
+        except EmeraldEmailRouterMatchNotFoundError as mnfex:
+            match_result_collection = None
+            match_not_found_error = mnfex
+            outcome = EmailRouterRoutingOutcome.RECIPIENT_NOT_ALLOWED \
+                if match_trace is not None and match_trace.recipient_not_allowed \
+                else EmailRouterRoutingOutcome.NO_MATCH
+        except EmeraldEmailRouterInputDataError:
+            if flight_recorder is not None:
+                flight_recorder.record(address_to_collection=address_to_collection,
+                                       address_from=address_from,
+                                       sender_ip=sender_ip,
+                                       outcome=EmailRouterRoutingOutcome.INPUT_ERROR,
+                                       matched_target_names=list(),
+                                       target_rejections=match_trace.target_rejections,
+                                       match_seconds=time.perf_counter() - start_time)
+            raise
+        live_seconds = time.perf_counter() - start_time
+
+        if flight_recorder is not None:
+            flight_recorder.record(address_to_collection=address_to_collection,
+                                   address_from=address_from,
+                                   sender_ip=sender_ip,
+                                   outcome=outcome,
+                                   matched_target_names=live_target_names,
+                                   target_rejections=match_trace.target_rejections,
+                                   match_seconds=live_seconds)
+        if shadow_sampled:
+            shadow_evaluator.submit(address_to_collection=address_to_collection,
+                                    address_from=address_from,
+                                    sender_ip=sender_ip,
+                                    attachment_included=attachment_included,
+                                    body_size=body_size,
+                                    live_target_names=live_target_names,
+                                    live_seconds=live_seconds)
+        if match_not_found_error is not None:
+            raise match_not_found_error
+        return match_result_collection
+
+    def match_inbound_email_batch(self, batch_emails: Sequence[EmailRouterBatchEmail]) \
+            -> List[EmailRouterBatchMatchResult]:
+        """
+        Find the targets for many emails at once (offline re-routing, batched ingestion) - for each email the
+        same result as match_inbound_email, in order.  The sender ips of the whole batch are classified against
+        the whitelists of every rule in one pass (see email_router_batch_ip_classifier, needs numpy) and rules
+        held in memory are evaluated with the bitset engine whatever match_engine is.  Batch matches are not
+        recorded by the flight recorder nor sampled for the shadow candidate.
+        """
+        bitset_index, batch_ip_classifier = self._get_batch_match_index()
+        ip_classification = batch_ip_classifier.classify([x.sender_ip for x in batch_emails]) \
+            if batch_ip_classifier is not None else None
+
+        batch_match_results = list()
+        for email_index, this_email in enumerate(batch_emails):
+            try:
+                match_result_collection = self._match_inbound_email(
+                    address_to_collection=this_email.address_to_collection,
+                    address_from=this_email.address_from,
+                    sender_ip=this_email.sender_ip,
+                    attachment_included=this_email.attachment_included,
+                    body_size=this_email.body_size,
+                    bitset_index=bitset_index,
+                    sender_ip_pass_mask=ip_classification.get_rule_mask(email_index)
+                    if ip_classification is not None else None)
+                batch_match_results.append(EmailRouterBatchMatchResult(match_result_collection=match_result_collection,
+                                                                       error=None))
+            except (EmeraldEmailRouterMatchNotFoundError, EmeraldEmailRouterInputDataError) as ex:
+                # without the traceback - it would keep every failed email's frames alive until the batch is done
+                batch_match_results.append(EmailRouterBatchMatchResult(match_result_collection=None,
+                                                                       error=ex.with_traceback(None)))
+        return batch_match_results
+
+    def _match_inbound_email_cached(self,
+                                    address_to_collection: Collection[str],
+                                    address_from: str,
+                                    sender_ip: str,
+                                    attachment_included: Optional[bool],
+                                    body_size: Optional[int],
+                                    match_trace: Optional[EmailRouterMatchTrace] = None) \
+            -> EmailRouterMatchResultCollection:
+        match_cache_state = self._match_cache_state
+        if match_cache_state is None:
+            return self._match_inbound_email(address_to_collection=address_to_collection,
+                                             address_from=address_from,
+                                             sender_ip=sender_ip,
+                                             attachment_included=attachment_included,
+                                             body_size=body_size,
+                                             match_trace=match_trace)
+
+        (rules_datastore, keyed_on_attachment, keyed_on_body_size) = match_cache_state
+        match_cache_key = EmailRouterMatchCacheKey(address_to_collection=tuple(address_to_collection),
+                                                   address_from=address_from,
+                                                   sender_ip=sender_ip,
+                                                   attachment_included=attachment_included
+                                                   if keyed_on_attachment else None,
+                                                   body_size=body_size if keyed_on_body_size else None)
+        matched_target_results = self._match_cache.get(match_cache_key)
+        if matched_target_results is not None:
+            return EmailRouterMatchResultCollection(
+                matched_info_log=['Target "' + x.matched_target_name + '" matched (routing cache)'
+                                  for x in matched_target_results],
+                matched_target_results=list(matched_target_results))
+
+        match_result_collection = self._match_inbound_email(address_to_collection=address_to_collection,
+                                                            address_from=address_from,
+                                                            sender_ip=sender_ip,
+                                                            attachment_included=attachment_included,
+                                                            body_size=body_size,
+                                                            match_trace=match_trace)
+        self._match_cache.put(match_cache_key, tuple(match_result_collection.matched_target_results),
+                              rules_datastore=rules_datastore)
+        return match_result_collection
+
+    def _match_inbound_email(self,
+                             address_to_collection: Collection[str],
+                             address_from: str,
+                             sender_ip: str,
+                             attachment_included: Optional[bool],
+                             body_size: Optional[int],
+                             match_trace: Optional[EmailRouterMatchTrace] = None,
+                             bitset_index: Optional[EmailRouterBitsetIndex] = None,
+                             sender_ip_pass_mask: Optional[int] = None) \
+            -> EmailRouterMatchResultCollection:
         if not self._router_rules_datastore.router_rules_datastore_initialized:
             raise EmeraldEmailRouterConfigNotActiveError('Router match table is not active - current configuration ' +
                                                          'entry count: ' +
                                                          str(self._router_rules_datastore.target_count))
+        # mail to inboxes no rule can match (spam, typos) is turned away before walking the targets
+        if not self._get_recipient_allowlist().could_match(address_to_collection):
+            if match_trace is not None:
+                match_trace.recipient_not_allowed = True
+            raise EmeraldEmailRouterRecipientNotAllowedError('Unable to find match for target email request' +
+                                                             os.linesep + 'No rule can match recipient(s) ' +
+                                                             ','.join(address_to_collection))
+
+        # normalized values (split addresses, lower case, sender ip as an integer) are worked out once, on first use
+        match_input = EmailRouterMatchInput(address_to_collection=address_to_collection,
+                                            address_from=address_from,
+                                            sender_ip=sender_ip,
+                                            attachment_included=attachment_included,
+                                            body_size=body_size)
+
+        # a batch may use a bitset index even if the router walks
+        bitset_index = bitset_index if bitset_index is not None else self._bitset_index
+        if bitset_index is not None:
+            first_match_only = self.routing_policy == EmailRouterRoutingPolicy.FIRST_MATCH
+            bitset_match = bitset_index.match(
+                match_input=match_input,
+                first_match_only=first_match_only,
+                max_target_rejections=match_trace.max_target_rejections if match_trace is not None else 0,
+                max_no_match_target_rejections=WALK_NO_MATCH_LOG_LINE_COUNT,
+                sender_ip_pass_mask=sender_ip_pass_mask)
+            return self._get_bitset_match_result(bitset_match=bitset_match, match_trace=match_trace)
+
         matched_info_log: List[str] = list()
+        predicate_statistics = self._predicate_statistics
 
-        # now sort the router match table by target first (based on target priority) and then on rules
-        #  the first match "wins"
+        # now walk the router match table by target first (based on target priority) and then on rules
+        #  the first matching rule selects its target.  With FIRST_MATCH the first matching target "wins",
+        #  with ALL_MATCHES every matching target is returned.  The datastore may leave out rules that cannot
+        #  match this sender
         matched_targets = list()
-        for this_target in sorted(self._router_rules_datastore.router_config_by_target):
+        for this_target in self._router_rules_datastore.get_candidate_compiled_targets(
+                sender_domain=match_input.sender_domain,
+                sender_ip=sender_ip):
             matched_info_log.append('Evaluating match for target "' + this_target.target_name + '" at priority ' +
                                     str(this_target.target_priority) + os.linesep)
+            target_rejection = None
+            target_matched = False
 
-            # now iterate through the match rules.  We will take the first one we get
-            for this_rule in sorted(this_target.router_rules):
+            # now iterate through the match rules (already sorted by match priority)
+            for this_rule in this_target.router_rules:
                 matched_info_log.append('Checking rule at priority ' + str(this_rule.match_priority))
 
                 #
                 # matching proceeds where all included parameters within a rule must match (i.e. AND)
                 #  the outer iteration through rules by match priority provides the "OR" for more complex cases
+                #  so a failed check moves on to the next rule.  Predicates are ordered cheapest (or most
+                #  selective) first - the order never changes the result, only how soon a rule is rejected
                 #
-
-                # split the from address into domain and name
-                try:
-                    (left, right) = address_from.split('@')
-                    message_sender_name: str = left
-                    message_sender_domain: str = right
-                except ValueError:
-                    raise EmeraldEmailRouterInputDataError('Input from_address invalid - should be in form ' +
-                                                           'name@domain' + os.linesep +
-                                                           'Value = ' + address_from)
-
-                # match 1 - recipient name
-                # scan the to list and see
-                if this_rule.match_pattern.recipient_name is not None:
-                    # caller will pass a collection of recipients - iterate through each and find a match
-                    for to_address_count, this_to_address in enumerate(address_to_collection, start=1):
-                        matched_info_log.append('Checking recipient #' + str(to_address_count) + ' (value ' +
-                                                str(this_to_address) + ')')
-
-                        try:
-                            (left, right) = this_to_address.split('@')
-                            this_to_address_name: str = left
-                            this_to_address_domain: str = right
-                        except ValueError:
-                            raise EmeraldEmailRouterInputDataError('Input recipient #' + str(to_address_count) +
-                                                                   'is invalid - should be in form ' +
-                                                                   'name@domain' + os.linesep +
-                                                                   'Value = ' + str(this_to_address))
-
-                        try:
-                            match_set = re.search(this_rule.match_pattern.recipient_name,
-                                                  this_to_address_name, re.IGNORECASE).group()
-                        except AttributeError:
-                            # means we did not get a result
-                            matched_info_log.append('Target "' + this_target.target_name +
-                                                    '" match failed on recipient #' + str(to_address_count) +
-                                                    ' check' +
-                                                    os.linesep + 'Recipient name  was "' + this_to_address_name + '"' +
-                                                    os.linesep + 'Match pattern was "' +
-                                                    this_rule.match_pattern.recipient_name + '"')
-                        else:
-                            matched_info_log.append('Target "' + this_target.target_name +
-                                                    '" passed recipient name check' + os.linesep +
-                                                    'Matched ' + str(match_set))
-                            # no need to check others
-                            break
-
-                # match 2 - sender domain
-                # when we find a match set this
-                if this_rule.match_pattern.sender_domain is not None:
-                    try:
-                        match_set = re.search(this_rule.match_pattern.sender_domain,
-                                              message_sender_domain, re.IGNORECASE).group()
-                    except AttributeError:
-                        # means we did not get a result
-                        matched_info_log.append('Target "' + this_target.target_name +
-                                                '" match failed on sender domain check' +
-                                                os.linesep + 'Sender domain  was "' + message_sender_domain + '"' +
-                                                os.linesep + 'Match pattern was "' +
-                                                this_rule.match_pattern.sender_domain + '"')
-                        break
-                    else:
-                        matched_info_log.append('Target "' + this_target.target_name + '" passed sender domain check' +
-                                                os.linesep +
-                                                'Matched ' + str(match_set))
-
-                # match 3 - sender name
-                if this_rule.match_pattern.sender_name is not None:
-                    try:
-                        match_set = re.search(this_rule.match_pattern.sender_name,
-                                              message_sender_name, re.IGNORECASE).group()
-                    except AttributeError:
-                        # means we did not get a result
-                        matched_info_log.append(
-                            'Target "' + this_target.target_name + '" match failed on sender domain check' +
-                            os.linesep + 'Sender name was "' + message_sender_name + '"' +
-                            os.linesep + 'Match pattern was "' + this_rule.match_pattern.sender_name + '"')
+                rule_matched = True
+                for this_predicate in this_rule.predicates:
+                    predicate_passed = this_predicate.evaluate(match_input)
+                    if predicate_statistics is not None:
+                        predicate_statistics.record(this_predicate.predicate_type, rejected=not predicate_passed)
+                    if not predicate_passed:
+                        matched_info_log.append('Target "' + this_target.target_name + '" ' +
+                                                this_predicate.get_failure_message(match_input))
+                        if match_trace is not None and target_rejection is None:
+                            target_rejection = EmailRouterTargetRejection(target_name=this_target.target_name,
+                                                                          match_priority=this_rule.match_priority,
+                                                                          check_name=this_predicate.check_name)
+                        rule_matched = False
                         break
-                    else:
-                        matched_info_log.append('Target "' + this_target.target_name + '" passed sender name check' +
-                                                os.linesep +
-                                                'Matched ' + str(match_set))
+                    matched_info_log.append('Target "' + this_target.target_name + '" passed ' +
+                                            this_predicate.check_name + ' check')
+                if not rule_matched:
+                    continue
 
-                # match 4 - ip address whitelisting
-                if this_rule.match_pattern.sender_ip_whitelist is not None:
-                    try:
-                        sender_ip_as_address = IPAddress(sender_ip)
-                    except AddrFormatError:
-                        raise EmeraldEmailRouterInputDataError(
-                            'Input sender_ip invalid - cannot be converted to IP addr ' +
-                            'Value = ' + sender_ip)
-
-                    ip_matched = False
-                    for this_ip_network_count, this_ip_network in enumerate(this_rule.match_pattern.sender_ip_whitelist,
-                                                                            start=1):
-                        if sender_ip_as_address in this_ip_network:
-                            matched_info_log.append('Target "' + this_target.target_name +
-                                                    '" passed sender ip check against whitelist')
-                            ip_matched = True
-                            break
-                    if not ip_matched:
-                        matched_info_log.append('Target "' + this_target.target_name +
-                                                '" match failed on sender ip check (whitelist entry count: ' +
-                                                str(len(this_rule.match_pattern.sender_ip_whitelist)) + ') ' +
-                                                os.linesep + 'Sender ip was "' + sender_ip + '"' +
-                                                os.linesep + 'Whitelist pattern was "' +
-                                                ','.join([str(x) for x in
-                                                          this_rule.match_pattern.sender_ip_whitelist]) + '"')
-                        break
-
-                # match 5 - attachment included
-                if this_rule.match_pattern.attachment_included is not None:
-                    raise NotImplementedError('Code does not yet support parsing of attachment_included')
+                # keep track of which ones have matched in order - use a list
+                matched_targets.append(this_target)
+                target_matched = True
+                matched_info_log.append('Target "' + this_target.target_name + '" matched on rule at priority ' +
+                                        str(this_rule.match_priority))
+                # one matching rule is enough for this target
+                break
 
-                if this_rule.match_pattern.body_size_minimum is not None:
-                    raise NotImplementedError('Code does not yet support parsing of body_size_minimum')
+            if not target_matched and target_rejection is not None and \
+                    len(match_trace.target_rejections) < match_trace.max_target_rejections:
+                match_trace.target_rejections.append(target_rejection)
 
-                if this_rule.match_pattern.body_size_maximum is not None:
-                    raise NotImplementedError('Code does not yet support parsing of body_size_maximum')
+            if len(matched_targets) > 0 and self.routing_policy == EmailRouterRoutingPolicy.FIRST_MATCH:
+                break
 
-                # keep track of which ones have matched in order - use a list
-                matched_targets.append(this_target)
-                # do not break out of loop - try to match another
+        if predicate_statistics is not None:
+            self._matches_since_predicate_reorder += 1
+            if self._matches_since_predicate_reorder >= self._predicate_reorder_interval:
+                self._matches_since_predicate_reorder = 0
+                self._router_rules_datastore.reorder_predicates(predicate_statistics)
 
         if len(matched_targets) == 0:
+            no_match_log = matched_info_log[:WALK_NO_MATCH_LOG_LINE_COUNT]
+            if len(matched_info_log) > len(no_match_log):
+                no_match_log.append('... ' + str(len(matched_info_log) - len(no_match_log)) + ' more line(s)')
             raise EmeraldEmailRouterMatchNotFoundError('Unable to find match for target email request' +
                                                        os.linesep + 'Activity log: ' +
-                                                       os.linesep + os.linesep.join(matched_info_log))
+                                                       os.linesep + os.linesep.join(no_match_log))
 
         match_result_targets = list()
         for this_target in matched_targets:
@@ -1100,3 +1570,30 @@ class EmailRouter:
         return EmailRouterMatchResultCollection(
             matched_info_log=matched_info_log,
             matched_target_results=match_result_targets)
+
+    def _get_bitset_match_result(self,
+                                 bitset_match: EmailRouterBitsetMatch,
+                                 match_trace: Optional[EmailRouterMatchTrace]) -> EmailRouterMatchResultCollection:
+        # the bitset engine has no step by step log - report the first failed check per target instead
+        matched_info_log = ['Target "' + x.target_name + '" match failed on ' + x.check_name +
+                            ' check of rule at priority ' + str(x.match_priority)
+                            for x in bitset_match.target_rejections]
+        if match_trace is not None:
+            match_trace.target_rejections.extend(bitset_match.target_rejections[:match_trace.max_target_rejections])
+
+        if len(bitset_match.matched_rules) == 0:
+            raise EmeraldEmailRouterMatchNotFoundError('Unable to find match for target email request' +
+                                                       os.linesep + 'Activity log: ' +
+                                                       os.linesep +
+                                                       os.linesep.join(matched_info_log[:WALK_NO_MATCH_LOG_LINE_COUNT]))
+
+        for this_target, this_rule in bitset_match.matched_rules:
+            matched_info_log.append('Target "' + this_target.target_name + '" matched on rule at priority ' +
+                                    str(this_rule.match_priority))
+        return EmailRouterMatchResultCollection(
+            matched_info_log=matched_info_log,
+            matched_target_results=[
+                EmailRouterMatchResult(matched_target_name=this_target.target_name,
+                                       destinations=this_target.destinations)
+                for this_target, _ in bitset_match.matched_rules
+            ])
@@ -0,0 +1,384 @@
+import os
+import datetime
+import fcntl
+import json
+import logging
+import struct
+import threading
+import time
+import zlib
+
+from dateutil.parser import parse
+from enum import unique, Enum, auto
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from error import EmeraldEmailRouterDeadLetterError
+
+#
+# Dead letter store for inbound requests that cannot be routed (or delivered) - kept so they can be acknowledged
+#  (instead of failed, and retried by the sender over and over) and re-driven through the router once the rules or
+#  destinations change.
+#
+# A series of segment files in one directory, written as blocks:
+#
+#  block = header + zlib compressed records, header = crc32, record count, compressed length (little endian)
+#  record = info length, body length, info (json: instance type, content type, reason, detail, time), raw body
+#
+#  Dead letters arriving together share one block, one compression and one fsync (group commit) - append
+#  returns once its block is durable.  The crc covers the compressed records, so a torn write at the end of a
+#  segment is detected and dropped.
+#
+# Each store writes to a new segment of its own and holds an exclusive lock on it while open, so redrive (from
+#  another process, too) leaves the segments of running stores alone.
+#
+_DEAD_LETTER_BLOCK_HEADER = struct.Struct('<III')
+_DEAD_LETTER_RECORD_HEADER = struct.Struct('<II')
+_DEAD_LETTER_SEGMENT_PREFIX = 'deadletter_'
+_DEAD_LETTER_SEGMENT_SUFFIX = '.log'
+
+# the reason is the compact part - the detail (an error message) is only kept to this length
+DEAD_LETTER_DETAIL_MAX_LENGTH = 256
+
+
+@unique
+class EmailRouterDeadLetterReason(Enum):
+    # every target was tried and rejected the email
+    NO_MATCH = auto()
+    # no rule can match the recipient(s)
+    RECIPIENT_NOT_ALLOWED = auto()
+    # the envelope could not be evaluated (e.g. a missing recipient, a malformed sender ip)
+    INPUT_ERROR = auto()
+    # the request could not be read (a malformed payload, an email that does not parse)
+    UNPARSEABLE = auto()
+    # routed, but a destination rejected it or its delivery attempts ran out
+    UNDELIVERABLE = auto()
+
+    @staticmethod
+    def from_string(reason_name: str):
+        try:
+            return EmailRouterDeadLetterReason[reason_name.upper()]
+        except KeyError:
+            raise ValueError('Invalid dead letter reason "' + str(reason_name) + '"')
+
+
+class EmailRouterDeadLetter(NamedTuple):
+    router_instance_type_name: str
+    reason: EmailRouterDeadLetterReason
+    detail: str
+    content_type: Optional[str]
+    dead_lettered_datetime: datetime.datetime
+    body: bytes
+
+
+def _encode_dead_letter(dead_letter: EmailRouterDeadLetter) -> bytes:
+    dead_letter_info = json.dumps({
+        'instance_type': dead_letter.router_instance_type_name,
+        'content_type': dead_letter.content_type,
+        'reason': dead_letter.reason.name,
+        'detail': dead_letter.detail,
+        'dead_lettered': dead_letter.dead_lettered_datetime.isoformat()
+    }).encode('utf-8')
+    return _DEAD_LETTER_RECORD_HEADER.pack(len(dead_letter_info), len(dead_letter.body)) + \
+        dead_letter_info + dead_letter.body
+
+
+def _encode_block(dead_letters: List[EmailRouterDeadLetter], compression_level: int) -> bytes:
+    compressed_records = zlib.compress(b''.join(_encode_dead_letter(x) for x in dead_letters), compression_level)
+    return _DEAD_LETTER_BLOCK_HEADER.pack(zlib.crc32(compressed_records), len(dead_letters),
+                                          len(compressed_records)) + compressed_records
+
+
+def _decode_block(records: bytes) -> List[EmailRouterDeadLetter]:
+    dead_letters = list()
+    position = 0
+    while position < len(records):
+        (info_length, body_length) = _DEAD_LETTER_RECORD_HEADER.unpack_from(records, position)
+        info_start = position + _DEAD_LETTER_RECORD_HEADER.size
+        body_start = info_start + info_length
+        dead_letter_info = json.loads(records[info_start:body_start].decode('utf-8'))
+        dead_letters.append(EmailRouterDeadLetter(
+            router_instance_type_name=dead_letter_info['instance_type'],
+            reason=EmailRouterDeadLetterReason.from_string(dead_letter_info['reason']),
+            detail=dead_letter_info['detail'],
+            content_type=dead_letter_info['content_type'],
+            dead_lettered_datetime=parse(dead_letter_info['dead_lettered']),
+            body=records[body_start:body_start + body_length]))
+        position = body_start + body_length
+    return dead_letters
+
+
+def _read_segment(segment_file) -> Tuple[List[EmailRouterDeadLetter], int, int]:
+    """
+    Return the dead letters of a segment, the length of the valid part (anything after is a torn write) and
+    the segment length
+    """
+    segment_data = segment_file.read()
+    dead_letters = list()
+    position = 0
+    while position + _DEAD_LETTER_BLOCK_HEADER.size <= len(segment_data):
+        (crc, record_count, compressed_length) = _DEAD_LETTER_BLOCK_HEADER.unpack_from(segment_data, position)
+        block_start = position + _DEAD_LETTER_BLOCK_HEADER.size
+        block_end = block_start + compressed_length
+        if block_end > len(segment_data) or zlib.crc32(segment_data[block_start:block_end]) != crc:
+            break
+        block_dead_letters = _decode_block(zlib.decompress(segment_data[block_start:block_end]))
+        if len(block_dead_letters) != record_count:
+            break
+        dead_letters.extend(block_dead_letters)
+        position = block_end
+    return dead_letters, position, len(segment_data)
+
+
+class _PendingBlock:
+    __slots__ = ('dead_letters', 'written', 'error')
+
+    def __init__(self, dead_letters: List[EmailRouterDeadLetter]):
+        self.dead_letters = dead_letters
+        self.written = threading.Event()
+        self.error = None
+
+
+class EmailRouterDeadLetterStore:
+    """
+    Call open() once, then append the requests that cannot be routed.  redrive() passes the dead letters of
+    every segment not in use to a function that routes them again, keeps what it returns (still dead) and
+    deletes the segment.
+    """
+
+    @property
+    def dead_letter_directory(self) -> str:
+        return self._dead_letter_directory
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def __init__(self,
+                 dead_letter_directory: str,
+                 segment_max_bytes: int = 64 * 1024 * 1024,
+                 group_commit_window_seconds: float = 0.02,
+                 compression_level: int = 6):
+        if group_commit_window_seconds < 0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': group_commit_window_seconds must not ' +
+                             'be negative (value = ' + str(group_commit_window_seconds) + ')')
+        if not 0 <= compression_level <= 9:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': compression_level must be between 0 ' +
+                             'and 9 (value = ' + str(compression_level) + ')')
+
+        self._dead_letter_directory = dead_letter_directory
+        self._segment_max_bytes = segment_max_bytes
+        self._group_commit_window_seconds = group_commit_window_seconds
+        self._compression_level = compression_level
+        self._logger = logging.getLogger(type(self).__name__)
+
+        self._active_segment_number = 0
+        self._active_segment_file = None
+        self._active_segment_bytes = 0
+
+        self._pending_condition = threading.Condition()
+        self._pending_blocks: List[_PendingBlock] = list()
+        self._writer_thread: Optional[threading.Thread] = None
+        self._stop_requested = False
+
+        self._statistics_lock = threading.Lock()
+        self._counts_by_reason = {x: 0 for x in EmailRouterDeadLetterReason}
+        self._block_count = 0
+        self._body_bytes = 0
+        self._written_bytes = 0
+
+    def _get_segment_path(self, segment_number: int) -> str:
+        return os.path.join(self._dead_letter_directory,
+                            _DEAD_LETTER_SEGMENT_PREFIX + str(segment_number).zfill(20) + _DEAD_LETTER_SEGMENT_SUFFIX)
+
+    def _list_segment_numbers(self) -> List[int]:
+        segment_numbers = list()
+        for this_file_name in os.listdir(self._dead_letter_directory):
+            if this_file_name.startswith(_DEAD_LETTER_SEGMENT_PREFIX) and \
+                    this_file_name.endswith(_DEAD_LETTER_SEGMENT_SUFFIX):
+                try:
+                    segment_numbers.append(
+                        int(this_file_name[len(_DEAD_LETTER_SEGMENT_PREFIX):-len(_DEAD_LETTER_SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(segment_numbers)
+
+    def open(self):
+        try:
+            os.makedirs(self._dead_letter_directory, exist_ok=True)
+            self._open_active_segment()
+        except OSError as oex:
+            raise EmeraldEmailRouterDeadLetterError('Unable to open dead letter directory "' +
+                                                    self._dead_letter_directory + '"' +
+                                                    os.linesep + 'Exception detail: ' + str(oex))
+
+        self._writer_thread = threading.Thread(target=self._run_writer,
+                                               name=type(self).__name__ + '-writer',
+                                               daemon=True)
+        self._writer_thread.start()
+
+    def close(self):
+        with self._pending_condition:
+            self._stop_requested = True
+            self._pending_condition.notify_all()
+        if self._writer_thread is not None:
+            self._writer_thread.join()
+            self._writer_thread = None
+        if self._active_segment_file is not None:
+            self._close_active_segment()
+
+    def _open_active_segment(self):
+        # a new segment of our own - other stores (other processes) may be writing to theirs
+        while True:
+            segment_numbers = self._list_segment_numbers()
+            self._active_segment_number = max(segment_numbers[-1] if len(segment_numbers) > 0 else 0,
+                                              self._active_segment_number) + 1
+            try:
+                segment_file = open(self._get_segment_path(self._active_segment_number), 'xb')
+                break
+            except FileExistsError:
+                continue
+        fcntl.flock(segment_file.fileno(), fcntl.LOCK_EX)
+        self._active_segment_file = segment_file
+        self._active_segment_bytes = 0
+        # make the new file itself durable
+        directory_fd = os.open(self._dead_letter_directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def _close_active_segment(self):
+        segment_path = self._get_segment_path(self._active_segment_number)
+        if self._active_segment_bytes == 0:
+            # nothing was dead lettered - do not leave an empty segment behind for every run
+            os.remove(segment_path)
+        self._active_segment_file.close()
+        self._active_segment_file = None
+
+    def _run_writer(self):
+        while True:
+            with self._pending_condition:
+                while len(self._pending_blocks) == 0 and not self._stop_requested:
+                    self._pending_condition.wait()
+                if len(self._pending_blocks) == 0 and self._stop_requested:
+                    return
+
+            # group commit - give concurrent requests a moment to join this block
+            if self._group_commit_window_seconds > 0:
+                time.sleep(self._group_commit_window_seconds)
+
+            with self._pending_condition:
+                batch = self._pending_blocks
+                self._pending_blocks = list()
+
+            try:
+                self._write_block([y for x in batch for y in x.dead_letters])
+            except OSError as oex:
+                for this_pending_block in batch:
+                    this_pending_block.error = oex
+            for this_pending_block in batch:
+                this_pending_block.written.set()
+
+    def _write_block(self, dead_letters: List[EmailRouterDeadLetter]):
+        block_bytes = _encode_block(dead_letters, compression_level=self._compression_level)
+        if self._active_segment_bytes > 0 and \
+                self._active_segment_bytes + len(block_bytes) > self._segment_max_bytes:
+            self._active_segment_file.flush()
+            os.fsync(self._active_segment_file.fileno())
+            self._close_active_segment()
+            self._open_active_segment()
+
+        self._active_segment_file.write(block_bytes)
+        self._active_segment_file.flush()
+        os.fsync(self._active_segment_file.fileno())
+        self._active_segment_bytes += len(block_bytes)
+
+        with self._statistics_lock:
+            for this_dead_letter in dead_letters:
+                self._counts_by_reason[this_dead_letter.reason] += 1
+                self._body_bytes += len(this_dead_letter.body)
+            self._block_count += 1
+            self._written_bytes += len(block_bytes)
+
+    def append(self,
+               router_instance_type_name: str,
+               reason: EmailRouterDeadLetterReason,
+               detail: str,
+               content_type: Optional[str],
+               body: bytes):
+        """
+        Durably record a request that cannot be routed.  Blocks until the record is on disk
+        """
+        self.append_dead_letters([EmailRouterDeadLetter(router_instance_type_name=router_instance_type_name,
+                                                        reason=reason,
+                                                        detail=detail[:DEAD_LETTER_DETAIL_MAX_LENGTH],
+                                                        content_type=content_type,
+                                                        dead_lettered_datetime=datetime.datetime.now(
+                                                            datetime.timezone.utc),
+                                                        body=body)])
+
+    def append_dead_letters(self, dead_letters: List[EmailRouterDeadLetter]):
+        pending_block = _PendingBlock(dead_letters=dead_letters)
+        with self._pending_condition:
+            if self._stop_requested or self._writer_thread is None:
+                raise EmeraldEmailRouterDeadLetterError('Dead letter store "' + self._dead_letter_directory +
+                                                        '" is not open')
+            self._pending_blocks.append(pending_block)
+            self._pending_condition.notify_all()
+
+        pending_block.written.wait()
+        if pending_block.error is not None:
+            raise EmeraldEmailRouterDeadLetterError('Unable to write to dead letter store "' +
+                                                    self._dead_letter_directory + '"' +
+                                                    os.linesep + 'Exception detail: ' + str(pending_block.error))
+
+    def redrive(self, redrive_dead_letters: Callable[[List[EmailRouterDeadLetter]], List[EmailRouterDeadLetter]]) \
+            -> Tuple[int, int]:
+        """
+        Pass the dead letters of each segment not in use, oldest first, to redrive_dead_letters - it returns the
+        ones still dead, which are appended again before the segment is deleted.  Returns how many dead letters
+        were re-driven and how many of those are still dead
+        """
+        redriven_count = 0
+        still_dead_count = 0
+        for this_segment_number in self._list_segment_numbers():
+            if this_segment_number == self._active_segment_number:
+                continue
+            segment_path = self._get_segment_path(this_segment_number)
+            try:
+                segment_file = open(segment_path, 'rb')
+            except FileNotFoundError:
+                continue
+            with segment_file:
+                try:
+                    fcntl.flock(segment_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    self.logger.info('Dead letter segment ' + segment_path + ' is being written - skipping it')
+                    continue
+                if not os.path.exists(segment_path):
+                    # re-driven and deleted while we waited for it
+                    continue
+
+                (dead_letters, valid_length, segment_length) = _read_segment(segment_file)
+                if valid_length < segment_length:
+                    self.logger.warning('Dead letter segment ' + segment_path + ' has ' +
+                                        str(segment_length - valid_length) +
+                                        ' bytes of incomplete or corrupt records at the end - ignoring them')
+                still_dead_letters = redrive_dead_letters(dead_letters) if len(dead_letters) > 0 else list()
+                if len(still_dead_letters) > 0:
+                    self.append_dead_letters(still_dead_letters)
+                os.remove(segment_path)
+
+            redriven_count += len(dead_letters)
+            still_dead_count += len(still_dead_letters)
+        return redriven_count, still_dead_count
+
+    def get_statistics_as_dict(self) -> dict:
+        with self._statistics_lock:
+            return {
+                'dead_lettered_count': sum(self._counts_by_reason.values()),
+                'dead_lettered_count_by_reason': {x.name: y for x, y in self._counts_by_reason.items()},
+                'block_count': self._block_count,
+                'body_bytes': self._body_bytes,
+                'written_bytes': self._written_bytes
+            }
@@ -0,0 +1,148 @@
+import threading
+import time
+
+from collections import OrderedDict
+from enum import unique, Enum, auto
+from typing import Dict
+
+from email_router.email_router_bloom_filter import EmailRouterBloomFilter
+
+# seconds a retry of an email still being processed is asked to wait
+DEDUPE_IN_FLIGHT_RETRY_AFTER_SECONDS = 5
+
+
+@unique
+class EmailRouterDedupeStatus(Enum):
+    # not seen - now in flight, call complete() or remove() once processed
+    NEW = auto()
+    # the first copy is still being processed - its outcome is not known yet
+    IN_FLIGHT = auto()
+    # processed within the ttl
+    DUPLICATE = auto()
+
+
+class EmailRouterDedupeCache:
+    """
+    Remembers the dedupe keys (Message-ID or content hash) of recently accepted inbound emails so webhook
+    retries can be acknowledged without parsing or routing them again.
+
+    A key is in flight from check_and_add until the email is processed: complete() then remembers it, remove()
+    forgets it (processing failed, so a retry must be processed).  In flight keys are held for ttl_seconds at
+    most, in case their request never finishes.
+
+    Completed keys are held for ttl_seconds, and at most capacity keys are held (oldest dropped first).  Most
+    emails are new, so a Bloom filter answers "never seen" without touching the key table; a Bloom hit is
+    confirmed against the table.  Bloom filters cannot drop keys, so two are kept and rotated every
+    ttl_seconds - a key is in the current or previous filter for as long as it can be in the table.
+    """
+
+    @property
+    def ttl_seconds(self) -> float:
+        return self._ttl_seconds
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    def __init__(self,
+                 ttl_seconds: float,
+                 capacity: int = 100000,
+                 false_positive_rate: float = 0.01):
+        if ttl_seconds <= 0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': ttl_seconds must be positive ' +
+                             '(value = ' + str(ttl_seconds) + ')')
+        if capacity < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': capacity must be at least 1 ' +
+                             '(value = ' + str(capacity) + ')')
+
+        self._ttl_seconds = ttl_seconds
+        self._capacity = capacity
+        self._lock = threading.Lock()
+
+        # key -> expiry time, oldest first
+        self._expiry_by_key: Dict[str, float] = OrderedDict()
+        self._in_flight_expiry_by_key: Dict[str, float] = OrderedDict()
+        self._current_filter = EmailRouterBloomFilter(capacity=capacity, false_positive_rate=false_positive_rate)
+        self._previous_filter = EmailRouterBloomFilter(capacity=capacity, false_positive_rate=false_positive_rate)
+        self._filter_rotation_time = time.monotonic() + ttl_seconds
+
+        self._checked_count = 0
+        self._duplicate_count = 0
+        self._in_flight_count = 0
+        self._filter_negative_count = 0
+        self._evicted_count = 0
+
+    def _expire(self, now: float):
+        if now >= self._filter_rotation_time:
+            self._previous_filter, self._current_filter = self._current_filter, self._previous_filter
+            self._current_filter.clear()
+            self._filter_rotation_time = now + self._ttl_seconds
+
+        while len(self._expiry_by_key) > 0:
+            oldest_key, oldest_expiry = next(iter(self._expiry_by_key.items()))
+            if oldest_expiry > now:
+                break
+            del self._expiry_by_key[oldest_key]
+
+        while len(self._in_flight_expiry_by_key) > 0:
+            oldest_key, oldest_expiry = next(iter(self._in_flight_expiry_by_key.items()))
+            if oldest_expiry > now:
+                break
+            del self._in_flight_expiry_by_key[oldest_key]
+
+    def check_and_add(self, dedupe_key: str) -> EmailRouterDedupeStatus:
+        """
+        DUPLICATE if the key was processed within the ttl, IN_FLIGHT if it is being processed.  Otherwise the
+        key is now in flight and NEW is returned
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._checked_count += 1
+
+            if dedupe_key in self._in_flight_expiry_by_key:
+                self._in_flight_count += 1
+                return EmailRouterDedupeStatus.IN_FLIGHT
+            if dedupe_key not in self._current_filter and dedupe_key not in self._previous_filter:
+                self._filter_negative_count += 1
+            elif dedupe_key in self._expiry_by_key:
+                self._duplicate_count += 1
+                return EmailRouterDedupeStatus.DUPLICATE
+
+            self._in_flight_expiry_by_key[dedupe_key] = now + self._ttl_seconds
+            return EmailRouterDedupeStatus.NEW
+
+    def complete(self, dedupe_key: str):
+        """
+        Remember a key in flight as processed - retries within the ttl are duplicates from now on
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._in_flight_expiry_by_key.pop(dedupe_key, None)
+            self._expiry_by_key.pop(dedupe_key, None)
+            self._expiry_by_key[dedupe_key] = now + self._ttl_seconds
+            self._current_filter.add(dedupe_key)
+            if len(self._expiry_by_key) > self._capacity:
+                self._expiry_by_key.popitem(last=False)
+                self._evicted_count += 1
+
+    def remove(self, dedupe_key: str):
+        """
+        Forget a key - use when the email was not processed, so a retry is not treated as a duplicate
+        """
+        with self._lock:
+            self._in_flight_expiry_by_key.pop(dedupe_key, None)
+            self._expiry_by_key.pop(dedupe_key, None)
+
+    def get_statistics_as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'checked_count': self._checked_count,
+                'duplicate_count': self._duplicate_count,
+                'duplicate_hit_rate': self._duplicate_count / self._checked_count if self._checked_count > 0 else 0.0,
+                'in_flight_retry_count': self._in_flight_count,
+                'in_flight_key_count': len(self._in_flight_expiry_by_key),
+                'filter_negative_count': self._filter_negative_count,
+                'evicted_count': self._evicted_count,
+                'key_count': len(self._expiry_by_key)
+            }
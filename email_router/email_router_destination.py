@@ -6,6 +6,10 @@ from typing import NamedTuple, Optional
 @unique
 class EmailRouterDestinationType(Enum):
     DIRECT_PROCESSING = auto()
+    # the inbound POST is passed on as received to destination_uri (http or https - see email_router_dispatcher)
+    HTTP_POST = auto()
+    # as HTTP_POST, but sent together with other routed emails in one NDJSON POST (see email_router_dispatcher)
+    HTTP_POST_BATCH = auto()
 
 
 class EmailRouterDestinationConfig(NamedTuple):
@@ -22,8 +26,9 @@ class EmailRouterDestinationConfig(NamedTuple):
             ]
         )
 
+    # hash on values (not str) so equal configs with an int vs float sequence hash the same
     def __hash__(self):
-        return hash(str(self))
+        return hash((self.destination_type, float(self.destination_sequence), self.destination_uri))
 
     def __eq__(self, other):
         if not isinstance(other, EmailRouterDestinationConfig):
@@ -36,7 +41,7 @@ class EmailRouterDestinationConfig(NamedTuple):
         )
 
     def __ne__(self, other):
-        return not (__eq__(self, other))
+        return not self.__eq__(other)
 
     def __lt__(self, other):
         if not isinstance(other, EmailRouterDestinationConfig):
@@ -79,7 +84,7 @@ class EmailRouterDestinationConfig(NamedTuple):
         return False
 
     def __ge__(self, other):
-        return not (__lt__(self, other))
+        return not self.__lt__(other)
 
     def __le__(self, other):
-        return not (__gt__(self, other))
\ No newline at end of file
+        return not self.__gt__(other)
\ No newline at end of file
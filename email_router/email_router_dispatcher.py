@@ -0,0 +1,696 @@
+import base64
+import heapq
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+from collections import deque
+from enum import unique, Enum, auto
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+#
+# Delivery of routed emails to HTTP_POST destinations.  A shared pool of worker threads takes deliveries from
+#  per destination queues, round robin, so a slow destination holds at most its own concurrency limit of workers:
+#
+#  - the limit adapts per destination (AIMD): +1 per limit successful deliveries, halved (at most once per
+#    baseline latency) on a failure or a delivery taking more than latency_tolerance times the baseline latency
+#  - a circuit breaker per destination opens after failure_threshold consecutive failures.  While it is open,
+#    deliveries go straight to the retry queue without being tried; after open_seconds one trial delivery is let
+#    through (half open), which closes the breaker again or re-opens it
+#  - failed deliveries wait in one bounded retry queue with exponential backoff, up to max_attempts attempts
+#
+# Deliveries are held in memory only - the inbound request has been acknowledged by the time they are queued.
+#  A submitter keeping its own durable copy of the email until it is delivered passes on_complete, called once
+#  (on a worker thread, outside the dispatcher's lock) with True when delivered and False when given up on -
+#  rejected, out of attempts or dropped from a full retry queue.  It is not called for deliveries still queued at
+#  stop().
+#
+# Batched deliveries (HTTP_POST_BATCH destinations) are held back until batch_max_count of them or
+#  batch_max_bytes of email are pending or the oldest has waited batch_linger_seconds, then sent as one POST of
+#  application/x-ndjson, one JSON object per email:
+#
+#   {"id": <delivery id>, "instance_type": ..., "target": ..., "attempt": ..., "content_type": ..., "body": <base64>}
+#
+#  The destination acknowledges each email with an NDJSON line {"id": <delivery id>, "status": <HTTP status>}
+#  in its (2xx) response and each email is then handled as if it had been POSTed on its own - 2xx delivered, 429
+#  and 5xx retried, others rejected.  An email the response does not mention is retried; a response without any
+#  acknowledgement (empty, or e.g. "OK") accepts the whole batch.  The delivery id stays the same across retries,
+#  for the destination to dedupe on.
+#
+
+
+@unique
+class EmailRouterCircuitState(Enum):
+    CLOSED = auto()
+    # failing - deliveries are not tried until open_seconds have passed
+    OPEN = auto()
+    # one trial delivery decides whether to close or re-open
+    HALF_OPEN = auto()
+
+
+class EmailRouterConcurrencyLimiter:
+    """
+    Adaptive (AIMD) limit on the deliveries in flight to one destination.  Not thread safe - the dispatcher
+    calls it under its lock
+    """
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight_count(self) -> int:
+        return self._in_flight_count
+
+    @property
+    def baseline_latency_seconds(self) -> Optional[float]:
+        return self._baseline_latency_seconds
+
+    def __init__(self,
+                 initial_limit: int = 4,
+                 min_limit: int = 1,
+                 max_limit: int = 64,
+                 latency_tolerance: float = 2.0,
+                 backoff_ratio: float = 0.5,
+                 baseline_smoothing: float = 0.05):
+        if min_limit < 1 or max_limit < min_limit:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': limits must satisfy 1 <= min_limit ' +
+                             '<= max_limit (values = ' + str(min_limit) + ', ' + str(max_limit) + ')')
+        if not 0 < backoff_ratio < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': backoff_ratio must be between 0 and ' +
+                             '1 (value = ' + str(backoff_ratio) + ')')
+
+        self._limit = float(min(max_limit, max(min_limit, initial_limit)))
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._latency_tolerance = latency_tolerance
+        self._backoff_ratio = backoff_ratio
+        self._baseline_smoothing = baseline_smoothing
+        self._baseline_latency_seconds = None
+        self._in_flight_count = 0
+        self._last_decrease_time = 0.0
+
+    def try_acquire(self) -> bool:
+        if self._in_flight_count >= int(self._limit):
+            return False
+        self._in_flight_count += 1
+        return True
+
+    def release(self,
+                latency_seconds: float,
+                congested: bool):
+        """
+        congested: the delivery failed in a way that suggests the destination is overloaded (e.g. a timeout, 503)
+        """
+        self._in_flight_count -= 1
+        now = time.monotonic()
+        if self._baseline_latency_seconds is None:
+            self._baseline_latency_seconds = latency_seconds
+
+        if congested or latency_seconds > self._baseline_latency_seconds * self._latency_tolerance:
+            # deliveries in flight together fail together - count that as one signal
+            if now - self._last_decrease_time >= self._baseline_latency_seconds:
+                self._limit = max(float(self._min_limit), self._limit * self._backoff_ratio)
+                self._last_decrease_time = now
+        else:
+            self._limit = min(float(self._max_limit), self._limit + 1.0 / self._limit)
+
+        if not congested:
+            self._baseline_latency_seconds += \
+                (latency_seconds - self._baseline_latency_seconds) * self._baseline_smoothing
+
+
+class EmailRouterCircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures.  Not thread safe - the dispatcher calls it under its lock
+    """
+
+    @property
+    def state(self) -> EmailRouterCircuitState:
+        return self._state
+
+    @property
+    def consecutive_failure_count(self) -> int:
+        return self._consecutive_failure_count
+
+    @property
+    def open_until(self) -> float:
+        """
+        time.monotonic() value at which an open breaker lets a trial delivery through
+        """
+        return self._open_until
+
+    @property
+    def opened_count(self) -> int:
+        return self._opened_count
+
+    def __init__(self,
+                 failure_threshold: int = 5,
+                 open_seconds: float = 30.0):
+        if failure_threshold < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': failure_threshold must be at least 1 ' +
+                             '(value = ' + str(failure_threshold) + ')')
+        self._failure_threshold = failure_threshold
+        self._open_seconds = open_seconds
+        self._state = EmailRouterCircuitState.CLOSED
+        self._consecutive_failure_count = 0
+        self._open_until = 0.0
+        self._trial_in_flight = False
+        self._opened_count = 0
+
+    def allow_request(self, now: float) -> bool:
+        """
+        True if a delivery may be tried now - in the half open state only one (the trial) is allowed
+        """
+        if self._state == EmailRouterCircuitState.OPEN:
+            if now < self._open_until:
+                return False
+            self._state = EmailRouterCircuitState.HALF_OPEN
+            self._trial_in_flight = False
+        if self._state == EmailRouterCircuitState.HALF_OPEN:
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+        return True
+
+    def record_success(self):
+        self._state = EmailRouterCircuitState.CLOSED
+        self._consecutive_failure_count = 0
+        self._trial_in_flight = False
+
+    def record_failure(self, now: float):
+        self._consecutive_failure_count += 1
+        if self._state == EmailRouterCircuitState.HALF_OPEN or \
+                self._consecutive_failure_count >= self._failure_threshold:
+            if self._state != EmailRouterCircuitState.OPEN:
+                self._opened_count += 1
+            self._state = EmailRouterCircuitState.OPEN
+            self._open_until = now + self._open_seconds
+            self._trial_in_flight = False
+
+
+class EmailRouterDelivery(NamedTuple):
+    delivery_id: str
+    destination_uri: str
+    router_instance_type_name: str
+    target_name: str
+    # the inbound POST as received
+    content_type: Optional[str]
+    body: bytes
+    # sent in an NDJSON batch with other emails for the destination
+    batched: bool = False
+    attempt_count: int = 0
+    # time.monotonic() value when the delivery was last queued
+    queued_time: float = 0.0
+    # called with True once delivered, False once given up on
+    on_complete: Optional[Callable[[bool], None]] = None
+
+
+# (succeeded, retryable, failure detail)
+_DeliveryResult = Tuple[bool, bool, Optional[str]]
+
+
+class _DestinationState:
+    __slots__ = ('concurrency_limiter', 'circuit_breaker', 'pending_deliveries', 'pending_byte_count',
+                 'delivered_count', 'failed_count', 'rejected_count', 'short_circuited_count', 'batch_count')
+
+    def __init__(self,
+                 concurrency_limiter: EmailRouterConcurrencyLimiter,
+                 circuit_breaker: EmailRouterCircuitBreaker):
+        self.concurrency_limiter = concurrency_limiter
+        self.circuit_breaker = circuit_breaker
+        self.pending_deliveries: Deque[EmailRouterDelivery] = deque()
+        self.pending_byte_count = 0
+        self.delivered_count = 0
+        self.failed_count = 0
+        # answered with a client error (4xx other than 429) - not retried
+        self.rejected_count = 0
+        self.short_circuited_count = 0
+        self.batch_count = 0
+
+
+class EmailRouterDispatcher:
+    """
+    Delivers routed emails to HTTP_POST destinations (see the notes at the top of this module)
+    """
+
+    TARGET_HEADER = 'X-Emerald-Target'
+    INSTANCE_TYPE_HEADER = 'X-Emerald-Instance-Type'
+    ATTEMPT_HEADER = 'X-Emerald-Delivery-Attempt'
+    DELIVERY_ID_HEADER = 'X-Emerald-Delivery-Id'
+    BATCH_CONTENT_TYPE = 'application/x-ndjson'
+
+    @property
+    def worker_count(self) -> int:
+        return self._worker_count
+
+    def __init__(self,
+                 worker_count: int = 16,
+                 delivery_timeout_seconds: float = 30.0,
+                 max_pending_per_destination: int = 1000,
+                 retry_queue_capacity: int = 10000,
+                 max_attempts: int = 5,
+                 retry_base_seconds: float = 1.0,
+                 retry_max_seconds: float = 300.0,
+                 initial_concurrency: int = 4,
+                 max_concurrency: Optional[int] = None,
+                 failure_threshold: int = 5,
+                 open_seconds: float = 30.0,
+                 batch_max_count: int = 100,
+                 batch_max_bytes: int = 4 * 1024 * 1024,
+                 batch_linger_seconds: float = 0.05,
+                 logger: Optional[logging.Logger] = None):
+        if worker_count < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': worker_count must be at least 1 ' +
+                             '(value = ' + str(worker_count) + ')')
+        if delivery_timeout_seconds <= 0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': delivery_timeout_seconds must be ' +
+                             'positive (value = ' + str(delivery_timeout_seconds) + ')')
+        if max_attempts < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': max_attempts must be at least 1 ' +
+                             '(value = ' + str(max_attempts) + ')')
+        if batch_max_count < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': batch_max_count must be at least 1 ' +
+                             '(value = ' + str(batch_max_count) + ')')
+
+        self._worker_count = worker_count
+        self._delivery_timeout_seconds = delivery_timeout_seconds
+        self._max_pending_per_destination = max_pending_per_destination
+        self._retry_queue_capacity = retry_queue_capacity
+        self._max_attempts = max_attempts
+        self._retry_base_seconds = retry_base_seconds
+        self._retry_max_seconds = retry_max_seconds
+        self._initial_concurrency = initial_concurrency
+        # one destination may use at most half the workers unless told otherwise
+        self._max_concurrency = max_concurrency if max_concurrency is not None else max(1, worker_count // 2)
+        self._failure_threshold = failure_threshold
+        self._open_seconds = open_seconds
+        self._batch_max_count = batch_max_count
+        self._batch_max_bytes = batch_max_bytes
+        self._batch_linger_seconds = batch_linger_seconds
+        self._logger = logger if logger is not None else logging.getLogger(type(self).__name__)
+
+        self._condition = threading.Condition()
+        self._destination_states: Dict[str, _DestinationState] = dict()
+        # destinations with pending deliveries, in the order workers visit them
+        self._ready_destination_uris: Deque[str] = deque()
+        # (due time, sequence, delivery)
+        self._retry_queue: List[Tuple[float, int, EmailRouterDelivery]] = list()
+        self._retry_sequence = 0
+        self._submitted_count = 0
+        self._dropped_count = 0
+        self._exhausted_count = 0
+        # (delivery, delivered) of finished deliveries with an on_complete, for a worker to call outside the lock
+        self._completed_deliveries: List[Tuple[EmailRouterDelivery, bool]] = list()
+        self._running = False
+        self._workers: List[threading.Thread] = list()
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._workers = [threading.Thread(target=self._run_worker, name=type(self).__name__ + '-' + str(x),
+                                          daemon=True) for x in range(self._worker_count)]
+        for this_worker in self._workers:
+            this_worker.start()
+
+    def stop(self, timeout_seconds: float = 5.0):
+        with self._condition:
+            self._running = False
+            undelivered_count = len(self._retry_queue) + \
+                sum(len(x.pending_deliveries) for x in self._destination_states.values())
+            self._condition.notify_all()
+        deadline = time.monotonic() + timeout_seconds
+        for this_worker in self._workers:
+            this_worker.join(max(0.0, deadline - time.monotonic()))
+        if undelivered_count > 0:
+            self._logger.warning('Dispatcher stopped with ' + str(undelivered_count) + ' undelivered email(s)')
+
+    def drain(self, timeout_seconds: float) -> bool:
+        """
+        Wait for every queued delivery to be delivered or given up on - False if some are still queued (or in
+        flight) at the timeout
+        """
+        deadline = time.monotonic() + timeout_seconds
+        with self._condition:
+            while len(self._retry_queue) > 0 or \
+                    any(len(x.pending_deliveries) > 0 or x.concurrency_limiter.in_flight_count > 0
+                        for x in self._destination_states.values()):
+                wait_seconds = deadline - time.monotonic()
+                if wait_seconds <= 0:
+                    return False
+                self._condition.wait(min(1.0, wait_seconds))
+        return True
+
+    def submit(self,
+               destination_uri: str,
+               router_instance_type_name: str,
+               target_name: str,
+               content_type: Optional[str],
+               body: bytes,
+               batched: bool = False,
+               on_complete: Optional[Callable[[bool], None]] = None) -> bool:
+        """
+        Queue a routed email for delivery, on its own or in a batch - False if it was dropped because the queues
+        are full (on_complete has then been called with False)
+        """
+        delivery = EmailRouterDelivery(delivery_id=uuid.uuid4().hex,
+                                       destination_uri=destination_uri,
+                                       router_instance_type_name=router_instance_type_name,
+                                       target_name=target_name,
+                                       content_type=content_type,
+                                       body=body,
+                                       batched=batched,
+                                       on_complete=on_complete)
+        with self._condition:
+            self._submitted_count += 1
+            destination_state = self._get_destination_state(destination_uri)
+            if destination_state.circuit_breaker.state == EmailRouterCircuitState.OPEN:
+                # fail fast - no point queueing behind a destination that is known to be down
+                destination_state.short_circuited_count += 1
+                queued = self._add_retry(delivery, due_time=destination_state.circuit_breaker.open_until)
+            elif len(destination_state.pending_deliveries) >= self._max_pending_per_destination:
+                queued = self._add_retry(delivery, due_time=time.monotonic() + self._retry_base_seconds)
+            else:
+                self._add_pending(destination_state, delivery)
+                self._condition.notify()
+                queued = True
+        self._call_on_complete()
+        return queued
+
+    def _get_destination_state(self, destination_uri: str) -> _DestinationState:
+        destination_state = self._destination_states.get(destination_uri)
+        if destination_state is None:
+            destination_state = _DestinationState(
+                concurrency_limiter=EmailRouterConcurrencyLimiter(initial_limit=self._initial_concurrency,
+                                                                  max_limit=self._max_concurrency),
+                circuit_breaker=EmailRouterCircuitBreaker(failure_threshold=self._failure_threshold,
+                                                          open_seconds=self._open_seconds))
+            self._destination_states[destination_uri] = destination_state
+        return destination_state
+
+    def _add_pending(self,
+                     destination_state: _DestinationState,
+                     delivery: EmailRouterDelivery):
+        if len(destination_state.pending_deliveries) == 0:
+            self._ready_destination_uris.append(delivery.destination_uri)
+        destination_state.pending_deliveries.append(delivery._replace(queued_time=time.monotonic()))
+        destination_state.pending_byte_count += len(delivery.body)
+
+    def _take_pending(self, destination_state: _DestinationState) -> EmailRouterDelivery:
+        delivery = destination_state.pending_deliveries.popleft()
+        destination_state.pending_byte_count -= len(delivery.body)
+        return delivery
+
+    def _get_batch_due_time(self, destination_state: _DestinationState) -> float:
+        """
+        When the batch at the head of the pending deliveries may be sent - a single delivery may be sent at once
+        """
+        first_delivery = destination_state.pending_deliveries[0]
+        if not first_delivery.batched or len(destination_state.pending_deliveries) >= self._batch_max_count or \
+                destination_state.pending_byte_count >= self._batch_max_bytes:
+            return 0.0
+        return first_delivery.queued_time + self._batch_linger_seconds
+
+    def _add_retry(self,
+                   delivery: EmailRouterDelivery,
+                   due_time: float) -> bool:
+        if len(self._retry_queue) >= self._retry_queue_capacity:
+            self._dropped_count += 1
+            self._logger.error('Dispatch retry queue full - dropped email for target ' + delivery.target_name +
+                               ' to ' + delivery.destination_uri)
+            self._complete_delivery(delivery, delivered=False)
+            return False
+        self._retry_sequence += 1
+        heapq.heappush(self._retry_queue, (due_time, self._retry_sequence, delivery))
+        return True
+
+    def _take_deliveries(self, now: float) -> Tuple[List[EmailRouterDelivery], float]:
+        """
+        The next delivery (or batch) a worker may make now, round robin over the destinations, and when to look
+        again if there is none - called under the lock
+        """
+        while len(self._retry_queue) > 0 and self._retry_queue[0][0] <= now:
+            (_, _, delivery) = heapq.heappop(self._retry_queue)
+            self._add_pending(self._get_destination_state(delivery.destination_uri), delivery)
+
+        next_check_time = min(now + 1.0, self._retry_queue[0][0]) if len(self._retry_queue) > 0 else now + 1.0
+        for _ in range(len(self._ready_destination_uris)):
+            destination_uri = self._ready_destination_uris.popleft()
+            destination_state = self._destination_states[destination_uri]
+            if destination_state.concurrency_limiter.in_flight_count >= destination_state.concurrency_limiter.limit:
+                self._ready_destination_uris.append(destination_uri)
+                continue
+            batch_due_time = self._get_batch_due_time(destination_state)
+            if batch_due_time > now:
+                # lingering for more emails to batch
+                next_check_time = min(next_check_time, batch_due_time)
+                self._ready_destination_uris.append(destination_uri)
+                continue
+            if not destination_state.circuit_breaker.allow_request(now):
+                if destination_state.circuit_breaker.state == EmailRouterCircuitState.OPEN:
+                    # opened while these were waiting - park them until the trial delivery is due
+                    while len(destination_state.pending_deliveries) > 0:
+                        destination_state.short_circuited_count += 1
+                        self._add_retry(self._take_pending(destination_state),
+                                        due_time=destination_state.circuit_breaker.open_until)
+                else:
+                    # half open with the trial delivery in flight
+                    self._ready_destination_uris.append(destination_uri)
+                continue
+
+            destination_state.concurrency_limiter.try_acquire()
+            deliveries = [self._take_pending(destination_state)]
+            if deliveries[0].batched:
+                batch_byte_count = len(deliveries[0].body)
+                while len(deliveries) < self._batch_max_count and \
+                        len(destination_state.pending_deliveries) > 0 and \
+                        destination_state.pending_deliveries[0].batched and \
+                        batch_byte_count + len(destination_state.pending_deliveries[0].body) <= self._batch_max_bytes:
+                    deliveries.append(self._take_pending(destination_state))
+                    batch_byte_count += len(deliveries[-1].body)
+                destination_state.batch_count += 1
+            if len(destination_state.pending_deliveries) > 0:
+                self._ready_destination_uris.append(destination_uri)
+            return deliveries, now
+        return list(), next_check_time
+
+    def _run_worker(self):
+        while True:
+            with self._condition:
+                deliveries = list()
+                while self._running:
+                    now = time.monotonic()
+                    (deliveries, next_check_time) = self._take_deliveries(now)
+                    if len(deliveries) > 0:
+                        break
+                    self._condition.wait(max(0.001, next_check_time - now))
+                if len(deliveries) == 0:
+                    return
+            # parking deliveries of a destination whose breaker opened may have dropped some
+            self._call_on_complete()
+
+            start_time = time.monotonic()
+            if deliveries[0].batched:
+                (request_result, delivery_results) = self._deliver_batch(deliveries)
+            else:
+                request_result = self._deliver(deliveries[0])
+                delivery_results = [request_result]
+            self._record_results(deliveries=deliveries,
+                                 request_result=request_result,
+                                 delivery_results=delivery_results,
+                                 latency_seconds=time.monotonic() - start_time)
+            self._call_on_complete()
+
+    def _post(self,
+              destination_uri: str,
+              body: bytes,
+              content_type: Optional[str],
+              headers: Dict[str, str]) -> Tuple[_DeliveryResult, bytes]:
+        """
+        The result of one POST and the response body
+        """
+        delivery_request = urllib.request.Request(url=destination_uri, data=body, method='POST', headers=headers)
+        if content_type is not None:
+            delivery_request.add_header('Content-Type', content_type)
+
+        try:
+            with urllib.request.urlopen(delivery_request, timeout=self._delivery_timeout_seconds) as response:
+                return (True, False, None), response.read()
+        except urllib.error.HTTPError as htex:
+            # 429 and 5xx are the destination's trouble - anything else it will never accept
+            return (False, type(self)._is_retryable_status(htex.code), 'HTTP status ' + str(htex.code)), b''
+        except (urllib.error.URLError, OSError) as ex:
+            return (False, True, str(ex)), b''
+
+    @staticmethod
+    def _is_retryable_status(status_code: int) -> bool:
+        return status_code == 429 or status_code >= 500
+
+    def _deliver(self, delivery: EmailRouterDelivery) -> _DeliveryResult:
+        (delivery_result, _) = self._post(destination_uri=delivery.destination_uri,
+                                          body=delivery.body,
+                                          content_type=delivery.content_type,
+                                          headers={
+                                              type(self).TARGET_HEADER: delivery.target_name,
+                                              type(self).INSTANCE_TYPE_HEADER: delivery.router_instance_type_name,
+                                              type(self).ATTEMPT_HEADER: str(delivery.attempt_count + 1),
+                                              type(self).DELIVERY_ID_HEADER: delivery.delivery_id
+                                          })
+        return delivery_result
+
+    def _deliver_batch(self, deliveries: List[EmailRouterDelivery]) -> Tuple[_DeliveryResult, List[_DeliveryResult]]:
+        """
+        The result of the batch POST and of each delivery in it, from the destination's acknowledgements
+        """
+        batch_body = b''.join(json.dumps({
+            'id': x.delivery_id,
+            'instance_type': x.router_instance_type_name,
+            'target': x.target_name,
+            'attempt': x.attempt_count + 1,
+            'content_type': x.content_type,
+            'body': base64.b64encode(x.body).decode('ascii')
+        }).encode('utf-8') + b'\n' for x in deliveries)
+        (request_result, response_body) = self._post(destination_uri=deliveries[0].destination_uri,
+                                                     body=batch_body,
+                                                     content_type=type(self).BATCH_CONTENT_TYPE,
+                                                     headers={type(self).ATTEMPT_HEADER: str(
+                                                         min(x.attempt_count for x in deliveries) + 1)})
+        if not request_result[0]:
+            return request_result, [request_result] * len(deliveries)
+
+        status_codes_by_delivery_id: Dict[str, int] = dict()
+        for this_line in response_body.splitlines():
+            try:
+                acknowledgement = json.loads(this_line.decode('utf-8'))
+                status_codes_by_delivery_id[str(acknowledgement['id'])] = int(acknowledgement['status'])
+            except (ValueError, KeyError, TypeError):
+                # not an acknowledgement - the deliveries it was meant for are retried
+                continue
+        if len(status_codes_by_delivery_id) == 0:
+            # a destination that does not acknowledge per email accepted the batch as a whole
+            return request_result, [request_result] * len(deliveries)
+
+        delivery_results = list()
+        for this_delivery in deliveries:
+            status_code = status_codes_by_delivery_id.get(this_delivery.delivery_id)
+            if status_code is None:
+                delivery_results.append((False, True, 'not acknowledged in batch response'))
+            elif 200 <= status_code < 300:
+                delivery_results.append((True, False, None))
+            else:
+                delivery_results.append((False, type(self)._is_retryable_status(status_code),
+                                         'HTTP status ' + str(status_code) + ' in batch response'))
+        return request_result, delivery_results
+
+    def _record_results(self,
+                        deliveries: List[EmailRouterDelivery],
+                        request_result: _DeliveryResult,
+                        delivery_results: List[_DeliveryResult],
+                        latency_seconds: float):
+        with self._condition:
+            now = time.monotonic()
+            destination_state = self._destination_states[deliveries[0].destination_uri]
+            # the limiter and breaker judge the request - emails a batch acknowledges as failed are retried, but the
+            #  destination answered
+            (_, request_retryable, _) = request_result
+            destination_state.concurrency_limiter.release(latency_seconds=latency_seconds, congested=request_retryable)
+            if request_retryable:
+                destination_state.circuit_breaker.record_failure(now)
+            else:
+                destination_state.circuit_breaker.record_success()
+
+            for this_delivery, (succeeded, retryable, failure_detail) in zip(deliveries, delivery_results):
+                self._record_delivery_result(destination_state=destination_state,
+                                             delivery=this_delivery,
+                                             succeeded=succeeded,
+                                             retryable=retryable,
+                                             failure_detail=failure_detail,
+                                             now=now)
+            self._condition.notify_all()
+
+    def _record_delivery_result(self,
+                                destination_state: _DestinationState,
+                                delivery: EmailRouterDelivery,
+                                succeeded: bool,
+                                retryable: bool,
+                                failure_detail: Optional[str],
+                                now: float):
+        if succeeded:
+            destination_state.delivered_count += 1
+            self._complete_delivery(delivery, delivered=True)
+        elif not retryable:
+            destination_state.rejected_count += 1
+            self._logger.error('Destination ' + delivery.destination_uri + ' rejected email for target ' +
+                               delivery.target_name + ' (' + str(failure_detail) + ') - not retried')
+            self._complete_delivery(delivery, delivered=False)
+        else:
+            destination_state.failed_count += 1
+            attempt_count = delivery.attempt_count + 1
+            if attempt_count >= self._max_attempts:
+                self._exhausted_count += 1
+                self._logger.error('Delivery to ' + delivery.destination_uri + ' for target ' +
+                                   delivery.target_name + ' failed ' + str(attempt_count) +
+                                   ' time(s) - giving up' + os.linesep + 'Last failure: ' + str(failure_detail))
+                self._complete_delivery(delivery, delivered=False)
+            else:
+                backoff_seconds = min(self._retry_max_seconds,
+                                      self._retry_base_seconds * 2 ** (attempt_count - 1))
+                # jittered, so deliveries failed together are not retried together
+                due_time = max(now + backoff_seconds * random.uniform(0.5, 1.0),
+                               destination_state.circuit_breaker.open_until)
+                self._add_retry(delivery._replace(attempt_count=attempt_count), due_time=due_time)
+
+    def _complete_delivery(self,
+                           delivery: EmailRouterDelivery,
+                           delivered: bool):
+        # called under the lock - the callback itself runs in _call_on_complete
+        if delivery.on_complete is not None:
+            self._completed_deliveries.append((delivery, delivered))
+
+    def _call_on_complete(self):
+        with self._condition:
+            if len(self._completed_deliveries) == 0:
+                return
+            completed_deliveries = self._completed_deliveries
+            self._completed_deliveries = list()
+        for (this_delivery, delivered) in completed_deliveries:
+            try:
+                this_delivery.on_complete(delivered)
+            except Exception as ex:
+                # the submitter's trouble - it must not take the worker down
+                self._logger.error('Completion callback failed for email for target ' + this_delivery.target_name +
+                                   ' to ' + this_delivery.destination_uri + os.linesep + 'Exception: ' + str(ex))
+
+    def get_statistics_as_dict(self) -> dict:
+        with self._condition:
+            return {
+                'worker_count': self._worker_count,
+                'submitted_count': self._submitted_count,
+                'retry_queue_size': len(self._retry_queue),
+                'dropped_count': self._dropped_count,
+                'exhausted_count': self._exhausted_count,
+                'destinations': {
+                    destination_uri: {
+                        'concurrency_limit': x.concurrency_limiter.limit,
+                        'in_flight_count': x.concurrency_limiter.in_flight_count,
+                        'baseline_latency_seconds': x.concurrency_limiter.baseline_latency_seconds,
+                        'pending_count': len(x.pending_deliveries),
+                        'circuit_state': x.circuit_breaker.state.name,
+                        'consecutive_failure_count': x.circuit_breaker.consecutive_failure_count,
+                        'circuit_opened_count': x.circuit_breaker.opened_count,
+                        'delivered_count': x.delivered_count,
+                        'failed_count': x.failed_count,
+                        'rejected_count': x.rejected_count,
+                        'short_circuited_count': x.short_circuited_count,
+                        'batch_count': x.batch_count
+                    } for destination_uri, x in self._destination_states.items()
+                }
+            }
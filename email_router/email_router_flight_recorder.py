@@ -0,0 +1,167 @@
+import hashlib
+import threading
+import time
+
+from enum import unique, Enum, auto
+from typing import Collection, List, NamedTuple, Optional, Tuple
+
+
+@unique
+class EmailRouterRoutingOutcome(Enum):
+    MATCHED = auto()
+    # every target was tried and rejected the email
+    NO_MATCH = auto()
+    # no rule can match the recipient(s), so no target was tried
+    RECIPIENT_NOT_ALLOWED = auto()
+    # the envelope could not be evaluated (e.g. a malformed sender ip)
+    INPUT_ERROR = auto()
+
+
+class EmailRouterTargetRejection(NamedTuple):
+    target_name: str
+    # the first rule tried for the target and the check that rejected it
+    match_priority: float
+    check_name: str
+
+
+class EmailRouterMatchTrace:
+    """
+    Filled in by the router during one match, for the flight recorder
+    """
+    __slots__ = ('recipient_not_allowed', 'target_rejections', 'max_target_rejections')
+
+    def __init__(self, max_target_rejections: int = 16):
+        self.recipient_not_allowed = False
+        # the highest priority targets only - a record must not grow with the rule base
+        self.target_rejections: List[EmailRouterTargetRejection] = list()
+        self.max_target_rejections = max_target_rejections
+
+
+class EmailRouterFlightRecord(NamedTuple):
+    timestamp: float
+    envelope_digest: str
+    address_from: str
+    sender_ip: str
+    outcome: EmailRouterRoutingOutcome
+    matched_target_names: Tuple[str, ...]
+    target_rejections: Tuple[EmailRouterTargetRejection, ...]
+    match_seconds: float
+
+    def get_as_dict(self) -> dict:
+        return {
+            'timestamp': self.timestamp,
+            'envelope_digest': self.envelope_digest,
+            'address_from': self.address_from,
+            'sender_ip': self.sender_ip,
+            'outcome': self.outcome.name,
+            'matched_target_names': list(self.matched_target_names),
+            'target_rejections': [x._asdict() for x in self.target_rejections],
+            'match_seconds': self.match_seconds
+        }
+
+
+class EmailRouterFlightRecorder:
+    """
+    The last capacity routing decisions, kept in a ring buffer whose slots are allocated up front and
+    overwritten oldest first, so memory does not grow with traffic.
+
+    A record is compact: the recipients are kept only as part of envelope_digest (see get_envelope_digest)
+    and the per target trace is the first check that rejected each target, not the full match log - for at
+    most max_target_rejections targets, highest priority first.
+    """
+
+    @property
+    def capacity(self) -> int:
+        return len(self._records)
+
+    @property
+    def recorded_count(self) -> int:
+        return self._recorded_count
+
+    @property
+    def max_target_rejections(self) -> int:
+        return self._max_target_rejections
+
+    def __init__(self,
+                 capacity: int = 10000,
+                 max_target_rejections: int = 16):
+        if capacity < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': capacity must be at least 1 ' +
+                             '(value = ' + str(capacity) + ')')
+        self._max_target_rejections = max_target_rejections
+        self._lock = threading.Lock()
+        self._records: List[Optional[EmailRouterFlightRecord]] = [None] * capacity
+        self._next_index = 0
+        self._recorded_count = 0
+
+    @staticmethod
+    def get_envelope_digest(address_to_collection: Collection[str],
+                            address_from: str,
+                            sender_ip: str) -> str:
+        envelope_text = ','.join(sorted(x.strip().lower() for x in address_to_collection)) + '|' + \
+            address_from.strip().lower() + '|' + sender_ip.strip()
+        return hashlib.blake2b(envelope_text.encode('utf-8'), digest_size=8).hexdigest()
+
+    def record(self,
+               address_to_collection: Collection[str],
+               address_from: str,
+               sender_ip: str,
+               outcome: EmailRouterRoutingOutcome,
+               matched_target_names: Collection[str],
+               target_rejections: Collection[EmailRouterTargetRejection],
+               match_seconds: float):
+        flight_record = EmailRouterFlightRecord(
+            timestamp=time.time(),
+            envelope_digest=type(self).get_envelope_digest(address_to_collection=address_to_collection,
+                                                           address_from=address_from,
+                                                           sender_ip=sender_ip),
+            address_from=address_from,
+            sender_ip=sender_ip,
+            outcome=outcome,
+            matched_target_names=tuple(matched_target_names),
+            target_rejections=tuple(target_rejections),
+            match_seconds=match_seconds)
+        with self._lock:
+            self._records[self._next_index] = flight_record
+            self._next_index = (self._next_index + 1) % len(self._records)
+            self._recorded_count += 1
+
+    def get_records(self,
+                    sender: Optional[str] = None,
+                    target_name: Optional[str] = None,
+                    envelope_digest: Optional[str] = None,
+                    limit: int = 100) -> List[EmailRouterFlightRecord]:
+        """
+        Newest first.  sender matches the sender address, its domain or the sender ip; target_name matches a
+        target that was matched or that rejected the email
+        """
+        with self._lock:
+            records = self._records[self._next_index:] + self._records[:self._next_index]
+
+        sender = sender.strip().lower() if sender is not None else None
+        matching_records = list()
+        for this_record in reversed(records):
+            if len(matching_records) >= limit:
+                break
+            if this_record is None:
+                # the buffer has not wrapped yet - nothing older
+                break
+            if sender is not None:
+                address_from = this_record.address_from.lower()
+                if sender != address_from and sender != address_from.rpartition('@')[2] and \
+                        sender != this_record.sender_ip:
+                    continue
+            if target_name is not None and target_name not in this_record.matched_target_names and \
+                    all(x.target_name != target_name for x in this_record.target_rejections):
+                continue
+            if envelope_digest is not None and envelope_digest != this_record.envelope_digest:
+                continue
+            matching_records.append(this_record)
+        return matching_records
+
+    def get_statistics_as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'capacity': len(self._records),
+                'recorded_count': self._recorded_count
+            }
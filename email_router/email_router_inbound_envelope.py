@@ -0,0 +1,149 @@
+import json
+import re
+
+from enum import unique, Enum, auto
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+from error import EmeraldEmailRouterInputDataError
+
+#
+# Routing, dedupe and admission only need a handful of the small text fields of a SendGrid inbound parse POST.
+#  Parsing the whole multipart body (werkzeug's request.form/request.files, or ParsedEmail) decodes every part,
+#  including the email bodies and attachments, so instead the raw body is scanned for part boundaries and only
+#  the wanted fields are decoded.  File parts are counted but never copied.
+#
+
+@unique
+class EmailRouterInboundFormat(Enum):
+    # SendGrid inbound parse - multipart/form-data
+    SENDGRID = auto()
+    # Postmark inbound webhook - application/json
+    POSTMARK = auto()
+
+    @staticmethod
+    def from_mimetype(mimetype: Optional[str]):
+        return EmailRouterInboundFormat.POSTMARK if mimetype == 'application/json' \
+            else EmailRouterInboundFormat.SENDGRID
+
+
+# form fields read for routing, dedupe and admission
+INBOUND_ENVELOPE_FIELD_NAMES = frozenset(['envelope', 'from', 'to', 'sender_ip', 'headers', 'attachments'])
+
+_PART_NAME_REGEX = re.compile(r'(?:^|[;\s])name="([^"]*)"', re.IGNORECASE)
+_PART_FILENAME_REGEX = re.compile(r'(?:^|[;\s])filename\*?=', re.IGNORECASE)
+_PART_CHARSET_REGEX = re.compile(r'(?:^|[;\s])charset="?([^";\s]+)', re.IGNORECASE)
+
+# address within angle brackets, or the whole value when there are none
+_ADDRESS_REGEX = re.compile(r'<([^<>]*)>\s*$')
+
+
+def _get_address(address_value: str) -> str:
+    match_result = _ADDRESS_REGEX.search(address_value.strip())
+    return match_result.group(1).strip() if match_result is not None else address_value.strip()
+
+
+class EmailRouterInboundEnvelope(NamedTuple):
+    # the wanted text fields found in the request
+    form_fields: Dict[str, str]
+    # parts carrying a filename (attachments)
+    file_part_count: int
+    body_size: Optional[int]
+
+    @property
+    def _envelope_json(self) -> dict:
+        try:
+            envelope_json = json.loads(self.form_fields.get('envelope', '{}'))
+        except ValueError:
+            return dict()
+        return envelope_json if isinstance(envelope_json, dict) else dict()
+
+    # SMTP recipients from the envelope field, or the To header addresses when there is no envelope
+    @property
+    def address_to_collection(self) -> List[str]:
+        envelope_to = self._envelope_json.get('to')
+        if isinstance(envelope_to, list) and len(envelope_to) > 0:
+            return [str(x) for x in envelope_to]
+        if 'to' in self.form_fields:
+            return [_get_address(x) for x in self.form_fields['to'].split(',') if len(x.strip()) > 0]
+        raise EmeraldEmailRouterInputDataError('Inbound request has neither an envelope nor a "to" field')
+
+    @property
+    def address_from(self) -> str:
+        envelope_from = self._envelope_json.get('from')
+        if isinstance(envelope_from, str) and len(envelope_from) > 0:
+            return envelope_from
+        if 'from' in self.form_fields:
+            return _get_address(self.form_fields['from'])
+        raise EmeraldEmailRouterInputDataError('Inbound request has neither an envelope nor a "from" field')
+
+    @property
+    def sender_ip(self) -> str:
+        if 'sender_ip' not in self.form_fields:
+            raise EmeraldEmailRouterInputDataError('Inbound request has no "sender_ip" field')
+        return self.form_fields['sender_ip'].strip()
+
+
+def _scan_multipart_body(body: bytes,
+                         boundary: bytes,
+                         field_names: FrozenSet[str]) -> Optional[Tuple[Dict[str, str], int]]:
+    """
+    Wanted field values and the number of file parts, or None if the body is not well formed multipart
+    """
+    delimiter = b'\r\n--' + boundary
+    form_fields = dict()
+    file_part_count = 0
+
+    # the first delimiter may start the body, so look for it without the leading line break
+    position = body.find(delimiter[2:])
+    if position < 0:
+        return None
+    position += len(delimiter) - 2
+    while not body.startswith(b'--', position):
+        header_start = body.find(b'\r\n', position)
+        header_end = body.find(b'\r\n\r\n', header_start)
+        if header_start < 0 or header_end < 0:
+            return None
+        # an empty part has the line break before the next delimiter as the end of its header block
+        content_end = body.find(delimiter, header_end + 2)
+        if content_end < 0:
+            return None
+        content_start = min(header_end + 4, content_end)
+
+        part_headers = body[header_start + 2:header_end].decode('latin-1')
+        name_match = _PART_NAME_REGEX.search(part_headers)
+        if _PART_FILENAME_REGEX.search(part_headers) is not None:
+            file_part_count += 1
+        elif name_match is not None and name_match.group(1) in field_names:
+            charset_match = _PART_CHARSET_REGEX.search(part_headers)
+            try:
+                form_fields[name_match.group(1)] = body[content_start:content_end].decode(
+                    charset_match.group(1) if charset_match is not None else 'utf-8', errors='replace')
+            except LookupError:
+                form_fields[name_match.group(1)] = body[content_start:content_end].decode('utf-8', errors='replace')
+
+        position = content_end + len(delimiter)
+    return form_fields, file_part_count
+
+
+def get_inbound_envelope(inbound_request,
+                         field_names: FrozenSet[str] = INBOUND_ENVELOPE_FIELD_NAMES) -> EmailRouterInboundEnvelope:
+    """
+    Read the routing fields of an inbound (SendGrid inbound parse) POST without parsing the rest of it.  The raw
+    body is kept on the request (get_data(cache=True)) so the full form can still be parsed later
+    """
+    boundary = inbound_request.mimetype_params.get('boundary')
+    if inbound_request.mimetype == 'multipart/form-data' and boundary is not None:
+        scan_result = _scan_multipart_body(body=inbound_request.get_data(cache=True),
+                                           boundary=boundary.encode('latin-1'),
+                                           field_names=field_names)
+        if scan_result is not None:
+            (form_fields, file_part_count) = scan_result
+            return EmailRouterInboundEnvelope(form_fields=form_fields,
+                                              file_part_count=file_part_count,
+                                              body_size=inbound_request.content_length)
+
+    # not multipart, or not in a form the scan understands - let werkzeug parse it
+    inbound_request.get_data(cache=True)
+    return EmailRouterInboundEnvelope(form_fields={k: v for k, v in inbound_request.form.items() if k in field_names},
+                                      file_part_count=len(inbound_request.files),
+                                      body_size=inbound_request.content_length)
@@ -0,0 +1,91 @@
+import hashlib
+import re
+
+from typing import NamedTuple, Optional
+
+from email_router.email_router_inbound_envelope import EmailRouterInboundEnvelope
+from error import EmeraldEmailRouterInputDataError
+
+
+class EmailRouterInboundPayloadInfo(NamedTuple):
+    body_size: Optional[int] = None
+    attachment_included: Optional[bool] = None
+
+
+def get_inbound_payload_info(inbound_envelope: EmailRouterInboundEnvelope) -> EmailRouterInboundPayloadInfo:
+    """
+    Work out the body size and attachment presence of an inbound (SendGrid inbound parse) POST once, from
+    the request headers and the multipart part headers, so the router can test body_size_minimum,
+    body_size_maximum and attachment_included without reading the email text or attachment content.
+
+    The body size is the Content-Length of the inbound payload.  An attachment is included if SendGrid's
+    "attachments" count field is positive or any multipart part carries a filename.
+    """
+    body_size = inbound_envelope.body_size
+
+    attachment_count = inbound_envelope.form_fields.get('attachments')
+    try:
+        attachment_included = int(attachment_count) > 0 if attachment_count is not None else None
+    except ValueError:
+        attachment_included = None
+
+    if attachment_included is not True and inbound_envelope.file_part_count > 0:
+        attachment_included = True
+    elif attachment_included is None:
+        attachment_included = False
+
+    return EmailRouterInboundPayloadInfo(body_size=body_size,
+                                         attachment_included=attachment_included)
+
+
+# Message-ID header line within SendGrid's raw "headers" form field
+_MESSAGE_ID_HEADER_REGEX = re.compile(r'^message-id:[ \t]*(.*(?:\r?\n[ \t]+.*)*)', re.IGNORECASE | re.MULTILINE)
+
+
+def get_inbound_dedupe_key(inbound_envelope: EmailRouterInboundEnvelope) -> Optional[str]:
+    """
+    Identify an inbound (SendGrid inbound parse) POST so webhook retries of the same email can be recognized
+    before it is parsed.  Uses the Message-ID header when present, otherwise a hash of the envelope and raw
+    headers.  Returns None if the request carries neither.
+    """
+    raw_headers = inbound_envelope.form_fields.get('headers')
+    if raw_headers is not None:
+        match_result = _MESSAGE_ID_HEADER_REGEX.search(raw_headers)
+        if match_result is not None:
+            message_id = ' '.join(match_result.group(1).split())
+            if len(message_id) > 0:
+                return 'message-id:' + message_id
+
+    envelope = inbound_envelope.form_fields.get('envelope')
+    if raw_headers is None and envelope is None:
+        return None
+
+    content_hash = hashlib.sha256()
+    for this_value in (envelope, raw_headers):
+        content_hash.update((this_value or '').encode('utf-8', errors='surrogateescape'))
+        content_hash.update(b'\0')
+    return 'sha256:' + content_hash.hexdigest()
+
+
+class EmailRouterInboundSenderInfo(NamedTuple):
+    sender_domain: Optional[str] = None
+    sender_ip: Optional[str] = None
+
+
+def get_inbound_sender_info(inbound_envelope: EmailRouterInboundEnvelope) -> EmailRouterInboundSenderInfo:
+    """
+    Sender domain and IP of an inbound POST, without parsing the email - cheap enough to decide admission before
+    any parsing or matching.  The domain is that of the sender routing matches on - the SMTP envelope sender, else
+    the address in the From header
+    """
+    sender_domain = None
+    try:
+        (_, separator, domain) = inbound_envelope.address_from.rpartition('@')
+        if len(separator) > 0 and len(domain.strip()) > 0:
+            sender_domain = domain.strip()
+    except EmeraldEmailRouterInputDataError:
+        # no sender at all - routing will dead letter it
+        pass
+
+    return EmailRouterInboundSenderInfo(sender_domain=sender_domain,
+                                        sender_ip=inbound_envelope.form_fields.get('sender_ip'))
@@ -0,0 +1,280 @@
+import os
+import threading
+import time
+
+from typing import Collection, Dict, Iterable, List, Optional
+
+from email_router.email_router_admission import EmailRouterAdmissionController, EmailRouterAdmissionDimension
+from email_router.email_router_datastore import EmailRouter, EmailRouterMatchResultCollection
+from email_router.email_router_dedupe import EmailRouterDedupeCache, EmailRouterDedupeStatus
+from email_router.email_router_inbound_payload import EmailRouterInboundSenderInfo
+from email_router.router_instance_type import RouterInstanceType
+from error import EmeraldEmailRouterMatchNotFoundError, EmeraldEmailRouterInputDataError
+
+
+class EmailRouterMatchStatistics:
+    """
+    Match counters for one router instance type
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._request_count = 0
+        self._matched_count = 0
+        self._match_not_found_count = 0
+        self._input_error_count = 0
+        self._match_seconds_total = 0.0
+        self._matched_count_by_target: Dict[str, int] = dict()
+
+    @property
+    def request_count(self) -> int:
+        return self._request_count
+
+    @property
+    def matched_count(self) -> int:
+        return self._matched_count
+
+    @property
+    def match_not_found_count(self) -> int:
+        return self._match_not_found_count
+
+    @property
+    def input_error_count(self) -> int:
+        return self._input_error_count
+
+    def record_match(self,
+                     match_result_collection: EmailRouterMatchResultCollection,
+                     elapsed_seconds: float):
+        with self._lock:
+            self._request_count += 1
+            self._matched_count += 1
+            self._match_seconds_total += elapsed_seconds
+            for this_result in match_result_collection.matched_target_results:
+                self._matched_count_by_target[this_result.matched_target_name] = \
+                    self._matched_count_by_target.get(this_result.matched_target_name, 0) + 1
+
+    def record_match_not_found(self, elapsed_seconds: float):
+        with self._lock:
+            self._request_count += 1
+            self._match_not_found_count += 1
+            self._match_seconds_total += elapsed_seconds
+
+    def record_input_error(self):
+        with self._lock:
+            self._request_count += 1
+            self._input_error_count += 1
+
+    def get_statistics_as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'request_count': self._request_count,
+                'matched_count': self._matched_count,
+                'match_not_found_count': self._match_not_found_count,
+                'input_error_count': self._input_error_count,
+                'match_seconds_total': self._match_seconds_total,
+                'matched_count_by_target': dict(self._matched_count_by_target)
+            }
+
+
+class EmailRouterInboundProcessor:
+    """
+    Dispatches inbound emails to the router for their instance type, so one process can serve several
+    instance types.  Each instance type keeps its own router (rules, routing policy), match statistics and,
+    when dedupe_ttl_seconds is given, its own cache of recently seen emails for dropping webhook retries and,
+    when admission rates are given, its own token buckets for sender domains, sender IPs and targets.
+    """
+
+    @property
+    def router_instance_types(self) -> List[RouterInstanceType]:
+        return sorted(self._email_routers.keys(), key=lambda x: x.name)
+
+    @property
+    def dedupe_enabled(self) -> bool:
+        return len(self._dedupe_caches) > 0
+
+    @property
+    def admission_control_enabled(self) -> bool:
+        return len(self._admission_controllers) > 0
+
+    def __init__(self,
+                 email_routers: Iterable[EmailRouter],
+                 dedupe_ttl_seconds: Optional[float] = None,
+                 dedupe_capacity: int = 100000,
+                 admission_rates_per_second: Optional[Dict[EmailRouterAdmissionDimension, float]] = None,
+                 admission_burst_seconds: float = 10.0,
+                 admission_tracked_key_capacity: int = 10000):
+        self._email_routers: Dict[RouterInstanceType, EmailRouter] = dict()
+        self._match_statistics: Dict[RouterInstanceType, EmailRouterMatchStatistics] = dict()
+        self._dedupe_caches: Dict[RouterInstanceType, EmailRouterDedupeCache] = dict()
+        self._admission_controllers: Dict[RouterInstanceType, EmailRouterAdmissionController] = dict()
+
+        admission_enabled = admission_rates_per_second is not None and \
+            any(x is not None and x > 0 for x in admission_rates_per_second.values())
+
+        for this_email_router in email_routers:
+            if this_email_router.router_instance_type in self._email_routers:
+                raise ValueError('Cannot initialize ' + type(self).__name__ + ': more than one router for ' +
+                                 'instance type ' + this_email_router.router_instance_type.name)
+            self._email_routers[this_email_router.router_instance_type] = this_email_router
+            self._match_statistics[this_email_router.router_instance_type] = EmailRouterMatchStatistics()
+            if dedupe_ttl_seconds is not None:
+                self._dedupe_caches[this_email_router.router_instance_type] = \
+                    EmailRouterDedupeCache(ttl_seconds=dedupe_ttl_seconds, capacity=dedupe_capacity)
+            if admission_enabled:
+                self._admission_controllers[this_email_router.router_instance_type] = \
+                    EmailRouterAdmissionController(rates_per_second=admission_rates_per_second,
+                                                   burst_seconds=admission_burst_seconds,
+                                                   tracked_key_capacity=admission_tracked_key_capacity)
+
+        if len(self._email_routers) == 0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': at least one router is required')
+
+    def get_email_router(self, router_instance_type: RouterInstanceType) -> EmailRouter:
+        try:
+            return self._email_routers[router_instance_type]
+        except KeyError:
+            raise ValueError('No router for instance type "' + str(router_instance_type) + '"' +
+                             os.linesep + 'Served instance type(s): ' +
+                             ','.join([x.name for x in self.router_instance_types]))
+
+    def get_match_statistics(self, router_instance_type: RouterInstanceType) -> EmailRouterMatchStatistics:
+        self.get_email_router(router_instance_type)
+        return self._match_statistics[router_instance_type]
+
+    def check_duplicate(self,
+                        router_instance_type: RouterInstanceType,
+                        dedupe_key: Optional[str]) -> EmailRouterDedupeStatus:
+        """
+        DUPLICATE if an email with this dedupe key was already processed for the instance type within the ttl,
+        IN_FLIGHT if one is being processed.  Otherwise NEW, and the key is in flight until the email is
+        processed - call complete_dedupe_key, or forget_dedupe_key if it fails
+        """
+        self.get_email_router(router_instance_type)
+        if dedupe_key is None or router_instance_type not in self._dedupe_caches:
+            return EmailRouterDedupeStatus.NEW
+        return self._dedupe_caches[router_instance_type].check_and_add(dedupe_key)
+
+    def complete_dedupe_key(self,
+                            router_instance_type: RouterInstanceType,
+                            dedupe_key: Optional[str]):
+        if dedupe_key is not None and router_instance_type in self._dedupe_caches:
+            self._dedupe_caches[router_instance_type].complete(dedupe_key)
+
+    def forget_dedupe_key(self,
+                          router_instance_type: RouterInstanceType,
+                          dedupe_key: Optional[str]):
+        if dedupe_key is not None and router_instance_type in self._dedupe_caches:
+            self._dedupe_caches[router_instance_type].remove(dedupe_key)
+
+    def check_sender_admission(self,
+                               router_instance_type: RouterInstanceType,
+                               sender_info: EmailRouterInboundSenderInfo) \
+            -> Optional[EmailRouterAdmissionDimension]:
+        """
+        Take a token for the sender domain and sender IP.  Returns the dimension that is over its limit, if any
+        """
+        admission_controller = self._admission_controllers.get(router_instance_type)
+        if admission_controller is None:
+            return None
+        if not admission_controller.admit(EmailRouterAdmissionDimension.SENDER_DOMAIN, sender_info.sender_domain):
+            return EmailRouterAdmissionDimension.SENDER_DOMAIN
+        if not admission_controller.admit(EmailRouterAdmissionDimension.SENDER_IP, sender_info.sender_ip):
+            return EmailRouterAdmissionDimension.SENDER_IP
+        return None
+
+    def check_target_admission(self,
+                               router_instance_type: RouterInstanceType,
+                               match_result_collection: EmailRouterMatchResultCollection) \
+            -> Optional[EmailRouterAdmissionDimension]:
+        """
+        Take a token for each matched target.  Returns TARGET if any of them is over its limit
+        """
+        admission_controller = self._admission_controllers.get(router_instance_type)
+        if admission_controller is None:
+            return None
+        for this_result in match_result_collection.matched_target_results:
+            if not admission_controller.admit(EmailRouterAdmissionDimension.TARGET,
+                                              this_result.matched_target_name):
+                return EmailRouterAdmissionDimension.TARGET
+        return None
+
+    def get_retry_after_seconds(self,
+                                router_instance_type: RouterInstanceType,
+                                dimension: EmailRouterAdmissionDimension) -> int:
+        admission_controller = self._admission_controllers.get(router_instance_type)
+        return 1 if admission_controller is None else admission_controller.get_retry_after_seconds(dimension)
+
+    def match_inbound_email(self,
+                            router_instance_type: RouterInstanceType,
+                            address_to_collection: Collection[str],
+                            address_from: str,
+                            sender_ip: str,
+                            attachment_included: Optional[bool] = None,
+                            body_size: Optional[int] = None) -> EmailRouterMatchResultCollection:
+        email_router = self.get_email_router(router_instance_type)
+        match_statistics = self._match_statistics[router_instance_type]
+
+        start_time = time.perf_counter()
+        try:
+            match_result_collection = email_router.match_inbound_email(address_to_collection=address_to_collection,
+                                                                       address_from=address_from,
+                                                                       sender_ip=sender_ip,
+                                                                       attachment_included=attachment_included,
+                                                                       body_size=body_size)
+        except EmeraldEmailRouterMatchNotFoundError:
+            match_statistics.record_match_not_found(elapsed_seconds=time.perf_counter() - start_time)
+            raise
+        except EmeraldEmailRouterInputDataError:
+            match_statistics.record_input_error()
+            raise
+
+        match_statistics.record_match(match_result_collection=match_result_collection,
+                                      elapsed_seconds=time.perf_counter() - start_time)
+        return match_result_collection
+
+    def reload(self):
+        """
+        Reload every router from its source.  A router that fails to reload keeps its current rules; the
+        first failure is raised once all routers have been tried
+        """
+        first_exception = None
+        for this_instance_type in self.router_instance_types:
+            try:
+                self._email_routers[this_instance_type].reload()
+            except Exception as ex:
+                if first_exception is None:
+                    first_exception = ex
+        if first_exception is not None:
+            raise first_exception
+
+    def get_metrics_as_dict(self) -> dict:
+        metrics = dict()
+        for this_instance_type in self.router_instance_types:
+            email_router = self._email_routers[this_instance_type]
+            instance_metrics = {
+                'routing_policy': email_router.routing_policy.name,
+                'revision_number': email_router.router_rules_datastore.revision_number,
+                'target_count': email_router.router_rules_datastore.target_count,
+                'match_statistics': self._match_statistics[this_instance_type].get_statistics_as_dict()
+            }
+            if this_instance_type in self._dedupe_caches:
+                instance_metrics['dedupe_statistics'] = \
+                    self._dedupe_caches[this_instance_type].get_statistics_as_dict()
+            if this_instance_type in self._admission_controllers:
+                instance_metrics['admission_statistics'] = \
+                    self._admission_controllers[this_instance_type].get_statistics_as_dict()
+            if email_router.recipient_allowlist is not None:
+                instance_metrics['recipient_allowlist_statistics'] = \
+                    email_router.recipient_allowlist.get_statistics_as_dict()
+            if email_router.shadow_evaluator is not None:
+                instance_metrics['shadow_statistics'] = email_router.shadow_evaluator.get_statistics_as_dict()
+            if email_router.flight_recorder is not None:
+                instance_metrics['flight_recorder_statistics'] = \
+                    email_router.flight_recorder.get_statistics_as_dict()
+            if email_router.predicate_statistics is not None:
+                instance_metrics['predicate_statistics'] = \
+                    email_router.predicate_statistics.get_statistics_as_dict()
+            if email_router.match_cache is not None:
+                instance_metrics['match_cache_statistics'] = email_router.match_cache.get_statistics_as_dict()
+            metrics[this_instance_type.name.lower()] = instance_metrics
+        return metrics
@@ -0,0 +1,147 @@
+import datetime
+import json
+import logging
+import queue
+import threading
+
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+# attributes every LogRecord has - anything else on a record came in through extra= and is written as a field
+_STANDARD_LOG_RECORD_ATTRIBUTES = frozenset(logging.LogRecord('', 0, '', 0, '', None, None).__dict__.keys()) | \
+                                  frozenset(['message', 'asctime'])
+
+
+class EmailRouterJsonFormatter(logging.Formatter):
+    """
+    One compact JSON object per record: ts, level, logger, message, any extra= fields and the exception if any
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        log_entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, tz=datetime.timezone.utc).isoformat(
+                timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field_name, field_value in record.__dict__.items():
+            if field_name not in _STANDARD_LOG_RECORD_ATTRIBUTES and not field_name.startswith('_'):
+                log_entry[field_name] = field_value
+        if record.exc_info:
+            log_entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            log_entry['exception'] = record.exc_text
+        return json.dumps(log_entry, separators=(',', ':'), default=str)
+
+
+class EmailRouterQueueLogHandler(QueueHandler):
+    """
+    Hands records to a bounded queue for a background writer and never blocks the caller.  Once the queue is
+    past its high water mark only one in debug_sample_interval debug records is kept; when it is full every
+    record is dropped.  Drops are counted.
+    """
+
+    def __init__(self,
+                 log_queue: queue.Queue,
+                 high_water_mark: int,
+                 debug_sample_interval: int = 10):
+        super().__init__(log_queue)
+        self._high_water_mark = high_water_mark
+        self._debug_sample_interval = max(1, debug_sample_interval)
+        self._counter_lock = threading.Lock()
+        self._debug_seen_under_pressure = 0
+        self._sampled_out_count = 0
+        self._dropped_count = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # merge the message arguments now (they may change after we return) but leave formatting to the writer
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record: logging.LogRecord):
+        if record.levelno <= logging.DEBUG and self.queue.qsize() >= self._high_water_mark:
+            with self._counter_lock:
+                self._debug_seen_under_pressure += 1
+                if self._debug_seen_under_pressure % self._debug_sample_interval != 0:
+                    self._sampled_out_count += 1
+                    return
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            with self._counter_lock:
+                self._dropped_count += 1
+        except Exception:
+            self.handleError(record)
+
+    def get_statistics_as_dict(self) -> dict:
+        with self._counter_lock:
+            return {
+                'queued_count': self.queue.qsize(),
+                'sampled_out_debug_count': self._sampled_out_count,
+                'dropped_count': self._dropped_count
+            }
+
+
+class EmailRouterQueueLogging:
+    """
+    Structured (JSON) logging written by a background thread.  start() attaches the queue handler to the root
+    logger; loggers that keep their own handlers (EmailRouter, the app logger) should use queue_handler instead.
+    """
+
+    @property
+    def queue_handler(self) -> EmailRouterQueueLogHandler:
+        return self._queue_handler
+
+    def __init__(self,
+                 output_handler: Optional[logging.Handler] = None,
+                 queue_size: int = 10000,
+                 debug_sample_interval: int = 10):
+        if queue_size < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': queue_size must be at least 1 ' +
+                             '(value = ' + str(queue_size) + ')')
+
+        self._output_handler = output_handler if output_handler is not None else logging.StreamHandler()
+        self._output_handler.setFormatter(EmailRouterJsonFormatter())
+
+        log_queue = queue.Queue(maxsize=queue_size)
+        self._queue_handler = EmailRouterQueueLogHandler(log_queue=log_queue,
+                                                         high_water_mark=max(1, queue_size // 2),
+                                                         debug_sample_interval=debug_sample_interval)
+        self._queue_listener = QueueListener(log_queue, self._output_handler, respect_handler_level=True)
+        self._started = False
+
+    def start(self):
+        if self._started:
+            return
+        logging.getLogger().addHandler(self._queue_handler)
+        self._queue_listener.start()
+        self._started = True
+
+    def stop(self):
+        """
+        Detach from the root logger and write out whatever is still queued
+        """
+        if not self._started:
+            return
+        logging.getLogger().removeHandler(self._queue_handler)
+        self._queue_listener.stop()
+        self._started = False
+
+    def attach(self, logger: logging.Logger):
+        """
+        Send a logger that has its own handlers through the queue instead
+        """
+        for this_handler in list(logger.handlers):
+            logger.removeHandler(this_handler)
+        logger.addHandler(self._queue_handler)
+        # the root logger has the queue handler too
+        logger.propagate = False
+
+    def get_statistics_as_dict(self) -> dict:
+        return self._queue_handler.get_statistics_as_dict()
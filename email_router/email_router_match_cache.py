@@ -0,0 +1,175 @@
+import os
+import json
+import threading
+
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+#
+# Routing cache: the matched targets of recently routed envelopes, so a frequent sender / recipient / sender ip
+#  combination is not evaluated against the rules again.  Only matches are cached (no match errors carry a log
+#  of the checks made) and the cache is emptied whenever the rules are (re)loaded.
+#
+# The hottest entries can be written to a snapshot file at shutdown and the next process warms its cache from
+#  it - the snapshot keeps the keys and target names only, the keys are matched again against the rules loaded
+#  then (see EmailRouter.warm_match_cache).
+#
+_MATCH_CACHE_SNAPSHOT_VERSION = 1
+
+
+class EmailRouterMatchCacheKey(NamedTuple):
+    address_to_collection: Tuple[str, ...]
+    address_from: str
+    sender_ip: str
+    # None unless the rules test them - otherwise every body size would be a key of its own
+    attachment_included: Optional[bool] = None
+    body_size: Optional[int] = None
+
+
+class EmailRouterMatchCacheEntry(NamedTuple):
+    key: EmailRouterMatchCacheKey
+    target_names: Tuple[str, ...]
+    hit_count: int = 0
+
+
+class EmailRouterMatchCacheSnapshot(NamedTuple):
+    # which of the optional key fields the entries were keyed on - entries keyed differently do not fit rules
+    #  that test other fields
+    keyed_on_attachment: bool
+    keyed_on_body_size: bool
+    entries: List[EmailRouterMatchCacheEntry]
+
+
+class EmailRouterMatchCache:
+    """
+    Least recently used cache of match results, capacity entries at most.  Results are tied to the rules
+    datastore they were matched against - put() drops results for any datastore but the one of the last reset()
+    """
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    def __init__(self, capacity: int = 10000):
+        if capacity < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': capacity must be at least 1 ' +
+                             '(value = ' + str(capacity) + ')')
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        # key -> [cached value, hit count]
+        self._entries: 'OrderedDict[EmailRouterMatchCacheKey, list]' = OrderedDict()
+        self._rules_datastore = None
+        self._hit_count = 0
+        self._miss_count = 0
+
+    def reset(self, rules_datastore):
+        with self._lock:
+            self._entries.clear()
+            self._rules_datastore = rules_datastore
+
+    def get(self, key: EmailRouterMatchCacheKey):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._miss_count += 1
+                return None
+            self._entries.move_to_end(key)
+            entry[1] += 1
+            self._hit_count += 1
+            return entry[0]
+
+    def put(self,
+            key: EmailRouterMatchCacheKey,
+            value,
+            rules_datastore,
+            hit_count: int = 0):
+        with self._lock:
+            # matched against rules replaced while the match ran
+            if rules_datastore is not self._rules_datastore:
+                return
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[0] = value
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = [value, hit_count]
+            if len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+
+    def get_hottest(self, count: int) -> List[Tuple[EmailRouterMatchCacheKey, object, int]]:
+        """
+        The count most hit entries as (key, value, hit count), most hit first
+        """
+        with self._lock:
+            entries = [(x, y[0], y[1]) for x, y in self._entries.items()]
+        return sorted(entries, key=lambda x: x[2], reverse=True)[:count]
+
+    def get_statistics_as_dict(self) -> dict:
+        with self._lock:
+            lookup_count = self._hit_count + self._miss_count
+            return {
+                'capacity': self._capacity,
+                'size': len(self._entries),
+                'hit_count': self._hit_count,
+                'miss_count': self._miss_count,
+                'hit_rate': self._hit_count / lookup_count if lookup_count > 0 else None
+            }
+
+
+def save_match_cache_snapshots(snapshot_path: str,
+                               snapshots_by_instance_type_name: Dict[str, EmailRouterMatchCacheSnapshot]):
+    """
+    Write the snapshots of every instance type to one file, replacing it only once the new one is complete
+    """
+    snapshot_json = {
+        'version': _MATCH_CACHE_SNAPSHOT_VERSION,
+        'instance_types': {
+            instance_type_name: {
+                'keyed_on_attachment': this_snapshot.keyed_on_attachment,
+                'keyed_on_body_size': this_snapshot.keyed_on_body_size,
+                'entries': [{
+                    'to': list(x.key.address_to_collection),
+                    'from': x.key.address_from,
+                    'sender_ip': x.key.sender_ip,
+                    'attachment_included': x.key.attachment_included,
+                    'body_size': x.key.body_size,
+                    'targets': list(x.target_names),
+                    'hits': x.hit_count
+                } for x in this_snapshot.entries]
+            } for instance_type_name, this_snapshot in snapshots_by_instance_type_name.items()
+        }
+    }
+    temporary_path = snapshot_path + '.tmp'
+    with open(temporary_path, mode='w', encoding='utf-8') as snapshot_file:
+        json.dump(snapshot_json, snapshot_file)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary_path, snapshot_path)
+
+
+def load_match_cache_snapshots(snapshot_path: str) -> Dict[str, EmailRouterMatchCacheSnapshot]:
+    """
+    Read the snapshots written by save_match_cache_snapshots - ValueError if the file is not one
+    """
+    with open(snapshot_path, mode='r', encoding='utf-8') as snapshot_file:
+        snapshot_json = json.load(snapshot_file)
+
+    try:
+        if snapshot_json['version'] != _MATCH_CACHE_SNAPSHOT_VERSION:
+            raise ValueError('Unsupported routing cache snapshot version ' + str(snapshot_json['version']))
+        return {
+            instance_type_name: EmailRouterMatchCacheSnapshot(
+                keyed_on_attachment=bool(this_snapshot['keyed_on_attachment']),
+                keyed_on_body_size=bool(this_snapshot['keyed_on_body_size']),
+                entries=[EmailRouterMatchCacheEntry(
+                    key=EmailRouterMatchCacheKey(address_to_collection=tuple(str(y) for y in x['to']),
+                                                 address_from=str(x['from']),
+                                                 sender_ip=str(x['sender_ip']),
+                                                 attachment_included=x['attachment_included'],
+                                                 body_size=x['body_size']),
+                    target_names=tuple(str(y) for y in x['targets']),
+                    hit_count=int(x['hits'])) for x in this_snapshot['entries']])
+            for instance_type_name, this_snapshot in snapshot_json['instance_types'].items()
+        }
+    except (KeyError, TypeError, AttributeError) as ex:
+        raise ValueError('Malformed routing cache snapshot (' + type(ex).__name__ + ': ' + str(ex) + ')')
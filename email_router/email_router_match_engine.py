@@ -0,0 +1,22 @@
+import os
+
+from enum import unique, Enum, auto
+
+
+@unique
+class EmailRouterMatchEngine(Enum):
+    # walk targets and rules in priority order, evaluating each rule's checks until one fails
+    WALK = auto()
+    # evaluate each kind of check once per email as a bitmask over all rules (see email_router_bitset_index)
+    BITSET = auto()
+
+    @staticmethod
+    def from_string(engine_name: str):
+        try:
+            new_value = EmailRouterMatchEngine[engine_name.upper()]
+        except KeyError:
+            raise ValueError('Unable to initialize ' + EmailRouterMatchEngine.__name__ + ' with name "' +
+                             str(engine_name) + '" (type=' + str(type(engine_name)) +
+                             os.linesep + 'Must be one of: ' +
+                             ','.join([x.name for x in EmailRouterMatchEngine]))
+        return new_value
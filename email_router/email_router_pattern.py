@@ -0,0 +1,52 @@
+from typing import NamedTuple, Optional
+
+# characters that carry meaning in a python regular expression when not escaped
+_REGEX_METACHARACTERS = frozenset('.^$*+?{}[]|()\\')
+
+
+class EmailRouterLiteralPattern(NamedTuple):
+    literal: str
+    exact_match: bool
+    anchored_start: bool = False
+    anchored_end: bool = False
+
+
+def get_literal_from_pattern(pattern: Optional[str]) -> Optional[EmailRouterLiteralPattern]:
+    """
+    Router patterns are applied with re.search(pattern, value, re.IGNORECASE).  Many of them are really plain
+    strings such as "bseglobal\\.net" - for those return the unescaped (lowercase) literal, and whether the
+    pattern is anchored at the start and/or end (both means exact match, neither means substring match).
+    Returns None if the pattern uses any regex construct we cannot reduce to a literal.
+    """
+    if pattern is None or len(pattern) == 0:
+        return None
+
+    anchored_start = pattern.startswith('^')
+    anchored_end = pattern.endswith('$') and not pattern.endswith('\\$')
+    body = pattern[1 if anchored_start else 0:len(pattern) - 1 if anchored_end else len(pattern)]
+
+    literal_chars = list()
+    position = 0
+    while position < len(body):
+        this_char = body[position]
+        if this_char == '\\':
+            # only escaped punctuation is a literal - \d, \w, \b and friends are character classes or assertions
+            if position + 1 >= len(body) or body[position + 1].isalnum():
+                return None
+            literal_chars.append(body[position + 1])
+            position += 2
+            continue
+        if this_char in _REGEX_METACHARACTERS:
+            return None
+        literal_chars.append(this_char)
+        position += 1
+
+    literal = ''.join(literal_chars)
+    # case folding for non-ascii text differs between str.lower and re.IGNORECASE so leave those to the regex
+    if len(literal) == 0 or any(ord(x) > 127 for x in literal):
+        return None
+
+    return EmailRouterLiteralPattern(literal=literal.lower(),
+                                     exact_match=anchored_start and anchored_end,
+                                     anchored_start=anchored_start,
+                                     anchored_end=anchored_end)
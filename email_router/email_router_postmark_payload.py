@@ -0,0 +1,262 @@
+import json
+import re
+
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from email_router.email_router_inbound_envelope import EmailRouterInboundEnvelope
+from error import EmeraldEmailRouterInputDataError
+
+#
+# Postmark posts inbound email as one JSON document, attachments included as base64 strings.  Decoding all of it
+#  (json.loads) just to route the email costs time and memory in proportion to the attachments, so the body is
+#  scanned instead: strings are skipped with a search for the closing quote, and only the fields routing needs
+#  (From, To, Cc, OriginalRecipient, Headers, MessageID) are decoded.  Everything else - bodies, attachment
+#  content - stays where it is in the raw body; dispatch forwards the raw body as it is.
+#
+# A decoded field of an unexpected type (e.g. a number for OriginalRecipient) is an input error like malformed
+#  JSON, so the request is dead lettered rather than failed and retried.
+#
+
+_WHITESPACE_REGEX = re.compile(rb'[ \t\r\n]*')
+_STRUCTURE_REGEX = re.compile(rb'["{}\[\]]')
+_PRIMITIVE_REGEX = re.compile(rb'[^ \t\r\n,\]}]+')
+_CLIENT_IP_REGEX = re.compile(r'client-ip=\[?([0-9A-Fa-f:.]+)\]?')
+
+# a span is the (start, end) byte offsets of a JSON value within the body
+_Span = Tuple[int, int]
+
+
+def _get_malformed_error(position: int) -> EmeraldEmailRouterInputDataError:
+    return EmeraldEmailRouterInputDataError('Inbound JSON is malformed near byte ' + str(position))
+
+
+def _check_field_type(value, expected_type: type, field_name: str):
+    """
+    Return value if it is None or of expected_type
+    """
+    if value is not None and not isinstance(value, expected_type):
+        raise EmeraldEmailRouterInputDataError('Inbound JSON field ' + field_name + ' should be of type ' +
+                                               expected_type.__name__ + ' (is ' + type(value).__name__ + ')')
+    return value
+
+
+def _skip_whitespace(body: bytes, position: int) -> int:
+    return _WHITESPACE_REGEX.match(body, position).end()
+
+
+def _skip_string(body: bytes, position: int) -> int:
+    # position is at the opening quote - a quote preceded by an odd number of backslashes is escaped
+    while True:
+        position = body.find(b'"', position + 1)
+        if position < 0:
+            raise _get_malformed_error(len(body))
+        backslash_position = position - 1
+        while body[backslash_position] == 0x5c:
+            backslash_position -= 1
+        if (position - 1 - backslash_position) % 2 == 0:
+            return position + 1
+
+
+def _skip_value(body: bytes, position: int) -> int:
+    if position >= len(body):
+        raise _get_malformed_error(position)
+    if body[position] == 0x22:
+        return _skip_string(body, position)
+    if body[position] not in b'{[':
+        match_result = _PRIMITIVE_REGEX.match(body, position)
+        if match_result is None:
+            raise _get_malformed_error(position)
+        return match_result.end()
+
+    # object or array - only quotes and brackets matter, and string content is jumped over
+    depth = 0
+    while True:
+        match_result = _STRUCTURE_REGEX.search(body, position)
+        if match_result is None:
+            raise _get_malformed_error(len(body))
+        position = match_result.start()
+        if body[position] == 0x22:
+            position = _skip_string(body, position)
+            continue
+        depth += 1 if body[position] in b'{[' else -1
+        position += 1
+        if depth == 0:
+            return position
+
+
+def _scan_object(body: bytes, position: int) -> Dict[str, _Span]:
+    """
+    Spans of the member values of the object starting at position
+    """
+    if body[position:position + 1] != b'{':
+        raise _get_malformed_error(position)
+    member_spans = dict()
+    position = _skip_whitespace(body, position + 1)
+    if body[position:position + 1] == b'}':
+        return member_spans
+    while True:
+        if body[position:position + 1] != b'"':
+            raise _get_malformed_error(position)
+        key_end = _skip_string(body, position)
+        member_name = json.loads(body[position:key_end].decode('utf-8'))
+        position = _skip_whitespace(body, key_end)
+        if body[position:position + 1] != b':':
+            raise _get_malformed_error(position)
+        value_start = _skip_whitespace(body, position + 1)
+        value_end = _skip_value(body, value_start)
+        member_spans[member_name] = (value_start, value_end)
+        position = _skip_whitespace(body, value_end)
+        if body[position:position + 1] == b',':
+            position = _skip_whitespace(body, position + 1)
+            continue
+        if body[position:position + 1] == b'}':
+            return member_spans
+        raise _get_malformed_error(position)
+
+
+def _scan_array(body: bytes, position: int) -> List[_Span]:
+    if body[position:position + 1] != b'[':
+        raise _get_malformed_error(position)
+    element_spans = list()
+    position = _skip_whitespace(body, position + 1)
+    if body[position:position + 1] == b']':
+        return element_spans
+    while True:
+        element_end = _skip_value(body, position)
+        element_spans.append((position, element_end))
+        position = _skip_whitespace(body, element_end)
+        if body[position:position + 1] == b',':
+            position = _skip_whitespace(body, position + 1)
+            continue
+        if body[position:position + 1] == b']':
+            return element_spans
+        raise _get_malformed_error(position)
+
+
+class EmailRouterPostmarkAttachment(NamedTuple):
+    name: Optional[str]
+    content_type: Optional[str]
+    content_length: Optional[int]
+    content_id: Optional[str]
+
+
+class EmailRouterPostmarkInboundMessage:
+    """
+    A Postmark inbound webhook body, scanned but not decoded.  inbound_envelope holds what routing, dedupe and
+    admission need (in the same form as for SendGrid posts); get_field decodes the rest on request.
+    """
+
+    @property
+    def inbound_envelope(self) -> EmailRouterInboundEnvelope:
+        return self._inbound_envelope
+
+    @property
+    def attachments(self) -> List[EmailRouterPostmarkAttachment]:
+        return self._attachments
+
+    def __init__(self,
+                 body: bytes,
+                 body_size: Optional[int] = None):
+        self._body = body
+        position = _skip_whitespace(body, 0)
+        self._member_spans = _scan_object(body, position)
+
+        self._attachments = list()
+        if 'Attachments' in self._member_spans and body[self._member_spans['Attachments'][0]] == 0x5b:
+            for (element_start, _) in _scan_array(body, self._member_spans['Attachments'][0]):
+                attachment_spans = _scan_object(body, element_start)
+                self._attachments.append(EmailRouterPostmarkAttachment(
+                    name=_check_field_type(self._decode_span(attachment_spans.get('Name')), str,
+                                           'Attachments.Name'),
+                    content_type=_check_field_type(self._decode_span(attachment_spans.get('ContentType')), str,
+                                                   'Attachments.ContentType'),
+                    content_length=_check_field_type(self._decode_span(attachment_spans.get('ContentLength')), int,
+                                                     'Attachments.ContentLength'),
+                    content_id=_check_field_type(self._decode_span(attachment_spans.get('ContentID')), str,
+                                                 'Attachments.ContentID')))
+
+        self._inbound_envelope = self._build_inbound_envelope(body_size=body_size if body_size is not None
+                                                              else len(body))
+
+    def _decode_span(self, span: Optional[_Span]):
+        if span is None:
+            return None
+        try:
+            return json.loads(self._body[span[0]:span[1]].decode('utf-8'))
+        except ValueError:
+            raise _get_malformed_error(span[0])
+
+    def get_field(self, field_name: str):
+        """
+        Decode one top-level field (e.g. TextBody) - None if the message does not have it
+        """
+        return self._decode_span(self._member_spans.get(field_name))
+
+    def _get_typed_field(self, field_name: str, expected_type: type):
+        return _check_field_type(self.get_field(field_name), expected_type, field_name)
+
+    def _build_inbound_envelope(self, body_size: int) -> EmailRouterInboundEnvelope:
+        from_full = self._get_typed_field('FromFull', dict)
+        address_from = _check_field_type(from_full.get('Email'), str, 'FromFull.Email') \
+            if from_full is not None else None
+        if address_from is None:
+            address_from = self._get_typed_field('From', str)
+
+        # the address the email was delivered to, else everyone it was addressed to
+        original_recipient = self._get_typed_field('OriginalRecipient', str)
+        if original_recipient is not None and len(original_recipient) > 0:
+            address_to_collection = [original_recipient]
+        else:
+            address_to_collection = list()
+            for field_name in ('ToFull', 'CcFull'):
+                for this_recipient in self._get_typed_field(field_name, list) or list():
+                    _check_field_type(this_recipient, dict, field_name + ' element')
+                    recipient_address = _check_field_type(this_recipient.get('Email'), str, field_name + '.Email')
+                    if recipient_address is not None:
+                        address_to_collection.append(recipient_address)
+
+        headers = self._get_typed_field('Headers', list) or list()
+        header_values = dict()
+        for this_header in headers:
+            _check_field_type(this_header, dict, 'Headers element')
+            _check_field_type(this_header.get('Name'), str, 'Headers.Name')
+            _check_field_type(this_header.get('Value'), str, 'Headers.Value')
+            header_values.setdefault(this_header.get('Name', '').lower(), this_header.get('Value', ''))
+
+        sender_ip = None
+        client_ip_match = _CLIENT_IP_REGEX.search(header_values.get('received-spf', ''))
+        if client_ip_match is not None:
+            sender_ip = client_ip_match.group(1)
+        elif 'x-originating-ip' in header_values:
+            sender_ip = header_values['x-originating-ip'].strip('[] ')
+
+        # raw header lines as SendGrid would give them, for the dedupe key - Postmark's own id if there is no
+        #  Message-ID header
+        raw_headers = ''.join([x.get('Name', '') + ': ' + x.get('Value', '') + '\r\n' for x in headers])
+        message_id = self._get_typed_field('MessageID', str)
+        if 'message-id' not in header_values and message_id is not None:
+            raw_headers = 'Message-ID: <' + message_id + '>\r\n' + raw_headers
+
+        form_fields = {
+            'envelope': json.dumps({'to': address_to_collection, 'from': address_from}),
+            'headers': raw_headers,
+            'attachments': str(len(self._attachments))
+        }
+        if address_from is not None:
+            form_fields['from'] = address_from
+        if len(address_to_collection) > 0:
+            form_fields['to'] = ','.join(address_to_collection)
+        if sender_ip is not None:
+            form_fields['sender_ip'] = sender_ip
+        return EmailRouterInboundEnvelope(form_fields=form_fields,
+                                          file_part_count=len(self._attachments),
+                                          body_size=body_size)
+
+
+def get_postmark_inbound_message(inbound_request) -> EmailRouterPostmarkInboundMessage:
+    """
+    Scan a Postmark inbound webhook POST.  The raw body is kept on the request (get_data(cache=True)) for the
+    spool and for forwarding
+    """
+    return EmailRouterPostmarkInboundMessage(body=inbound_request.get_data(cache=True),
+                                             body_size=inbound_request.content_length)
@@ -0,0 +1,133 @@
+import re
+import threading
+
+from enum import unique, Enum, auto
+from typing import Collection, List, Optional, Pattern
+
+from email_router.email_router_bloom_filter import EmailRouterBloomFilter
+from email_router.email_router_pattern import get_literal_from_pattern
+
+
+@unique
+class EmailRouterRecipientAllowlistMode(Enum):
+    # some rule does not test the recipient - every email may match
+    OPEN = auto()
+    # recipient names that reduce to literals are held in a set
+    EXACT = auto()
+    # too many literal names for a set - held in a Bloom filter (may let a few unknown names through)
+    BLOOM = auto()
+
+
+class EmailRouterRecipientAllowlist:
+    """
+    Answers "can any rule match an email to these recipients?" from the recipient_name checks of a rule base, so
+    emails to inboxes no rule knows are turned away before they are matched against every target.
+
+    Recipient patterns that reduce to exact literals (e.g. ^orders$) are looked up in a set, or in a Bloom
+    filter when there are more than exact_set_limit of them; any other pattern is kept and searched.  An email
+    passes if any of its recipient names passes.  Never rejects an email a rule could match.
+    """
+
+    @property
+    def mode(self) -> EmailRouterRecipientAllowlistMode:
+        return self._mode
+
+    @property
+    def literal_name_count(self) -> int:
+        return self._literal_name_count
+
+    @property
+    def residual_pattern_count(self) -> int:
+        return len(self._residual_patterns)
+
+    # chance that an unknown literal name is let through
+    @property
+    def false_positive_rate(self) -> float:
+        return self._bloom_filter.estimated_false_positive_rate if self._bloom_filter is not None else 0.0
+
+    def __init__(self,
+                 recipient_patterns: Collection[Optional[str]],
+                 exact_set_limit: int = 100000,
+                 false_positive_rate: float = 0.001):
+        """
+        recipient_patterns holds the recipient_name of every rule (None for a rule without one)
+        """
+        self._literal_names = frozenset()
+        self._bloom_filter: Optional[EmailRouterBloomFilter] = None
+        self._residual_patterns: List[Pattern] = list()
+        self._literal_name_count = 0
+
+        self._lock = threading.Lock()
+        self._checked_count = 0
+        self._rejected_count = 0
+
+        if len(recipient_patterns) == 0 or any(x is None or len(x) == 0 for x in recipient_patterns):
+            self._mode = EmailRouterRecipientAllowlistMode.OPEN
+            return
+
+        literal_names = set()
+        residual_patterns = set()
+        for this_pattern in recipient_patterns:
+            literal_pattern = get_literal_from_pattern(this_pattern)
+            if literal_pattern is not None and literal_pattern.exact_match:
+                literal_names.add(literal_pattern.literal)
+            else:
+                residual_patterns.add(this_pattern)
+
+        self._residual_patterns = [re.compile(x, re.IGNORECASE) for x in sorted(residual_patterns)]
+        self._literal_name_count = len(literal_names)
+        if len(literal_names) <= exact_set_limit:
+            self._mode = EmailRouterRecipientAllowlistMode.EXACT
+            self._literal_names = frozenset(literal_names)
+        else:
+            self._mode = EmailRouterRecipientAllowlistMode.BLOOM
+            self._bloom_filter = EmailRouterBloomFilter(capacity=len(literal_names),
+                                                        false_positive_rate=false_positive_rate)
+            for this_name in literal_names:
+                self._bloom_filter.add(this_name)
+
+    def _name_could_match(self, recipient_name: str) -> bool:
+        # literals are lower case ascii - leave case folding of anything else to the patterns' own rules
+        try:
+            recipient_name.encode('ascii')
+        except UnicodeEncodeError:
+            return True
+        recipient_name_lower = recipient_name.lower()
+        if self._bloom_filter is not None:
+            if recipient_name_lower in self._bloom_filter:
+                return True
+        elif recipient_name_lower in self._literal_names:
+            return True
+        return any(x.search(recipient_name) is not None for x in self._residual_patterns)
+
+    def could_match(self, address_to_collection: Collection[str]) -> bool:
+        """
+        False only if no rule can match an email to these recipients
+        """
+        if self._mode == EmailRouterRecipientAllowlistMode.OPEN:
+            return True
+
+        result = False
+        for this_to_address in address_to_collection:
+            (recipient_name, separator, _) = this_to_address.rpartition('@')
+            # a malformed address (not name@domain) passes no recipient check
+            if len(separator) > 0 and '@' not in recipient_name and self._name_could_match(recipient_name):
+                result = True
+                break
+
+        with self._lock:
+            self._checked_count += 1
+            if not result:
+                self._rejected_count += 1
+        return result
+
+    def get_statistics_as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'mode': self._mode.name,
+                'literal_name_count': self._literal_name_count,
+                'residual_pattern_count': len(self._residual_patterns),
+                'false_positive_rate': self.false_positive_rate,
+                'checked_count': self._checked_count,
+                'rejected_count': self._rejected_count
+            }
@@ -0,0 +1,22 @@
+import os
+
+from enum import unique, Enum, auto
+
+
+@unique
+class EmailRouterRoutingPolicy(Enum):
+    # stop at the highest priority target with a matching rule
+    FIRST_MATCH = auto()
+    # return every target with a matching rule (in target priority order)
+    ALL_MATCHES = auto()
+
+    @staticmethod
+    def from_string(policy_name: str):
+        try:
+            new_value = EmailRouterRoutingPolicy[policy_name.upper()]
+        except KeyError:
+            raise ValueError('Unable to initialize ' + EmailRouterRoutingPolicy.__name__ + ' with name "' +
+                             str(policy_name) + '" (type=' + str(type(policy_name)) +
+                             os.linesep + 'Must be one of: ' +
+                             ','.join([x.name for x in EmailRouterRoutingPolicy]))
+        return new_value
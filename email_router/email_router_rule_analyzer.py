@@ -0,0 +1,242 @@
+import os
+
+from enum import unique, Enum, auto
+from typing import Collection, Iterable, List, NamedTuple, Optional, Tuple
+
+from email_router.email_router_compiled_rules import EmailRouterRuleCompiler, CompiledIpWhitelist
+from email_router.email_router_datastore import EmailRouterTargetConfig, EmailRouterRule, \
+    EmailRouterRuleMatchPattern
+from email_router.email_router_pattern import get_literal_from_pattern
+from email_router.email_router_routing_policy import EmailRouterRoutingPolicy
+
+#
+# Static analysis of a rule base.  Rules within a target are OR'ed, so a rule whose matches are all matched by
+#  another rule of the same target adds nothing.  Under FIRST_MATCH the same holds for a rule whose matches are
+#  all matched by a rule of a higher priority target - that target always wins.
+#
+# Subsumption is decided conservatively, field by field: a rule A covers a rule B if every check of A is implied
+#  by a check of B.  Patterns are only compared when identical or when both reduce to literals (see
+#  email_router_pattern); anything else is assumed not to cover.
+#
+
+
+@unique
+class EmailRouterRuleFindingType(Enum):
+    # same checks as another rule of the target
+    IDENTICAL_RULE = auto()
+    # matches only emails another rule of the target matches
+    SUBSUMED_RULE = auto()
+    # FIRST_MATCH only - matches only emails a rule of a higher priority target matches
+    SHADOWED_BY_HIGHER_PRIORITY_TARGET = auto()
+    # a whitelist entry covered by the other entries of the same whitelist (reported, never pruned)
+    REDUNDANT_WHITELIST_ENTRY = auto()
+
+
+class EmailRouterRuleFinding(NamedTuple):
+    finding_type: EmailRouterRuleFindingType
+    target_name: str
+    match_priority: float
+    covering_target_name: Optional[str]
+    covering_match_priority: Optional[float]
+    detail: str
+
+    # rules that can be removed from the evaluation plan without changing any match result
+    @property
+    def prunable(self) -> bool:
+        return self.finding_type != EmailRouterRuleFindingType.REDUNDANT_WHITELIST_ENTRY
+
+    def __str__(self):
+        covering_text = '' if self.covering_target_name is None else \
+            ' (covered by target "' + self.covering_target_name + '" rule at priority ' + \
+            str(self.covering_match_priority) + ')'
+        return self.finding_type.name + ': target "' + self.target_name + '" rule at priority ' + \
+               str(self.match_priority) + covering_text + ' - ' + self.detail
+
+
+def _pattern_covers(covering_pattern: Optional[str],
+                    covered_pattern: Optional[str]) -> bool:
+    if covering_pattern is None:
+        return True
+    if covered_pattern is None:
+        return False
+    if covering_pattern == covered_pattern:
+        return True
+
+    covering_literal = get_literal_from_pattern(covering_pattern)
+    covered_literal = get_literal_from_pattern(covered_pattern)
+    if covering_literal is None or covered_literal is None:
+        return False
+
+    # every value the covered pattern matches contains its literal at the anchored position(s)
+    if covering_literal.anchored_start and not covered_literal.anchored_start:
+        return False
+    if covering_literal.anchored_end and not covered_literal.anchored_end:
+        return False
+    if covering_literal.anchored_start and covering_literal.anchored_end:
+        return covering_literal.literal == covered_literal.literal
+    if covering_literal.anchored_start:
+        return covered_literal.literal.startswith(covering_literal.literal)
+    if covering_literal.anchored_end:
+        return covered_literal.literal.endswith(covering_literal.literal)
+    return covering_literal.literal in covered_literal.literal
+
+
+def _ranges_cover(covering_ranges: List[Tuple[int, int]],
+                  covered_ranges: List[Tuple[int, int]]) -> bool:
+    # both lists are merged (sorted, disjoint, not adjacent) so each covered range must sit inside one range
+    for (range_start, range_end) in covered_ranges:
+        if not any(x[0] <= range_start and range_end <= x[1] for x in covering_ranges):
+            return False
+    return True
+
+
+def _whitelist_covers(covering_whitelist: Optional[CompiledIpWhitelist],
+                      covered_whitelist: Optional[CompiledIpWhitelist]) -> bool:
+    if covering_whitelist is None:
+        return True
+    if covered_whitelist is None:
+        return False
+    return _ranges_cover(covering_whitelist.ipv4_ranges, covered_whitelist.ipv4_ranges) and \
+        _ranges_cover(covering_whitelist.ipv6_ranges, covered_whitelist.ipv6_ranges)
+
+
+class _AnalyzedRule:
+    __slots__ = ('target_name', 'target_priority', 'match_priority', 'match_pattern', 'ip_whitelist')
+
+    def __init__(self,
+                 target_config: EmailRouterTargetConfig,
+                 router_rule: EmailRouterRule,
+                 rule_compiler: EmailRouterRuleCompiler):
+        self.target_name = target_config.target_name
+        self.target_priority = target_config.target_priority
+        self.match_priority = router_rule.match_priority
+        self.match_pattern: EmailRouterRuleMatchPattern = router_rule.match_pattern
+        self.ip_whitelist = rule_compiler.compile_ip_whitelist(
+            None if router_rule.match_pattern.sender_ip_whitelist is None else
+            [str(x) for x in router_rule.match_pattern.sender_ip_whitelist])
+
+    def covers(self, other) -> bool:
+        """
+        True if every email matching other also matches this rule
+        """
+        this_pattern = self.match_pattern
+        other_pattern = other.match_pattern
+
+        if this_pattern.attachment_included is not None and \
+                this_pattern.attachment_included != other_pattern.attachment_included:
+            return False
+        if this_pattern.body_size_minimum is not None and \
+                (other_pattern.body_size_minimum is None or
+                 other_pattern.body_size_minimum < this_pattern.body_size_minimum):
+            return False
+        if this_pattern.body_size_maximum is not None and \
+                (other_pattern.body_size_maximum is None or
+                 other_pattern.body_size_maximum > this_pattern.body_size_maximum):
+            return False
+
+        return _pattern_covers(this_pattern.sender_domain, other_pattern.sender_domain) and \
+            _pattern_covers(this_pattern.sender_name, other_pattern.sender_name) and \
+            _pattern_covers(this_pattern.recipient_name, other_pattern.recipient_name) and \
+            _whitelist_covers(self.ip_whitelist, other.ip_whitelist)
+
+
+def _describe_cover(covering_rule: _AnalyzedRule, covered_rule: _AnalyzedRule) -> str:
+    details = list()
+    for field_name in ('sender_domain', 'sender_name', 'recipient_name'):
+        covering_value = getattr(covering_rule.match_pattern, field_name)
+        covered_value = getattr(covered_rule.match_pattern, field_name)
+        if covering_value is not None and covering_value != covered_value:
+            details.append(field_name + ' "' + covered_value + '" within "' + covering_value + '"')
+    if covering_rule.ip_whitelist is not None and \
+            covering_rule.ip_whitelist.cidrs != covered_rule.ip_whitelist.cidrs:
+        details.append('sender_ip_whitelist fully covered by ' + ','.join(covering_rule.ip_whitelist.cidrs))
+    if covering_rule.match_pattern.body_size_minimum is not None or \
+            covering_rule.match_pattern.body_size_maximum is not None:
+        details.append('body size range within ' + str(covering_rule.match_pattern.body_size_minimum) + '..' +
+                       str(covering_rule.match_pattern.body_size_maximum))
+    return '; '.join(details) if len(details) > 0 else 'covering rule has fewer checks'
+
+
+def _find_redundant_whitelist_entries(analyzed_rule: _AnalyzedRule,
+                                      rule_compiler: EmailRouterRuleCompiler) -> List[EmailRouterRuleFinding]:
+    findings = list()
+    if analyzed_rule.ip_whitelist is None or len(analyzed_rule.ip_whitelist) < 2:
+        return findings
+
+    cidrs = list(analyzed_rule.ip_whitelist.cidrs)
+    redundant_indexes = set()
+    for this_index, this_cidr in enumerate(cidrs):
+        # leave out entries already reported so that all reported entries can be dropped together
+        other_cidrs = [cidrs[x] for x in range(len(cidrs)) if x != this_index and x not in redundant_indexes]
+        if _whitelist_covers(rule_compiler.compile_ip_whitelist(other_cidrs),
+                             rule_compiler.compile_ip_whitelist([this_cidr])):
+            redundant_indexes.add(this_index)
+            findings.append(EmailRouterRuleFinding(
+                finding_type=EmailRouterRuleFindingType.REDUNDANT_WHITELIST_ENTRY,
+                target_name=analyzed_rule.target_name,
+                match_priority=analyzed_rule.match_priority,
+                covering_target_name=None,
+                covering_match_priority=None,
+                detail='whitelist entry "' + this_cidr + '" is covered by the other entries'))
+    return findings
+
+
+def analyze_target_configs(target_configs: Collection[EmailRouterTargetConfig],
+                           routing_policy: EmailRouterRoutingPolicy = EmailRouterRoutingPolicy.ALL_MATCHES) \
+        -> List[EmailRouterRuleFinding]:
+    """
+    Find rules that can never change a routing result (identical, subsumed or - under FIRST_MATCH - shadowed by
+    a higher priority target) and redundant whitelist entries.  Every rule reported as prunable is covered by a
+    rule that is not, so all prunable rules can be removed together.
+    """
+    rule_compiler = EmailRouterRuleCompiler()
+    analyzed_rules_by_target: List[List[_AnalyzedRule]] = [
+        [_AnalyzedRule(target_config=this_target, router_rule=x, rule_compiler=rule_compiler)
+         for x in sorted(this_target.router_rules)]
+        for this_target in sorted(target_configs)
+    ]
+
+    findings: List[EmailRouterRuleFinding] = list()
+    for target_index, these_rules in enumerate(analyzed_rules_by_target):
+        for rule_index, this_rule in enumerate(these_rules):
+            findings.extend(_find_redundant_whitelist_entries(this_rule, rule_compiler=rule_compiler))
+
+            # candidates: the other rules of the target, then (FIRST_MATCH) rules of higher priority targets.
+            #  Of two rules covering each other the one evaluated first is kept
+            covering_finding = None
+            for other_index, other_rule in enumerate(these_rules):
+                if other_index == rule_index or not other_rule.covers(this_rule):
+                    continue
+                if this_rule.covers(other_rule):
+                    if other_index > rule_index:
+                        continue
+                    finding_type = EmailRouterRuleFindingType.IDENTICAL_RULE
+                else:
+                    finding_type = EmailRouterRuleFindingType.SUBSUMED_RULE
+                covering_finding = (finding_type, other_rule)
+                break
+
+            if covering_finding is None and routing_policy == EmailRouterRoutingPolicy.FIRST_MATCH:
+                for earlier_rules in analyzed_rules_by_target[:target_index]:
+                    other_rule = next((x for x in earlier_rules if x.covers(this_rule)), None)
+                    if other_rule is not None:
+                        covering_finding = (EmailRouterRuleFindingType.SHADOWED_BY_HIGHER_PRIORITY_TARGET,
+                                            other_rule)
+                        break
+
+            if covering_finding is not None:
+                (finding_type, other_rule) = covering_finding
+                findings.append(EmailRouterRuleFinding(
+                    finding_type=finding_type,
+                    target_name=this_rule.target_name,
+                    match_priority=this_rule.match_priority,
+                    covering_target_name=other_rule.target_name,
+                    covering_match_priority=other_rule.match_priority,
+                    detail='identical checks' if finding_type == EmailRouterRuleFindingType.IDENTICAL_RULE else
+                    _describe_cover(covering_rule=other_rule, covered_rule=this_rule)))
+
+    return findings
+
+
+def get_findings_as_table(findings: Iterable[EmailRouterRuleFinding]) -> str:
+    return os.linesep.join([str(x) for x in findings])
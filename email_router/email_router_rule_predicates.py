@@ -0,0 +1,369 @@
+import os
+
+from enum import unique, Enum, auto
+from netaddr import IPAddress
+from netaddr.core import AddrFormatError
+from typing import Collection, Dict, Iterable, List, Optional, Pattern, Tuple
+
+from email_router.email_router_pattern import EmailRouterLiteralPattern
+from error import EmeraldEmailRouterInputDataError
+
+#
+# Each compiled rule is an AND of predicates.  Predicates have no side effects and never raise, so they can be
+#  evaluated in any order with the same result - we order them cheapest first (integer compares, then range /
+#  literal lookups, then regexes) and, optionally, by how often each kind of predicate rejects an email in
+#  practice.  Input a check cannot evaluate fails that check: a malformed sender ip is in no whitelist and a
+#  malformed recipient (not name@domain) has no name to match.
+#
+
+# estimated relative cost of one evaluation
+PREDICATE_COST_INTEGER_COMPARE = 1.0
+PREDICATE_COST_RANGE_LOOKUP = 2.0
+PREDICATE_COST_LITERAL_COMPARE = 3.0
+PREDICATE_COST_REGEX = 10.0
+# recipient predicates run once per recipient
+PREDICATE_COST_PER_RECIPIENT_FACTOR = 1.5
+
+# below this many evaluations the observed reject rate is not trusted and the static cost alone is used
+PREDICATE_STATISTICS_MINIMUM_SAMPLES = 100
+
+
+@unique
+class EmailRouterPredicateType(Enum):
+    ATTACHMENT_INCLUDED = auto()
+    BODY_SIZE_MINIMUM = auto()
+    BODY_SIZE_MAXIMUM = auto()
+    SENDER_IP_WHITELIST = auto()
+    SENDER_DOMAIN = auto()
+    SENDER_NAME = auto()
+    RECIPIENT_NAME = auto()
+
+
+def _is_ascii(value: str) -> bool:
+    try:
+        value.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _literal_search(literal_pattern: EmailRouterLiteralPattern,
+                    value_lower: str) -> bool:
+    # same answer as re.search(pattern, value, re.IGNORECASE) for an ascii literal and ascii value -
+    #  including "$" also matching in front of a trailing newline
+    literal = literal_pattern.literal
+    if literal_pattern.anchored_start and literal_pattern.anchored_end:
+        return value_lower == literal or value_lower == literal + '\n'
+    if literal_pattern.anchored_start:
+        return value_lower.startswith(literal)
+    if literal_pattern.anchored_end:
+        return value_lower.endswith(literal) or value_lower.endswith(literal + '\n')
+    return literal in value_lower
+
+
+class EmailRouterMatchInput:
+    """
+    The inbound email values a rule is evaluated against.  Anything derived (lower case values, split
+    recipients, the sender ip as an integer) is worked out once per email, on first use.  Only a malformed
+    from address is rejected, up front.
+    """
+    __slots__ = ('address_to_collection',
+                 'address_from',
+                 'sender_ip',
+                 'sender_name',
+                 'sender_domain',
+                 'attachment_included',
+                 'body_size',
+                 '_sender_name_lower',
+                 '_sender_domain_lower',
+                 '_recipient_names',
+                 '_recipient_names_lower',
+                 '_sender_ip_version_and_value')
+
+    def __init__(self,
+                 address_to_collection: Collection[str],
+                 address_from: str,
+                 sender_ip: str,
+                 attachment_included: Optional[bool] = None,
+                 body_size: Optional[int] = None):
+        self.address_to_collection = address_to_collection
+        self.address_from = address_from
+        self.sender_ip = sender_ip
+        self.attachment_included = attachment_included
+        self.body_size = body_size
+
+        # split the from address into domain and name
+        try:
+            (left, right) = address_from.split('@')
+            self.sender_name: str = left
+            self.sender_domain: str = right
+        except ValueError:
+            raise EmeraldEmailRouterInputDataError('Input from_address invalid - should be in form ' +
+                                                   'name@domain' + os.linesep +
+                                                   'Value = ' + address_from)
+
+        self._sender_name_lower = None
+        self._sender_domain_lower = None
+        self._recipient_names = None
+        self._recipient_names_lower = None
+        self._sender_ip_version_and_value = None
+
+    # lower case value for literal compares, or None if the value is not ascii (leave that to the regex)
+    @property
+    def sender_name_lower(self) -> Optional[str]:
+        if self._sender_name_lower is None:
+            self._sender_name_lower = self.sender_name.lower() if _is_ascii(self.sender_name) else False
+        return self._sender_name_lower or None
+
+    @property
+    def sender_domain_lower(self) -> Optional[str]:
+        if self._sender_domain_lower is None:
+            self._sender_domain_lower = self.sender_domain.lower() if _is_ascii(self.sender_domain) else False
+        return self._sender_domain_lower or None
+
+    # names of the well formed recipients only
+    @property
+    def recipient_names(self) -> List[str]:
+        if self._recipient_names is None:
+            recipient_names = list()
+            for this_to_address in self.address_to_collection:
+                try:
+                    (left, right) = this_to_address.split('@')
+                except (AttributeError, ValueError):
+                    continue
+                recipient_names.append(left)
+            self._recipient_names = recipient_names
+        return self._recipient_names
+
+    @property
+    def recipient_names_lower(self) -> List[Optional[str]]:
+        if self._recipient_names_lower is None:
+            self._recipient_names_lower = [x.lower() if _is_ascii(x) else None for x in self.recipient_names]
+        return self._recipient_names_lower
+
+    # None if the sender ip is malformed
+    @property
+    def sender_ip_version_and_value(self) -> Optional[Tuple[int, int]]:
+        if self._sender_ip_version_and_value is None:
+            try:
+                sender_ip_as_address = IPAddress(self.sender_ip)
+                self._sender_ip_version_and_value = (sender_ip_as_address.version, int(sender_ip_as_address))
+            except (AddrFormatError, TypeError, ValueError):
+                self._sender_ip_version_and_value = False
+        return self._sender_ip_version_and_value or None
+
+
+class EmailRouterRulePredicate:
+    __slots__ = ('estimated_cost',)
+
+    predicate_type: EmailRouterPredicateType = None
+    check_name: str = None
+
+    def evaluate(self, match_input: EmailRouterMatchInput) -> bool:
+        raise NotImplementedError('Predicate type ' + type(self).__name__ + ' does not implement evaluate')
+
+    def get_failure_message(self, match_input: EmailRouterMatchInput) -> str:
+        raise NotImplementedError('Predicate type ' + type(self).__name__ + ' does not implement get_failure_message')
+
+
+class AttachmentIncludedPredicate(EmailRouterRulePredicate):
+    __slots__ = ('attachment_included',)
+
+    predicate_type = EmailRouterPredicateType.ATTACHMENT_INCLUDED
+    check_name = 'attachment included'
+
+    def __init__(self, attachment_included: bool):
+        self.attachment_included = attachment_included
+        self.estimated_cost = PREDICATE_COST_INTEGER_COMPARE
+
+    def evaluate(self, match_input: EmailRouterMatchInput) -> bool:
+        return match_input.attachment_included == self.attachment_included
+
+    def get_failure_message(self, match_input: EmailRouterMatchInput) -> str:
+        return 'match failed on attachment included check (rule requires ' + str(self.attachment_included) + ')' + \
+               os.linesep + 'Attachment included was ' + str(match_input.attachment_included)
+
+
+class BodySizeMinimumPredicate(EmailRouterRulePredicate):
+    __slots__ = ('body_size_minimum',)
+
+    predicate_type = EmailRouterPredicateType.BODY_SIZE_MINIMUM
+    check_name = 'body size minimum'
+
+    def __init__(self, body_size_minimum: int):
+        self.body_size_minimum = body_size_minimum
+        self.estimated_cost = PREDICATE_COST_INTEGER_COMPARE
+
+    def evaluate(self, match_input: EmailRouterMatchInput) -> bool:
+        return match_input.body_size is not None and match_input.body_size >= self.body_size_minimum
+
+    def get_failure_message(self, match_input: EmailRouterMatchInput) -> str:
+        return 'match failed on body size minimum check (minimum ' + str(self.body_size_minimum) + ')' + \
+               os.linesep + 'Body size was ' + str(match_input.body_size)
+
+
+class BodySizeMaximumPredicate(EmailRouterRulePredicate):
+    __slots__ = ('body_size_maximum',)
+
+    predicate_type = EmailRouterPredicateType.BODY_SIZE_MAXIMUM
+    check_name = 'body size maximum'
+
+    def __init__(self, body_size_maximum: int):
+        self.body_size_maximum = body_size_maximum
+        self.estimated_cost = PREDICATE_COST_INTEGER_COMPARE
+
+    def evaluate(self, match_input: EmailRouterMatchInput) -> bool:
+        return match_input.body_size is not None and match_input.body_size <= self.body_size_maximum
+
+    def get_failure_message(self, match_input: EmailRouterMatchInput) -> str:
+        return 'match failed on body size maximum check (maximum ' + str(self.body_size_maximum) + ')' + \
+               os.linesep + 'Body size was ' + str(match_input.body_size)
+
+
+class SenderIpWhitelistPredicate(EmailRouterRulePredicate):
+    __slots__ = ('sender_ip_whitelist',)
+
+    predicate_type = EmailRouterPredicateType.SENDER_IP_WHITELIST
+    check_name = 'sender ip'
+
+    # sender_ip_whitelist is a CompiledIpWhitelist
+    def __init__(self, sender_ip_whitelist):
+        self.sender_ip_whitelist = sender_ip_whitelist
+        self.estimated_cost = PREDICATE_COST_RANGE_LOOKUP
+
+    def evaluate(self, match_input: EmailRouterMatchInput) -> bool:
+        sender_ip_version_and_value = match_input.sender_ip_version_and_value
+        if sender_ip_version_and_value is None:
+            return False
+        return self.sender_ip_whitelist.contains(ip_version=sender_ip_version_and_value[0],
+                                                 ip_value=sender_ip_version_and_value[1])
+
+    def get_failure_message(self, match_input: EmailRouterMatchInput) -> str:
+        return 'match failed on sender ip check (whitelist entry count: ' + \
+               str(len(self.sender_ip_whitelist)) + ') ' + \
+               os.linesep + 'Sender ip was "' + str(match_input.sender_ip) + '"' + \
+               (' (not a valid ip address)' if match_input.sender_ip_version_and_value is None else '') + \
+               os.linesep + 'Whitelist pattern was "' + ','.join(self.sender_ip_whitelist.cidrs) + '"'
+
+
+class _PatternPredicate(EmailRouterRulePredicate):
+    __slots__ = ('pattern', 'regex', 'literal_pattern')
+
+    def __init__(self,
+                 pattern: str,
+                 regex: Pattern,
+                 literal_pattern: Optional[EmailRouterLiteralPattern]):
+        self.pattern = pattern
+        self.regex = regex
+        self.literal_pattern = literal_pattern
+        self.estimated_cost = PREDICATE_COST_REGEX if literal_pattern is None else PREDICATE_COST_LITERAL_COMPARE
+
+    def _search(self, value: str, value_lower: Optional[str]) -> bool:
+        if self.literal_pattern is not None and value_lower is not None:
+            return _literal_search(self.literal_pattern, value_lower)
+        return self.regex.search(value) is not None
+
+
+class SenderDomainPredicate(_PatternPredicate):
+    __slots__ = ()
+
+    predicate_type = EmailRouterPredicateType.SENDER_DOMAIN
+    check_name = 'sender domain'
+
+    def evaluate(self, match_input: EmailRouterMatchInput) -> bool:
+        return self._search(match_input.sender_domain, match_input.sender_domain_lower)
+
+    def get_failure_message(self, match_input: EmailRouterMatchInput) -> str:
+        return 'match failed on sender domain check' + \
+               os.linesep + 'Sender domain  was "' + match_input.sender_domain + '"' + \
+               os.linesep + 'Match pattern was "' + self.pattern + '"'
+
+
+class SenderNamePredicate(_PatternPredicate):
+    __slots__ = ()
+
+    predicate_type = EmailRouterPredicateType.SENDER_NAME
+    check_name = 'sender name'
+
+    def evaluate(self, match_input: EmailRouterMatchInput) -> bool:
+        return self._search(match_input.sender_name, match_input.sender_name_lower)
+
+    def get_failure_message(self, match_input: EmailRouterMatchInput) -> str:
+        return 'match failed on sender name check' + \
+               os.linesep + 'Sender name was "' + match_input.sender_name + '"' + \
+               os.linesep + 'Match pattern was "' + self.pattern + '"'
+
+
+class RecipientNamePredicate(_PatternPredicate):
+    __slots__ = ()
+
+    predicate_type = EmailRouterPredicateType.RECIPIENT_NAME
+    check_name = 'recipient name'
+
+    def __init__(self,
+                 pattern: str,
+                 regex: Pattern,
+                 literal_pattern: Optional[EmailRouterLiteralPattern]):
+        super().__init__(pattern=pattern, regex=regex, literal_pattern=literal_pattern)
+        self.estimated_cost *= PREDICATE_COST_PER_RECIPIENT_FACTOR
+
+    # any one recipient matching is enough
+    def evaluate(self, match_input: EmailRouterMatchInput) -> bool:
+        for this_recipient_name, this_recipient_name_lower in zip(match_input.recipient_names,
+                                                                  match_input.recipient_names_lower):
+            if self._search(this_recipient_name, this_recipient_name_lower):
+                return True
+        return False
+
+    def get_failure_message(self, match_input: EmailRouterMatchInput) -> str:
+        return 'match failed on recipient name check' + \
+               os.linesep + 'Recipient names were "' + ','.join(match_input.recipient_names) + '"' + \
+               os.linesep + 'Match pattern was "' + self.pattern + '"'
+
+
+class EmailRouterPredicateStatistics:
+    """
+    Evaluation and reject counts per predicate type, collected while routing.  Counts are updated without a
+    lock - they only steer evaluation order, so an occasional lost increment does not matter.
+    """
+
+    def __init__(self):
+        self._evaluated_count: Dict[EmailRouterPredicateType, int] = {x: 0 for x in EmailRouterPredicateType}
+        self._rejected_count: Dict[EmailRouterPredicateType, int] = {x: 0 for x in EmailRouterPredicateType}
+
+    def record(self,
+               predicate_type: EmailRouterPredicateType,
+               rejected: bool):
+        self._evaluated_count[predicate_type] += 1
+        if rejected:
+            self._rejected_count[predicate_type] += 1
+
+    def get_reject_rate(self, predicate_type: EmailRouterPredicateType) -> Optional[float]:
+        evaluated_count = self._evaluated_count[predicate_type]
+        if evaluated_count < PREDICATE_STATISTICS_MINIMUM_SAMPLES:
+            return None
+        return self._rejected_count[predicate_type] / evaluated_count
+
+    def get_statistics_as_dict(self) -> Dict[str, Dict[str, int]]:
+        return {
+            x.name.lower(): {'evaluated': self._evaluated_count[x], 'rejected': self._rejected_count[x]}
+            for x in EmailRouterPredicateType
+        }
+
+
+def order_predicates(predicates: Iterable[EmailRouterRulePredicate],
+                     predicate_statistics: Optional[EmailRouterPredicateStatistics] = None) \
+        -> Tuple[EmailRouterRulePredicate, ...]:
+    """
+    Order predicates by estimated cost, or - once statistics are available - by expected cost per rejection
+    (cost / reject rate), which minimizes the expected work to reject a rule.  The sort is stable.
+    """
+    def get_rank(predicate: EmailRouterRulePredicate) -> float:
+        if predicate_statistics is None:
+            return predicate.estimated_cost
+        reject_rate = predicate_statistics.get_reject_rate(predicate.predicate_type)
+        if reject_rate is None:
+            return predicate.estimated_cost
+        return predicate.estimated_cost / max(reject_rate, 0.001)
+
+    return tuple(sorted(predicates, key=get_rank))
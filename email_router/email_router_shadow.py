@@ -0,0 +1,194 @@
+import logging
+import queue
+import random
+import threading
+import time
+
+from collections import deque
+from typing import Collection, List, NamedTuple, Optional
+
+from error import EmeraldEmailRouterMatchNotFoundError
+
+
+class EmailRouterShadowDivergence(NamedTuple):
+    address_to_collection: List[str]
+    address_from: str
+    sender_ip: str
+    live_target_names: List[str]
+    candidate_target_names: List[str]
+
+    def get_as_dict(self) -> dict:
+        return self._asdict()
+
+
+class _EmailRouterShadowRequest(NamedTuple):
+    address_to_collection: List[str]
+    address_from: str
+    sender_ip: str
+    attachment_included: Optional[bool]
+    body_size: Optional[int]
+    live_target_names: List[str]
+    live_seconds: float
+
+
+class EmailRouterShadowEvaluator:
+    """
+    Replays a sample of live matches against a candidate router on a background thread and counts where the
+    candidate would route differently, and how long it takes compared with the live router.
+
+    The request thread only draws a random number and, for sampled emails, does a non-blocking put on a
+    bounded queue - when the queue is full the sample is dropped.  The worker evaluates at most
+    max_evaluations_per_second samples, which caps the CPU the shadow work can take from live requests.
+    """
+
+    @property
+    def candidate_router(self):
+        return self._candidate_router
+
+    @property
+    def sample_rate(self) -> float:
+        return self._sample_rate
+
+    def __init__(self,
+                 candidate_router,
+                 sample_rate: float = 0.01,
+                 queue_size: int = 1000,
+                 max_evaluations_per_second: float = 100.0,
+                 divergence_sample_size: int = 20,
+                 logger: Optional[logging.Logger] = None):
+        """
+        candidate_router is an EmailRouter holding the candidate rules
+        """
+        if not 0.0 < sample_rate <= 1.0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': sample_rate must be above 0 and at ' +
+                             'most 1 (value = ' + str(sample_rate) + ')')
+        if queue_size < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': queue_size must be at least 1 ' +
+                             '(value = ' + str(queue_size) + ')')
+        if max_evaluations_per_second <= 0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': max_evaluations_per_second must be ' +
+                             'positive (value = ' + str(max_evaluations_per_second) + ')')
+
+        self._candidate_router = candidate_router
+        self._sample_rate = sample_rate
+        self._evaluation_interval_seconds = 1.0 / max_evaluations_per_second
+        self._logger = logger if logger is not None else logging.getLogger(type(self).__name__)
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._statistics_lock = threading.Lock()
+        self._submitted_count = 0
+        self._dropped_count = 0
+        self._evaluated_count = 0
+        self._divergence_count = 0
+        self._candidate_error_count = 0
+        self._live_seconds_total = 0.0
+        self._candidate_seconds_total = 0.0
+        self._recent_divergences = deque(maxlen=divergence_sample_size)
+
+        self._stop_requested = threading.Event()
+        self._worker_thread = threading.Thread(target=self._run,
+                                               name=type(self).__name__,
+                                               daemon=True)
+        self._worker_thread.start()
+
+    def should_sample(self) -> bool:
+        return self._sample_rate >= 1.0 or random.random() < self._sample_rate
+
+    def submit(self,
+               address_to_collection: Collection[str],
+               address_from: str,
+               sender_ip: str,
+               attachment_included: Optional[bool],
+               body_size: Optional[int],
+               live_target_names: List[str],
+               live_seconds: float):
+        """
+        Queue a live match for evaluation against the candidate - never blocks
+        """
+        try:
+            self._queue.put_nowait(_EmailRouterShadowRequest(address_to_collection=list(address_to_collection),
+                                                             address_from=address_from,
+                                                             sender_ip=sender_ip,
+                                                             attachment_included=attachment_included,
+                                                             body_size=body_size,
+                                                             live_target_names=live_target_names,
+                                                             live_seconds=live_seconds))
+        except queue.Full:
+            with self._statistics_lock:
+                self._dropped_count += 1
+            return
+        with self._statistics_lock:
+            self._submitted_count += 1
+
+    def _evaluate(self, shadow_request: _EmailRouterShadowRequest):
+        start_time = time.perf_counter()
+        try:
+            match_result_collection = self._candidate_router.match_inbound_email(
+                address_to_collection=shadow_request.address_to_collection,
+                address_from=shadow_request.address_from,
+                sender_ip=shadow_request.sender_ip,
+                attachment_included=shadow_request.attachment_included,
+                body_size=shadow_request.body_size)
+            candidate_target_names = [x.matched_target_name for x in match_result_collection.matched_target_results]
+        except EmeraldEmailRouterMatchNotFoundError:
+            candidate_target_names = list()
+        except Exception as ex:
+            with self._statistics_lock:
+                self._candidate_error_count += 1
+            self._logger.warning('Shadow evaluation failed: ' + str(ex))
+            return
+        candidate_seconds = time.perf_counter() - start_time
+
+        divergence = None
+        if candidate_target_names != shadow_request.live_target_names:
+            divergence = EmailRouterShadowDivergence(address_to_collection=shadow_request.address_to_collection,
+                                                     address_from=shadow_request.address_from,
+                                                     sender_ip=shadow_request.sender_ip,
+                                                     live_target_names=shadow_request.live_target_names,
+                                                     candidate_target_names=candidate_target_names)
+        with self._statistics_lock:
+            self._evaluated_count += 1
+            self._live_seconds_total += shadow_request.live_seconds
+            self._candidate_seconds_total += candidate_seconds
+            if divergence is not None:
+                self._divergence_count += 1
+                self._recent_divergences.append(divergence)
+
+        if divergence is not None:
+            self._logger.info('Shadow divergence: live target(s) ' + ','.join(divergence.live_target_names) +
+                              ' candidate target(s) ' + ','.join(divergence.candidate_target_names),
+                              extra={'shadow_divergence': divergence.get_as_dict()})
+
+    def _run(self):
+        while not self._stop_requested.is_set():
+            try:
+                shadow_request = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            started = time.monotonic()
+            self._evaluate(shadow_request)
+            # pace the worker so it stays within max_evaluations_per_second
+            remaining_seconds = self._evaluation_interval_seconds - (time.monotonic() - started)
+            if remaining_seconds > 0:
+                self._stop_requested.wait(remaining_seconds)
+
+    def close(self):
+        self._stop_requested.set()
+        self._worker_thread.join()
+
+    def get_statistics_as_dict(self) -> dict:
+        with self._statistics_lock:
+            return {
+                'sample_rate': self._sample_rate,
+                'submitted_count': self._submitted_count,
+                'dropped_count': self._dropped_count,
+                'evaluated_count': self._evaluated_count,
+                'divergence_count': self._divergence_count,
+                'divergence_rate': self._divergence_count / self._evaluated_count
+                if self._evaluated_count > 0 else 0.0,
+                'candidate_error_count': self._candidate_error_count,
+                # candidate match time relative to the live match time for the same emails
+                'relative_match_latency': self._candidate_seconds_total / self._live_seconds_total
+                if self._live_seconds_total > 0 else None,
+                'recent_divergences': [x.get_as_dict() for x in self._recent_divergences]
+            }
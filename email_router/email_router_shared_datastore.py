@@ -0,0 +1,595 @@
+import os
+import datetime
+import heapq
+import struct
+import threading
+
+from bisect import bisect_right
+from dateutil.parser import parse
+from multiprocessing import shared_memory
+from netaddr import IPAddress
+from netaddr.core import AddrFormatError
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from email_router.email_router_compiled_rules import EmailRouterRuleCompiler, CompiledRouterRule, \
+    CompiledRouterTarget
+from email_router.email_router_datastore import EmailRouterRulesDatastore, EmailRouterTargetConfig, \
+    get_target_config_from_compiled
+from email_router.email_router_destination import EmailRouterDestinationType, EmailRouterDestinationConfig
+from email_router.email_router_rule_predicates import EmailRouterPredicateStatistics, order_predicates
+from email_router.router_instance_type import RouterInstanceType
+from error import EmeraldEmailRouterDatabaseInitializationError
+
+#
+# Shared memory layout - everything is addressed by offset or index, there are no pointers, so every process
+#  can map the segment at any address.  All integers little endian.
+#
+#  control segment "<name>":             magic, current generation
+#  data segment "<name>_<generation>":   header, targets, destinations, rules, ip ranges, string table
+#
+#  Strings are (offset, length) references into the string table; identical strings are stored once.
+#  IP ranges are stored as 16 byte big endian start/end values so a bytes compare is a numeric compare.
+#
+_SHARED_RULES_MAGIC = b'EMRS'
+_SHARED_RULES_LAYOUT_VERSION = 1
+_NULL_STRING_LENGTH = 0xFFFFFFFF
+
+_CONTROL_STRUCT = struct.Struct('<4sIQ')
+_HEADER_STRUCT = struct.Struct('<4sIqQIIIIII' + 'II' * 3)
+_TARGET_STRUCT = struct.Struct('<dIIIIII')
+_DESTINATION_STRUCT = struct.Struct('<dIIII')
+_RULE_STRUCT = struct.Struct('<dI' + 'II' * 3 + 'bqqIIB')
+_IP_RANGE_STRUCT = struct.Struct('<B16s16sII')
+
+# a generation read from the control segment can be retired (the publisher keeps two) before we attach to it -
+#  read the control segment again this many times before giving up
+_ATTACH_ATTEMPT_COUNT = 5
+
+# target name, target priority, rule count and destinations
+_TargetInfo = Tuple[str, float, int, FrozenSet[EmailRouterDestinationConfig]]
+
+
+def _attach_shared_memory(segment_name: str) -> shared_memory.SharedMemory:
+    segment = shared_memory.SharedMemory(name=segment_name, create=False)
+    # attaching registers the segment with this process' resource tracker which would unlink it when we
+    #  exit - the publisher owns the segment, not us
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(getattr(segment, '_name', '/' + segment_name), 'shared_memory')
+    except (ImportError, KeyError, AttributeError):
+        pass
+    return segment
+
+
+def _get_data_segment_name(segment_name: str, generation: int) -> str:
+    return segment_name + '_' + str(generation)
+
+
+class _IpRangeIndex:
+    """
+    Whitelist ranges of many rules cut into segments, each with the (sorted) indexes of the rules whose ranges
+    cover it
+    """
+    __slots__ = ('_segment_starts', '_segment_rule_indexes')
+
+    def __init__(self, ranges_with_rule_indexes: Iterable[Tuple[int, int, int]]):
+        changes_by_point: Dict[int, List[Tuple[int, int]]] = dict()
+        for range_start, range_end, this_rule_index in ranges_with_rule_indexes:
+            changes_by_point.setdefault(range_start, list()).append((this_rule_index, 1))
+            changes_by_point.setdefault(range_end + 1, list()).append((this_rule_index, -1))
+
+        # ranges of one rule may overlap, so count how many of its ranges cover each segment
+        self._segment_starts: List[int] = list()
+        self._segment_rule_indexes: List[Tuple[int, ...]] = list()
+        active_range_counts: Dict[int, int] = dict()
+        for this_point in sorted(changes_by_point):
+            for this_rule_index, this_change in changes_by_point[this_point]:
+                active_range_count = active_range_counts.get(this_rule_index, 0) + this_change
+                if active_range_count == 0:
+                    del active_range_counts[this_rule_index]
+                else:
+                    active_range_counts[this_rule_index] = active_range_count
+            self._segment_starts.append(this_point)
+            self._segment_rule_indexes.append(tuple(sorted(active_range_counts)))
+
+    def get_rule_indexes(self, value: int) -> Tuple[int, ...]:
+        segment_index = bisect_right(self._segment_starts, value) - 1
+        return self._segment_rule_indexes[segment_index] if segment_index >= 0 else ()
+
+
+class _SharedRulesStringTable:
+    def __init__(self):
+        self._offsets_by_value: Dict[str, Tuple[int, int]] = dict()
+        self._chunks: List[bytes] = list()
+        self._length = 0
+
+    @property
+    def data(self) -> bytes:
+        return b''.join(self._chunks)
+
+    def add(self, value: Optional[str]) -> Tuple[int, int]:
+        if value is None:
+            return 0, _NULL_STRING_LENGTH
+        if value not in self._offsets_by_value:
+            value_as_bytes = value.encode('utf-8')
+            self._offsets_by_value[value] = (self._length, len(value_as_bytes))
+            self._chunks.append(value_as_bytes)
+            self._length += len(value_as_bytes)
+        return self._offsets_by_value[value]
+
+
+def _serialize_rules_datastore(rules_datastore: EmailRouterRulesDatastore,
+                               generation: int) -> bytes:
+    strings = _SharedRulesStringTable()
+    target_records = list()
+    destination_records = list()
+    rule_records = list()
+    ip_range_records = list()
+
+    for target_index, this_target in enumerate(sorted(rules_datastore.router_config_by_target)):
+        first_rule_index = len(rule_records)
+        first_destination_index = len(destination_records)
+
+        for this_destination in sorted(this_target.destinations):
+            destination_records.append(_DESTINATION_STRUCT.pack(
+                this_destination.destination_sequence,
+                *strings.add(this_destination.destination_type.name),
+                *strings.add(this_destination.destination_uri)))
+
+        for this_rule in sorted(this_target.router_rules):
+            match_pattern = this_rule.match_pattern
+            first_ip_range_index = len(ip_range_records)
+            for this_ip_network in sorted(match_pattern.sender_ip_whitelist or set()):
+                ip_range_records.append(_IP_RANGE_STRUCT.pack(
+                    this_ip_network.version,
+                    this_ip_network.first.to_bytes(16, byteorder='big'),
+                    this_ip_network.last.to_bytes(16, byteorder='big'),
+                    *strings.add(str(this_ip_network))))
+
+            rule_records.append(_RULE_STRUCT.pack(
+                this_rule.match_priority,
+                target_index,
+                *strings.add(match_pattern.sender_domain),
+                *strings.add(match_pattern.sender_name),
+                *strings.add(match_pattern.recipient_name),
+                -1 if match_pattern.attachment_included is None else int(match_pattern.attachment_included),
+                -1 if match_pattern.body_size_minimum is None else match_pattern.body_size_minimum,
+                -1 if match_pattern.body_size_maximum is None else match_pattern.body_size_maximum,
+                first_ip_range_index,
+                len(ip_range_records) - first_ip_range_index,
+                0 if match_pattern.sender_ip_whitelist is None else 1))
+
+        target_records.append(_TARGET_STRUCT.pack(
+            this_target.target_priority,
+            *strings.add(this_target.target_name),
+            first_rule_index,
+            len(rule_records) - first_rule_index,
+            first_destination_index,
+            len(destination_records) - first_destination_index))
+
+    name_ref = strings.add(rules_datastore.datastore_name)
+    revision_datetime_ref = strings.add(rules_datastore.revision_datetime.isoformat())
+    instance_type_ref = strings.add(rules_datastore.instance_type.name)
+
+    body = b''.join(target_records + destination_records + rule_records + ip_range_records)
+    string_table = strings.data
+
+    header = _HEADER_STRUCT.pack(
+        _SHARED_RULES_MAGIC,
+        _SHARED_RULES_LAYOUT_VERSION,
+        rules_datastore.revision_number,
+        generation,
+        len(target_records),
+        len(destination_records),
+        len(rule_records),
+        len(ip_range_records),
+        _HEADER_STRUCT.size + len(body),
+        len(string_table),
+        *name_ref,
+        *revision_datetime_ref,
+        *instance_type_ref)
+
+    return header + body + string_table
+
+
+class EmailRouterSharedRulesPublisher:
+    """
+    Loader side of the shared memory rules store.  publish() writes a datastore into a new generation of the
+    segment and then switches the control segment to it, so attached workers move to the new revision as a unit.
+    The publisher owns the segments and must stay alive while workers use them - close() unlinks everything.
+    """
+
+    @property
+    def segment_name(self) -> str:
+        return self._segment_name
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def __init__(self,
+                 segment_name: str):
+        if type(segment_name) is not str or len(segment_name) == 0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': segment_name must be a non-empty string')
+
+        self._segment_name = segment_name
+        self._generation = 0
+        self._data_segments: List[shared_memory.SharedMemory] = list()
+        try:
+            self._control_segment = shared_memory.SharedMemory(name=segment_name,
+                                                               create=True,
+                                                               size=_CONTROL_STRUCT.size)
+        except FileExistsError:
+            raise EmeraldEmailRouterDatabaseInitializationError(
+                'Shared memory segment "' + segment_name + '" already exists - another publisher is running ' +
+                'or a previous one did not clean up')
+        _CONTROL_STRUCT.pack_into(self._control_segment.buf, 0, _SHARED_RULES_MAGIC, _SHARED_RULES_LAYOUT_VERSION, 0)
+
+    def publish(self,
+                rules_datastore: EmailRouterRulesDatastore) -> int:
+        generation = self._generation + 1
+        serialized_rules = _serialize_rules_datastore(rules_datastore=rules_datastore,
+                                                      generation=generation)
+
+        data_segment = shared_memory.SharedMemory(name=_get_data_segment_name(self._segment_name, generation),
+                                                  create=True,
+                                                  size=len(serialized_rules))
+        data_segment.buf[0:len(serialized_rules)] = serialized_rules
+
+        # switch workers over, then retire everything but the generation just replaced (workers that are
+        #  still mapped to it keep their mapping after the unlink)
+        _CONTROL_STRUCT.pack_into(self._control_segment.buf, 0,
+                                  _SHARED_RULES_MAGIC, _SHARED_RULES_LAYOUT_VERSION, generation)
+        self._generation = generation
+        self._data_segments.append(data_segment)
+        while len(self._data_segments) > 2:
+            retired_segment = self._data_segments.pop(0)
+            retired_segment.close()
+            retired_segment.unlink()
+
+        return generation
+
+    def close(self):
+        for this_segment in self._data_segments + [self._control_segment]:
+            this_segment.close()
+            try:
+                this_segment.unlink()
+            except FileNotFoundError:
+                pass
+        self._data_segments = list()
+
+
+class EmailRouterSharedRulesDatastore:
+    """
+    Worker side of the shared memory rules store.  Attaches read only to the segments written by an
+    EmailRouterSharedRulesPublisher.  On attaching a generation the whitelist ranges are indexed, so a lookup
+    only touches the rules whose ip whitelist could hold the sender ip; rules are compiled on first use and kept
+    until the next generation.  A new published generation is picked up on the next lookup.
+    """
+
+    @property
+    def segment_name(self) -> str:
+        return self._segment_name
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def datastore_name(self) -> str:
+        return self._datastore_name
+
+    @property
+    def revision_datetime(self) -> datetime.datetime:
+        return self._revision_datetime
+
+    @property
+    def revision_number(self) -> int:
+        return self._revision_number
+
+    @property
+    def instance_type(self) -> RouterInstanceType:
+        return self._instance_type
+
+    @property
+    def router_rules_datastore_initialized(self) -> bool:
+        return self._router_rules_datastore_initialized
+
+    @router_rules_datastore_initialized.setter
+    def router_rules_datastore_initialized(self, value):
+        if type(value) is not bool:
+            raise TypeError('Cannot initialize router_rules_datastore_initialized to an object of type "' +
+                            type(value).__name__ + '" - this is a boolean')
+        self._router_rules_datastore_initialized = value
+
+    @property
+    def target_count(self) -> int:
+        return self._target_count
+
+    @property
+    def targets_info_as_list_with_header(self) -> List[List[str]]:
+        return_data: List[List[str]] = list()
+        return_data.append(['Priority', 'Target Name'])
+        with self._segment_lock:
+            for this_target_index in range(self._target_count):
+                target_priority, target_name = self._read_target_priority_and_name(this_target_index)
+                return_data.append([str(target_priority), target_name])
+        return return_data
+
+    @property
+    def targets_info_as_table(self) -> List[str]:
+        return_data: List[str] = list()
+        return_data.append('Priority' + '  ' + 'Target Name')
+        with self._segment_lock:
+            for this_target_index in range(self._target_count):
+                target_priority, target_name = self._read_target_priority_and_name(this_target_index)
+                return_data.append('{:05.3f}'.format(target_priority) + '{:5s}'.format('') +
+                                   '{:20s}'.format(target_name))
+        return return_data
+
+    # this decodes the whole rule base - use for introspection only
+    @property
+    def router_config_by_target(self) -> Set[EmailRouterTargetConfig]:
+        with self._segment_lock:
+            return set([get_target_config_from_compiled(x)
+                        for x in self._build_compiled_targets(range(self._rule_count))])
+
+    def __init__(self,
+                 segment_name: str):
+        if type(segment_name) is not str or len(segment_name) == 0:
+            raise EmeraldEmailRouterDatabaseInitializationError('Empty or missing router db source identifier' +
+                                                                ': for shared memory specify the segment name')
+        self._segment_name = segment_name
+        try:
+            self._control_segment = _attach_shared_memory(segment_name)
+        except FileNotFoundError:
+            raise EmeraldEmailRouterDatabaseInitializationError(
+                'Shared memory segment "' + segment_name + '" not found - start the rules publisher first')
+
+        self._segment_lock = threading.Lock()
+        self._data_segment: Optional[shared_memory.SharedMemory] = None
+        self._generation = 0
+        # built for each attached generation
+        self._unconstrained_rule_indexes: Tuple[int, ...] = ()
+        self._ip_range_indexes: Dict[int, _IpRangeIndex] = dict()
+        # rule index -> (target index, compiled rule)
+        self._compiled_rules_by_index: Dict[int, Tuple[int, CompiledRouterRule]] = dict()
+        self._target_info_by_index: Dict[int, _TargetInfo] = dict()
+        # targets all of whose rules are candidates (most are, for rules without whitelists) are built once
+        self._complete_compiled_targets_by_index: Dict[int, CompiledRouterTarget] = dict()
+        # compiled regexes are shared by every lookup
+        self._rule_compiler = EmailRouterRuleCompiler()
+        self._router_rules_datastore_initialized = False
+
+        with self._segment_lock:
+            if not self._attach_current_generation():
+                raise EmeraldEmailRouterDatabaseInitializationError(
+                    'Shared memory segment "' + segment_name + '" has no published rules yet')
+
+    def close(self):
+        with self._segment_lock:
+            if self._data_segment is not None:
+                self._data_segment.close()
+                self._data_segment = None
+            self._control_segment.close()
+
+    def refresh(self) -> int:
+        """
+        Attach the current generation if a newer one has been published and return it (lookups do this too)
+        """
+        with self._segment_lock:
+            self._attach_current_generation()
+            return self._generation
+
+    # the distinct recipient_name values of the rules (None for rules without one) in the current generation, read
+    #  from the string table without compiling any rule
+    def get_recipient_patterns(self) -> List[Optional[str]]:
+        with self._segment_lock:
+            self._attach_current_generation()
+            recipient_patterns = set()
+            for this_rule_index in range(self._rule_count):
+                recipient_name_offset, recipient_name_length = _RULE_STRUCT.unpack_from(
+                    self._data_segment.buf, self._rules_offset + this_rule_index * _RULE_STRUCT.size)[6:8]
+                recipient_patterns.add(self._read_string(recipient_name_offset, recipient_name_length))
+            return list(recipient_patterns)
+
+    # compiled rules are reordered in place, rules compiled later use the new statistics
+    def reorder_predicates(self, predicate_statistics: EmailRouterPredicateStatistics):
+        with self._segment_lock:
+            self._rule_compiler.predicate_statistics = predicate_statistics
+            for _, this_rule in self._compiled_rules_by_index.values():
+                this_rule.predicates = order_predicates(this_rule.predicates,
+                                                        predicate_statistics=predicate_statistics)
+
+    def get_candidate_compiled_targets(self,
+                                       sender_domain: str,
+                                       sender_ip: str) -> List[CompiledRouterTarget]:
+        """
+        Return compiled targets (sorted by target priority) holding only the rules whose ip whitelist, if any,
+        contains the sender ip.  Rules left out cannot match, so this is the same as evaluating every rule.
+        """
+        try:
+            sender_ip_as_address = IPAddress(sender_ip)
+        except (AddrFormatError, TypeError, ValueError):
+            # no whitelist can contain an invalid address, so only rules without a whitelist are candidates
+            sender_ip_as_address = None
+
+        with self._segment_lock:
+            self._attach_current_generation()
+
+            ip_range_index = None if sender_ip_as_address is None else \
+                self._ip_range_indexes.get(sender_ip_as_address.version)
+            if ip_range_index is None:
+                return self._build_compiled_targets(self._unconstrained_rule_indexes)
+            # both are sorted, and so is the merge
+            return self._build_compiled_targets(heapq.merge(self._unconstrained_rule_indexes,
+                                                            ip_range_index.get_rule_indexes(int(sender_ip_as_address))))
+
+    # caller must hold the segment lock.  Returns False if nothing has been published yet
+    def _attach_current_generation(self) -> bool:
+        for _ in range(_ATTACH_ATTEMPT_COUNT):
+            magic, layout_version, generation = _CONTROL_STRUCT.unpack_from(self._control_segment.buf, 0)
+            if magic != _SHARED_RULES_MAGIC or layout_version != _SHARED_RULES_LAYOUT_VERSION:
+                raise EmeraldEmailRouterDatabaseInitializationError(
+                    'Shared memory segment "' + self._segment_name + '" is not a router rules segment ' +
+                    '(or uses an unsupported layout version)')
+            if generation == 0:
+                return False
+            if generation == self._generation:
+                return True
+
+            try:
+                data_segment = _attach_shared_memory(_get_data_segment_name(self._segment_name, generation))
+                break
+            except FileNotFoundError:
+                # retired after we read the control segment - a newer generation is current by now
+                continue
+        else:
+            raise EmeraldEmailRouterDatabaseInitializationError(
+                'Unable to attach to the current generation of shared memory segment "' + self._segment_name +
+                '" - retired before attaching ' + str(_ATTACH_ATTEMPT_COUNT) + ' times')
+
+        header = _HEADER_STRUCT.unpack_from(data_segment.buf, 0)
+        (magic, layout_version, revision_number, header_generation, target_count, destination_count, rule_count,
+         ip_range_count, strings_offset, strings_length) = header[0:10]
+        if magic != _SHARED_RULES_MAGIC or header_generation != generation:
+            data_segment.close()
+            raise EmeraldEmailRouterDatabaseInitializationError(
+                'Shared memory data segment for generation ' + str(generation) + ' is not valid')
+
+        if self._data_segment is not None:
+            self._data_segment.close()
+        self._data_segment = data_segment
+        self._generation = generation
+        self._revision_number = revision_number
+        self._target_count = target_count
+        self._rule_count = rule_count
+        self._targets_offset = _HEADER_STRUCT.size
+        self._destinations_offset = self._targets_offset + target_count * _TARGET_STRUCT.size
+        self._rules_offset = self._destinations_offset + destination_count * _DESTINATION_STRUCT.size
+        self._ip_ranges_offset = self._rules_offset + rule_count * _RULE_STRUCT.size
+        self._strings_offset = strings_offset
+
+        self._datastore_name = self._read_string(*header[10:12])
+        self._revision_datetime = parse(self._read_string(*header[12:14]))
+        self._instance_type = RouterInstanceType.from_string(self._read_string(*header[14:16]))
+
+        self._compiled_rules_by_index = dict()
+        self._target_info_by_index = dict()
+        self._complete_compiled_targets_by_index = dict()
+        self._index_ip_ranges()
+        return True
+
+    # caller must hold the segment lock
+    def _index_ip_ranges(self):
+        buffer = self._data_segment.buf
+        unconstrained_rule_indexes = list()
+        ranges_by_ip_version: Dict[int, List[Tuple[int, int, int]]] = dict()
+        for this_rule_index in range(self._rule_count):
+            first_ip_range_index, ip_range_count, has_ip_whitelist = _RULE_STRUCT.unpack_from(
+                buffer, self._rules_offset + this_rule_index * _RULE_STRUCT.size)[11:14]
+            if not has_ip_whitelist:
+                unconstrained_rule_indexes.append(this_rule_index)
+                continue
+            for this_ip_range_index in range(first_ip_range_index, first_ip_range_index + ip_range_count):
+                ip_version, ip_start, ip_end = _IP_RANGE_STRUCT.unpack_from(
+                    buffer, self._ip_ranges_offset + this_ip_range_index * _IP_RANGE_STRUCT.size)[0:3]
+                ranges_by_ip_version.setdefault(ip_version, list()).append(
+                    (int.from_bytes(ip_start, byteorder='big'), int.from_bytes(ip_end, byteorder='big'),
+                     this_rule_index))
+
+        self._unconstrained_rule_indexes = tuple(unconstrained_rule_indexes)
+        self._ip_range_indexes = {x: _IpRangeIndex(y) for x, y in ranges_by_ip_version.items()}
+
+    def _read_string(self, offset: int, length: int) -> Optional[str]:
+        if length == _NULL_STRING_LENGTH:
+            return None
+        start = self._strings_offset + offset
+        return bytes(self._data_segment.buf[start:start + length]).decode('utf-8')
+
+    def _read_target_priority_and_name(self, target_index: int) -> Tuple[float, str]:
+        target_values = _TARGET_STRUCT.unpack_from(self._data_segment.buf,
+                                                   self._targets_offset + target_index * _TARGET_STRUCT.size)
+        return target_values[0], self._read_string(*target_values[1:3])
+
+    # caller must hold the segment lock.  Rule indexes are in target priority order already
+    def _build_compiled_targets(self, rule_indexes: Iterable[int]) -> List[CompiledRouterTarget]:
+        rules_by_target_index: Dict[int, List[CompiledRouterRule]] = dict()
+        for this_rule_index in rule_indexes:
+            compiled_rule = self._compiled_rules_by_index.get(this_rule_index)
+            if compiled_rule is None:
+                compiled_rule = self._compile_rule(this_rule_index)
+                self._compiled_rules_by_index[this_rule_index] = compiled_rule
+            rules_by_target_index.setdefault(compiled_rule[0], list()).append(compiled_rule[1])
+
+        compiled_targets = list()
+        for this_target_index in sorted(rules_by_target_index):
+            target_rules = rules_by_target_index[this_target_index]
+            target_info = self._target_info_by_index.get(this_target_index)
+            if target_info is None:
+                target_info = self._read_target_info(this_target_index)
+                self._target_info_by_index[this_target_index] = target_info
+
+            target_complete = len(target_rules) == target_info[2]
+            compiled_target = self._complete_compiled_targets_by_index.get(this_target_index) \
+                if target_complete else None
+            if compiled_target is None:
+                compiled_target = self._rule_compiler.compile_target(target_name=target_info[0],
+                                                                     target_priority=target_info[1],
+                                                                     router_rules=target_rules,
+                                                                     destinations=target_info[3])
+                if target_complete:
+                    self._complete_compiled_targets_by_index[this_target_index] = compiled_target
+            compiled_targets.append(compiled_target)
+
+        return compiled_targets
+
+    # caller must hold the segment lock.  Returns (target index, compiled rule)
+    def _compile_rule(self, rule_index: int) -> Tuple[int, CompiledRouterRule]:
+        buffer = self._data_segment.buf
+        (match_priority, target_index,
+         sender_domain_offset, sender_domain_length,
+         sender_name_offset, sender_name_length,
+         recipient_name_offset, recipient_name_length,
+         attachment_included, body_size_minimum, body_size_maximum,
+         first_ip_range_index, ip_range_count, has_ip_whitelist) = \
+            _RULE_STRUCT.unpack_from(buffer, self._rules_offset + rule_index * _RULE_STRUCT.size)
+
+        sender_ip_whitelist_cidrs = None
+        if has_ip_whitelist:
+            sender_ip_whitelist_cidrs = list()
+            for this_ip_range_index in range(first_ip_range_index, first_ip_range_index + ip_range_count):
+                cidr_offset, cidr_length = _IP_RANGE_STRUCT.unpack_from(
+                    buffer, self._ip_ranges_offset + this_ip_range_index * _IP_RANGE_STRUCT.size)[3:5]
+                sender_ip_whitelist_cidrs.append(self._read_string(cidr_offset, cidr_length))
+
+        return target_index, self._rule_compiler.compile_rule(
+            match_priority=match_priority,
+            sender_domain=self._read_string(sender_domain_offset, sender_domain_length),
+            sender_name=self._read_string(sender_name_offset, sender_name_length),
+            recipient_name=self._read_string(recipient_name_offset, recipient_name_length),
+            attachment_included=None if attachment_included < 0 else bool(attachment_included),
+            body_size_minimum=None if body_size_minimum < 0 else body_size_minimum,
+            body_size_maximum=None if body_size_maximum < 0 else body_size_maximum,
+            sender_ip_whitelist_cidrs=sender_ip_whitelist_cidrs
+        )
+
+    # caller must hold the segment lock
+    def _read_target_info(self, target_index: int) -> _TargetInfo:
+        buffer = self._data_segment.buf
+        (target_priority, target_name_offset, target_name_length, first_rule_index, rule_count,
+         first_destination_index, destination_count) = \
+            _TARGET_STRUCT.unpack_from(buffer, self._targets_offset + target_index * _TARGET_STRUCT.size)
+
+        destinations = set()
+        for this_destination_index in range(first_destination_index, first_destination_index + destination_count):
+            (destination_sequence, type_offset, type_length, uri_offset, uri_length) = \
+                _DESTINATION_STRUCT.unpack_from(
+                    buffer, self._destinations_offset + this_destination_index * _DESTINATION_STRUCT.size)
+            destinations.add(EmailRouterDestinationConfig(
+                destination_type=EmailRouterDestinationType[self._read_string(type_offset, type_length)],
+                destination_sequence=destination_sequence,
+                destination_uri=self._read_string(uri_offset, uri_length)))
+
+        return self._read_string(target_name_offset, target_name_length), target_priority, rule_count, \
+            frozenset(destinations)
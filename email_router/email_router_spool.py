@@ -0,0 +1,463 @@
+import os
+import datetime
+import json
+import logging
+import struct
+import threading
+import time
+import zlib
+
+from dateutil.parser import parse
+from enum import unique, Enum
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from error import EmeraldEmailRouterSpoolError
+
+#
+# Append only spool of accepted inbound requests, kept as a series of segment files in one directory.
+#
+#  record = header + payload, header = crc32, record type, record id, payload length (little endian)
+#  the crc covers everything after itself, so a torn write at the end of a segment is detected and dropped
+#
+#  ACCEPTED records carry the request (instance type and content type as a json line, then the raw body) and
+#  are durable (fsync'd) before append_accepted returns.  Concurrent requests share one fsync (group commit).
+#  COMPLETED records only carry the id of the ACCEPTED record they close and are not waited for - if one is
+#  lost the request is replayed, which is safe as routing does not change state.
+#
+#  A segment is deleted once it holds no open ACCEPTED records and no COMPLETED record whose ACCEPTED record
+#  (or a compaction copy of it) is still in an older segment on disk - otherwise a restart would replay it.
+#
+_SPOOL_RECORD_HEADER = struct.Struct('<IBQI')
+_SPOOL_SEGMENT_PREFIX = 'spool_'
+_SPOOL_SEGMENT_SUFFIX = '.log'
+
+# a sealed segment holding less than this share of open records is compacted
+_SPOOL_COMPACTION_OPEN_RATIO = 0.5
+
+
+@unique
+class EmailRouterSpoolRecordType(Enum):
+    ACCEPTED = 1
+    COMPLETED = 2
+
+
+class EmailRouterSpoolRecord(NamedTuple):
+    record_id: int
+    router_instance_type_name: str
+    content_type: str
+    accepted_datetime: datetime.datetime
+    body: bytes
+
+
+def _encode_record(record_type: EmailRouterSpoolRecordType,
+                   record_id: int,
+                   payload: bytes) -> bytes:
+    header_without_crc = _SPOOL_RECORD_HEADER.pack(0, record_type.value, record_id, len(payload))[4:]
+    crc = zlib.crc32(payload, zlib.crc32(header_without_crc))
+    return struct.pack('<I', crc) + header_without_crc + payload
+
+
+def _encode_accepted_payload(router_instance_type_name: str,
+                             content_type: str,
+                             accepted_datetime: datetime.datetime,
+                             body: bytes) -> bytes:
+    request_info = {
+        'instance_type': router_instance_type_name,
+        'content_type': content_type,
+        'accepted': accepted_datetime.isoformat()
+    }
+    return json.dumps(request_info).encode('utf-8') + b'\n' + body
+
+
+def _decode_accepted_payload(record_id: int, payload: bytes) -> EmailRouterSpoolRecord:
+    (request_info_line, body) = payload.split(b'\n', 1)
+    request_info = json.loads(request_info_line.decode('utf-8'))
+    return EmailRouterSpoolRecord(record_id=record_id,
+                                  router_instance_type_name=request_info['instance_type'],
+                                  content_type=request_info['content_type'],
+                                  accepted_datetime=parse(request_info['accepted']),
+                                  body=body)
+
+
+def _read_segment(segment_path: str) -> Tuple[List[Tuple[EmailRouterSpoolRecordType, int, bytes]], int]:
+    """
+    Return the valid records of a segment and the length of the valid part (anything after is a torn write)
+    """
+    with open(segment_path, 'rb') as segment_file:
+        segment_data = segment_file.read()
+
+    records = list()
+    position = 0
+    while position + _SPOOL_RECORD_HEADER.size <= len(segment_data):
+        (crc, record_type_value, record_id, payload_length) = \
+            _SPOOL_RECORD_HEADER.unpack_from(segment_data, position)
+        payload_start = position + _SPOOL_RECORD_HEADER.size
+        payload_end = payload_start + payload_length
+        if payload_end > len(segment_data) or \
+                zlib.crc32(segment_data[position + 4:payload_end]) != crc:
+            break
+        try:
+            record_type = EmailRouterSpoolRecordType(record_type_value)
+        except ValueError:
+            break
+        records.append((record_type, record_id, segment_data[payload_start:payload_end]))
+        position = payload_end
+    return records, position
+
+
+class _PendingWrite:
+    __slots__ = ('record_type', 'record_id', 'record_bytes', 'moved_from_segment_number',
+                 'accepted_segment_numbers', 'written', 'error')
+
+    def __init__(self,
+                 record_type: EmailRouterSpoolRecordType,
+                 record_id: int,
+                 payload: bytes,
+                 moved_from_segment_number: Optional[int] = None,
+                 accepted_segment_numbers: Optional[List[int]] = None):
+        self.record_type = record_type
+        self.record_id = record_id
+        self.record_bytes = _encode_record(record_type, record_id=record_id, payload=payload)
+        # set when compaction copies an open record out of an old segment
+        self.moved_from_segment_number = moved_from_segment_number
+        # for a COMPLETED record, the segments that held a copy of the ACCEPTED record it closes
+        self.accepted_segment_numbers = accepted_segment_numbers if accepted_segment_numbers is not None else []
+        self.written = threading.Event()
+        self.error = None
+
+
+class EmailRouterSpool:
+    """
+    Write ahead spool for accepted inbound requests.  Call open() once (it returns the requests accepted by
+    a previous run but never completed, for replay), then append_accepted before acknowledging a request and
+    mark_completed once it has been handled.  Segments holding no open requests are deleted.
+    """
+
+    @property
+    def spool_directory(self) -> str:
+        return self._spool_directory
+
+    @property
+    def logger(self):
+        return self._logger
+
+    @property
+    def open_record_count(self) -> int:
+        with self._state_lock:
+            return len(self._segment_by_open_record_id)
+
+    def __init__(self,
+                 spool_directory: str,
+                 segment_max_bytes: int = 64 * 1024 * 1024,
+                 group_commit_window_seconds: float = 0.005):
+        if segment_max_bytes < _SPOOL_RECORD_HEADER.size:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': segment_max_bytes too small (value = ' +
+                             str(segment_max_bytes) + ')')
+        if group_commit_window_seconds < 0:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': group_commit_window_seconds must not ' +
+                             'be negative (value = ' + str(group_commit_window_seconds) + ')')
+
+        self._spool_directory = spool_directory
+        self._segment_max_bytes = segment_max_bytes
+        self._group_commit_window_seconds = group_commit_window_seconds
+        self._logger = logging.getLogger(type(self).__name__)
+
+        self._state_lock = threading.Lock()
+        self._next_record_id = 1
+        # which segment holds the ACCEPTED record of each open (not completed) request
+        self._segment_by_open_record_id: Dict[int, int] = dict()
+        # every segment holding a copy of the ACCEPTED record of each open request (compaction makes copies)
+        self._accepted_segments_by_open_record_id: Dict[int, List[int]] = dict()
+        # segments whose COMPLETED records close ACCEPTED records held in these other segments
+        self._completed_dependencies_by_segment: Dict[int, Set[int]] = dict()
+        self._record_count_by_segment: Dict[int, int] = dict()
+        self._sealed_segments: Set[int] = set()
+
+        self._active_segment_number = 0
+        self._active_segment_file = None
+        self._active_segment_bytes = 0
+
+        self._pending_condition = threading.Condition()
+        self._pending_writes: List[_PendingWrite] = list()
+        self._writer_thread: Optional[threading.Thread] = None
+        self._stop_requested = False
+
+    def _get_segment_path(self, segment_number: int) -> str:
+        return os.path.join(self._spool_directory,
+                            _SPOOL_SEGMENT_PREFIX + str(segment_number).zfill(20) + _SPOOL_SEGMENT_SUFFIX)
+
+    def _list_segment_numbers(self) -> List[int]:
+        segment_numbers = list()
+        for this_file_name in os.listdir(self._spool_directory):
+            if this_file_name.startswith(_SPOOL_SEGMENT_PREFIX) and this_file_name.endswith(_SPOOL_SEGMENT_SUFFIX):
+                try:
+                    segment_numbers.append(
+                        int(this_file_name[len(_SPOOL_SEGMENT_PREFIX):-len(_SPOOL_SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(segment_numbers)
+
+    def open(self) -> List[EmailRouterSpoolRecord]:
+        """
+        Read the existing segments and start the writer.  Returns requests accepted but not completed by a
+        previous run, oldest first - replay them and call mark_completed for each
+        """
+        try:
+            os.makedirs(self._spool_directory, exist_ok=True)
+            segment_numbers = self._list_segment_numbers()
+        except OSError as oex:
+            raise EmeraldEmailRouterSpoolError('Unable to open spool directory "' + self._spool_directory + '"' +
+                                               os.linesep + 'Exception detail: ' + str(oex))
+
+        open_records: Dict[int, EmailRouterSpoolRecord] = dict()
+        accepted_segments_by_record_id: Dict[int, List[int]] = dict()
+        for this_segment_number in segment_numbers:
+            segment_path = self._get_segment_path(this_segment_number)
+            (records, valid_length) = _read_segment(segment_path)
+            if valid_length < os.path.getsize(segment_path):
+                self.logger.warning('Spool segment ' + segment_path + ' has ' +
+                                    str(os.path.getsize(segment_path) - valid_length) +
+                                    ' bytes of incomplete or corrupt records at the end - ignoring them')
+
+            self._record_count_by_segment[this_segment_number] = 0
+            self._sealed_segments.add(this_segment_number)
+            for (record_type, record_id, payload) in records:
+                self._next_record_id = max(self._next_record_id, record_id + 1)
+                # a record moved by compaction may also still be in its old segment - the later copy counts
+                previous_segment_number = self._segment_by_open_record_id.pop(record_id, None)
+                if previous_segment_number is not None:
+                    self._record_count_by_segment[previous_segment_number] -= 1
+                    del open_records[record_id]
+                if record_type == EmailRouterSpoolRecordType.ACCEPTED:
+                    open_records[record_id] = _decode_accepted_payload(record_id=record_id, payload=payload)
+                    self._segment_by_open_record_id[record_id] = this_segment_number
+                    self._record_count_by_segment[this_segment_number] += 1
+                    accepted_segments_by_record_id.setdefault(record_id, list()).append(this_segment_number)
+                else:
+                    self._add_completed_dependencies(this_segment_number,
+                                                     accepted_segments_by_record_id.pop(record_id, []))
+        self._accepted_segments_by_open_record_id = {x: accepted_segments_by_record_id[x] for x in open_records}
+
+        # new writes always go to a new segment
+        self._active_segment_number = segment_numbers[-1] + 1 if len(segment_numbers) > 0 else 1
+        self._open_active_segment()
+
+        self._writer_thread = threading.Thread(target=self._run_writer,
+                                               name=type(self).__name__ + '-writer',
+                                               daemon=True)
+        self._writer_thread.start()
+
+        self.compact()
+        return [open_records[x] for x in sorted(open_records.keys())]
+
+    def close(self):
+        with self._pending_condition:
+            self._stop_requested = True
+            self._pending_condition.notify_all()
+        if self._writer_thread is not None:
+            self._writer_thread.join()
+            self._writer_thread = None
+        if self._active_segment_file is not None:
+            self._active_segment_file.close()
+            self._active_segment_file = None
+
+    def _open_active_segment(self):
+        self._active_segment_file = open(self._get_segment_path(self._active_segment_number), 'ab')
+        self._active_segment_bytes = 0
+        self._record_count_by_segment[self._active_segment_number] = 0
+        # make the new file itself durable
+        directory_fd = os.open(self._spool_directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def _run_writer(self):
+        while True:
+            with self._pending_condition:
+                while len(self._pending_writes) == 0 and not self._stop_requested:
+                    self._pending_condition.wait()
+                if len(self._pending_writes) == 0 and self._stop_requested:
+                    return
+
+            # group commit - give concurrent requests a moment to join this fsync
+            if self._group_commit_window_seconds > 0:
+                time.sleep(self._group_commit_window_seconds)
+
+            with self._pending_condition:
+                batch = self._pending_writes
+                self._pending_writes = list()
+
+            try:
+                self._write_batch(batch)
+            except OSError as oex:
+                for this_pending_write in batch:
+                    this_pending_write.error = oex
+            for this_pending_write in batch:
+                this_pending_write.written.set()
+
+    def _write_batch(self, batch: List[_PendingWrite]):
+        sealed_segment = False
+        segment_number_by_write: List[int] = list()
+        for this_pending_write in batch:
+            if self._active_segment_bytes > 0 and \
+                    self._active_segment_bytes + len(this_pending_write.record_bytes) > self._segment_max_bytes:
+                self._active_segment_file.flush()
+                os.fsync(self._active_segment_file.fileno())
+                self._active_segment_file.close()
+                with self._state_lock:
+                    self._sealed_segments.add(self._active_segment_number)
+                    self._active_segment_number += 1
+                    self._open_active_segment()
+                sealed_segment = True
+
+            self._active_segment_file.write(this_pending_write.record_bytes)
+            self._active_segment_bytes += len(this_pending_write.record_bytes)
+            segment_number_by_write.append(self._active_segment_number)
+
+        self._active_segment_file.flush()
+        os.fsync(self._active_segment_file.fileno())
+
+        # account for the new records before any segment can be judged empty
+        completed_while_moving = list()
+        with self._state_lock:
+            for this_pending_write, this_segment_number in zip(batch, segment_number_by_write):
+                if this_pending_write.record_type != EmailRouterSpoolRecordType.ACCEPTED:
+                    self._add_completed_dependencies(this_segment_number, this_pending_write.accepted_segment_numbers)
+                    continue
+                record_id = this_pending_write.record_id
+                if this_pending_write.moved_from_segment_number is not None:
+                    if self._segment_by_open_record_id.get(record_id) != \
+                            this_pending_write.moved_from_segment_number:
+                        # completed while being copied - the copy must be closed again
+                        completed_while_moving.append((record_id, this_segment_number))
+                        continue
+                    self._record_count_by_segment[this_pending_write.moved_from_segment_number] -= 1
+                self._segment_by_open_record_id[record_id] = this_segment_number
+                self._accepted_segments_by_open_record_id.setdefault(record_id, list()).append(this_segment_number)
+                self._record_count_by_segment[this_segment_number] += 1
+
+        if len(completed_while_moving) > 0:
+            with self._pending_condition:
+                self._pending_writes.extend([_PendingWrite(record_type=EmailRouterSpoolRecordType.COMPLETED,
+                                                           record_id=record_id,
+                                                           payload=b'',
+                                                           accepted_segment_numbers=[segment_number])
+                                             for (record_id, segment_number) in completed_while_moving])
+
+        if sealed_segment:
+            self._delete_empty_segments()
+
+    def _enqueue(self, pending_write: _PendingWrite) -> _PendingWrite:
+        with self._pending_condition:
+            if self._stop_requested or self._writer_thread is None:
+                raise EmeraldEmailRouterSpoolError('Spool "' + self._spool_directory + '" is not open')
+            self._pending_writes.append(pending_write)
+            self._pending_condition.notify_all()
+        return pending_write
+
+    def _wait_written(self, pending_write: _PendingWrite):
+        pending_write.written.wait()
+        if pending_write.error is not None:
+            raise EmeraldEmailRouterSpoolError('Unable to write to spool "' + self._spool_directory + '"' +
+                                               os.linesep + 'Exception detail: ' + str(pending_write.error))
+
+    def append_accepted(self,
+                        router_instance_type_name: str,
+                        content_type: str,
+                        body: bytes) -> int:
+        """
+        Durably record an accepted request and return its record id.  Blocks until the record is on disk
+        """
+        with self._state_lock:
+            record_id = self._next_record_id
+            self._next_record_id += 1
+
+        payload = _encode_accepted_payload(router_instance_type_name=router_instance_type_name,
+                                           content_type=content_type,
+                                           accepted_datetime=datetime.datetime.now(datetime.timezone.utc),
+                                           body=body)
+        self._wait_written(self._enqueue(_PendingWrite(record_type=EmailRouterSpoolRecordType.ACCEPTED,
+                                                       record_id=record_id,
+                                                       payload=payload)))
+        return record_id
+
+    def mark_completed(self, record_id: int):
+        with self._state_lock:
+            segment_number = self._segment_by_open_record_id.pop(record_id, None)
+            if segment_number is None:
+                return
+            self._record_count_by_segment[segment_number] -= 1
+            accepted_segment_numbers = self._accepted_segments_by_open_record_id.pop(record_id, [segment_number])
+        self._enqueue(_PendingWrite(record_type=EmailRouterSpoolRecordType.COMPLETED,
+                                    record_id=record_id,
+                                    payload=b'',
+                                    accepted_segment_numbers=accepted_segment_numbers))
+
+    def _add_completed_dependencies(self, segment_number: int, accepted_segment_numbers: List[int]):
+        dependencies = [x for x in accepted_segment_numbers if x != segment_number]
+        if len(dependencies) > 0:
+            self._completed_dependencies_by_segment.setdefault(segment_number, set()).update(dependencies)
+
+    def _delete_empty_segments(self):
+        with self._state_lock:
+            # oldest first, so a segment whose COMPLETED records depend on an older one can go in the same pass
+            empty_segments = list()
+            for this_segment_number in sorted(self._sealed_segments):
+                if self._record_count_by_segment[this_segment_number] > 0:
+                    continue
+                if any(x in self._record_count_by_segment
+                       for x in self._completed_dependencies_by_segment.get(this_segment_number, ())):
+                    continue
+                empty_segments.append(this_segment_number)
+                self._sealed_segments.discard(this_segment_number)
+                del self._record_count_by_segment[this_segment_number]
+                self._completed_dependencies_by_segment.pop(this_segment_number, None)
+
+        # also oldest first - a crash part way must not leave a COMPLETED record's ACCEPTED record behind
+        for this_segment_number in empty_segments:
+            try:
+                os.remove(self._get_segment_path(this_segment_number))
+            except FileNotFoundError:
+                pass
+
+    def compact(self):
+        """
+        Delete sealed segments without open requests, and move the open requests out of sealed segments that
+        are mostly completed so those can be deleted too
+        """
+        with self._state_lock:
+            segments_to_compact = list()
+            for this_segment_number in self._sealed_segments:
+                if self._record_count_by_segment[this_segment_number] > 0:
+                    segments_to_compact.append(this_segment_number)
+
+        for this_segment_number in sorted(segments_to_compact):
+            segment_path = self._get_segment_path(this_segment_number)
+            try:
+                (records, valid_length) = _read_segment(segment_path)
+            except FileNotFoundError:
+                continue
+
+            with self._state_lock:
+                open_records = [(record_id, payload) for (record_type, record_id, payload) in records
+                                if record_type == EmailRouterSpoolRecordType.ACCEPTED and
+                                self._segment_by_open_record_id.get(record_id) == this_segment_number]
+            accepted_count = len([x for x in records if x[0] == EmailRouterSpoolRecordType.ACCEPTED])
+            if accepted_count > 0 and len(open_records) / accepted_count >= _SPOOL_COMPACTION_OPEN_RATIO:
+                continue
+
+            # rewrite the open records into the active segment; once durable the old segment is not needed
+            pending_writes = [
+                self._enqueue(_PendingWrite(record_type=EmailRouterSpoolRecordType.ACCEPTED,
+                                            record_id=record_id,
+                                            payload=payload,
+                                            moved_from_segment_number=this_segment_number))
+                for (record_id, payload) in open_records
+            ]
+            for this_pending_write in pending_writes:
+                self._wait_written(this_pending_write)
+            self.logger.info('Compacted spool segment ' + segment_path + ' (moved ' + str(len(open_records)) +
+                             ' open of ' + str(accepted_count) + ' accepted records)')
+
+        self._delete_empty_segments()
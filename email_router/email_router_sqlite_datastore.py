@@ -0,0 +1,534 @@
+import os
+import datetime
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from dateutil.parser import parse
+from netaddr import IPAddress
+from netaddr.core import AddrFormatError
+from typing import Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
+
+from email_router.email_router_compiled_rules import EmailRouterRuleCompiler, CompiledRouterRule, \
+    CompiledRouterTarget
+from email_router.email_router_datastore import EmailRouterRulesDatastore, EmailRouterTargetConfig, \
+    get_target_config_from_compiled
+from email_router.email_router_destination import EmailRouterDestinationType, EmailRouterDestinationConfig
+from email_router.email_router_pattern import get_literal_from_pattern
+from email_router.email_router_rule_predicates import EmailRouterPredicateStatistics, order_predicates
+from email_router.router_instance_type import RouterInstanceType
+from error import EmeraldEmailRouterDatabaseInitializationError
+
+# sender_domain_kind values stored per rule - only LITERAL domains are indexed, the rest are always candidates
+SENDER_DOMAIN_KIND_NONE = 0
+SENDER_DOMAIN_KIND_LITERAL = 1
+SENDER_DOMAIN_KIND_REGEX = 2
+
+#
+# IPv4 ranges are stored as integers.  SQLite integers are signed 64 bit so IPv6 ranges are stored as 16 byte
+#  big endian blobs instead, which sort and compare the same way as the integers would (within one ip_version)
+#
+_SQLITE_SCHEMA = [
+    'CREATE TABLE router_datastore_info (' +
+    ' name TEXT NOT NULL,' +
+    ' revision_number INTEGER NOT NULL,' +
+    ' revision_datetime TEXT NOT NULL,' +
+    ' instance_type TEXT NOT NULL)',
+    'CREATE TABLE router_targets (' +
+    ' target_id INTEGER PRIMARY KEY,' +
+    ' target_name TEXT NOT NULL UNIQUE,' +
+    ' target_priority REAL NOT NULL UNIQUE)',
+    'CREATE TABLE router_target_destinations (' +
+    ' target_id INTEGER NOT NULL REFERENCES router_targets(target_id),' +
+    ' destination_type TEXT NOT NULL,' +
+    ' destination_sequence NUMERIC NOT NULL,' +
+    ' destination_uri TEXT)',
+    'CREATE TABLE router_rules (' +
+    ' rule_id INTEGER PRIMARY KEY,' +
+    ' target_id INTEGER NOT NULL REFERENCES router_targets(target_id),' +
+    ' match_priority REAL NOT NULL,' +
+    ' sender_domain TEXT,' +
+    ' sender_name TEXT,' +
+    ' recipient_name TEXT,' +
+    ' attachment_included INTEGER,' +
+    ' body_size_minimum INTEGER,' +
+    ' body_size_maximum INTEGER,' +
+    ' sender_domain_kind INTEGER NOT NULL,' +
+    ' has_ip_whitelist INTEGER NOT NULL)',
+    'CREATE TABLE router_rule_ip_ranges (' +
+    ' rule_id INTEGER NOT NULL REFERENCES router_rules(rule_id),' +
+    ' ip_version INTEGER NOT NULL,' +
+    ' ip_start NOT NULL,' +
+    ' ip_end NOT NULL,' +
+    ' cidr TEXT NOT NULL)',
+    'CREATE TABLE router_rule_literal_domains (' +
+    ' rule_id INTEGER NOT NULL REFERENCES router_rules(rule_id),' +
+    ' literal_domain TEXT NOT NULL,' +
+    ' exact_match INTEGER NOT NULL)',
+    'CREATE INDEX idx_router_target_destinations_target ON router_target_destinations(target_id)',
+    'CREATE INDEX idx_router_rules_target ON router_rules(target_id)',
+    'CREATE INDEX idx_router_rules_candidate_kind ON router_rules(sender_domain_kind, has_ip_whitelist)',
+    'CREATE INDEX idx_router_rule_ip_ranges_start ON router_rule_ip_ranges(ip_version, ip_start)',
+    'CREATE INDEX idx_router_rule_ip_ranges_end ON router_rule_ip_ranges(ip_version, ip_end)',
+    'CREATE INDEX idx_router_rule_ip_ranges_rule ON router_rule_ip_ranges(rule_id)',
+    'CREATE INDEX idx_router_rule_literal_domains ON router_rule_literal_domains(exact_match, literal_domain)'
+]
+
+#
+# Candidate rules are found with index lookups only, so the work per email depends on the number of candidates,
+#  not on the size of the rule base:
+#
+#  - rules whose sender domain is not a literal and that have no whitelist are always candidates
+#  - whitelist entries are CIDR networks, so the networks containing the sender ip start at one of the (33 or
+#    129) masked values of the ip - each is a point lookup on (ip_version, ip_start)
+#  - literal sender domains are looked up by the domain (exact) and by every substring of the domain that has
+#    the length of some substring literal
+#
+# Of the rules found through an ip range or a literal domain, those whose other constraint rules them out are
+#  dropped in python.
+#
+_SQLITE_UNCONSTRAINED_RULES_QUERY = \
+    'SELECT rule_id FROM router_rules' + \
+    ' WHERE sender_domain_kind IN (' + str(SENDER_DOMAIN_KIND_NONE) + ', ' + str(SENDER_DOMAIN_KIND_REGEX) + ')' + \
+    ' AND has_ip_whitelist = 0'
+
+_SQLITE_RULE_COLUMNS = \
+    'rule_id, target_id, match_priority, sender_domain, sender_name, recipient_name,' + \
+    ' attachment_included, body_size_minimum, body_size_maximum, has_ip_whitelist'
+
+# target name, target priority and destinations
+_TargetInfo = Tuple[str, float, FrozenSet[EmailRouterDestinationConfig]]
+
+# compiled rules kept by default - each is a few hundred bytes plus its predicates
+SQLITE_COMPILED_RULE_CACHE_SIZE = 100000
+
+
+def _ip_value_for_sqlite(ip_version: int, ip_value: int):
+    if ip_version == 4:
+        return ip_value
+    return ip_value.to_bytes(16, byteorder='big')
+
+
+def _get_network_starts(ip_version: int, ip_value: int) -> List:
+    """
+    The first address of every network (of any prefix length) containing the ip, in sqlite form
+    """
+    bit_count = 32 if ip_version == 4 else 128
+    return [_ip_value_for_sqlite(ip_version, ip_value >> host_bit_count << host_bit_count)
+            for host_bit_count in range(bit_count + 1)]
+
+
+class EmailRouterSqliteRulesDatastore:
+    """
+    Rules datastore backed by a SQLite file.  Only the rules that could match a given sender domain and
+    sender ip are read for each inbound email, and compiled rules are kept in a least recently used cache
+    (compiled_rule_cache_size rules), so memory use stays bounded no matter how large the rule base is.
+    Create the file with create_sqlite_database from a loaded datastore.
+    """
+
+    @property
+    def datastore_name(self) -> str:
+        return self._datastore_name
+
+    @property
+    def revision_datetime(self) -> datetime.datetime:
+        return self._revision_datetime
+
+    @property
+    def revision_number(self) -> int:
+        return self._revision_number
+
+    @property
+    def instance_type(self) -> RouterInstanceType:
+        return self._instance_type
+
+    @property
+    def sqlite_path(self) -> str:
+        return self._sqlite_path
+
+    @property
+    def router_rules_datastore_initialized(self) -> bool:
+        return self._router_rules_datastore_initialized
+
+    @router_rules_datastore_initialized.setter
+    def router_rules_datastore_initialized(self, value):
+        if type(value) is not bool:
+            raise TypeError('Cannot initialize router_rules_datastore_initialized to an object of type "' +
+                            type(value).__name__ + '" - this is a boolean')
+        self._router_rules_datastore_initialized = value
+
+    @property
+    def target_count(self) -> int:
+        with self._borrow_connection() as connection:
+            return connection.execute('SELECT COUNT(*) FROM router_targets').fetchone()[0]
+
+    @property
+    def targets_info_as_list_with_header(self) -> List[List[str]]:
+        return_data: List[List[str]] = list()
+        return_data.append(['Priority', 'Target Name'])
+        for target_priority, target_name in self._get_target_names_by_priority():
+            return_data.append([str(target_priority), target_name])
+        return return_data
+
+    @property
+    def targets_info_as_table(self) -> List[str]:
+        return_data: List[str] = list()
+        return_data.append('Priority' + '  ' + 'Target Name')
+        for target_priority, target_name in self._get_target_names_by_priority():
+            return_data.append('{:05.3f}'.format(target_priority) + '{:5s}'.format('') +
+                               '{:20s}'.format(target_name))
+        return return_data
+
+    # this reads the whole rule base - use for introspection only, matching uses get_candidate_compiled_targets
+    @property
+    def router_config_by_target(self) -> Set[EmailRouterTargetConfig]:
+        with self._borrow_connection() as connection:
+            rule_ids = [x[0] for x in connection.execute('SELECT rule_id FROM router_rules')]
+            return set([get_target_config_from_compiled(x)
+                        for x in self._build_compiled_targets(connection, rule_ids)])
+
+    # the distinct recipient_name values of the rules (None for rules without one), for the recipient allowlist
+    def get_recipient_patterns(self) -> List[Optional[str]]:
+        with self._borrow_connection() as connection:
+            return [x[0] for x in connection.execute('SELECT DISTINCT recipient_name FROM router_rules')]
+
+    @property
+    def compiled_rule_cache_size(self) -> int:
+        return self._compiled_rule_cache_size
+
+    def __init__(self,
+                 sqlite_path: str,
+                 compiled_rule_cache_size: int = SQLITE_COMPILED_RULE_CACHE_SIZE):
+        if type(sqlite_path) is not str or len(sqlite_path) == 0:
+            raise EmeraldEmailRouterDatabaseInitializationError('Empty or missing router db source identifier' +
+                                                                ': for SQLite should specify a valid filename')
+        if compiled_rule_cache_size < 1:
+            raise ValueError('Cannot initialize ' + type(self).__name__ + ': compiled_rule_cache_size must be at ' +
+                             'least 1 (value = ' + str(compiled_rule_cache_size) + ')')
+        self._sqlite_path = os.path.expanduser(sqlite_path)
+        if not os.path.isfile(self._sqlite_path):
+            raise EmeraldEmailRouterDatabaseInitializationError('Source SQLite file "' + self._sqlite_path + '"' +
+                                                                ' not found or not accessible to this process')
+
+        # flask may call us from several threads - each lookup borrows a read only connection of its own, so
+        #  lookups run in parallel.  Connections are kept for reuse, as many as were ever in use at once
+        self._connections_lock = threading.Lock()
+        self._idle_connections: List[sqlite3.Connection] = list()
+        self._closed = False
+        try:
+            connection = self._connect()
+            info_row = connection.execute(
+                'SELECT name, revision_number, revision_datetime, instance_type FROM router_datastore_info'
+            ).fetchone()
+            # lengths of the substring (not exact) literal domains - domains are searched for substrings of these
+            self._substring_literal_domain_lengths: Tuple[int, ...] = tuple(sorted(
+                x[0] for x in connection.execute(
+                    'SELECT DISTINCT length(literal_domain) FROM router_rule_literal_domains WHERE exact_match = 0')))
+        except sqlite3.Error as sqex:
+            raise EmeraldEmailRouterDatabaseInitializationError(
+                'Unable to read router datastore from SQLite file "' + self._sqlite_path + '"' +
+                os.linesep + 'Exception detail: ' + str(sqex.args))
+        if info_row is None:
+            connection.close()
+            raise EmeraldEmailRouterDatabaseInitializationError(
+                'SQLite file "' + self._sqlite_path + '" has no router_datastore_info entry - not a router datastore')
+        self._idle_connections.append(connection)
+
+        self._datastore_name = info_row[0]
+        self._revision_number = info_row[1]
+        self._revision_datetime = parse(info_row[2])
+        try:
+            self._instance_type = RouterInstanceType.from_string(info_row[3])
+        except ValueError as vex:
+            raise EmeraldEmailRouterDatabaseInitializationError(
+                'SQLite file "' + self._sqlite_path + '" has an invalid instance type' +
+                os.linesep + 'Exception detail: ' + str(vex.args[0]))
+
+        # compiled regexes are shared by every lookup
+        self._rule_compiler = EmailRouterRuleCompiler()
+        # (revision number, rule id) -> (target id, compiled rule)
+        self._compiled_rule_cache_size = compiled_rule_cache_size
+        self._compiled_rule_cache: 'OrderedDict[Tuple[int, int], Tuple[int, CompiledRouterRule]]' = OrderedDict()
+        self._compiled_rule_cache_lock = threading.Lock()
+        # targets are few - all are kept once read
+        self._target_info_by_id: Dict[int, _TargetInfo] = dict()
+        self._router_rules_datastore_initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect('file:' + self._sqlite_path + '?mode=ro',
+                               uri=True,
+                               check_same_thread=False)
+
+    @contextmanager
+    def _borrow_connection(self) -> Iterator[sqlite3.Connection]:
+        with self._connections_lock:
+            connection = self._idle_connections.pop() if len(self._idle_connections) > 0 else None
+        if connection is None:
+            connection = self._connect()
+        try:
+            yield connection
+        finally:
+            with self._connections_lock:
+                if self._closed:
+                    connection.close()
+                else:
+                    self._idle_connections.append(connection)
+
+    def close(self):
+        with self._connections_lock:
+            self._closed = True
+            idle_connections = self._idle_connections
+            self._idle_connections = list()
+        for this_connection in idle_connections:
+            this_connection.close()
+
+    # cached rules are reordered in place, rules compiled later use the new statistics
+    def reorder_predicates(self, predicate_statistics: EmailRouterPredicateStatistics):
+        self._rule_compiler.predicate_statistics = predicate_statistics
+        with self._compiled_rule_cache_lock:
+            compiled_rules = [x[1] for x in self._compiled_rule_cache.values()]
+        for this_rule in compiled_rules:
+            this_rule.predicates = order_predicates(this_rule.predicates, predicate_statistics=predicate_statistics)
+
+    def get_candidate_compiled_targets(self,
+                                       sender_domain: str,
+                                       sender_ip: str) -> List[CompiledRouterTarget]:
+        """
+        Return compiled targets (sorted by target priority) holding only the rules that could match the sender
+        domain and sender ip.  Rules not returned cannot match, so evaluating the result is the same as
+        evaluating the whole rule base.
+        """
+        with self._borrow_connection() as connection:
+            rule_ids = self._get_candidate_rule_ids(connection, sender_domain=sender_domain, sender_ip=sender_ip)
+            return self._build_compiled_targets(connection, rule_ids)
+
+    def _get_candidate_rule_ids(self,
+                                connection: sqlite3.Connection,
+                                sender_domain: str,
+                                sender_ip: str) -> List[int]:
+        # rules found through a whitelist range containing the sender ip
+        ip_rule_ids: Set[int] = set()
+        try:
+            sender_ip_as_address = IPAddress(sender_ip)
+        except (AddrFormatError, TypeError, ValueError):
+            # no whitelist can contain an invalid address, so only rules without a whitelist are candidates
+            sender_ip_as_address = None
+        if sender_ip_as_address is not None:
+            ip_version = sender_ip_as_address.version
+            network_starts = _get_network_starts(ip_version, int(sender_ip_as_address))
+            ip_value = _ip_value_for_sqlite(ip_version, int(sender_ip_as_address))
+            ip_rule_ids.update(x[0] for x in connection.execute(
+                'SELECT rule_id FROM router_rule_ip_ranges WHERE ip_version = ? AND ip_start IN (' +
+                ','.join(['?'] * len(network_starts)) + ') AND ip_end >= ?',
+                [ip_version] + network_starts + [ip_value]))
+
+        # rules found through a literal sender domain
+        sender_domain_lower = sender_domain.lower()
+        literal_domain_rule_ids: Set[int] = set(x[0] for x in connection.execute(
+            'SELECT rule_id FROM router_rule_literal_domains WHERE exact_match = 1 AND literal_domain = ?',
+            (sender_domain_lower,)))
+        domain_substrings = list(set(
+            sender_domain_lower[start:start + this_length]
+            for this_length in self._substring_literal_domain_lengths
+            for start in range(len(sender_domain_lower) - this_length + 1)))
+        for this_chunk in _chunked(domain_substrings):
+            literal_domain_rule_ids.update(x[0] for x in connection.execute(
+                'SELECT rule_id FROM router_rule_literal_domains WHERE exact_match = 0 AND literal_domain IN (' +
+                ','.join(['?'] * len(this_chunk)) + ')', this_chunk))
+
+        candidate_rule_ids = [x[0] for x in connection.execute(_SQLITE_UNCONSTRAINED_RULES_QUERY)]
+        for this_chunk in _chunked(list(ip_rule_ids | literal_domain_rule_ids)):
+            for rule_id, sender_domain_kind, has_ip_whitelist in connection.execute(
+                    'SELECT rule_id, sender_domain_kind, has_ip_whitelist FROM router_rules WHERE rule_id IN (' +
+                    ','.join(['?'] * len(this_chunk)) + ')', this_chunk):
+                if sender_domain_kind == SENDER_DOMAIN_KIND_LITERAL and rule_id not in literal_domain_rule_ids:
+                    continue
+                if has_ip_whitelist and rule_id not in ip_rule_ids:
+                    continue
+                candidate_rule_ids.append(rule_id)
+        return candidate_rule_ids
+
+    def _get_target_names_by_priority(self) -> List[Tuple[float, str]]:
+        with self._borrow_connection() as connection:
+            return connection.execute(
+                'SELECT target_priority, target_name FROM router_targets ORDER BY target_priority').fetchall()
+
+    def _get_compiled_rules(self,
+                            connection: sqlite3.Connection,
+                            rule_ids: List[int]) -> List[Tuple[int, CompiledRouterRule]]:
+        """
+        (target id, compiled rule) for each rule id - from the cache, reading and compiling the rest
+        """
+        compiled_rules = list()
+        missing_rule_ids = list()
+        with self._compiled_rule_cache_lock:
+            for this_rule_id in rule_ids:
+                cache_key = (self._revision_number, this_rule_id)
+                cached_rule = self._compiled_rule_cache.get(cache_key)
+                if cached_rule is None:
+                    missing_rule_ids.append(this_rule_id)
+                    continue
+                self._compiled_rule_cache.move_to_end(cache_key)
+                compiled_rules.append(cached_rule)
+        if len(missing_rule_ids) == 0:
+            return compiled_rules
+
+        ip_whitelist_by_rule: Dict[int, List[str]] = dict()
+        rule_rows = list()
+        for this_chunk in _chunked(missing_rule_ids):
+            placeholders = ','.join(['?'] * len(this_chunk))
+            rule_rows.extend(connection.execute(
+                'SELECT ' + _SQLITE_RULE_COLUMNS + ' FROM router_rules WHERE rule_id IN (' + placeholders + ')',
+                this_chunk))
+            for rule_id, cidr in connection.execute(
+                    'SELECT rule_id, cidr FROM router_rule_ip_ranges WHERE rule_id IN (' + placeholders + ')',
+                    this_chunk):
+                ip_whitelist_by_rule.setdefault(rule_id, list()).append(cidr)
+
+        compiled_rules_by_key = dict()
+        for (rule_id, target_id, match_priority, sender_domain, sender_name, recipient_name,
+             attachment_included, body_size_minimum, body_size_maximum, has_ip_whitelist) in rule_rows:
+            compiled_rules_by_key[(self._revision_number, rule_id)] = (target_id, self._rule_compiler.compile_rule(
+                match_priority=match_priority,
+                sender_domain=sender_domain,
+                sender_name=sender_name,
+                recipient_name=recipient_name,
+                attachment_included=None if attachment_included is None else bool(attachment_included),
+                body_size_minimum=body_size_minimum,
+                body_size_maximum=body_size_maximum,
+                sender_ip_whitelist_cidrs=ip_whitelist_by_rule[rule_id] if has_ip_whitelist else None
+            ))
+        with self._compiled_rule_cache_lock:
+            for cache_key, this_compiled_rule in compiled_rules_by_key.items():
+                self._compiled_rule_cache[cache_key] = this_compiled_rule
+            while len(self._compiled_rule_cache) > self._compiled_rule_cache_size:
+                self._compiled_rule_cache.popitem(last=False)
+        compiled_rules.extend(compiled_rules_by_key.values())
+        return compiled_rules
+
+    def _get_target_info(self,
+                         connection: sqlite3.Connection,
+                         target_ids: List[int]) -> Dict[int, _TargetInfo]:
+        missing_target_ids = [x for x in target_ids if x not in self._target_info_by_id]
+        if len(missing_target_ids) > 0:
+            target_rows = dict()
+            destinations_by_target: Dict[int, Set[EmailRouterDestinationConfig]] = dict()
+            for this_chunk in _chunked(missing_target_ids):
+                placeholders = ','.join(['?'] * len(this_chunk))
+                for target_id, target_name, target_priority in connection.execute(
+                        'SELECT target_id, target_name, target_priority FROM router_targets WHERE target_id IN (' +
+                        placeholders + ')', this_chunk):
+                    target_rows[target_id] = (target_name, target_priority)
+                for target_id, destination_type, destination_sequence, destination_uri in connection.execute(
+                        'SELECT target_id, destination_type, destination_sequence, destination_uri' +
+                        ' FROM router_target_destinations WHERE target_id IN (' + placeholders + ')', this_chunk):
+                    destinations_by_target.setdefault(target_id, set()).add(
+                        EmailRouterDestinationConfig(destination_type=EmailRouterDestinationType[destination_type],
+                                                     destination_sequence=destination_sequence,
+                                                     destination_uri=destination_uri))
+            for target_id, (target_name, target_priority) in target_rows.items():
+                self._target_info_by_id[target_id] = (target_name, target_priority,
+                                                      frozenset(destinations_by_target.get(target_id, set())))
+        return {x: self._target_info_by_id[x] for x in target_ids}
+
+    # returns targets sorted by target priority
+    def _build_compiled_targets(self,
+                                connection: sqlite3.Connection,
+                                rule_ids: List[int]) -> List[CompiledRouterTarget]:
+        if len(rule_ids) == 0:
+            return list()
+
+        rules_by_target: Dict[int, List[CompiledRouterRule]] = dict()
+        for target_id, this_compiled_rule in self._get_compiled_rules(connection, rule_ids):
+            rules_by_target.setdefault(target_id, list()).append(this_compiled_rule)
+        target_info_by_id = self._get_target_info(connection, list(rules_by_target.keys()))
+
+        return sorted([
+            self._rule_compiler.compile_target(target_name=target_info_by_id[target_id][0],
+                                               target_priority=target_info_by_id[target_id][1],
+                                               router_rules=rules_by_target[target_id],
+                                               destinations=target_info_by_id[target_id][2])
+            for target_id in rules_by_target
+        ], key=lambda x: x.target_priority)
+
+
+# keep IN (...) lists under the SQLite host parameter limit
+def _chunked(values: List[int], chunk_size: int = 500):
+    for start in range(0, len(values), chunk_size):
+        yield values[start:start + chunk_size]
+
+
+def create_sqlite_database(rules_datastore: EmailRouterRulesDatastore,
+                           sqlite_path: str):
+    """
+    Write a loaded (in memory) rules datastore to a new SQLite file that can be used as a
+    EmailRouterDatastoreSourceType.SQLITE source.  Refuses to overwrite an existing file.
+    """
+    sqlite_path = os.path.expanduser(sqlite_path)
+    if os.path.exists(sqlite_path):
+        raise EmeraldEmailRouterDatabaseInitializationError('Unable to create SQLite router datastore: file "' +
+                                                            sqlite_path + '" already exists')
+
+    connection = sqlite3.connect(sqlite_path)
+    try:
+        with connection:
+            for this_statement in _SQLITE_SCHEMA:
+                connection.execute(this_statement)
+
+            connection.execute(
+                'INSERT INTO router_datastore_info (name, revision_number, revision_datetime, instance_type)' +
+                ' VALUES (?, ?, ?, ?)',
+                (rules_datastore.datastore_name,
+                 rules_datastore.revision_number,
+                 rules_datastore.revision_datetime.isoformat(),
+                 rules_datastore.instance_type.name))
+
+            for this_target in sorted(rules_datastore.router_config_by_target):
+                target_id = connection.execute(
+                    'INSERT INTO router_targets (target_name, target_priority) VALUES (?, ?)',
+                    (this_target.target_name, this_target.target_priority)).lastrowid
+
+                for this_destination in this_target.destinations:
+                    connection.execute(
+                        'INSERT INTO router_target_destinations' +
+                        ' (target_id, destination_type, destination_sequence, destination_uri) VALUES (?, ?, ?, ?)',
+                        (target_id, this_destination.destination_type.name,
+                         this_destination.destination_sequence, this_destination.destination_uri))
+
+                for this_rule in sorted(this_target.router_rules):
+                    match_pattern = this_rule.match_pattern
+                    literal_domain = get_literal_from_pattern(match_pattern.sender_domain)
+                    if match_pattern.sender_domain is None:
+                        sender_domain_kind = SENDER_DOMAIN_KIND_NONE
+                    elif literal_domain is not None:
+                        sender_domain_kind = SENDER_DOMAIN_KIND_LITERAL
+                    else:
+                        sender_domain_kind = SENDER_DOMAIN_KIND_REGEX
+
+                    rule_id = connection.execute(
+                        'INSERT INTO router_rules (target_id, match_priority, sender_domain, sender_name,' +
+                        ' recipient_name, attachment_included, body_size_minimum, body_size_maximum,' +
+                        ' sender_domain_kind, has_ip_whitelist) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (target_id, this_rule.match_priority, match_pattern.sender_domain,
+                         match_pattern.sender_name, match_pattern.recipient_name,
+                         None if match_pattern.attachment_included is None else int(match_pattern.attachment_included),
+                         match_pattern.body_size_minimum, match_pattern.body_size_maximum,
+                         sender_domain_kind, 0 if match_pattern.sender_ip_whitelist is None else 1)).lastrowid
+
+                    if literal_domain is not None:
+                        connection.execute(
+                            'INSERT INTO router_rule_literal_domains (rule_id, literal_domain, exact_match)' +
+                            ' VALUES (?, ?, ?)',
+                            (rule_id, literal_domain.literal, 1 if literal_domain.exact_match else 0))
+
+                    for this_ip_network in match_pattern.sender_ip_whitelist or set():
+                        connection.execute(
+                            'INSERT INTO router_rule_ip_ranges (rule_id, ip_version, ip_start, ip_end, cidr)' +
+                            ' VALUES (?, ?, ?, ?, ?)',
+                            (rule_id, this_ip_network.version,
+                             _ip_value_for_sqlite(this_ip_network.version, this_ip_network.first),
+                             _ip_value_for_sqlite(this_ip_network.version, this_ip_network.last),
+                             str(this_ip_network)))
+    finally:
+        connection.close()
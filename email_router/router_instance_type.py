@@ -29,7 +29,7 @@ class RouterInstanceTypeConfig(NamedTuple):
         return True
 
     def __ne__(self, other):
-        return not (__eq__(self, other))
+        return not self.__eq__(other)
 
     def __lt__(self, other):
         if not isinstance(other, RouterInstanceTypeConfig):
@@ -64,10 +64,10 @@ class RouterInstanceTypeConfig(NamedTuple):
         return False
 
     def __le__(self, other):
-        return not (__gt__(self, other))
+        return not self.__gt__(other)
 
     def __ge__(self, other):
-        return not (__lt__(self, other))
+        return not self.__lt__(other)
 
 
 @unique
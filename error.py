@@ -55,9 +55,20 @@ class EmeraldEmailRouterMatchNotFoundError(EmeraldError):
     pass
 
 
+class EmeraldEmailRouterRecipientNotAllowedError(EmeraldEmailRouterMatchNotFoundError):
+    pass
+
+
 class EmeraldEmailRouterConfigNotActiveError(EmeraldError):
     pass
 
 class EmeraldEmailRouterInputDataError(EmeraldError):
     pass
 
+
+class EmeraldEmailRouterSpoolError(EmeraldError):
+    pass
+
+
+class EmeraldEmailRouterDeadLetterError(EmeraldError):
+    pass
@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import threading
+import types
+
+import pytest
+
+from email_router.email_router_dead_letter import DEAD_LETTER_DETAIL_MAX_LENGTH, EmailRouterDeadLetterReason, \
+    EmailRouterDeadLetterStore
+from email_router.router_instance_type import RouterInstanceType
+
+#
+# Dead letters are written in compressed blocks and read back by redrive(), which keeps what the re-drive
+#  function returns and deletes the segments it has read
+#
+CONTENT_TYPE = 'multipart/form-data; boundary=emeraldtestboundary'
+
+
+def get_segment_file_names(dead_letter_directory) -> list:
+    return sorted(x for x in os.listdir(str(dead_letter_directory)) if x.endswith('.log'))
+
+
+def open_store(dead_letter_directory, group_commit_window_seconds: float = 0.0) -> EmailRouterDeadLetterStore:
+    dead_letter_store = EmailRouterDeadLetterStore(str(dead_letter_directory),
+                                                   group_commit_window_seconds=group_commit_window_seconds)
+    dead_letter_store.open()
+    return dead_letter_store
+
+
+def read_back(dead_letter_directory, still_dead=lambda dead_letter: False) -> list:
+    """
+    Re-drive every dead letter, keeping those still_dead selects - returns what was read
+    """
+    read_dead_letters = list()
+
+    def redrive_dead_letters(dead_letters):
+        read_dead_letters.extend(dead_letters)
+        return [x for x in dead_letters if still_dead(x)]
+
+    dead_letter_store = open_store(dead_letter_directory)
+    try:
+        dead_letter_store.redrive(redrive_dead_letters)
+    finally:
+        dead_letter_store.close()
+    return read_dead_letters
+
+
+def test_compressed_blocks_read_back(tmp_path):
+    dead_letter_store = open_store(tmp_path, group_commit_window_seconds=0.05)
+    appending_threads = [threading.Thread(target=dead_letter_store.append,
+                                          kwargs={'router_instance_type_name': 'BLUE',
+                                                  'reason': EmailRouterDeadLetterReason.NO_MATCH,
+                                                  'detail': 'no target for email ' + str(x),
+                                                  'content_type': CONTENT_TYPE,
+                                                  'body': ('email ' + str(x) + ' ').encode('utf-8') * 200})
+                         for x in range(10)]
+    for this_thread in appending_threads:
+        this_thread.start()
+    for this_thread in appending_threads:
+        this_thread.join()
+    dead_letter_store.append(router_instance_type_name='GREEN',
+                             reason=EmailRouterDeadLetterReason.INPUT_ERROR,
+                             detail='x' * (DEAD_LETTER_DETAIL_MAX_LENGTH * 2),
+                             content_type=None,
+                             body=b'')
+    statistics = dead_letter_store.get_statistics_as_dict()
+    dead_letter_store.close()
+
+    # appended together, compressed together
+    assert statistics['dead_lettered_count'] == 11
+    assert statistics['dead_lettered_count_by_reason']['NO_MATCH'] == 10
+    assert statistics['block_count'] < 11
+    assert statistics['written_bytes'] < statistics['body_bytes']
+
+    dead_letters = read_back(tmp_path)
+    assert sorted(x.body for x in dead_letters[:10]) == \
+        sorted(('email ' + str(x) + ' ').encode('utf-8') * 200 for x in range(10))
+    assert {(x.router_instance_type_name, x.reason, x.content_type) for x in dead_letters[:10]} == \
+        {('BLUE', EmailRouterDeadLetterReason.NO_MATCH, CONTENT_TYPE)}
+    assert dead_letters[10].router_instance_type_name == 'GREEN'
+    assert dead_letters[10].content_type is None
+    assert dead_letters[10].detail == 'x' * DEAD_LETTER_DETAIL_MAX_LENGTH
+    assert get_segment_file_names(tmp_path) == []
+
+
+def test_redrive_keeps_what_is_still_dead(tmp_path):
+    dead_letter_store = open_store(tmp_path)
+    for this_index in range(3):
+        dead_letter_store.append(router_instance_type_name='BLUE',
+                                 reason=EmailRouterDeadLetterReason.NO_MATCH,
+                                 detail='no match',
+                                 content_type=CONTENT_TYPE,
+                                 body=b'email ' + str(this_index).encode('utf-8'))
+    dead_letter_store.close()
+    (original_segment_file_name,) = get_segment_file_names(tmp_path)
+
+    dead_letter_store = open_store(tmp_path)
+    assert dead_letter_store.redrive(
+        lambda dead_letters: [x._replace(detail='still no match') for x in dead_letters if x.body == b'email 1']) \
+        == (3, 1)
+    # the segment read is gone, the dead letter kept is in the re-driving store's own segment
+    assert original_segment_file_name not in get_segment_file_names(tmp_path)
+    assert len(get_segment_file_names(tmp_path)) == 1
+    dead_letter_store.close()
+
+    assert [(x.body, x.detail) for x in read_back(tmp_path)] == [(b'email 1', 'still no match')]
+
+
+def test_redrive_skips_segments_being_written(tmp_path):
+    writing_store = open_store(tmp_path)
+    writing_store.append(router_instance_type_name='BLUE',
+                         reason=EmailRouterDeadLetterReason.UNDELIVERABLE,
+                         detail='HTTP status 400',
+                         content_type=CONTENT_TYPE,
+                         body=b'email')
+
+    assert read_back(tmp_path) == []
+    assert len(get_segment_file_names(tmp_path)) == 1
+    writing_store.close()
+    assert [x.reason for x in read_back(tmp_path)] == [EmailRouterDeadLetterReason.UNDELIVERABLE]
+
+
+def test_torn_block_is_dropped(tmp_path):
+    dead_letter_store = open_store(tmp_path)
+    for this_index in range(2):
+        dead_letter_store.append(router_instance_type_name='BLUE',
+                                 reason=EmailRouterDeadLetterReason.UNPARSEABLE,
+                                 detail='unreadable',
+                                 content_type=CONTENT_TYPE,
+                                 body=b'email ' + str(this_index).encode('utf-8'))
+    dead_letter_store.close()
+
+    # a crash part way through writing the second block
+    segment_path = str(tmp_path / get_segment_file_names(tmp_path)[0])
+    with open(segment_path, 'r+b') as segment_file:
+        segment_file.truncate(os.path.getsize(segment_path) - 3)
+
+    assert [x.body for x in read_back(tmp_path)] == [b'email 0']
+
+
+def get_form_body(form_fields: dict) -> bytes:
+    boundary = CONTENT_TYPE.split('boundary=')[1]
+    return b''.join(('--' + boundary + '\r\n' +
+                     'Content-Disposition: form-data; name="' + x + '"\r\n\r\n' +
+                     y + '\r\n').encode('utf-8') for x, y in form_fields.items()) + \
+        ('--' + boundary + '--\r\n').encode('utf-8')
+
+
+def test_redrive_routes_dead_letters_with_the_current_rules(tmp_path):
+    # app.py needs the parsers of emerald_message for the reasons a dead letter is kept
+    pytest.importorskip('emerald_message')
+    import app
+    from email_router.email_router_config_source import EmailRouterDatastoreSourceType, EmailRouterSourceConfig
+    from email_router.email_router_datastore import EmailRouter
+    from email_router.email_router_inbound_envelope import get_inbound_envelope
+    from email_router.email_router_inbound_processor import EmailRouterInboundProcessor
+    from exitcode import ExitCode
+
+    # dead lettered under rules without a target for nomatch.org - the current rules have one
+    router_config_path = tmp_path / 'rules.json'
+    router_config_path.write_text(json.dumps({
+        'name': 'Redrive Test',
+        'revision_number': 2,
+        'revision_datetime': '2019-06-13T10:00:00-0300',
+        'instance_type': 'blue',
+        'router_rules': [
+            {'orders': {'target_priority': 1,
+                        'destination': 'direct_processing',
+                        'match_rules': [{'match_priority': 1, 'sender_domain': '^nomatch\\.org$',
+                                         'recipient_name': '^orders$'}]}}
+        ]
+    }))
+    dead_letter_directory = tmp_path / 'dead_letters'
+    dead_letter_store = open_store(dead_letter_directory)
+    bodies_by_name = dict()
+    for (this_name, router_instance_type_name, address_to, address_from) in (
+            ('routed now', 'BLUE', 'orders@me.com', 'jane@nomatch.org'),
+            ('still no match', 'BLUE', 'orders@me.com', 'bill@other.net'),
+            ('recipient not allowed', 'BLUE', 'someone@me.com', 'jane@nomatch.org'),
+            ('not served', 'GREEN', 'orders@me.com', 'jane@nomatch.org')):
+        bodies_by_name[this_name] = get_form_body({'to': address_to,
+                                                   'from': address_from,
+                                                   'sender_ip': '10.0.0.1',
+                                                   'headers': 'Message-ID: <' + this_name.replace(' ', '.') + '@x>'})
+        dead_letter_store.append(router_instance_type_name=router_instance_type_name,
+                                 reason=EmailRouterDeadLetterReason.NO_MATCH,
+                                 detail='no match',
+                                 content_type=CONTENT_TYPE,
+                                 body=bodies_by_name[this_name])
+    dead_letter_store.close()
+
+    inbound_processor = EmailRouterInboundProcessor(email_routers=[
+        EmailRouter(EmailRouterSourceConfig(EmailRouterDatastoreSourceType.JSONFILE, str(router_config_path)),
+                    RouterInstanceType.BLUE)])
+    dispatched = list()
+
+    def get_request_envelope(inbound_request, inbound_format):
+        return get_inbound_envelope(inbound_request=inbound_request)
+
+    def dispatch_routed_email(router_instance_type, inbound_request, match_result_set):
+        dispatched.append((router_instance_type, inbound_request.get_data(),
+                           [x.matched_target_name for x in match_result_set.matched_target_results]))
+
+    dead_letter_store = open_store(dead_letter_directory)
+    try:
+        exit_code = app.redrive_dead_letters(
+            dead_letter_store=dead_letter_store,
+            inbound_processor=inbound_processor,
+            get_request_envelope=get_request_envelope,
+            dispatch_routed_email=dispatch_routed_email,
+            dispatcher=None,
+            drain_seconds=1.0,
+            logger=types.SimpleNamespace(logger=logging.getLogger('test_dead_letter')))
+    finally:
+        dead_letter_store.close()
+
+    assert exit_code == ExitCode.SUCCESS
+    assert dispatched == [(RouterInstanceType.BLUE, bodies_by_name['routed now'], ['orders'])]
+    reasons_by_body = {x.body: x.reason for x in read_back(dead_letter_directory)}
+    assert reasons_by_body == {
+        bodies_by_name['still no match']: EmailRouterDeadLetterReason.NO_MATCH,
+        bodies_by_name['recipient not allowed']: EmailRouterDeadLetterReason.RECIPIENT_NOT_ALLOWED,
+        bodies_by_name['not served']: EmailRouterDeadLetterReason.NO_MATCH
+    }
@@ -0,0 +1,331 @@
+import http.server
+import json
+import threading
+import time
+
+import pytest
+
+from email_router.email_router_dispatcher import EmailRouterCircuitState, EmailRouterConcurrencyLimiter, \
+    EmailRouterDispatcher
+
+#
+# Deliveries go to a local HTTP server whose answers each test sets (respond(request) -> (status, body))
+#
+INSTANCE_TYPE_NAME = 'BLUE'
+
+
+class DestinationRequest:
+    def __init__(self, headers, body: bytes):
+        self.headers = headers
+        self.body = body
+
+
+class Destination:
+
+    def __init__(self):
+        self.respond = lambda request: (200, b'')
+        self.requests = list()
+        self.in_flight_count = 0
+        self.max_in_flight_count = 0
+        self.lock = threading.Lock()
+
+    def handle(self, handler: http.server.BaseHTTPRequestHandler):
+        request = DestinationRequest(headers=handler.headers,
+                                     body=handler.rfile.read(int(handler.headers['Content-Length'])))
+        with self.lock:
+            self.requests.append(request)
+            self.in_flight_count += 1
+            self.max_in_flight_count = max(self.max_in_flight_count, self.in_flight_count)
+        try:
+            (status_code, response_body) = self.respond(request)
+        finally:
+            with self.lock:
+                self.in_flight_count -= 1
+        handler.send_response(status_code)
+        handler.send_header('Content-Length', str(len(response_body)))
+        handler.end_headers()
+        handler.wfile.write(response_body)
+
+
+@pytest.fixture
+def destination():
+    this_destination = Destination()
+
+    class DestinationHandler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            this_destination.handle(self)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), DestinationHandler)
+    server.daemon_threads = True
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    this_destination.uri = 'http://127.0.0.1:' + str(server.server_address[1]) + '/inbound/'
+    yield this_destination
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def start_dispatcher():
+    dispatchers = list()
+
+    def _start_dispatcher(**kwargs) -> EmailRouterDispatcher:
+        dispatcher = EmailRouterDispatcher(**kwargs)
+        dispatcher.start()
+        dispatchers.append(dispatcher)
+        return dispatcher
+
+    yield _start_dispatcher
+    for this_dispatcher in dispatchers:
+        this_dispatcher.stop(timeout_seconds=1.0)
+
+
+class Completions:
+    """
+    on_complete callbacks by target name
+    """
+
+    def __init__(self):
+        self.delivered_by_target_name = dict()
+
+    def get_callback(self, target_name: str):
+        return lambda delivered: self.delivered_by_target_name.__setitem__(target_name, delivered)
+
+
+def get_destination_statistics(dispatcher: EmailRouterDispatcher, destination: Destination) -> dict:
+    return dispatcher.get_statistics_as_dict()['destinations'][destination.uri]
+
+
+def wait_for(condition, timeout_seconds: float = 5.0):
+    deadline = time.monotonic() + timeout_seconds
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out waiting'
+        time.sleep(0.01)
+
+
+def test_concurrency_limiter_increases_additively_and_halves_once_per_baseline():
+    concurrency_limiter = EmailRouterConcurrencyLimiter(initial_limit=4, max_limit=8)
+    for _ in range(4):
+        assert concurrency_limiter.try_acquire()
+    assert not concurrency_limiter.try_acquire()
+
+    # +1 per limit successful deliveries
+    for _ in range(4):
+        concurrency_limiter.release(latency_seconds=10.0, congested=False)
+        concurrency_limiter.try_acquire()
+    assert concurrency_limiter.limit == 4
+    concurrency_limiter.release(latency_seconds=10.0, congested=False)
+    assert concurrency_limiter.limit == 5
+
+    # deliveries failing together halve the limit once
+    concurrency_limiter.release(latency_seconds=10.0, congested=True)
+    concurrency_limiter.release(latency_seconds=10.0, congested=True)
+    assert concurrency_limiter.limit == 2
+
+    # a delivery much slower than the baseline counts as congestion
+    concurrency_limiter = EmailRouterConcurrencyLimiter(initial_limit=4)
+    concurrency_limiter.try_acquire()
+    concurrency_limiter.release(latency_seconds=0.0001, congested=False)
+    concurrency_limiter.try_acquire()
+    concurrency_limiter.release(latency_seconds=1.0, congested=False)
+    assert concurrency_limiter.limit == 2
+
+
+def test_deliveries_in_flight_stay_within_the_adaptive_limit(destination, start_dispatcher):
+    def respond(request):
+        time.sleep(0.05)
+        return 200, b''
+    destination.respond = respond
+    dispatcher = start_dispatcher(worker_count=8, initial_concurrency=2, max_concurrency=2)
+    for this_index in range(12):
+        dispatcher.submit(destination_uri=destination.uri,
+                          router_instance_type_name=INSTANCE_TYPE_NAME,
+                          target_name='target' + str(this_index),
+                          content_type='text/plain',
+                          body=b'email')
+    assert dispatcher.drain(timeout_seconds=5.0)
+    assert len(destination.requests) == 12
+    assert destination.max_in_flight_count <= 2
+
+    # the destination struggling halves the limit
+    destination.respond = lambda request: (503, b'')
+    dispatcher.submit(destination_uri=destination.uri,
+                      router_instance_type_name=INSTANCE_TYPE_NAME,
+                      target_name='struggling',
+                      content_type='text/plain',
+                      body=b'email')
+    wait_for(lambda: get_destination_statistics(dispatcher, destination)['failed_count'] == 1)
+    assert get_destination_statistics(dispatcher, destination)['concurrency_limit'] == 1
+
+
+def test_circuit_breaker_opens_then_half_opens_for_one_trial(destination, start_dispatcher):
+    destination.respond = lambda request: (500, b'')
+    completions = Completions()
+    dispatcher = start_dispatcher(worker_count=4,
+                                  failure_threshold=2,
+                                  open_seconds=0.5,
+                                  max_attempts=100,
+                                  retry_base_seconds=0.01,
+                                  retry_max_seconds=0.01)
+    dispatcher.submit(destination_uri=destination.uri,
+                      router_instance_type_name=INSTANCE_TYPE_NAME,
+                      target_name='first',
+                      content_type='text/plain',
+                      body=b'email',
+                      on_complete=completions.get_callback('first'))
+    wait_for(lambda: get_destination_statistics(dispatcher, destination)['circuit_state'] ==
+             EmailRouterCircuitState.OPEN.name)
+    assert len(destination.requests) == 2
+
+    # while open nothing is tried - new emails wait for the breaker
+    dispatcher.submit(destination_uri=destination.uri,
+                      router_instance_type_name=INSTANCE_TYPE_NAME,
+                      target_name='second',
+                      content_type='text/plain',
+                      body=b'email',
+                      on_complete=completions.get_callback('second'))
+    assert get_destination_statistics(dispatcher, destination)['short_circuited_count'] == 1
+    time.sleep(0.25)
+    assert len(destination.requests) == 2
+
+    # one trial delivery once open_seconds have passed - it fails, so the breaker re-opens
+    wait_for(lambda: len(destination.requests) == 3)
+    time.sleep(0.2)
+    statistics = get_destination_statistics(dispatcher, destination)
+    assert len(destination.requests) == 3
+    assert statistics['circuit_state'] == EmailRouterCircuitState.OPEN.name
+    assert statistics['circuit_opened_count'] == 2
+
+    # the next trial succeeds and closes it - everything waiting is delivered
+    destination.respond = lambda request: (200, b'')
+    assert dispatcher.drain(timeout_seconds=5.0)
+    assert get_destination_statistics(dispatcher, destination)['circuit_state'] == \
+        EmailRouterCircuitState.CLOSED.name
+    assert completions.delivered_by_target_name == {'first': True, 'second': True}
+
+
+def test_retries_back_off_until_attempts_run_out(destination, start_dispatcher):
+    destination.respond = lambda request: (503, b'')
+    completions = Completions()
+    dispatcher = start_dispatcher(worker_count=2,
+                                  failure_threshold=100,
+                                  max_attempts=3,
+                                  retry_base_seconds=0.1,
+                                  retry_max_seconds=1.0)
+    start_time = time.monotonic()
+    dispatcher.submit(destination_uri=destination.uri,
+                      router_instance_type_name=INSTANCE_TYPE_NAME,
+                      target_name='unlucky',
+                      content_type='text/plain',
+                      body=b'email',
+                      on_complete=completions.get_callback('unlucky'))
+    assert dispatcher.drain(timeout_seconds=5.0)
+    # jittered backoff of at least half of 0.1 then 0.2 seconds
+    assert time.monotonic() - start_time >= 0.15
+
+    assert completions.delivered_by_target_name == {'unlucky': False}
+    assert [x.headers[EmailRouterDispatcher.ATTEMPT_HEADER] for x in destination.requests] == ['1', '2', '3']
+    assert len({x.headers[EmailRouterDispatcher.DELIVERY_ID_HEADER] for x in destination.requests}) == 1
+    assert dispatcher.get_statistics_as_dict()['exhausted_count'] == 1
+
+    # a client error is not retried
+    destination.respond = lambda request: (400, b'')
+    dispatcher.submit(destination_uri=destination.uri,
+                      router_instance_type_name=INSTANCE_TYPE_NAME,
+                      target_name='rejected',
+                      content_type='text/plain',
+                      body=b'email',
+                      on_complete=completions.get_callback('rejected'))
+    assert dispatcher.drain(timeout_seconds=5.0)
+    assert completions.delivered_by_target_name['rejected'] is False
+    assert len(destination.requests) == 4
+    assert get_destination_statistics(dispatcher, destination)['rejected_count'] == 1
+
+
+def get_batch_items(request: DestinationRequest) -> list:
+    assert request.headers['Content-Type'] == EmailRouterDispatcher.BATCH_CONTENT_TYPE
+    return [json.loads(x) for x in request.body.splitlines()]
+
+
+def submit_batch(dispatcher: EmailRouterDispatcher,
+                 destination: Destination,
+                 completions: Completions,
+                 target_names):
+    for this_target_name in target_names:
+        dispatcher.submit(destination_uri=destination.uri,
+                          router_instance_type_name=INSTANCE_TYPE_NAME,
+                          target_name=this_target_name,
+                          content_type='text/plain',
+                          body=this_target_name.encode('utf-8'),
+                          batched=True,
+                          on_complete=completions.get_callback(this_target_name))
+
+
+def start_batch_dispatcher(start_dispatcher) -> EmailRouterDispatcher:
+    return start_dispatcher(worker_count=2,
+                            failure_threshold=100,
+                            retry_base_seconds=0.01,
+                            retry_max_seconds=0.01,
+                            batch_max_count=4,
+                            batch_linger_seconds=0.2)
+
+
+def test_batch_acknowledgements_are_handled_per_email(destination, start_dispatcher):
+    # accepted, busy the first time, rejected, not acknowledged the first time
+    def respond(request):
+        acknowledgements = list()
+        for this_item in get_batch_items(request):
+            if this_item['target'] == 'accepted' or this_item['attempt'] > 1:
+                status_code = 202
+            elif this_item['target'] == 'busy':
+                status_code = 503
+            elif this_item['target'] == 'rejected':
+                status_code = 422
+            else:
+                continue
+            acknowledgements.append(json.dumps({'id': this_item['id'], 'status': status_code}).encode('utf-8'))
+        return 200, b'\n'.join(acknowledgements + [b'not an acknowledgement'])
+    destination.respond = respond
+    completions = Completions()
+    dispatcher = start_batch_dispatcher(start_dispatcher)
+    submit_batch(dispatcher, destination, completions, ['accepted', 'busy', 'rejected', 'unmentioned'])
+    assert dispatcher.drain(timeout_seconds=5.0)
+
+    assert completions.delivered_by_target_name == {'accepted': True, 'busy': True, 'rejected': False,
+                                                    'unmentioned': True}
+    first_batch_items = get_batch_items(destination.requests[0])
+    assert [x['target'] for x in first_batch_items] == ['accepted', 'busy', 'rejected', 'unmentioned']
+    # retried together, under the same delivery ids
+    retried_batch_items = [x for this_request in destination.requests[1:] for x in get_batch_items(this_request)]
+    assert sorted((x['target'], x['id'], x['attempt']) for x in retried_batch_items) == \
+        sorted((x['target'], x['id'], 2) for x in first_batch_items if x['target'] in ('busy', 'unmentioned'))
+    statistics = get_destination_statistics(dispatcher, destination)
+    assert statistics['rejected_count'] == 1
+    assert statistics['circuit_state'] == EmailRouterCircuitState.CLOSED.name
+
+
+@pytest.mark.parametrize('response_body', [b'', b'\n', b'OK', b'{"accepted": 4}'])
+def test_batch_response_without_acknowledgements_accepts_the_batch(destination, start_dispatcher, response_body):
+    destination.respond = lambda request: (200, response_body)
+    completions = Completions()
+    dispatcher = start_batch_dispatcher(start_dispatcher)
+    submit_batch(dispatcher, destination, completions, ['first', 'second', 'third'])
+    assert dispatcher.drain(timeout_seconds=5.0)
+
+    assert len(destination.requests) == 1
+    assert completions.delivered_by_target_name == {'first': True, 'second': True, 'third': True}
+
+
+def test_failed_batch_request_retries_every_email(destination, start_dispatcher):
+    responses = [(500, b''), (200, b'')]
+    destination.respond = lambda request: responses.pop(0)
+    completions = Completions()
+    dispatcher = start_batch_dispatcher(start_dispatcher)
+    submit_batch(dispatcher, destination, completions, ['first', 'second'])
+    assert dispatcher.drain(timeout_seconds=5.0)
+
+    assert [len(get_batch_items(x)) for x in destination.requests] == [2, 2]
+    assert completions.delivered_by_target_name == {'first': True, 'second': True}
@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+import unittest
+
+#
+# --help and --version must stay cheap - app.py imports Flask, the parsers and the router only on the paths
+#  that need them.  This runs "app.py --version" under -X importtime and checks the total against a budget
+#
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+IMPORT_TIME_BUDGET_MICROSECONDS = 150000
+HEAVY_MODULE_NAMES = ['flask', 'werkzeug', 'netaddr', 'dateutil', 'pytz', 'tzlocal', 'pkg_resources',
+                      'emerald_message', 'email_router.email_router_datastore']
+
+
+def get_import_times(argv):
+    """
+    Run app.py under -X importtime and return (module name, cumulative microseconds, is top level) per import
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', APP_PATH] + argv,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               universal_newlines=True,
+                               check=True)
+    # import time: self [us] | cumulative | imported package - nested imports are indented below their parent
+    import_times = list()
+    for this_line in completed.stderr.splitlines():
+        if not this_line.startswith('import time:'):
+            continue
+        (_, cumulative, module_name) = this_line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        import_times.append((module_name.strip(), int(cumulative), not module_name.startswith('  ')))
+    return import_times
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_version_skips_heavy_modules(self):
+        imported_names = {x[0] for x in get_import_times(['--version'])}
+        for this_name in HEAVY_MODULE_NAMES:
+            self.assertNotIn(this_name, imported_names)
+
+    def test_version_within_import_time_budget(self):
+        top_level_import_times = [(x[0], x[1]) for x in get_import_times(['--version']) if x[2]]
+        total_microseconds = sum(x[1] for x in top_level_import_times)
+        slowest = sorted(top_level_import_times, key=lambda x: x[1], reverse=True)[:5]
+        self.assertLessEqual(total_microseconds, IMPORT_TIME_BUDGET_MICROSECONDS,
+                             'app.py --version spent ' + str(total_microseconds) + ' us importing (budget ' +
+                             str(IMPORT_TIME_BUDGET_MICROSECONDS) + ' us) - slowest: ' + str(slowest))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+from email_router.email_router_inbound_envelope import EmailRouterInboundEnvelope
+from email_router.email_router_inbound_payload import get_inbound_sender_info
+
+
+def get_envelope(form_fields: dict) -> EmailRouterInboundEnvelope:
+    return EmailRouterInboundEnvelope(form_fields=form_fields, file_part_count=0, body_size=None)
+
+
+def test_sender_domain_comes_from_the_smtp_envelope():
+    sender_info = get_inbound_sender_info(get_envelope({
+        'envelope': '{"to": ["orders@me.com"], "from": "bounces@mailer.example.net"}',
+        'from': 'Bank <alerts@bank.example.com>',
+        'sender_ip': '10.0.0.1'
+    }))
+    assert sender_info.sender_domain == 'mailer.example.net'
+    assert sender_info.sender_ip == '10.0.0.1'
+
+
+def test_sender_domain_falls_back_to_the_from_header():
+    assert get_inbound_sender_info(get_envelope({'from': 'Bill <bill@cottonfields.us>'})).sender_domain == \
+        'cottonfields.us'
+    assert get_inbound_sender_info(get_envelope({'envelope': '{"from": ""}', 'from': 'x@a.com'})).sender_domain == \
+        'a.com'
+
+
+def test_no_sender_domain_without_a_sender_address():
+    assert get_inbound_sender_info(get_envelope({})).sender_domain is None
+    assert get_inbound_sender_info(get_envelope({'from': 'Undisclosed'})).sender_domain is None
+    assert get_inbound_sender_info(get_envelope({'from': 'someone@'})).sender_domain is None
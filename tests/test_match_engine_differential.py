@@ -0,0 +1,126 @@
+import json
+import logging
+import random
+
+import pytest
+
+from email_router.email_router_config_source import EmailRouterDatastoreSourceType, EmailRouterSourceConfig
+from email_router.email_router_datastore import EmailRouter, EmailRouterBatchEmail
+from email_router.email_router_match_engine import EmailRouterMatchEngine
+from email_router.email_router_routing_policy import EmailRouterRoutingPolicy
+from email_router.router_instance_type import RouterInstanceType
+from error import EmeraldEmailRouterInputDataError, EmeraldEmailRouterMatchNotFoundError
+
+#
+# The bitset engine (and the batch match, which always uses it) must route every email exactly as walking the
+#  rules does.  Random rule bases - sender / recipient patterns, IPv4 and IPv6 whitelists, body size bounds and
+#  attachment flags - are matched against random emails, including malformed addresses and sender ips
+#
+RULE_BASE_COUNT = 20
+EMAILS_PER_RULE_BASE = 200
+SENDER_DOMAIN_PATTERNS = ['bseglobal\\.net', '^other\\.com$', 'cotton.*\\.us', '^a\\.com$', 'A\\.COM', '\\.org$',
+                          '^b', 'x', '^k\\.com$']
+NAME_PATTERNS = ['^bill$', '^orders$', 'help', '^ORDERS$', 'o.*s', '^x$', 'inv', '^k$']
+SENDER_IP_WHITELIST_CIDRS = ['9.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '2001:db8::/32', '2001:db8:1::/48',
+                             '192.168.0.0/16', '10.0.0.0/8', '10.1.2.3/32', '::1/128']
+RECIPIENT_NAMES = ['orders', 'ORDERS', 'help', 'bill', 'x', 'k', 'kx', 'invoices', 'orders\n', 'héllo', 'K']
+SENDER_NAMES = ['bill', 'x', 'orders', 'K', 'b']
+SENDER_DOMAINS = ['bseglobal.net', 'other.com', 'cottonfields.us', 'a.com', 'b.org', 'k.com', 'K.com', 'other.com\n']
+SENDER_IPS = ['9.1.2.3', '10.1.2.3', '10.1.3.3', '10.2.0.1', '2001:db8::1', '2001:db8:1::7', '::1', '192.168.1.1',
+              '8.8.8.8', 'not-an-ip']
+BODY_SIZES = [None, 0, 50, 100, 999, 1000, 5000, 200000]
+
+
+def get_random_match_rule(rng: random.Random, match_priority: int) -> dict:
+    match_rule = {'match_priority': match_priority}
+    if rng.random() < 0.4:
+        match_rule['sender_domain'] = rng.choice(SENDER_DOMAIN_PATTERNS)
+    if rng.random() < 0.3:
+        match_rule['sender_name'] = rng.choice(NAME_PATTERNS)
+    if rng.random() < 0.4:
+        match_rule['recipient_name'] = rng.choice(NAME_PATTERNS)
+    if rng.random() < 0.2:
+        match_rule['attachment_included'] = rng.random() < 0.5
+    if rng.random() < 0.2:
+        match_rule['body_size_minimum'] = rng.choice([0, 100, 1000, 5000])
+    if rng.random() < 0.2:
+        match_rule['body_size_maximum'] = rng.choice([100, 1000, 5000, 100000])
+    if rng.random() < 0.3:
+        match_rule['sender_ip_whitelist'] = ','.join(rng.sample(SENDER_IP_WHITELIST_CIDRS, rng.randint(1, 3)))
+    # every rule needs at least one address pattern
+    if not any(x in match_rule for x in ('sender_domain', 'sender_name', 'recipient_name')):
+        match_rule['sender_domain'] = rng.choice(SENDER_DOMAIN_PATTERNS)
+    return match_rule
+
+
+def get_random_router_config(rng: random.Random) -> dict:
+    return {
+        'name': 'Differential Test',
+        'revision_number': 1,
+        'revision_datetime': '2019-06-13T10:00:00-0300',
+        'instance_type': 'blue',
+        'router_rules': [
+            {'target' + str(target_index): {
+                'target_priority': target_index + 1,
+                'destination': 'direct_processing',
+                'match_rules': [get_random_match_rule(rng, x + 1) for x in range(rng.randint(1, 4))]}}
+            for target_index in range(rng.randint(1, 12))
+        ]
+    }
+
+
+def get_random_email(rng: random.Random) -> EmailRouterBatchEmail:
+    address_to_collection = [rng.choice(RECIPIENT_NAMES) + '@me.com' for _ in range(rng.randint(0, 2))]
+    if rng.random() < 0.03:
+        address_to_collection.append('malformed')
+    return EmailRouterBatchEmail(address_to_collection=address_to_collection,
+                                 address_from=rng.choice(SENDER_NAMES) + '@' + rng.choice(SENDER_DOMAINS),
+                                 sender_ip=rng.choice(SENDER_IPS),
+                                 attachment_included=rng.choice([None, True, False]),
+                                 body_size=rng.choice(BODY_SIZES))
+
+
+def get_outcome(email_router: EmailRouter, email: EmailRouterBatchEmail):
+    """
+    The matched targets in order, or the type of error raised instead
+    """
+    try:
+        match_result_collection = email_router.match_inbound_email(*email)
+    except (EmeraldEmailRouterMatchNotFoundError, EmeraldEmailRouterInputDataError) as ex:
+        return type(ex)
+    return [x.matched_target_name for x in match_result_collection.matched_target_results]
+
+
+def get_batch_outcomes(email_router: EmailRouter, emails):
+    return [type(x.error) if x.error is not None else
+            [y.matched_target_name for y in x.match_result_collection.matched_target_results]
+            for x in email_router.match_inbound_email_batch(emails)]
+
+
+@pytest.fixture(autouse=True)
+def quiet_router_logging():
+    logging.disable(logging.WARNING)
+    yield
+    logging.disable(logging.NOTSET)
+
+
+@pytest.mark.parametrize('routing_policy', list(EmailRouterRoutingPolicy))
+def test_bitset_and_batch_match_route_as_walk(tmp_path, routing_policy):
+    rng = random.Random(routing_policy.name)
+    for rule_base_index in range(RULE_BASE_COUNT):
+        router_config_path = tmp_path / ('rules' + str(rule_base_index) + '.json')
+        router_config_path.write_text(json.dumps(get_random_router_config(rng)))
+        source_config = EmailRouterSourceConfig(EmailRouterDatastoreSourceType.JSONFILE, str(router_config_path))
+        walk_router = EmailRouter(source_config, RouterInstanceType.BLUE,
+                                  routing_policy=routing_policy,
+                                  match_engine=EmailRouterMatchEngine.WALK)
+        bitset_router = EmailRouter(source_config, RouterInstanceType.BLUE,
+                                    routing_policy=routing_policy,
+                                    match_engine=EmailRouterMatchEngine.BITSET)
+        assert bitset_router.match_engine == EmailRouterMatchEngine.BITSET
+
+        emails = [get_random_email(rng) for _ in range(EMAILS_PER_RULE_BASE)]
+        walk_outcomes = [get_outcome(walk_router, x) for x in emails]
+        assert [get_outcome(bitset_router, x) for x in emails] == walk_outcomes
+        assert get_batch_outcomes(walk_router, emails) == walk_outcomes
+        assert get_batch_outcomes(bitset_router, emails) == walk_outcomes
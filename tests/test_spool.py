@@ -0,0 +1,126 @@
+import os
+import random
+import threading
+import time
+
+from email_router.email_router_spool import EmailRouterSpool
+
+#
+# The spool must hand back, after a restart, exactly the requests accepted and not completed - whatever
+#  segments they were written to, moved to by compaction or torn at the end by a crash
+#
+SEGMENT_MAX_BYTES = 400
+CONTENT_TYPE = 'multipart/form-data; boundary=xyz'
+
+
+def get_segment_file_names(spool_directory) -> list:
+    return sorted(x for x in os.listdir(str(spool_directory)) if x.endswith('.log'))
+
+
+def open_spool(spool_directory,
+               segment_max_bytes: int = SEGMENT_MAX_BYTES,
+               group_commit_window_seconds: float = 0.0):
+    spool = EmailRouterSpool(str(spool_directory),
+                             segment_max_bytes=segment_max_bytes,
+                             group_commit_window_seconds=group_commit_window_seconds)
+    return spool, spool.open()
+
+
+def test_segment_rollover(tmp_path):
+    spool, replayed_records = open_spool(tmp_path)
+    assert replayed_records == []
+    bodies = [('body ' + str(x)).encode('utf-8') * 10 for x in range(12)]
+    record_ids = [spool.append_accepted('BLUE', CONTENT_TYPE, x) for x in bodies]
+    spool.close()
+
+    assert len(get_segment_file_names(tmp_path)) > 1
+    assert all(os.path.getsize(str(tmp_path / x)) <= SEGMENT_MAX_BYTES for x in get_segment_file_names(tmp_path))
+
+    spool, replayed_records = open_spool(tmp_path)
+    spool.close()
+    assert [x.record_id for x in replayed_records] == record_ids
+    assert [x.body for x in replayed_records] == bodies
+    assert {(x.router_instance_type_name, x.content_type) for x in replayed_records} == {('BLUE', CONTENT_TYPE)}
+
+
+def test_torn_tail_is_dropped(tmp_path):
+    spool = EmailRouterSpool(str(tmp_path))
+    spool.open()
+    record_ids = [spool.append_accepted('GREEN', CONTENT_TYPE, b'request ' + str(x).encode('utf-8'))
+                  for x in range(3)]
+    spool.close()
+
+    # a crash part way through writing the last record
+    (segment_file_name,) = get_segment_file_names(tmp_path)
+    segment_path = str(tmp_path / segment_file_name)
+    with open(segment_path, 'r+b') as segment_file:
+        segment_file.truncate(os.path.getsize(segment_path) - 4)
+
+    spool, replayed_records = open_spool(tmp_path)
+    assert [x.record_id for x in replayed_records] == record_ids[:2]
+    spool.append_accepted('GREEN', CONTENT_TYPE, b'after the crash')
+    spool.close()
+
+    # garbage after the last record is ignored the same way
+    with open(str(tmp_path / get_segment_file_names(tmp_path)[-1]), 'ab') as segment_file:
+        segment_file.write(b'\x01\x02\x03 not a record')
+    spool, replayed_records = open_spool(tmp_path)
+    spool.close()
+    assert [x.body for x in replayed_records] == [b'request 0', b'request 1', b'after the crash']
+
+
+def test_compaction_while_records_complete(tmp_path):
+    spool, _ = open_spool(tmp_path, segment_max_bytes=4 * SEGMENT_MAX_BYTES, group_commit_window_seconds=0.05)
+    # fill the first segment, then roll over to a second one so the first is sealed
+    first_segment_record_ids = list()
+    while len(get_segment_file_names(tmp_path)) == 1:
+        first_segment_record_ids.append(spool.append_accepted('BLUE', CONTENT_TYPE, b'x' * 100))
+    later_record_ids = [first_segment_record_ids.pop()]
+    later_record_ids.append(spool.append_accepted('BLUE', CONTENT_TYPE, b'x' * 100))
+    assert len(first_segment_record_ids) >= 5
+
+    # the first segment is mostly completed, so compaction moves its two open records - one of which is
+    #  completed while being moved
+    for this_record_id in first_segment_record_ids[:-2]:
+        spool.mark_completed(this_record_id)
+    first_segment_file_name = get_segment_file_names(tmp_path)[0]
+    compaction_thread = threading.Thread(target=spool.compact)
+    compaction_thread.start()
+    time.sleep(0.02)
+    spool.mark_completed(first_segment_record_ids[-2])
+    compaction_thread.join()
+    assert first_segment_file_name not in get_segment_file_names(tmp_path)
+    assert spool.open_record_count == 1 + len(later_record_ids)
+    spool.close()
+
+    spool, replayed_records = open_spool(tmp_path)
+    spool.close()
+    assert [x.record_id for x in replayed_records] == sorted([first_segment_record_ids[-1]] + later_record_ids)
+
+
+def test_replay_after_restart(tmp_path):
+    rng = random.Random(34)
+    spool, _ = open_spool(tmp_path)
+    open_record_ids = set()
+    for step in range(1500):
+        if rng.random() < 0.5 or len(open_record_ids) == 0:
+            open_record_ids.add(spool.append_accepted('BLUE', CONTENT_TYPE, b'x' * rng.randint(10, 150)))
+        else:
+            this_record_id = rng.choice(sorted(open_record_ids))
+            open_record_ids.discard(this_record_id)
+            spool.mark_completed(this_record_id)
+        if step % 97 == 0:
+            spool.compact()
+        if step % 250 == 0:
+            spool.close()
+            spool, replayed_records = open_spool(tmp_path)
+            assert [x.record_id for x in replayed_records] == sorted(open_record_ids)
+
+    # once everything replayed is completed, a restart replays nothing
+    for this_record_id in open_record_ids:
+        spool.mark_completed(this_record_id)
+    spool.compact()
+    spool.close()
+    spool, replayed_records = open_spool(tmp_path)
+    spool.close()
+    assert replayed_records == []